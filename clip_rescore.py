@@ -0,0 +1,90 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Add CLIP scores to saved predictions.
+
+Two kinds of predictions are supported:
+    * a csv written by YouRefItEvaluator (SAVE_EVALUATION_PREDICTIONS = True): the clip_score column is
+      filled in and the csv is written to --output (default: overwrite --predictions)
+    * a directory of parquet parts written by predict.py: a clip_scores column (one score per box)
+      is written, keyed like the predictions, to parquet parts in --output
+
+Example:
+    python clip_rescore.py --predictions predictions/eye-to-fingertip.csv --image_dir yourefit/images
+    python clip_rescore.py --predictions predictions/frames --image_dir frames/ --output predictions/frames_clip
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+from models.clip_rescoring import ClipRescorer
+from util.columnar import PartitionedParquetWriter, pa, read_table, require_pyarrow
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("CLIP rescoring of predictions")
+    parser.add_argument("--predictions", required=True, help="evaluator csv or predict.py parquet directory")
+    parser.add_argument("--image_dir", required=True)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--clip_model", default="ViT-B/32")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--images_per_batch", default=16, type=int)
+    parser.add_argument("--num_workers", default=4, type=int)
+    return parser
+
+
+def rescore_csv(rescorer, args):
+    df = pd.read_csv(args.predictions)
+    df["clip_score"] = rescorer.score(
+        [os.path.join(args.image_dir, name + ".jpg") for name in df["image_name"].astype(str)],
+        df[["box_xmin", "box_ymin", "box_xmax", "box_ymax"]].to_numpy(),
+        df["sentence"].astype(str),
+    )
+    output = args.output or args.predictions
+    df.to_csv(output, index=False)
+    return len(df), output
+
+
+def rescore_parquet(rescorer, args):
+    require_pyarrow()
+    if args.output is None:
+        raise RuntimeError("--output is required for parquet predictions")
+    table = read_table(args.predictions, columns=["key", "image", "sentence", "width", "height", "boxes"])
+    rows = table.to_pylist()
+
+    image_paths, boxes, sentences, owners = [], [], [], []
+    for row_index, row in enumerate(rows):
+        scale = np.array([row["width"], row["height"], row["width"], row["height"]], dtype=np.float32)
+        for box in row["boxes"]:
+            image_paths.append(os.path.join(args.image_dir, row["image"]))
+            boxes.append(np.asarray(box, dtype=np.float32) / scale)
+            sentences.append(row["sentence"])
+            owners.append(row_index)
+    scores = rescorer.score(image_paths, np.stack(boxes), sentences) if boxes else np.zeros(0)
+
+    per_row = [[] for _ in rows]
+    for owner, score in zip(owners, scores.tolist()):
+        per_row[owner].append(score)
+    schema = pa.schema([("key", pa.int64()), ("clip_scores", pa.list_(pa.float32()))])
+    with PartitionedParquetWriter(args.output, "clip", schema, rows_per_part=max(1, len(rows))) as writer:
+        for row, row_scores in zip(rows, per_row):
+            writer.write({"key": row["key"], "clip_scores": row_scores})
+    return len(scores), args.output
+
+
+def main(args):
+    start = time.time()
+    rescorer = ClipRescorer(device=args.device, model_name=args.clip_model,
+                            images_per_batch=args.images_per_batch, num_workers=args.num_workers)
+    if os.path.isdir(args.predictions):
+        num_boxes, output = rescore_parquet(rescorer, args)
+    else:
+        num_boxes, output = rescore_csv(rescorer, args)
+    print(f"Scored {num_boxes} boxes in {time.time() - start:.0f}s, wrote {output}")
+
+
+if __name__ == "__main__":
+    main(get_args_parser().parse_args())
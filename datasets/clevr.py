@@ -15,9 +15,9 @@ import torch
 import torch.utils.data
 import torchvision
 from PIL import Image
-from transformers import RobertaTokenizerFast
 
 import datasets.transforms as T
+from util import text_assets
 
 from .coco import ConvertCocoPolysToMask, create_positive_map
 
@@ -195,7 +195,7 @@ def build(dataset_file, image_set, args):
             ann_file,
             transforms=make_clevr_transforms(image_set, cautious=True),
         )
-    tokenizer = RobertaTokenizerFast.from_pretrained(args.text_encoder_type)
+    tokenizer = text_assets.tokenizer(args.text_encoder_type)
 
     img_dir = Path(args.clevr_img_path) / f"{image_set}"
     ann_file = Path(args.clevr_ann_path) / f"{image_set}.json"
@@ -6,10 +6,10 @@ from pathlib import Path
 
 import torch
 import torch.utils.data
-from transformers import RobertaTokenizerFast
 
 import util.dist as dist
 from datasets.clevr import make_clevr_transforms
+from util import text_assets
 from util.box_ops import generalized_box_iou
 
 from .coco import ModulatedDetection, make_coco_transforms
@@ -37,7 +37,7 @@ class ClevrRefEvaluator(object):
         self.predictions.update(predictions)
 
     def synchronize_between_processes(self):
-        all_predictions = dist.all_gather(self.predictions)
+        all_predictions = dist.all_gather_tensors(self.predictions)
         merged_predictions = {}
         for p in all_predictions:
             merged_predictions.update(p)
@@ -92,7 +92,7 @@ class ClevrRefEvaluator(object):
 
 
 def build(image_set, args):
-    tokenizer = RobertaTokenizerFast.from_pretrained(args.text_encoder_type)
+    tokenizer = text_assets.tokenizer(args.text_encoder_type)
 
     img_dir = Path(args.clevr_img_path) / f"{image_set}"
     ann_file = Path(args.clevr_ann_path) / f"{image_set}.json"
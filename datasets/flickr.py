@@ -4,7 +4,7 @@ Data class for the Flickr30k entities dataset. The task considered is phrase gro
 """
 from pathlib import Path
 
-from transformers import RobertaTokenizerFast
+from util import text_assets
 
 from .coco import ModulatedDetection, make_coco_transforms
 
@@ -29,7 +29,7 @@ def build(image_set, args):
     else:
         ann_file = Path(args.flickr_ann_path) / f"final_flickr_{identifier}_{image_set}.json"
 
-    tokenizer = RobertaTokenizerFast.from_pretrained(args.text_encoder_type)
+    tokenizer = text_assets.tokenizer(args.text_encoder_type)
     dataset = FlickrDetection(
         img_dir,
         ann_file,
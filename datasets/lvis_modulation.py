@@ -1,9 +1,8 @@
 # Copyright (c) Aishwarya Kamath & Nicolas Carion. Licensed under the Apache License 2.0. All Rights Reserved
 from pathlib import Path
 
-from transformers import RobertaTokenizerFast
-
 import datasets.transforms as T
+from util import text_assets
 
 from .coco import ModulatedDetection, make_coco_transforms
 
@@ -20,7 +19,7 @@ def build(image_set, args):
     else:
         ann_file = Path(args.modulated_lvis_ann_path) / f"finetune_lvis{args.lvis_subset}_{image_set}.json"
 
-    tokenizer = RobertaTokenizerFast.from_pretrained(args.text_encoder_type)
+    tokenizer = text_assets.tokenizer(args.text_encoder_type)
     dataset = LvisModulatedDetection(
         img_dir,
         ann_file,
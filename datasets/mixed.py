@@ -11,7 +11,8 @@ from typing import Any, Callable, Optional, Tuple
 
 from PIL import Image
 from torchvision.datasets.vision import VisionDataset
-from transformers import RobertaTokenizerFast
+
+from util import text_assets
 
 from .coco import ConvertCocoPolysToMask, make_coco_transforms
 
@@ -105,7 +106,7 @@ def build(image_set, args):
 
     ann_file = Path(args.gqa_ann_path) / f"final_mixed_{image_set}.json"
 
-    tokenizer = RobertaTokenizerFast.from_pretrained(args.text_encoder_type)
+    tokenizer = text_assets.tokenizer(args.text_encoder_type)
     dataset = MixedDetection(
         coco_img_dir,
         vg_img_dir,
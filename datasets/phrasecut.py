@@ -5,7 +5,7 @@ Data class for the PhraseCut dataset. The task considered is referring expressio
 
 from pathlib import Path
 
-from transformers import RobertaTokenizerFast
+from util import text_assets
 
 from .coco import ModulatedDetection, make_coco_transforms
 
@@ -30,7 +30,7 @@ def build(image_set, args):
     if args.test:
         ann_file = Path(args.phrasecut_ann_path) / f"finetune_phrasecut_test.json"
 
-    tokenizer = RobertaTokenizerFast.from_pretrained(args.text_encoder_type)
+    tokenizer = text_assets.tokenizer(args.text_encoder_type)
     dataset = PhrasecutDetection(
         img_dir,
         ann_file,
@@ -5,9 +5,9 @@ from pathlib import Path
 
 import torch
 import torch.utils.data
-from transformers import RobertaTokenizerFast
 
 import util.dist as dist
+from util import text_assets
 from util.box_ops import generalized_box_iou
 
 from .coco import ModulatedDetection, make_coco_transforms
@@ -35,7 +35,7 @@ class RefExpEvaluator(object):
         self.predictions.update(predictions)
 
     def synchronize_between_processes(self):
-        all_predictions = dist.all_gather(self.predictions)
+        all_predictions = dist.all_gather_tensors(self.predictions)
         merged_predictions = {}
         for p in all_predictions:
             merged_predictions.update(p)
@@ -105,7 +105,7 @@ def build(image_set, args):
     else:
         assert False, f"{refexp_dataset_name} not a valid datasset name for refexp"
 
-    tokenizer = RobertaTokenizerFast.from_pretrained(args.text_encoder_type)
+    tokenizer = text_assets.tokenizer(args.text_encoder_type)
     dataset = RefExpDetection(
         img_dir,
         ann_file,
@@ -23,7 +23,6 @@ import scipy.io as sio
 import torch.utils.data as data
 from collections import OrderedDict
 
-import temp_vars
 import util.dist
 
 sys.path.append('.')
@@ -35,18 +34,18 @@ import json
 import pickle5 as pickle
 import re
 import util.dist as dist
-from transformers import RobertaTokenizerFast
 
 sys.path.append('./datasets')
 from .yourefit_token import match_pos
 import copy
+import functools
 from util.box_ops import generalized_box_iou, box_iou
-from magic_numbers import *
+from util import profiling, ray_ops, text_assets
+from util.prediction_store import load_foreground_boxes
+from util.runtime_config import RuntimeConfig
 import pandas as pd
 
 import torch
-if SAVE_EVALUATION_PREDICTIONS and SAVE_CLIP_SCORES:
-    import clip
 from PIL import Image
 
 import torchvision
@@ -56,14 +55,17 @@ transform = T.ToPILImage()
 
 cv2.setNumThreads(0)
 
-if USE_MDETR_PREDICTIONS_AS_GROUNDTRUTHS:
-    mdetr_predictions = pd.read_csv(MDETR_PREDICTION_PATH)
-else:
-    mdetr_predictions = None
-eye_to_fingertip_annotation_df_train = pd.read_csv(
-    EYE_TO_FINGERTIP_ANNOTATION_TRAIN_PATH)
-eye_to_fingertip_annotation_df_valid = pd.read_csv(
-    EYE_TO_FINGERTIP_ANNOTATION_VALID_PATH)
+
+
+# Read once per process and path, and shared by the datasets of every runtime config (sweep.py)
+@functools.lru_cache(maxsize=None)
+def load_mdetr_predictions(path):
+    return load_foreground_boxes(path)
+
+
+@functools.lru_cache(maxsize=None)
+def load_eye_to_fingertip_annotations(path):
+    return pd.read_csv(path)
 
 
 def progressBar(i, max, text):
@@ -126,7 +128,7 @@ class ReferDataset(data.Dataset):
                  transform=None, augment=False, device=None, return_idx=False,
                  testmode=False,
                  split='train', max_query_len=128, lstm=False,
-                 bert_model='bert-base-uncased', args=None):
+                 bert_model='bert-base-uncased', args=None, config=None):
         self.images = []
         self.image_files = {}
         self.data_root = data_root
@@ -140,12 +142,21 @@ class ReferDataset(data.Dataset):
         self.device = device
         self.augment = augment
         self.return_idx = return_idx
-        self.tokenizer = RobertaTokenizerFast.from_pretrained(
-            args.text_encoder_type)
+        self.text_encoder_type = args.text_encoder_type
+        self.config = config if config is not None else RuntimeConfig()
+        self.mdetr_predictions = None
+        if self.config.use_mdetr_predictions_as_groundtruths:
+            self.mdetr_predictions = load_mdetr_predictions(self.config.mdetr_prediction_path)
+        self.eye_to_fingertip_annotations = {
+            'train': load_eye_to_fingertip_annotations(self.config.eye_to_fingertip_annotation_train_path),
+            'val': load_eye_to_fingertip_annotations(self.config.eye_to_fingertip_annotation_valid_path),
+        }
+        # created once per process, before the DataLoader workers that inherit it
+        text_assets.tokenizer(self.text_encoder_type)
         if self.dataset == 'yourefit':
             self.dataset_root = osp.join(self.data_root, 'yourefit')
             self.im_dir = osp.join(self.dataset_root, 'images')
-            self.inpaint_dir = osp.join(self.dataset_root, INPAINT_DIR)
+            self.inpaint_dir = osp.join(self.dataset_root, self.config.inpaint_dir)
             self.arm_dir = osp.join(self.dataset_root, 'arms.json')
             with open(self.arm_dir, "r") as f:
                 self.arm_data = json.load(f)
@@ -175,31 +186,30 @@ class ReferDataset(data.Dataset):
                 while True:
                     img_name = f.readline()
                     if img_name:
-                        if USE_MDETR_PREDICTIONS_AS_GROUNDTRUTHS and REPLACE_ARM_WITH_EYE_TO_FINGERTIP:
+                        if self.config.use_mdetr_predictions_as_groundtruths and \
+                                self.config.replace_arm_with_eye_to_fingertip:
                             raise NotImplementedError()
-                        if USE_MDETR_PREDICTIONS_AS_GROUNDTRUTHS and self.split == 'train':
+                        if self.config.use_mdetr_predictions_as_groundtruths and self.split == 'train':
                             # Only for the training set:
                             # Ignore images without mdetr foreground predictions
                             # Check if current image has mdetr foreground prediction.
                             # If it does, append its name into image list.
                             has_mdetr_foreground_prediction = \
-                                mdetr_predictions[
-                                    mdetr_predictions['img_name'] == img_name[
-                                                                     :-1]].shape[
-                                    0] > 0
+                                self.mdetr_predictions.get(img_name[:-1]) is not None
                             if has_mdetr_foreground_prediction:
                                 self.images.append(img_name[:-1])
-                        elif REPLACE_ARM_WITH_EYE_TO_FINGERTIP and self.split == 'train':
+                        elif self.config.replace_arm_with_eye_to_fingertip and self.split == 'train':
+                            df = self.eye_to_fingertip_annotations['train']
                             has_eye_to_fingertip_annotation = \
-                                eye_to_fingertip_annotation_df_train[
-                                    eye_to_fingertip_annotation_df_train[
-                                        'name'] == img_name[:-1]].shape[0] > 0
+                                df[df['name'] == img_name[:-1]].shape[0] > 0
                             if has_eye_to_fingertip_annotation:
                                 self.images.append(img_name[:-1])
                         # Exclude images without eye to fingertip annotations from the validaiton set
                         # Useful when computing cosine similarities for the dataset
-                        elif REPLACE_ARM_WITH_EYE_TO_FINGERTIP and CALCULATE_COS_SIM and self.split == 'val':
-                            has_eye_to_fingertip_annotation = eye_to_fingertip_annotation_df_valid[eye_to_fingertip_annotation_df_valid['name'] == img_name[:-1]].shape[0] > 0
+                        elif self.config.replace_arm_with_eye_to_fingertip and self.config.calculate_cos_sim and \
+                                self.split == 'val':
+                            df = self.eye_to_fingertip_annotations['val']
+                            has_eye_to_fingertip_annotation = df[df['name'] == img_name[:-1]].shape[0] > 0
                             if has_eye_to_fingertip_annotation:
                                 self.images.append(img_name[:-1])
                         else:
@@ -211,6 +221,11 @@ class ReferDataset(data.Dataset):
         for split_idx in range(len(self.images)):
             self.image_files[self.images[split_idx]] = split_idx
 
+    @property
+    def tokenizer(self):
+        # shared by the process (util.text_assets), neither deep copied by YouRefItEvaluator nor pickled to workers
+        return text_assets.tokenizer(self.text_encoder_type)
+
     def exists_dataset(self):
         return osp.exists(osp.join(self.split_root, self.dataset))
 
@@ -249,16 +264,16 @@ class ReferDataset(data.Dataset):
         target_word = pick['anno_target']
         phrase = pick['anno_sentence']
 
-        if REPLACE_SENTENCE_WITH_TARGET_WORD:
+        if self.config.replace_sentence_with_target_word:
             phrase = target_word
 
-        if REPLACE_LANGUAGE_INPUTS:
-            phrase = DUMMY_LANGUAGE_INPUT
-            target_word = DUMMY_LANGUAGE_INPUT
+        if self.config.replace_language_inputs:
+            phrase = self.config.dummy_language_input
+            target_word = self.config.dummy_language_input
         token_pos = match_pos(phrase, target_word)
         token_pos = [token_pos]
         bbox = np.array(bbox, dtype=int)  # x1y1x2y2
-        if not REPLACE_IMAGES_WITH_INPAINT:
+        if not self.config.replace_images_with_inpaint:
             img_path = osp.join(self.im_dir, img_name + '.jpg')
             img = Image.open(img_path).convert('RGB')
         else:
@@ -274,21 +289,12 @@ class ReferDataset(data.Dataset):
                 img_path = osp.join(self.im_dir, img_name + '.jpg')
                 img = Image.open(img_path).convert('RGB')
         # replace bbox with MDETR predictions
-        if USE_MDETR_PREDICTIONS_AS_GROUNDTRUTHS and self.split == 'train':
+        if self.config.use_mdetr_predictions_as_groundtruths and self.split == 'train':
             width = img.width
             height = img.height
-            df_for_current_image = mdetr_predictions[
-                mdetr_predictions['img_name'] == img_name]
-            if df_for_current_image.shape[0] > 0:
-                xmin, ymin, xmax, ymax = [df_for_current_image.xmin,
-                                          df_for_current_image.ymin,
-                                          df_for_current_image.xmax,
-                                          df_for_current_image.ymax]
-                xmin, ymin, xmax, ymax = [xmin * width, ymin * height,
-                                          xmax * width, ymax * height]
-                xmin, ymin, xmax, ymax = [int(xmin), int(ymin), int(xmax),
-                                          int(ymax)]
-                bbox = np.array([xmin, ymin, xmax, ymax])
+            mdetr_box = self.mdetr_predictions.get(img_name)
+            if mdetr_box is not None:
+                bbox = (mdetr_box * np.array([width, height, width, height])).astype(int)
             else:
                 raise RuntimeError(
                     'Using MDETR predictions as groundtruths, but current image does not have any mdetr foreground prediction')
@@ -309,13 +315,11 @@ class ReferDataset(data.Dataset):
         arm = self.arm_data[img_name]
 
         # Replace arm coordinates with eye and fingertip coordinates
-        if REPLACE_ARM_WITH_EYE_TO_FINGERTIP:
+        if self.config.replace_arm_with_eye_to_fingertip:
             if self.dataset == 'yourefit':
                 # Determine the split of dataset
-                if self.split == 'train':
-                    df = eye_to_fingertip_annotation_df_train
-                elif self.split == 'val':
-                    df = eye_to_fingertip_annotation_df_valid
+                if self.split in self.eye_to_fingertip_annotations:
+                    df = self.eye_to_fingertip_annotations[self.split]
                 else:
                     raise NotImplementedError(
                         'replace arm with eye to fingertip is only implemented for yourefit train and valid splits')
@@ -356,8 +360,9 @@ class ReferDataset(data.Dataset):
         return len(self.images)
 
     def __getitem__(self, idx):
-        img, pt, ht, phrase, bbox, token_pos, arm, img_name = self.pull_item(
-            idx)
+        with profiling.region("data/load", host=True):
+            img, pt, ht, phrase, bbox, token_pos, arm, img_name = self.pull_item(
+                idx)
         # phrase = phrase.decode("utf-8").encode().lower()
         phrase = phrase.lower()
         ## seems a bug in torch transformation resize, so separate in advance
@@ -371,17 +376,21 @@ class ReferDataset(data.Dataset):
         target['image_id'] = torch.tensor([idx])
         target['tokens_positive'] = token_pos
         target['labels'] = torch.tensor([1])
-        target['arm'] = torch.tensor(arm).flatten()
+        # float32 whether the coordinates come from the annotations (numpy float64) or not (python ints), so that
+        # the losses have the same dtype on every process
+        target['arm'] = torch.tensor(arm, dtype=torch.float32).flatten()
         assert target['arm'].shape[0] == 4
 
         assert len(target["boxes"]) == len(target["tokens_positive"])
         # TODO: check if 'tokenized' can be used as embedded text
-        tokenized = self.tokenizer(phrase, return_tensors="pt")
-        target["positive_map"] = create_positive_map(tokenized,
-                                                     target["tokens_positive"])
+        with profiling.region("data/positive_map", host=True):
+            tokenized = self.tokenizer(phrase, return_tensors="pt")
+            target["positive_map"] = create_positive_map(tokenized,
+                                                         target["tokens_positive"])
         target['ht_map'] = torch.tensor(ht).unsqueeze(0)
         if self.transform is not None:
-            img, target = self.transform(img, target)
+            with profiling.region("data/transform", host=True):
+                img, target = self.transform(img, target)
         target['dataset_name'] = 'yourefit'
         return img, target
 
@@ -480,32 +489,23 @@ def draw_box(img, box, img_name, arm=None, gt_box=None, box1=None):
     cv2.imwrite(img_name, img)
 
 
-import torch.nn.functional as F
-
-
 def aligned_score(arm, box):
-    arm_tensor = torch.Tensor(arm[2:]) - torch.Tensor(arm[:2])
-    box_center = [(box[0] + box[2]) / 2, (box[1] + box[3]) / 2]
-    box_tensor = torch.Tensor(box_center) - torch.Tensor(arm[:2])
-    cos_sim = F.cosine_similarity(arm_tensor, box_tensor, dim=0)
-    return cos_sim
+    return aligned_scores(arm, torch.as_tensor(box, dtype=torch.float).view(1, 4))[0]
 
 
 def aligned_scores(arm, boxes):
-    arm_tensor = torch.Tensor(arm[2:]) - torch.Tensor(arm[:2])
-    box_center = [(boxes[:, 0] + boxes[:, 2]) / 2,
-                  (boxes[:, 1] + boxes[:, 3]) / 2]
-    box_tensor = torch.vstack(box_center).transpose(0, 1) - torch.Tensor(
-        arm[:2])
-    cos_sim = F.cosine_similarity(arm_tensor, box_tensor, dim=1)
-    return cos_sim
+    boxes = torch.as_tensor(boxes, dtype=torch.float)
+    arm = torch.as_tensor(arm, dtype=torch.float, device=boxes.device).view(1, 1, 4)
+    return ray_ops.arm_box_alignment(boxes[None], arm)["cos_sim"][0, :, 0]
 
 
 class YouRefItEvaluator(object):
     def __init__(self, ref_dataset, iou_types, k=1,
-                 thresh_iou=(0.25, 0.5, 0.75), draw=True):
+                 thresh_iou=(0.25, 0.5, 0.75), draw=True, config=None):
         ref_dataset = copy.deepcopy(ref_dataset)
         self.refexp_gt = ref_dataset
+        # by default the runtime config of the dataset
+        self.config = config if config is not None else ref_dataset.config
         self.iou_types = iou_types
         self.img_ids = self.refexp_gt.image_files.keys()
         self.predictions = {}
@@ -520,7 +520,7 @@ class YouRefItEvaluator(object):
         self.predictions.update(predictions)
 
     def synchronize_between_processes(self):
-        all_predictions = dist.all_gather(self.predictions)
+        all_predictions = dist.all_gather_tensors(self.predictions)
         merged_predictions = {}
         for p in all_predictions:
             merged_predictions.update(p)
@@ -534,6 +534,11 @@ class YouRefItEvaluator(object):
 
             dataset2count = {"yourefit": 0.0}
 
+            # Kept per call (not in module globals) so that repeated evaluations do not accumulate
+            size2score = {size: {thresh_iou: 0 for thresh_iou in self.thresh_iou}
+                          for size in ("small", "medium", "large")}
+            size2count = {size: 0 for size in ("small", "medium", "large")}
+
             arm_token_pair = {}
 
             image_name_list = []
@@ -600,12 +605,12 @@ class YouRefItEvaluator(object):
                             boxes1[i][1] = ymin
                             boxes1[i][2] = xmax
                             boxes1[i][3] = ymax
-                if EVALUATE_USING_GIOU_THRESHODS:
+                if self.config.evaluate_using_giou_threshods:
                     giou = generalized_box_iou(boxes1, boxes2)
                 else:
                     giou, _ = box_iou(boxes1, boxes2)
 
-                if ARGS_POSE:
+                if self.config.args_pose:
                     tmp_idx = prediction["arms_scores"].argmax()
                     arm_token_pair[img_name] = tmp_idx
                     torch.save(arm_token_pair, 'arm_token_pair.pth')
@@ -619,35 +624,24 @@ class YouRefItEvaluator(object):
                     sorted_arms = torch.cat(
                         [torch.as_tensor(x).view(1, 4) for x in sorted_arms]).to(device)
 
-                    if EVAL_EARLY_STOP:
-                        fingertip_xyxy = sorted_arms[0, 2:4]
-                        eye_xyxy = sorted_arms[0, 0:2]
-                        box_centers_xyxy = sorted_boxes[:, :2]
-                        arm_tensor = fingertip_xyxy - eye_xyxy
-                        box_tensor = box_centers_xyxy - eye_xyxy
-                        if len(arm_tensor.shape) == 1:
-                            arm_tensor = arm_tensor.unsqueeze(0)
-                        cos_sim = F.cosine_similarity(arm_tensor, box_tensor,
-                                                      dim=1)
+                    if self.config.eval_early_stop:
+                        cos_sim = aligned_scores(sorted_arms[0], sorted_boxes)
 
                         normalized_sorted_arms_xyxy = sorted_arms / torch.tensor(
                             [W, H, W, H], device=device)
                         normalized_sorted_boxes_xyxy = sorted_boxes / torch.tensor(
                             [W, H, W, H], device=device)
 
-                        if PRINT_PREDICTIONS_AT_BREAKPOINT:
+                        if self.config.print_predictions_at_breakpoint:
                             print("'" + img_name + "'", ',',
                                   normalized_sorted_boxes_xyxy, ',',
                                   normalized_sorted_arms_xyxy[0], ',', giou,
                                   ',', sorted_align_cost)
                             breakpoint()
 
-                if SAVE_EVALUATION_PREDICTIONS:
-                    # initialize CLIP model
-                    if SAVE_CLIP_SCORES:
-                        clip_model, preprocess = clip.load("ViT-B/32",
-                                                           device=device)
-                        sentence = self.refexp_gt.pull_item_sentence(image_id)
+                if self.config.save_evaluation_predictions:
+                    # CLIP scores are computed for all boxes at once, after the loop
+                    sentence = self.refexp_gt.pull_item_sentence(image_id)
 
                     normalized_sorted_boxes_xyxy = sorted_boxes / torch.tensor(
                         [W, H, W, H], device=device)
@@ -670,49 +664,8 @@ class YouRefItEvaluator(object):
                         box_xmin, box_ymin, box_xmax, box_ymax = current_box
                         arm_xmin, arm_ymin, arm_xmax, arm_ymax = current_arm
 
-                        # Find out CLIP scores for current prediction
-                        if SAVE_CLIP_SCORES:
-                            abs_xmin, abs_ymin, abs_xmax, abs_ymax = \
-                            sorted_boxes[i]
-                            abs_xmin, abs_ymin, abs_xmax, abs_ymax = int(
-                                abs_xmin), int(abs_ymin), int(abs_xmax), int(
-                                abs_ymax)
-                            # make sure coordinate does not exceed image width or height
-                            abs_xmin = max(0, abs_xmin)
-                            abs_ymin = max(0, abs_ymin)
-                            abs_xmax = min(W, abs_xmax - 1)
-                            abs_ymax = min(H, abs_ymax - 1)
-                            # using box coordinates to get current patch of image
-                            current_patch = img[abs_ymin:abs_ymax + 1,
-                                            abs_xmin:abs_xmax + 1, :]
-                            current_patch = torch.tensor(current_patch,
-                                                         device=device).permute(
-                                2, 0, 1)
-                            # convert tensor to PIL
-                            current_patch = transform(current_patch)
-                            # CLIP preprocess patch
-                            current_patch = preprocess(current_patch).unsqueeze(
-                                0).to(device)
-                            # TODO: process the sentence for better clip scores
-                            processed_sentence = sentence
-                            # CLIP tokenize text. Two classes: is something AND nothing
-                            text = clip.tokenize(
-                                [processed_sentence, 'nothing']).to(device)
-                            # compute CLIP score for current patch
-                            with torch.no_grad():
-                                image_features = clip_model.encode_image(
-                                    current_patch)
-                                text_features = clip_model.encode_text(text)
-                                logits_per_image, logits_per_text = clip_model(
-                                    current_patch, text)
-                                probs = logits_per_image.softmax(
-                                    dim=-1).cpu().numpy()
-                            # Append clip score and sentence to list
-                            clip_score_list.append(probs[0, 0])
-                            sentence_list.append(sentence)
-                        else:
-                            clip_score_list.append(-1)
-                            sentence_list.append('n/a')
+                        clip_score_list.append(-1)
+                        sentence_list.append(sentence)
 
                         # Append one prediction to lists
                         image_name_list.append(current_image_name)
@@ -734,55 +687,20 @@ class YouRefItEvaluator(object):
                 image_size = img.shape[0] * img.shape[1]
                 object_size = (gt_bbox[2] - gt_bbox[0]) * (gt_bbox[3] - gt_bbox[1])
                 object_size_wrt_image = object_size / image_size
-                if object_size_wrt_image > EVAL_SMALL_MEDIUM_LARGE_THRESHODS[-1]:
-                    temp_vars.large_object_count += 1
-                elif object_size_wrt_image > EVAL_SMALL_MEDIUM_LARGE_THRESHODS[-0]:
-                    temp_vars.medium_object_count += 1
+                if object_size_wrt_image < 0:
+                    raise RuntimeError()
+                elif object_size_wrt_image > self.config.eval_small_medium_large_threshods[-1]:
+                    object_size_category = "large"
+                elif object_size_wrt_image > self.config.eval_small_medium_large_threshods[0]:
+                    object_size_category = "medium"
                 else:
-                    temp_vars.small_object_count += 1
+                    object_size_category = "small"
+                size2count[object_size_category] += 1
 
                 for thresh_iou in self.thresh_iou:
-                    success = False
                     if max(giou[0]) >= thresh_iou:
                         dataset2score["yourefit"][thresh_iou] += 1.0
-                        success = True
-
-
-                    if object_size_wrt_image < 0:
-                        raise RuntimeError()
-                    # Large objects
-                    elif object_size_wrt_image > EVAL_SMALL_MEDIUM_LARGE_THRESHODS[-1]:
-                        if success:
-                            if thresh_iou == 0.25:
-                                temp_vars.large_object_success_count_25 += 1
-                            elif thresh_iou == 0.50:
-                                temp_vars.large_object_success_count_50 += 1
-                            elif thresh_iou == 0.75:
-                                temp_vars.large_object_success_count_75 += 1
-                            else:
-                                raise RuntimeError()
-                    # Medium objects
-                    elif object_size_wrt_image > EVAL_SMALL_MEDIUM_LARGE_THRESHODS[0]:
-                        if success:
-                            if thresh_iou == 0.25:
-                                temp_vars.medium_object_success_count_25 += 1
-                            elif thresh_iou == 0.50:
-                                temp_vars.medium_object_success_count_50 += 1
-                            elif thresh_iou == 0.75:
-                                temp_vars.medium_object_success_count_75 += 1
-                            else:
-                                raise RuntimeError()
-                    # Small objects:
-                    else:
-                        if success:
-                            if thresh_iou == 0.25:
-                                temp_vars.small_object_success_count_25 += 1
-                            elif thresh_iou == 0.50:
-                                temp_vars.small_object_success_count_50 += 1
-                            elif thresh_iou == 0.75:
-                                temp_vars.small_object_success_count_75 += 1
-                            else:
-                                raise RuntimeError()
+                        size2score[object_size_category][thresh_iou] += 1
 
                 dataset2count['yourefit'] += 1.0
 
@@ -790,24 +708,13 @@ class YouRefItEvaluator(object):
                 progressBar(current_image_index, total_num_images, status_string)
                 current_image_index += 1
 
-            total_object_count = temp_vars.large_object_count + \
-                                 temp_vars.medium_object_count + \
-                                 temp_vars.small_object_count
-
-            #assert total_object_count == dataset2count['yourefit']
-
             # Calculate precision for different object sizes
-            p_small_25 = temp_vars.small_object_success_count_25 / temp_vars.small_object_count
-            p_small_50 = temp_vars.small_object_success_count_50 / temp_vars.small_object_count
-            p_small_75 = temp_vars.small_object_success_count_75 / temp_vars.small_object_count
-
-            p_medium_25 = temp_vars.medium_object_success_count_25 / temp_vars.medium_object_count
-            p_medium_50 = temp_vars.medium_object_success_count_50 / temp_vars.medium_object_count
-            p_medium_75 = temp_vars.medium_object_success_count_75 / temp_vars.medium_object_count
-
-            p_large_25 = temp_vars.large_object_success_count_25 / temp_vars.large_object_count
-            p_large_50 = temp_vars.large_object_success_count_50 / temp_vars.large_object_count
-            p_large_75 = temp_vars.large_object_success_count_75 / temp_vars.large_object_count
+            p_small_25, p_small_50, p_small_75 = \
+                [size2score["small"][t] / size2count["small"] for t in self.thresh_iou]
+            p_medium_25, p_medium_50, p_medium_75 = \
+                [size2score["medium"][t] / size2count["medium"] for t in self.thresh_iou]
+            p_large_25, p_large_50, p_large_75 = \
+                [size2score["large"][t] / size2count["large"] for t in self.thresh_iou]
 
             print()
             print("Small:")
@@ -825,7 +732,7 @@ class YouRefItEvaluator(object):
 
 
             # Create a dataframe to store all predictions
-            if SAVE_EVALUATION_PREDICTIONS:
+            if self.config.save_evaluation_predictions:
                 df = pd.DataFrame({'image_name': image_name_list,
                                    'box_xmin': box_xmin_list,
                                    'box_ymin': box_ymin_list,
@@ -855,10 +762,18 @@ class YouRefItEvaluator(object):
                                 'clip_score': 'float',
                                 'sentence': 'str'})
 
+                if self.config.save_clip_scores:
+                    from models.clip_rescoring import ClipRescorer
+                    rescorer = ClipRescorer(device="cuda" if torch.cuda.is_available() else "cpu")
+                    df['clip_score'] = rescorer.score(
+                        [osp.join(self.refexp_gt.im_dir, name + '.jpg') for name in df['image_name']],
+                        df[['box_xmin', 'box_ymin', 'box_xmax', 'box_ymax']].to_numpy(),
+                        df['sentence'])
+
                 # Save df to disk
-                if not os.path.exists(prediction_dir):
-                    os.mkdir(prediction_dir)
-                df.to_csv(prediction_dir + '/' + prediction_file_name,
+                if not os.path.exists(self.config.prediction_dir):
+                    os.mkdir(self.config.prediction_dir)
+                df.to_csv(self.config.prediction_dir + '/' + self.config.prediction_file_name,
                           index=False)
 
             for key, value in dataset2score.items():
@@ -19,6 +19,7 @@ from torch.utils.data import ConcatDataset, DataLoader, DistributedSampler
 from IPython import embed
 import util.dist as dist
 import util.misc as utils
+from util.checkpoint import load_model_weights
 from engine import evaluate, train_one_epoch
 from models import build_model
 from models.postprocessors import build_postprocessors
@@ -305,7 +306,8 @@ def demo(
 
     metric_logger = MetricLogger(delimiter="  ")
     header = "Test:"
-    
+
+    res = {}
     for batch_dict in metric_logger.log_every(data_loader, 10, header, args.output_dir):
         samples = batch_dict["samples"].to(device)
         targets = batch_dict["targets"]
@@ -342,9 +344,9 @@ def demo(
 
         if not args.no_detection:
             orig_target_sizes = torch.stack([t["orig_size"] for t in targets], dim=0)
-            results = postprocessors["bbox"](outputs, orig_target_sizes)
-            res = {target["image_id"].item(): output for target, output in zip(targets, results)}
-        
+            results = postprocessors["bbox"](outputs, orig_target_sizes, targets=targets)
+            res.update({target["image_id"].item(): output for target, output in zip(targets, results)})
+
     return res
 
 
@@ -393,7 +395,8 @@ def main(args):
     model_ema = deepcopy(model) if args.ema else None
     model_without_ddp = model
     if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu], find_unused_parameters=True)
+        model = torch.nn.parallel.DistributedDataParallel(
+            model, device_ids=[args.gpu] if device.type == "cuda" else None, find_unused_parameters=True)
         model_without_ddp = model.module
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print("number of params:", n_parameters)
@@ -427,11 +430,7 @@ def main(args):
     # loading into a model with different functionality.
     if args.load:
         print("loading from", args.load)
-        checkpoint = torch.load(args.load, map_location="cpu")
-        if "model_ema" in checkpoint:
-            model_without_ddp.load_state_dict(checkpoint["model_ema"], strict=False)
-        else:
-            model_without_ddp.load_state_dict(checkpoint["model"], strict=False)
+        model_without_ddp.load_state_dict(load_model_weights(args.load), strict=False)
 
         if args.ema:
             model_ema = deepcopy(model_without_ddp)
@@ -454,22 +453,36 @@ def main(args):
                 model_ema.load_state_dict(checkpoint["model_ema"])
 
 
+    # Val dataset
+    dset = ReferDataset(data_root='./',
+                        split_root='./',
+                        dataset='yourefit',
+                        split='val',
+                        transform=make_coco_transforms('val', False),
+                        augment=False, args=args)
+    dataloader = DataLoader(
+        dset,
+        args.batch_size,
+        sampler=torch.utils.data.SequentialSampler(dset),
+        drop_last=False,
+        collate_fn=partial(utils.collate_fn, False),
+        num_workers=args.num_workers,
+    )
+
     # Runs only evaluation, by default on the validation set unless --test is passed.
-    test_stats = {}
     test_model = model_ema if model_ema is not None else model
-    postprocessors = build_postprocessors(args, item.dataset_name)
-    print(f"Evaluating {item.dataset_name}")
-    
-    curr_test_stats = demo(
+    postprocessors = build_postprocessors(args, 'yourefit')
+    print("Evaluating yourefit")
+
+    res = demo(
         model=test_model,
         postprocessors=postprocessors,
-        data_loader=item.dataloader,
+        data_loader=dataloader,
         device=device,
         args=args,
     )
-
-
-    return
+    print(f"Predicted {len(res)} images, see serve.py for a long-lived inference service")
+    return res
 
  
 
@@ -0,0 +1,30 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Write the tokenizer and text encoder of --text_encoder_type to TEXT_ASSETS_DIR (magic_numbers), from which training,
+evaluation and the deployment scripts read them first, without network access (util.text_assets).
+
+Example:
+    python download_text_assets.py roberta-base
+"""
+import argparse
+
+from util.text_assets import save_text_assets
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("Text encoder assets")
+    parser.add_argument("text_encoder_type", nargs="+", choices=("roberta-base", "distilroberta-base", "roberta-large"))
+    parser.add_argument("--output", default=None, help="directory of a single text encoder, by default "
+                                                       "TEXT_ASSETS_DIR/<text_encoder_type>")
+    return parser
+
+
+def main(args):
+    if args.output is not None and len(args.text_encoder_type) > 1:
+        raise RuntimeError("--output is the directory of a single text encoder")
+    for name in args.text_encoder_type:
+        print(f"Wrote {name} to {save_text_assets(name, args.output)}")
+
+
+if __name__ == "__main__":
+    main(get_args_parser().parse_args())
@@ -8,7 +8,8 @@ Train and eval functions used in main.py
 """
 import math
 import sys
-from typing import Dict, Iterable, Optional
+from contextlib import nullcontext
+from typing import Callable, Dict, Iterable, Optional
 
 import torch
 import torch.nn
@@ -21,15 +22,195 @@ from datasets.coco_eval import CocoEvaluator
 from datasets.flickr_eval import FlickrEvaluator
 # from datasets.phrasecut_eval import PhrasecutEvaluator
 from datasets.refexp import RefExpEvaluator
-from util.metrics import MetricLogger, SmoothedValue
-from util.misc import targets_to
-from util.optim import adjust_learning_rate, update_ema
+from util.metrics import LossRingBuffer, MetricLogger, SmoothedValue
+from util.misc import NestedTensor, targets_to
+from util.optim import adjust_learning_rate, maybe_update_ema
+from util import profiling
 import time
-from models.mdetr import get_pose_loss
+from models.mdetr import get_pose_loss, get_pose_loss_scaling_factor
+from util.runtime_config import RuntimeConfig
+
+
+@torch.no_grad()
+def run_inference(model: torch.nn.Module, samples, captions, img_names=None):
+    """Run both passes of the model (encoder, then decoder and heads) for inference.
+
+    Returns the raw outputs of the second pass, which can be fed to PostProcess.
+    Pose predictions of a separate pose model are merged into the outputs.
+    """
+    memory_cache, pose_out = model(samples, captions, encode_and_save=True,
+                                   img_names=img_names)
+    outputs = model(samples, captions, encode_and_save=False,
+                    memory_cache=memory_cache, img_names=img_names)
+    if pose_out is not None:
+        outputs.update(pose_out)
+    return outputs
+
+
+def inference_targets(captions):
+    """Build the minimal targets PostProcess needs when there is no annotation.
+
+    Without an annotated target word, the whole sentence is used as the positive span
+    for the box-to-text alignment cost.
+    """
+    return [{"tokens_positive": [[[0, len(caption)]]]} for caption in captions]
+
+
+def split_batch(samples, captions, targets, positive_map, answers, num_chunks):
+    """Split a batch into at most num_chunks micro-batches of consecutive images.
+
+    The images keep the padding of the whole batch, so each image gives the
+    same outputs as in the whole batch. The rows of the collapsed
+    positive_map are split along with the boxes of their targets. The
+    captions are padded to the longest caption of their micro-batch, and
+    the padding tokens enter the negative term of the contrastive alignment
+    loss, so that loss can differ slightly from the one of the whole batch.
+    """
+    if num_chunks <= 1 or len(targets) <= 1:
+        return [(samples, captions, targets, positive_map, answers)]
+    micro_batches = []
+    box_offsets = [0]
+    for t in targets:
+        box_offsets.append(box_offsets[-1] + len(t["boxes"]))
+    for indices in torch.arange(len(targets)).chunk(num_chunks):
+        begin, end = indices[0].item(), indices[-1].item() + 1
+        micro_batches.append((
+            NestedTensor(samples.tensors[begin:end], samples.mask[begin:end]),
+            captions[begin:end] if captions is not None else None,
+            targets[begin:end],
+            positive_map[box_offsets[begin]:box_offsets[end]] if positive_map is not None else None,
+            {k: v[begin:end] for k, v in answers.items()} if answers is not None else None,
+        ))
+    return micro_batches
+
+
+def compute_losses(model, criterion, contrastive_criterion, qa_criterion,
+                   weight_dict, samples, captions, targets, positive_map,
+                   answers, args, num_boxes=None,
+                   pose_loss_scaling_factor=None, config=None):
+    """Forward a (micro-)batch and compute its losses.
+
+    Returns the dict of losses and their weighted sum. With gradient
+    accumulation, num_boxes and pose_loss_scaling_factor are the
+    normalizations of the whole batch, so that the losses of the
+    micro-batches add up to the loss of the batch.
+    """
+    config = config if config is not None else RuntimeConfig()
+    pafs = None
+    yourefit = True
+    target_arms = None
+    if yourefit:
+        paf_list = []
+        target_arms = []
+        for target in targets:
+            paf_list.append(target['ht_map'])
+            if target['arm'].shape[0] == 4:
+                target['arm'] = target['arm'].unsqueeze(0)
+            target_arms.append(target['arm'])
+        pafs = NestedTensor.from_tensor_list(paf_list)
+
+    loss_dict = {}
+    memory_cache = None
+    target_arm = None
+    pred_arm = None
+    pose_out = None
+    if args.masks:
+        outputs = model(samples, captions)
+    else:
+        # First pass through the model
+        with profiling.region("train/encode"):
+            memory_cache, pose_out = model(samples,
+                                           captions=captions,
+                                           encode_and_save=True,
+                                           paf_samples=pafs)
+        # ***'s implementation of arm loss computation
+        if pose_out is not None and config.predict_pose_using_a_different_model:
+            for k in range(3):
+                pose_loss, target_arm, pred_arm = \
+                    get_pose_loss(pose_out['{0}_arms'.format(k)],
+                                  pose_out['{0}_arm_score'.format(k)],
+                                  target_arms,
+                                  k, pose_loss_scaling_factor, config)    # Shape:[4, 10, 4], [4, 10, 2], 4
+                loss_dict.update(pose_loss)
+
+        # Second pass through the model.
+        #   Pass in the encodings of memory_cache['tokenized'].
+        #   Otherwise, memory_cache['tokenized']._encodings passed in can
+        #   sometimes get lost inside the function below.
+        #   Specifically, memory_cache['tokenized']._encodings inside the
+        #   function below sometimes become empty if not pass in
+        #   the encodings of memory_cache['tokenized'] and manually set it
+        #   in the function below.
+        with profiling.region("train/decode"):
+            if memory_cache['tokenized'] is not None:
+                outputs = model(samples, captions, encode_and_save=False,
+                                memory_cache=memory_cache,
+                                arm_query=target_arm,
+                                encodings_of_tokenized=memory_cache['tokenized']._encodings)
+            else:
+                outputs = model(samples, captions, encode_and_save=False,
+                                memory_cache=memory_cache,
+                                arm_query=target_arm,
+                                encodings_of_tokenized=None)
+
+        # ***'s implementation of adding pred_arm ot outputs
+        if pose_out is not None and config.predict_pose_using_a_different_model:
+            outputs.update({'pred_arm': pred_arm})  # last layer
+            outputs.update(pose_out)
+
+        # Get the predicted arm and compute arm loss using the same transformer
+        # TODO: this should be computed before the arm-box-align loss,
+        #  so that the predicted arms with shortest l1 distanced can be
+        #  used for computing the arm-box-align loss
+        if args.pose and not config.predict_pose_using_a_different_model:
+            # This '2' was hard-coded by ***
+            i = 2
+            arm = outputs['{0}_arms'.format(i)]
+            arm_class = outputs['{0}_arm_score'.format(i)]
+            with profiling.region("train/pose_loss"):
+                pose_loss, processed_target_arm, pred_arm = \
+                    get_pose_loss(arm, arm_class, target_arms, i, pose_loss_scaling_factor, config)
+            loss_dict.update(pose_loss)
+            outputs.update({'pred_arm': pred_arm})
+
+        if pose_out is not None:
+            outputs.update({'pred_arm': pred_arm})  # last layer
+            outputs.update(pose_out)
+
+    if criterion is not None:
+        with profiling.region("train/criterion"):
+            loss_dict.update(
+                criterion(outputs, targets, positive_map, args=args,
+                          num_boxes=num_boxes))
+
+    if contrastive_criterion is not None:
+        assert memory_cache is not None
+        contrastive_loss = contrastive_criterion(
+            memory_cache["text_pooled_op"], memory_cache["img_pooled_op"])
+        loss_dict["contrastive_loss"] = contrastive_loss
+
+    if qa_criterion is not None:
+        answer_losses = qa_criterion(outputs, answers)
+        loss_dict.update(answer_losses)
+
+    losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if
+                 k in weight_dict)
+
+    return loss_dict, losses
+
+
+def stop_if_not_finite(steps):
+    """Exit if the loss of one of the steps flushed from a LossRingBuffer is not finite, return the steps otherwise.
+
+    In distributed training, the steps must be averaged over all processes, so that they all exit at the same step.
+    """
+    for step in steps:
+        if not math.isfinite(step["loss"]):
+            print("Loss is {}, stopping training".format(step["loss"]))
+            print(step)
+            sys.exit(1)
+    return steps
 
-from magic_numbers import *
-import pandas as pd
-import temp_vars
 
 def train_one_epoch(
         model: torch.nn.Module,
@@ -44,7 +225,16 @@ def train_one_epoch(
         args,
         max_norm: float = 0,
         model_ema: Optional[torch.nn.Module] = None,
+        start_step: int = 0,
+        step_callback: Optional[Callable[[int], bool]] = None,
+        config: Optional[RuntimeConfig] = None,
 ):
+    """Train for one epoch, from its step start_step if the data loader starts there (util.resume).
+
+    step_callback is called with the number of steps done in the epoch after each step, e.g. to checkpoint, and
+    stops the epoch if it returns True. config defaults to RuntimeConfig().
+    """
+    config = config if config is not None else RuntimeConfig()
     model.train()
     if criterion is not None:
         criterion.train()
@@ -60,24 +250,18 @@ def train_one_epoch(
     metric_logger.add_meter("lr_text_encoder",
                             SmoothedValue(window_size=1, fmt="{value:.6f}"))
     header = "Epoch: [{}]".format(epoch)
-    print_freq = 10
-
-    # Create lists to store the outputs of mdetr
-    list_for_pred_scores = []
-    list_for_pred_classes = []
-    list_for_img_names = []
-    list_for_xmin = []
-    list_for_ymin = []
-    list_for_xmax = []
-    list_for_ymax = []
+    print_freq = args.print_freq
+    loss_buffer = LossRingBuffer(print_freq, weight_dict)
 
     current_batch_index = 0
 
-    num_training_steps = int(len(data_loader) * args.epochs)
+    steps_per_epoch = start_step + len(data_loader)
+    num_training_steps = int(steps_per_epoch * args.epochs)
     for i, batch_dict in enumerate(
             metric_logger.log_every(data_loader, print_freq, header,
-                                    args.output_dir)):
-        curr_step = epoch * len(data_loader) + i
+                                    args.output_dir), start=start_step):
+        curr_step = epoch * steps_per_epoch + i
+        profiling.step(curr_step)
         samples = batch_dict["samples"].to(device)
         positive_map = batch_dict["positive_map"].to(
             device) if "positive_map" in batch_dict else None
@@ -85,195 +269,54 @@ def train_one_epoch(
         answers = {k: v.to(device) for k, v in batch_dict[
             "answers"].items()} if "answers" in batch_dict else None
         captions = [t["caption"] for t in targets]
-        if REMOVE_LANGUAGE_BY_SETTING_CAPTION_TO_NONE:
+        if config.remove_language_by_setting_caption_to_none:
             captions = None
             positive_map = positive_map * 0
 
         targets = targets_to(targets, device)
 
-        pafs = None
-        yourefit = True
-        target_arms = None
-        if yourefit:
-            paf_list = []
-            target_arms = []
-            for target in targets:
-                paf_list.append(target['ht_map'])
-                if target['arm'].shape[0] == 4:
-                    target['arm'] = target['arm'].unsqueeze(0)
-                target_arms.append(target['arm'])
-            from util.misc import NestedTensor
-            pafs = NestedTensor.from_tensor_list(paf_list)
+        micro_batches = split_batch(samples, captions, targets, positive_map,
+                                    answers, args.grad_accumulation_steps)
+        num_boxes = None
+        pose_loss_scaling_factor = None
+        if len(micro_batches) > 1:
+            if contrastive_criterion is not None or qa_criterion is not None:
+                raise NotImplementedError(
+                    'Gradient accumulation is not implemented for the contrastive and qa losses')
+            num_boxes = criterion.get_num_boxes(targets, device)
+            pose_loss_scaling_factor = get_pose_loss_scaling_factor(
+                [t['arm'] for t in targets], config)
 
+        optimizer.zero_grad()
         loss_dict = {}
-        memory_cache = None
-        target_arm = None
-        pred_arm = None
-        pose_out = None
-        if args.masks:
-            outputs = model(samples, captions)
-        else:
-            # First pass through the model
-            memory_cache, pose_out = model(samples,
-                                           captions=captions,
-                                           encode_and_save=True,
-                                           paf_samples=pafs)
-            # ***'s implementation of arm loss computation
-            if pose_out is not None and PREDICT_POSE_USING_A_DIFFERENT_MODEL:
-                for k in range(3):
-                    pose_loss, target_arm, pred_arm = \
-                        get_pose_loss(pose_out['{0}_arms'.format(k)],
-                                      pose_out['{0}_arm_score'.format(k)],
-                                      target_arms,
-                                      k)    # Shape:[4, 10, 4], [4, 10, 2], 4
-                    loss_dict.update(pose_loss)
-
-            # Second pass through the model.
-            #   Pass in the encodings of memory_cache['tokenized'].
-            #   Otherwise, memory_cache['tokenized']._encodings passed in can
-            #   sometimes get lost inside the function below.
-            #   Specifically, memory_cache['tokenized']._encodings inside the
-            #   function below sometimes become empty if not pass in
-            #   the encodings of memory_cache['tokenized'] and manually set it
-            #   in the function below.
-            if memory_cache['tokenized'] is not None:
-                outputs = model(samples, captions, encode_and_save=False,
-                                memory_cache=memory_cache,
-                                arm_query=target_arm,
-                                encodings_of_tokenized=memory_cache['tokenized']._encodings)
-            else:
-                outputs = model(samples, captions, encode_and_save=False,
-                                memory_cache=memory_cache,
-                                arm_query=target_arm,
-                                encodings_of_tokenized=None)
+        for j, micro_batch in enumerate(micro_batches):
+            # Only synchronize the gradients of DDP on the last micro-batch
+            is_last = j == len(micro_batches) - 1
+            with nullcontext() if is_last or not hasattr(model, 'no_sync') else model.no_sync():
+                micro_loss_dict, losses = compute_losses(
+                    model, criterion, contrastive_criterion, qa_criterion,
+                    weight_dict, *micro_batch, args, num_boxes=num_boxes,
+                    pose_loss_scaling_factor=pose_loss_scaling_factor,
+                    config=config)
+                with profiling.region("train/backward"):
+                    losses.backward()
+            for k, v in micro_loss_dict.items():
+                loss_dict[k] = loss_dict[k] + v.detach() if k in loss_dict else v.detach()
+
+        # The losses stay on the device until the next logging step. In a
+        # single process, a non-finite loss stops it before then. In distributed
+        # training, the processes stop together at the logging step, whose
+        # averaged losses are not finite if those of any process are not.
+        loss_buffer.push(loss_dict)
+        if not dist.is_dist_avail_and_initialized() and not loss_buffer.all_finite():
+            stop_if_not_finite(loss_buffer.flush(reduce=False))
 
-            # ***'s implementation of adding pred_arm ot outputs
-            if pose_out is not None and PREDICT_POSE_USING_A_DIFFERENT_MODEL:
-                outputs.update({'pred_arm': pred_arm})  # last layer
-                outputs.update(pose_out)
-
-            # Get the predicted arm and compute arm loss using the same transformer
-            # TODO: this should be computed before the arm-box-align loss,
-            #  so that the predicted arms with shortest l1 distanced can be
-            #  used for computing the arm-box-align loss
-            if args.pose and not PREDICT_POSE_USING_A_DIFFERENT_MODEL:
-                # This '2' was hard-coded by ***
-                i = 2
-                arm = outputs['{0}_arms'.format(i)]
-                arm_class = outputs['{0}_arm_score'.format(i)]
-                pose_loss, processed_target_arm, pred_arm = \
-                    get_pose_loss(arm, arm_class, target_arms, i)
-                loss_dict.update(pose_loss)
-                outputs.update({'pred_arm': pred_arm})
-
-            # Save predictions to lists and write them into a file
-            if SAVE_MDETR_PREDICTIONS:
-                for j in range(len(targets)):
-                    current_pred_logits = outputs['pred_logits'][
-                        j].detach().cpu()
-                    current_pred_boxes = outputs['pred_boxes'][j].detach().cpu()
-                    current_img_name = targets[j]['img_name']
-
-                    values, indices = current_pred_logits.softmax(-1).max(-1)
-
-                    num_boxes = current_pred_logits.shape[0]
-
-                    # Append each prediction for current image separately into lists
-                    for k in range(num_boxes):
-                        score = values[k]
-                        pred_class = indices[k]
-
-                        # cxcywh to xmin, ymin, xmax, ymax
-                        box = current_pred_boxes[k]
-                        cx, cy, w, h = box
-                        xmin, ymin, xmax, ymax = [cx - w / 2, cy - h / 2,
-                                                  cx + w / 2, cy + h / 2]
-
-                        list_for_pred_scores.append(score.item())
-                        list_for_pred_classes.append(pred_class.item())
-                        list_for_img_names.append(current_img_name)
-                        list_for_xmin.append(xmin.item())
-                        list_for_ymin.append(ymin.item())
-                        list_for_xmax.append(xmax.item())
-                        list_for_ymax.append(ymax.item())
-
-                # ???
-                del outputs
-                metric_logger.update(loss=-1)
-                metric_logger.update(lr=-1)
-                metric_logger.update(lr_backbone=-1)
-                metric_logger.update(lr_text_encoder=-1)
-
-                # process lists and store contents into a dataframe
-                if i == len(data_loader) - 1:
-                    print("Storing MDETR Predictions to Lists")
-                    df = pd.DataFrame({'img_name': list_for_img_names,
-                                       'pred_score': list_for_pred_scores,
-                                       'pred_class': list_for_pred_classes,
-                                       'xmin': list_for_xmin,
-                                       'ymin': list_for_ymin,
-                                       'xmax': list_for_xmax,
-                                       'ymax': list_for_ymax
-                                       })
-                    df.astype({'img_name': 'str',
-                               'pred_score': 'float',
-                               'pred_class': 'int',
-                               'xmin': 'float',
-                               'ymin': 'float',
-                               'xmax': 'float',
-                               'ymax': 'float'})
-
-                    # save dataframe to disk as a csv file
-                    print("Writing MDETR Predictions to Disk")
-                    file_name = 'mdetr_predictions_training_set.csv'
-                    print(file_name)
-                    df.to_csv(file_name, index=False)
-                    raise NotImplementedError('Done')
-                continue
-
-            if pose_out is not None:
-                outputs.update({'pred_arm': pred_arm})  # last layer
-                outputs.update(pose_out)
-
-        if criterion is not None:
-            loss_dict.update(
-                criterion(outputs, targets, positive_map, args=args))
-
-        if contrastive_criterion is not None:
-            assert memory_cache is not None
-            contrastive_loss = contrastive_criterion(
-                memory_cache["text_pooled_op"], memory_cache["img_pooled_op"])
-            loss_dict["contrastive_loss"] = contrastive_loss
-
-        if qa_criterion is not None:
-            answer_losses = qa_criterion(outputs, answers)
-            loss_dict.update(answer_losses)
-
-        losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if
-                     k in weight_dict)
-
-        # reduce losses over all GPUs for logging purposes
-        loss_dict_reduced = dist.reduce_dict(loss_dict)
-        loss_dict_reduced_unscaled = {f"{k}_unscaled": v for k, v in
-                                      loss_dict_reduced.items()}
-        loss_dict_reduced_scaled = {k: v * weight_dict[k] for k, v in
-                                    loss_dict_reduced.items() if
-                                    k in weight_dict}
-        losses_reduced_scaled = sum(loss_dict_reduced_scaled.values())
-
-        loss_value = losses_reduced_scaled.item()
-
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            print(loss_dict_reduced)
-            sys.exit(1)
-
-        optimizer.zero_grad()
-        losses.backward()
         if max_norm > 0:
-            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
-        if not CALCULATE_COS_SIM:
-            optimizer.step()
+            with profiling.region("train/clip_grad"):
+                torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
+        if not config.calculate_cos_sim:
+            with profiling.region("train/optimizer"):
+                optimizer.step()
 
         adjust_learning_rate(
             optimizer,
@@ -283,23 +326,112 @@ def train_one_epoch(
             args=args,
         )
         if model_ema is not None:
-            update_ema(model, model_ema, args.ema_decay)
-
-        metric_logger.update(loss=loss_value, **loss_dict_reduced_scaled,
-                             **loss_dict_reduced_unscaled)
+            with profiling.region("train/ema"):
+                maybe_update_ema(model, model_ema, args.ema_decay, curr_step + 1, args.ema_every)
+
+        # reduce losses over all GPUs for logging purposes, every print_freq
+        # steps only, as the host waits for the device
+        if i % print_freq == 0 or i == steps_per_epoch - 1:
+            for step in stop_if_not_finite(loss_buffer.flush()):
+                metric_logger.update(**step)
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
         metric_logger.update(lr_backbone=optimizer.param_groups[1]["lr"])
         metric_logger.update(lr_text_encoder=optimizer.param_groups[2]["lr"])
 
         current_batch_index += 1
-        if TRAIN_EARLY_STOP and current_batch_index >= TRAIN_EARLY_STOP_COUNT:
+        if config.train_early_stop and current_batch_index >= config.train_early_stop_count:
             break
+        if step_callback is not None and step_callback(i + 1):
+            break
+    for step in stop_if_not_finite(loss_buffer.flush()):
+        metric_logger.update(**step)
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
 
 
+@torch.no_grad()
+def evaluate_losses(model, criterion, contrastive_criterion, qa_criterion,
+                    samples, captions, targets, positive_map, answers,
+                    img_names, args, config):
+    """Forward a batch for evaluation and compute its losses.
+
+    Returns the dict of losses and the outputs of the model, with its arm predictions.
+    """
+    pafs = None
+    yourefit = True
+    target_arms = None
+    if yourefit:
+        paf_list = []
+        target_arms = []
+        for target in targets:
+            paf_list.append(target['ht_map'])
+            if target['arm'].shape[0] == 4:
+                target['arm'] = target['arm'].unsqueeze(0)
+            target_arms.append(target['arm'])
+        pafs = NestedTensor.from_tensor_list(paf_list)
+
+    loss_dict = {}
+    memory_cache = None
+    target_arm = None
+    pred_arm = None
+    pose_out = None
+
+    # First pass through the model
+    with profiling.region("eval/encode"):
+        memory_cache, pose_out = model(samples, captions, encode_and_save=True,
+                                       paf_samples=pafs, img_names=img_names)
+    # ***'s implementation of arm loss computation
+    if args.pose and config.predict_pose_using_a_different_model:
+        if pose_out is not None:
+            for i in range(3):
+                pose_loss, target_arm, pred_arm = \
+                    get_pose_loss(pose_out['{0}_arms'.format(i)],
+                                  pose_out['{0}_arm_score'.format(i)],
+                                  target_arms, i, config=config)
+                loss_dict.update(pose_loss)
+
+    # Second pass through the model
+    with profiling.region("eval/decode"):
+        outputs = model(samples, captions, encode_and_save=False,
+                        memory_cache=memory_cache, arm_query=target_arm,
+                        img_names=img_names)
+
+    # ***'s implementation of adding pred_arm ot outputs
+    if args.pose and config.predict_pose_using_a_different_model:
+        if pose_out is not None:
+            outputs.update({'pred_arm': pred_arm})  # last layer
+            outputs.update(pose_out)
+
+    # Get the predicted arm and compute arm loss using the same transformer
+    if args.pose and not config.predict_pose_using_a_different_model:
+        # This '2' was hard-coded by ***
+        i = 2
+        pose_loss, target_arm, pred_arm = \
+            get_pose_loss(outputs['{0}_arms'.format(i)],
+                          outputs['{0}_arm_score'.format(i)],
+                          target_arms, i, config=config)
+        loss_dict.update(pose_loss)
+        outputs.update({'pred_arm': pred_arm})
+
+    if criterion is not None:
+        with profiling.region("eval/criterion"):
+            loss_dict.update(criterion(outputs, targets, positive_map))
+
+    if contrastive_criterion is not None:
+        assert memory_cache is not None
+        contrastive_loss = contrastive_criterion(
+            memory_cache["text_pooled_op"], memory_cache["img_pooled_op"])
+        loss_dict["contrastive_loss"] = contrastive_loss
+
+    if qa_criterion is not None:
+        answer_losses = qa_criterion(outputs, answers)
+        loss_dict.update(answer_losses)
+
+    return loss_dict, outputs
+
+
 @torch.no_grad()
 def evaluate(
         model: torch.nn.Module,
@@ -312,7 +444,9 @@ def evaluate(
         evaluator_list,
         device: torch.device,
         args,
+        config: Optional[RuntimeConfig] = None,
 ):
+    config = config if config is not None else RuntimeConfig()
     model.eval()
     if criterion is not None:
         criterion.eval()
@@ -339,74 +473,9 @@ def evaluate(
 
         targets = targets_to(targets, device)
 
-        pafs = None
-        yourefit = True
-        target_arms = None
-        if yourefit:
-            paf_list = []
-            target_arms = []
-            for target in targets:
-                paf_list.append(target['ht_map'])
-                if target['arm'].shape[0] == 4:
-                    target['arm'] = target['arm'].unsqueeze(0)
-                target_arms.append(target['arm'])
-            from util.misc import NestedTensor
-            pafs = NestedTensor.from_tensor_list(paf_list)
-
-        loss_dict = {}
-        memory_cache = None
-        target_arm = None
-        pred_arm = None
-        pose_out = None
-
-        # First pass through the model
-        memory_cache, pose_out = model(samples, captions, encode_and_save=True,
-                                       paf_samples=pafs, img_names=img_names)
-        # ***'s implementation of arm loss computation
-        if args.pose and PREDICT_POSE_USING_A_DIFFERENT_MODEL:
-            if pose_out is not None:
-                for i in range(3):
-                    pose_loss, target_arm, pred_arm = \
-                        get_pose_loss(pose_out['{0}_arms'.format(i)],
-                                      pose_out['{0}_arm_score'.format(i)],
-                                      target_arms, i)
-                    loss_dict.update(pose_loss)
-
-        # Second pass through the model
-        outputs = model(samples, captions, encode_and_save=False,
-                        memory_cache=memory_cache, arm_query=target_arm,
-                        img_names=img_names)
-
-        # ***'s implementation of adding pred_arm ot outputs
-        if args.pose and PREDICT_POSE_USING_A_DIFFERENT_MODEL:
-            if pose_out is not None:
-                outputs.update({'pred_arm': pred_arm})  # last layer
-                outputs.update(pose_out)
-
-        # Get the predicted arm and compute arm loss using the same transformer
-        if args.pose and not PREDICT_POSE_USING_A_DIFFERENT_MODEL:
-            # This '2' was hard-coded by ***
-            i = 2
-            pose_loss, target_arm, pred_arm = \
-                get_pose_loss(outputs['{0}_arms'.format(i)],
-                              outputs['{0}_arm_score'.format(i)],
-                              target_arms, i)
-            loss_dict.update(pose_loss)
-            outputs.update({'pred_arm': pred_arm})
-
-
-        if criterion is not None:
-            loss_dict.update(criterion(outputs, targets, positive_map))
-
-        if contrastive_criterion is not None:
-            assert memory_cache is not None
-            contrastive_loss = contrastive_criterion(
-                memory_cache["text_pooled_op"], memory_cache["img_pooled_op"])
-            loss_dict["contrastive_loss"] = contrastive_loss
-
-        if qa_criterion is not None:
-            answer_losses = qa_criterion(outputs, answers)
-            loss_dict.update(answer_losses)
+        loss_dict, outputs = evaluate_losses(
+            model, criterion, contrastive_criterion, qa_criterion, samples,
+            captions, targets, positive_map, answers, img_names, args, config)
 
         # reduce losses over all GPUs for logging purposes
         loss_dict_reduced = dist.reduce_dict(loss_dict)
@@ -424,8 +493,9 @@ def evaluate(
         if not args.no_detection:
             orig_target_sizes = torch.stack([t["orig_size"] for t in targets],
                                             dim=0)
-            results = postprocessors["bbox"](outputs, orig_target_sizes,
-                                             img_names=img_names, targets=targets)
+            with profiling.region("eval/postprocess"):
+                results = postprocessors["bbox"](outputs, orig_target_sizes,
+                                                 img_names=img_names, targets=targets)
             if "segm" in postprocessors.keys():
                 target_sizes = torch.stack([t["size"] for t in targets], dim=0)
                 results = postprocessors["segm"](results, outputs,
@@ -460,27 +530,30 @@ def evaluate(
 
             res = {target["image_id"].item(): output for target, output in
                    zip(targets, results)}
-            for evaluator in evaluator_list:
-                if isinstance(evaluator, FlickrEvaluator):
-                    evaluator.update(flickr_res)
-                else:
-                    evaluator.update(res)
+            with profiling.region("eval/evaluator_update", host=True):
+                for evaluator in evaluator_list:
+                    if isinstance(evaluator, FlickrEvaluator):
+                        evaluator.update(flickr_res)
+                    else:
+                        evaluator.update(res)
 
         eval_count += 1
-        if EVAL_EARLY_STOP and eval_count >= EVAL_EARLY_STOP_COUNT:
+        if config.eval_early_stop and eval_count >= config.eval_early_stop_count:
             break
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
-    for evaluator in evaluator_list:
-        evaluator.synchronize_between_processes()
+    with profiling.region("eval/synchronize", host=True):
+        for evaluator in evaluator_list:
+            evaluator.synchronize_between_processes()
 
-    if CALCULATE_COS_SIM:
+    if config.calculate_cos_sim:
+        cos_sim_stats = criterion.cos_sim_stats
         print()
-        print('num_images:', temp_vars.image_count)
-        print("gt:", temp_vars.gt_cos_sim / temp_vars.image_count)
-        print('pred:', temp_vars.pred_cos_sim / temp_vars.image_count)
+        print('num_images:', cos_sim_stats["image_count"])
+        print("gt:", cos_sim_stats["gt_cos_sim"] / cos_sim_stats["image_count"])
+        print('pred:', cos_sim_stats["pred_cos_sim"] / cos_sim_stats["image_count"])
         print()
         breakpoint()
 
@@ -497,7 +570,8 @@ def evaluate(
         elif isinstance(evaluator, FlickrEvaluator):
             flickr_res = evaluator.summarize()
         elif isinstance(evaluator, YouRefItEvaluator):
-            yourefit_res = evaluator.summarize()
+            with profiling.region("eval/summarize", host=True):
+                yourefit_res = evaluator.summarize()
     # accumulate predictions from all images
 
     stats = {k: meter.global_avg for k, meter in metric_logger.meters.items()}
@@ -0,0 +1,75 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Export the predictions of a model on a YouRefIt split to a prediction store, for distillation.
+
+The split is read with the validation transform (no random flip or crop), the model runs in eval mode
+without gradients, and the raw outputs of every batch are written straight into the memory-mapped columns
+of the store (see util/prediction_store.py). To train on the exported boxes, set
+use_mdetr_predictions_as_groundtruths to true and mdetr_prediction_path to the store in a --runtime_config file
+(or USE_MDETR_PREDICTIONS_AS_GROUNDTRUTHS and MDETR_PREDICTION_PATH in magic_numbers.py).
+
+Example:
+    python export_distillation.py --dataset_config configs/yourefit.json --load pretrained/best_etf.pth \
+        --store mdetr_predictions_training_set --batch_size 16 --num_workers 8
+"""
+import argparse
+import json
+import time
+from functools import partial
+
+import torch
+from torch.utils.data import DataLoader
+
+import util.misc as utils
+from datasets.coco import make_coco_transforms
+from datasets.yourefit import ReferDataset
+from engine import run_inference
+from main_ref import get_args_parser
+from models import build_model
+from optimize_cpu import load_weights
+from util.prediction_store import PredictionStoreWriter
+from util.runtime_config import RuntimeConfig
+
+
+def get_export_args_parser():
+    parser = argparse.ArgumentParser("Distillation export", add_help=False)
+    parser.add_argument("--store", default="mdetr_predictions_training_set", help="directory of the prediction store")
+    parser.add_argument("--split", default="train")
+    return parser
+
+
+def main(args):
+    if args.dataset_config is not None:
+        with open(args.dataset_config, "r") as f:
+            vars(args).update(json.load(f))
+    device = torch.device(args.device)
+
+    config = RuntimeConfig.from_args(args)
+    model, _, _, _, _ = build_model(args, pretrained=not args.load, config=config)
+    if args.load:
+        load_weights(model, args.load)
+    model.to(device)
+    model.eval()
+
+    dataset = ReferDataset(data_root=".", split_root=".", dataset="yourefit", split=args.split,
+                           transform=make_coco_transforms("val", False), augment=False, args=args,
+                           config=config)
+    data_loader = DataLoader(dataset, args.batch_size, shuffle=False, collate_fn=partial(utils.collate_fn, False),
+                             num_workers=args.num_workers, pin_memory=device.type == "cuda")
+
+    start = time.time()
+    with PredictionStoreWriter(args.store, dataset.images) as writer:
+        for i, batch_dict in enumerate(data_loader):
+            samples = batch_dict["samples"].to(device, non_blocking=True)
+            targets = batch_dict["targets"]
+            outputs = run_inference(model, samples, [t["caption"] for t in targets])
+            writer.write([t["img_name"] for t in targets], outputs["pred_logits"], outputs["pred_boxes"])
+            if i % 50 == 0:
+                print(f"{i}/{len(data_loader)} batches, {(i + 1) * args.batch_size / (time.time() - start):.1f} images/s")
+    print(f"Wrote the predictions of {len(dataset)} images to {args.store} in {time.time() - start:.0f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Touch-line transformer distillation export",
+                                     parents=[get_args_parser(), get_export_args_parser()])
+    main(parser.parse_args())
@@ -0,0 +1,105 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Export the touch-line transformer to ONNX and check the exported graph against eager PyTorch.
+
+Example:
+    python export_onnx.py --dataset_config configs/yourefit.json --load pretrained/best_etf.pth \
+        --onnx_output pretrained/best_etf.onnx --check_samples 20
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from engine import inference_targets, run_inference
+from main_ref import get_args_parser
+from models import build_model
+from models.export import OnnxTouchLineModel, export_onnx
+from models.postprocessors import PostProcess
+from optimize_cpu import benchmark_inputs, load_weights
+from util import text_assets
+from util.misc import NestedTensor
+from util.runtime_config import RuntimeConfig
+
+COMPARED_KEYS = ("scores", "boxes", "align_cost", "arms", "arms_scores")
+
+
+def get_export_args_parser():
+    parser = argparse.ArgumentParser("ONNX export", add_help=False)
+    parser.add_argument("--onnx_output", required=True, help="where to save the ONNX graph")
+    parser.add_argument("--opset", default=13, type=int)
+    parser.add_argument("--trace_size", default=[800, 1066], type=int, nargs=2,
+                        help="Height and width of the dummy image used for tracing")
+    parser.add_argument("--check_samples", default=10, type=int,
+                        help="Number of images used to compare onnxruntime with eager PyTorch, 0 to skip")
+    parser.add_argument("--check_atol", default=1e-2, type=float,
+                        help="Maximum absolute difference tolerated on the normalized outputs")
+    parser.add_argument("--ort_threads", default=0, type=int)
+    return parser
+
+
+def check_parity(model, runtime, args):
+    """Compare the onnxruntime outputs with eager PyTorch, return the max abs difference of each output."""
+    postprocess = PostProcess(config=RuntimeConfig.from_args(args))
+    max_diff = {k: 0.0 for k in COMPARED_KEYS}
+    latency = {"eager": [], "onnxruntime": []}
+    for img, caption, _, orig_size in benchmark_inputs(args, args.check_samples):
+        samples = NestedTensor.from_tensor_list([img])
+        # Compare in normalized coordinates so that the tolerance does not depend on the image size
+        unit_size = torch.ones(1, 2)
+
+        start = time.perf_counter()
+        outputs = run_inference(model, samples, [caption])
+        expected = postprocess(outputs, unit_size, targets=inference_targets([caption]))[0]
+        latency["eager"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        actual = runtime(samples, [caption], unit_size)[0]
+        latency["onnxruntime"].append(time.perf_counter() - start)
+
+        for k in COMPARED_KEYS:
+            if k in expected:
+                diff = (expected[k].float() - actual[k]).abs().max().item()
+                max_diff[k] = max(max_diff[k], diff)
+    report = {"max_abs_diff": max_diff}
+    for name, values in latency.items():
+        # drop the first call, which includes the session / allocator warm up
+        values = np.array(values[1:] or values) * 1000
+        report[f"{name}_latency_ms_mean"] = float(values.mean())
+    return report
+
+
+def main(args):
+    if args.dataset_config is not None:
+        with open(args.dataset_config, "r") as f:
+            vars(args).update(json.load(f))
+    if not args.load:
+        raise RuntimeError("Please provide the checkpoint to export with --load")
+    args.device = "cpu"
+
+    model, _, _, _, _ = build_model(args, pretrained=not args.load, config=RuntimeConfig.from_args(args))
+    load_weights(model, args.load)
+    model.eval()
+    tokenizer = text_assets.tokenizer(args.text_encoder_type)
+
+    Path(args.onnx_output).parent.mkdir(parents=True, exist_ok=True)
+    export_onnx(model, args.onnx_output, tokenizer, image_size=tuple(args.trace_size), opset_version=args.opset)
+    print("Saved ONNX graph to", args.onnx_output)
+
+    if args.check_samples > 0:
+        runtime = OnnxTouchLineModel(args.onnx_output, tokenizer, num_threads=args.ort_threads)
+        report = check_parity(model, runtime, args)
+        print(json.dumps(report, indent=2))
+        failed = {k: v for k, v in report["max_abs_diff"].items() if v > args.check_atol}
+        if failed:
+            raise RuntimeError(f"onnxruntime outputs differ from eager PyTorch: {failed}")
+        print("Parity check passed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("ONNX export of the touch-line transformer",
+                                     parents=[get_args_parser(), get_export_args_parser()])
+    main(parser.parse_args())
@@ -1,11 +1,17 @@
 # Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
-SAVE_MDETR_PREDICTIONS = False
+# The defaults of util.runtime_config.RuntimeConfig, whose fields are the lower case names of these constants.
+# A run overrides them with a JSON file of fields, e.g. main_ref.py --runtime_config ablation.json, and sweep.py
+# evaluates several such configs in one process.
 USE_MDETR_PREDICTIONS_AS_GROUNDTRUTHS = False
+# A prediction store written by export_distillation.py, or a processed csv with one foreground box per image
 MDETR_PREDICTION_PATH = 'processed_mdetr_predictions_training_set.csv'
 
 REPLACE_ARM_WITH_EYE_TO_FINGERTIP = True
 EYE_TO_FINGERTIP_ANNOTATION_TRAIN_PATH = 'yourefit/eye_to_fingertip/eye_to_fingertip_annotations_train.csv'
 EYE_TO_FINGERTIP_ANNOTATION_VALID_PATH = 'yourefit/eye_to_fingertip/eye_to_fingertip_annotations_valid.csv'
+# The tokenizer and text encoder of --text_encoder_type are read from TEXT_ASSETS_DIR/<text_encoder_type> when it
+# exists (written by download_text_assets.py), else from the HuggingFace cache, and only then downloaded
+TEXT_ASSETS_DIR = 'pretrained/text_encoders'
 
 ARM_LOSS_COEF = 6
 ARM_SCORE_LOSS_COEF = 1.5
@@ -62,6 +68,11 @@ DUMMY_LANGUAGE_INPUT = 'object'
 
 COS_SIM_VERTEX = ['EYE', 'FINGERTIP', 'OBJECT'][0]
 
+# PostProcess adds the top-k boxes reranked by score * ((1 + cos) / 2) ** weight, where cos is the alignment
+# of the box center with the top predicted arm (0: disabled)
+ALIGNMENT_RERANK_TOP_K = 0
+ALIGNMENT_RERANK_WEIGHT = 1.0
+
 REPLACE_SENTENCE_WITH_TARGET_WORD = False
 
 REMOVE_LANGUAGE_BY_SETTING_CAPTION_TO_NONE = False
@@ -21,15 +21,22 @@ import torch.utils
 from torch.utils.data import ConcatDataset, DataLoader, DistributedSampler
 from IPython import embed
 
-import temp_vars
 import util.dist as dist
 import util.misc as utils
+from util import profiling
+from util.checkpoint import (AsyncCheckpointWriter, is_slim_checkpoint, load_checkpoint, load_model_weights,
+                              load_optimizer_state_dict, optimizer_shard_path, optimizer_state_dict)
+from util.resume import (PreemptionHandler, ResumableBatchSampler, SeededDataset, gather_rng_states,
+                         restore_rng_states, rng_state, set_rng_state)
+from util.optim import build_adamw, build_param_dicts
 from engine import evaluate, train_one_epoch
 from models import build_model
+from models.checkpointing import CHECKPOINTABLE_MODULES, enable_activation_checkpointing
+from models.meta_init import materialize
 from models.postprocessors import build_postprocessors
 from datasets.yourefit import ReferDataset, YouRefItEvaluator
 from datasets.coco import make_coco_transforms
-from magic_numbers import *
+from util.runtime_config import RuntimeConfig
 from torch.utils.tensorboard import SummaryWriter
 import os
 os.environ['TOKENIZERS_PARALLELISM'] = 'false'
@@ -51,6 +58,9 @@ def get_args_parser():
 
     # Dataset specific
     parser.add_argument("--dataset_config", default=None, required=True)
+    parser.add_argument("--runtime_config", default=None,
+                        help="JSON file of RuntimeConfig fields (util.runtime_config) overriding the defaults of "
+                             "magic_numbers.py")
     parser.add_argument("--do_qa", action="store_true",
                         help="Whether to do question answering")
     parser.add_argument(
@@ -91,6 +101,12 @@ def get_args_parser():
     parser.add_argument("--lr_backbone", default=1e-5, type=float)
     parser.add_argument("--text_encoder_lr", default=5e-5, type=float)
     parser.add_argument("--batch_size", default=2, type=int)
+    parser.add_argument("--grad_accumulation_steps", default=1, type=int,
+                        help="split each batch into this many micro-batches whose gradients are accumulated")
+    parser.add_argument("--activation_checkpointing", default=[], nargs="*", choices=CHECKPOINTABLE_MODULES,
+                        help="submodules whose activations are recomputed in the backward pass instead of stored")
+    parser.add_argument("--print_freq", default=10, type=int,
+                        help="number of training steps between two reductions and logs of the losses")
     parser.add_argument("--weight_decay", default=1e-4, type=float)
     parser.add_argument("--epochs", default=40, type=int)
     parser.add_argument("--lr_drop", default=35, type=int)
@@ -101,6 +117,13 @@ def get_args_parser():
         help="If greater than 0, will split the training set into chunks and validate/checkpoint after each chunk",
     )
     parser.add_argument("--optimizer", default="adam", type=str)
+    parser.add_argument("--optimizer_impl", default="auto", choices=("auto", "fused", "foreach", "for_loop"),
+                        help="implementation of AdamW: fused / multi-tensor (foreach) / one kernel per parameter")
+    parser.add_argument("--zero_optimizer", type=string_to_bool, default=False,
+                        help="in distributed training, shard the AdamW state between the processes (ZeRO stage 1)")
+    parser.add_argument("--optimizer_checkpoint", default="consolidated", choices=("consolidated", "sharded"),
+                        help="with --zero_optimizer, gather the optimizer state into the checkpoints on the main "
+                             "process, or write the state of each process next to them")
     parser.add_argument("--clip_max_norm", default=0.1, type=float,
                         help="gradient clipping max norm")
     parser.add_argument(
@@ -119,6 +142,8 @@ def get_args_parser():
     )
     parser.add_argument("--ema", action="store_true")
     parser.add_argument("--ema_decay", type=float, default=0.9998)
+    parser.add_argument("--ema_every", type=int, default=1,
+                        help="update the EMA every N steps, with a decay of ema_decay ** N")
     parser.add_argument("--fraction_warmup_steps", default=0.01, type=float,
                         help="Fraction of total number of steps")
 
@@ -299,23 +324,64 @@ def get_args_parser():
     parser.add_argument("--seed", default=42, type=int)
     parser.add_argument("--resume", default="", help="resume from checkpoint")
     parser.add_argument("--load", default="", help="resume from checkpoint")
+    parser.add_argument("--skip_pretrained", type=string_to_bool, default=True,
+                        help="with --resume or --load, build the backbone and text encoder without downloading and "
+                             "initializing their pretrained weights, their weights are those of the checkpoint. "
+                             "The pretrained weights are still used if a --load checkpoint lacks some of them")
+    parser.add_argument("--async_checkpoint", type=string_to_bool, default=True,
+                        help="write the checkpoints from a background thread, training only waits for a copy of "
+                             "the weights and optimizer state to CPU memory")
+    parser.add_argument("--keep_checkpoints", default=0, type=int,
+                        help="keep only the last N numbered checkpoints of output_dir, 0 to keep them all")
+    parser.add_argument("--checkpoint_every_steps", default=0, type=int,
+                        help="also write checkpoint.pth every N steps within the epochs, to resume from there, "
+                             "0 to only write it at the end of the epochs and on SIGTERM or SIGUSR1")
     parser.add_argument("--start-epoch", default=0, type=int, metavar="N",
                         help="start epoch")
     parser.add_argument("--eval", action="store_true",
                         help="Only run evaluation")
     parser.add_argument("--num_workers", default=5, type=int)
+    parser.add_argument("--profile", action="store_true",
+                        help="time the named regions of the training and evaluation loops (util/profiling.py), "
+                             "reported after each epoch. Data loading regions need --num_workers 0")
+    parser.add_argument("--profile_trace_start", default=-1, type=int,
+                        help="first training step of a torch.profiler trace written to output_dir/profiler, "
+                             "-1 for no trace")
+    parser.add_argument("--profile_trace_steps", default=5, type=int,
+                        help="number of training steps in the torch.profiler trace")
 
     # Distributed training parameters
     parser.add_argument("--world-size", default=1, type=int,
                         help="number of distributed processes")
     parser.add_argument("--dist-url", default="env://",
                         help="url used to set up distributed training")
+    parser.add_argument("--dist_backend", default=None, choices=("nccl", "gloo"),
+                        help="backend of distributed training, by default nccl on CUDA devices and gloo otherwise")
+    parser.add_argument("--pin_threads", type=string_to_bool, default=True,
+                        help="on CPU devices in distributed mode, pin each process to its share of the CPUs of the "
+                             "machine, in NUMA node order, with as many torch threads")
+    parser.add_argument("--find_unused_parameters", type=string_to_bool, default=False,
+                        help="search the autograd graph of each step for parameters without gradients, only needed "
+                             "by models with modules that some steps do not use")
+    parser.add_argument("--ddp_static_graph", type=string_to_bool, default=True,
+                        help="let DistributedDataParallel reuse the order of the gradients of the first step")
+    parser.add_argument("--ddp_bucket_cap_mb", default=25, type=float,
+                        help="size of the buckets of gradients all-reduced together")
 
     parser.add_argument('--pose', type=string_to_bool, default=True)
 
     return parser
 
 
+def report_profile(writer, tag, step, elapsed):
+    """Print and write to tensorboard the durations of the profiling regions since the last report."""
+    durations = profiling.collect()
+    if durations and dist.is_main_process():
+        print(f"{tag} (ms, rank 0):")
+        print(profiling.format_summary(durations, elapsed * 1e3))
+        profiling.add_to_tensorboard(writer, tag, durations, step)
+
+
 def main(args):
     # Init distributed mode
     dist.init_distributed_mode(args)
@@ -327,6 +393,7 @@ def main(args):
         with open(args.dataset_config, "r") as f:
             cfg = json.load(f)
         d.update(cfg)
+    config = RuntimeConfig.from_args(args)
     ARGS_POSE = args.pose
     # print("git:\n  {}\n".format(utils.get_sha()))
 
@@ -336,56 +403,56 @@ def main(args):
     if args.frozen_weights is not None:
         assert args.masks, "Frozen training is meant for segmentation only"
 
-    if REMOVE_LANGUAGE_BY_SETTING_CAPTION_TO_NONE:
+    if config.remove_language_by_setting_caption_to_none:
         args.contrastive_align_loss = False
 
     print(args)
 
     print()
     print()
-    print('AMSGRAD:                              ', AMSGRAD)
+    print('AMSGRAD:                              ', config.amsgrad)
     print('args.pose:                            ', args.pose)
-    if USE_MDETR_PREDICTIONS_AS_GROUNDTRUTHS:
+    if config.use_mdetr_predictions_as_groundtruths:
         print('USE_MDETR_PREDICTIONS_AS_GROUNDTRUTHS:',
-              USE_MDETR_PREDICTIONS_AS_GROUNDTRUTHS)
+              config.use_mdetr_predictions_as_groundtruths)
     print('REPLACE_ARM_WITH_EYE_TO_FINGERTIP:    ',
-          REPLACE_ARM_WITH_EYE_TO_FINGERTIP)
-    print('PREDICT_POSE_USING_A_DIFFERENT_MODEL: ', PREDICT_POSE_USING_A_DIFFERENT_MODEL)
-    print('ARM_LOSS_COEF:                        ', ARM_LOSS_COEF)
-    print('ARM_SCORE_LOSS_COEF:                  ', ARM_SCORE_LOSS_COEF)
-    print('ARM_BOX_ALIGN_LOSS_COEF:              ', ARM_BOX_ALIGN_LOSS_COEF)
+          config.replace_arm_with_eye_to_fingertip)
+    print('PREDICT_POSE_USING_A_DIFFERENT_MODEL: ', config.predict_pose_using_a_different_model)
+    print('ARM_LOSS_COEF:                        ', config.arm_loss_coef)
+    print('ARM_SCORE_LOSS_COEF:                  ', config.arm_score_loss_coef)
+    print('ARM_BOX_ALIGN_LOSS_COEF:              ', config.arm_box_align_loss_coef)
     print('args.bbox_loss_coef:                  ', args.bbox_loss_coef)
     print('args.giou_loss_coef:                  ', args.giou_loss_coef)
     print('USE_GT__ARM_FOR_ARM_BOX_ALIGN_LOSS:   ',
-          USE_GT__ARM_FOR_ARM_BOX_ALIGN_LOSS)
-    if ARM_BOX_ALIGN_OFFSET_BY_GT:
+          config.use_gt__arm_for_arm_box_align_loss)
+    if config.arm_box_align_offset_by_gt:
         print('ARM_BOX_ALIGN_OFFSET_BY_GT:           ',
-              ARM_BOX_ALIGN_OFFSET_BY_GT)
+              config.arm_box_align_offset_by_gt)
     else:
         print('ARM_BOX_ALIGH_FIXED_OFFSET:           ',
-              ARM_BOX_ALIGH_FIXED_OFFSET)
-    if DEACTIVATE_EXTRA_TRANSFORMS:
+              config.arm_box_aligh_fixed_offset)
+    if config.deactivate_extra_transforms:
         print('DEACTIVATE_EXTRA_TRANSFORMS:          ',
-              DEACTIVATE_EXTRA_TRANSFORMS)
+              config.deactivate_extra_transforms)
     print('eos_coef:                             ', args.eos_coef)
-    if REPLACE_IMAGES_WITH_INPAINT:
+    if config.replace_images_with_inpaint:
         print('REPLACE_IMAGES_WITH_INPAINT:          ',
-              REPLACE_IMAGES_WITH_INPAINT)
-        print('INPAINT_DIR:                          ', INPAINT_DIR)
+              config.replace_images_with_inpaint)
+        print('INPAINT_DIR:                          ', config.inpaint_dir)
     print()
-    print('RESERVE_QUERIES_FOR_ARMS:             ', RESERVE_QUERIES_FOR_ARMS)
-    print('NUM_RESERVED_QUERIES_FOR_ARMS:        ', NUM_RESERVED_QUERIES_FOR_ARMS)
+    print('RESERVE_QUERIES_FOR_ARMS:             ', config.reserve_queries_for_arms)
+    print('NUM_RESERVED_QUERIES_FOR_ARMS:        ', config.num_reserved_queries_for_arms)
     print()
-    if REPLACE_LANGUAGE_INPUTS:
-        print('REPLACE_LANGUAGE_INPUTS:              ', REPLACE_LANGUAGE_INPUTS)
-        print('DUMMY_LANGUAGE_INPUT:                 ', DUMMY_LANGUAGE_INPUT)
+    if config.replace_language_inputs:
+        print('REPLACE_LANGUAGE_INPUTS:              ', config.replace_language_inputs)
+        print('DUMMY_LANGUAGE_INPUT:                 ', config.dummy_language_input)
         print()
 
-    print('COS_SIM_VERTEX:                       ', COS_SIM_VERTEX)
+    print('COS_SIM_VERTEX:                       ', config.cos_sim_vertex)
     print()
-    print('REPLACE_SENTENCE_WITH_TARGET_WORD:    ', REPLACE_SENTENCE_WITH_TARGET_WORD)
+    print('REPLACE_SENTENCE_WITH_TARGET_WORD:    ', config.replace_sentence_with_target_word)
     print()
-    print('REMOVE_LANGUAGE_BY_SETTING_CAPTION_TO_NONE: ', REMOVE_LANGUAGE_BY_SETTING_CAPTION_TO_NONE)
+    print('REMOVE_LANGUAGE_BY_SETTING_CAPTION_TO_NONE: ', config.remove_language_by_setting_caption_to_none)
 
     # Initialize tensorboard
     tensorboard_log_dir = 'runs'
@@ -399,7 +466,15 @@ def main(args):
     writer = SummaryWriter(tensorboard_log_dir + '/' + experiment_name)
 
     device = torch.device(args.device)
+    if args.distributed and device.type == "cpu" and args.pin_threads:
+        cpus = dist.pin_cpu_threads(args.local_rank, args.local_size)
+        print(f"Pinned rank {args.rank} to {len(cpus)} CPUs, {torch.get_num_threads()} threads")
     output_dir = Path(args.output_dir)
+    if args.profile or args.profile_trace_start >= 0:
+        profiling.enable(device)
+    if args.profile_trace_start >= 0:
+        profiling.enable_trace(args.profile_trace_start, args.profile_trace_steps, str(output_dir / "profiler"),
+                               device)
 
     # fix the seed for reproducibility
     seed = args.seed + dist.get_rank()
@@ -408,10 +483,34 @@ def main(args):
     random.seed(seed)
     torch.use_deterministic_algorithms(False)
 
+    # The pretrained weights of the backbone and text encoder are overwritten by those of --resume or --load, they
+    # are neither downloaded nor initialized, and the parameters are materialized from the checkpoint
+    checkpoint, loaded_weights = None, None
+    if args.skip_pretrained and args.frozen_weights is None:
+        if args.resume:
+            checkpoint = load_checkpoint(args.resume)
+        elif args.load:
+            loaded_weights = load_model_weights(args.load)
+    weights = checkpoint["model"] if checkpoint is not None else loaded_weights
+
     # Build the model
+    build_rng_state = rng_state()
     model, criterion, contrastive_criterion, qa_criterion, weight_dict = build_model(
-        args)
+        args, pretrained=weights is None, config=config)
+    if weights is not None:
+        # inference checkpoints only lack the parameters no prediction depends on, but the training checkpoints of
+        # --load may lack pretrained ones, which then keep their pretrained weights
+        partial_load = checkpoint is None and not is_slim_checkpoint(args.load)
+        uninitialized = materialize(model, weights, report=not partial_load)
+        if uninitialized and partial_load:
+            print(f"{len(uninitialized)} pretrained parameters are not in {args.load}, building the model with "
+                  f"its pretrained weights: {uninitialized}")
+            set_rng_state(build_rng_state)
+            model, criterion, contrastive_criterion, qa_criterion, weight_dict = build_model(args, config=config)
+    del weights
     model.to(device)
+    if args.activation_checkpointing:
+        enable_activation_checkpointing(model, args.activation_checkpointing)
 
     assert (
             criterion is not None or qa_criterion is not None
@@ -421,41 +520,24 @@ def main(args):
     model_ema = deepcopy(model) if args.ema else None
     model_without_ddp = model
     if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model,
-                                                          device_ids=[args.gpu],
-                                                          find_unused_parameters=True)
+        model = dist.wrap_distributed(model, args, device)
         model_without_ddp = model.module
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print("number of params:", n_parameters)
 
     # Set up optimizers
-    param_dicts = [
-        {
-            "params": [
-                p
-                for n, p in model_without_ddp.named_parameters()
-                if
-                "backbone" not in n and "text_encoder" not in n and p.requires_grad
-            ]
-        },
-        {
-            "params": [p for n, p in model_without_ddp.named_parameters() if
-                       "backbone" in n and p.requires_grad],
-            "lr": args.lr_backbone,
-        },
-        {
-            "params": [p for n, p in model_without_ddp.named_parameters() if
-                       "text_encoder" in n and p.requires_grad],
-            "lr": args.text_encoder_lr,
-        },
-    ]
+    if args.zero_optimizer and not (args.distributed and args.optimizer in ["adam", "adamw"]):
+        raise RuntimeError("--zero_optimizer shards the state of AdamW between the processes of distributed training")
+    param_dicts = build_param_dicts(model_without_ddp, args)
     if args.optimizer == "sgd":
         optimizer = torch.optim.SGD(param_dicts, lr=args.lr, momentum=0.9,
                                     weight_decay=args.weight_decay)
     elif args.optimizer in ["adam", "adamw"]:
-        optimizer = torch.optim.AdamW(param_dicts, lr=args.lr,
-                                      weight_decay=args.weight_decay,
-                                      amsgrad=AMSGRAD)
+        optimizer = build_adamw(param_dicts, lr=args.lr,
+                                weight_decay=args.weight_decay,
+                                amsgrad=config.amsgrad,
+                                implementation=args.optimizer_impl,
+                                shard=args.zero_optimizer)
     else:
         raise RuntimeError(f"Unsupported optimizer {args.optimizer}")
 
@@ -465,9 +547,7 @@ def main(args):
 
     dataset_train, sampler_train, data_loader_train = None, None, None
     if not args.eval:
-        # Deactivate transformations such as random flip and random crop when
-        # saving the predictions of mdetr for distillation
-        if SAVE_MDETR_PREDICTIONS or DEACTIVATE_EXTRA_TRANSFORMS or TRAIN_EARLY_STOP:
+        if config.deactivate_extra_transforms or config.train_early_stop:
             input_transform = make_coco_transforms('val', False)
         else:
             input_transform = make_coco_transforms('train', False)
@@ -476,24 +556,28 @@ def main(args):
                                      dataset='yourefit',
                                      split='train',
                                      transform=input_transform,
-                                     augment=False, args=args)
+                                     augment=False, args=args, config=config)
         if args.distributed:
-            sampler_train = DistributedSampler(dataset_train, shuffle=not TRAIN_EARLY_STOP)
+            sampler_train = DistributedSampler(dataset_train, shuffle=not config.train_early_stop, seed=args.seed)
         else:
-            if TRAIN_EARLY_STOP:
+            if config.train_early_stop:
                 sampler_train = torch.utils.data.SequentialSampler(dataset_train)
             else:
                 sampler_train = torch.utils.data.RandomSampler(dataset_train)
 
-        batch_sampler_train = torch.utils.data.BatchSampler(sampler_train,
-                                                            args.batch_size,
-                                                            drop_last=DROP_LAST and not CALCULATE_COS_SIM)
+        # The data order and augmentations only depend on the seed, the epoch and the index of the samples, so
+        # that training can resume in the middle of an epoch (util.resume)
+        batch_sampler_train = ResumableBatchSampler(sampler_train,
+                                                    args.batch_size,
+                                                    drop_last=config.drop_last and not config.calculate_cos_sim,
+                                                    seed=args.seed)
         data_loader_train = DataLoader(
-            dataset_train,
+            SeededDataset(dataset_train),
             batch_sampler=batch_sampler_train,
             collate_fn=partial(utils.collate_fn, False),
             num_workers=args.num_workers,
-            persistent_workers=PERSISTENT_WORKERS
+            persistent_workers=config.persistent_workers,
+            generator=torch.Generator().manual_seed(args.seed)
         )
 
     # Val dataset
@@ -511,7 +595,7 @@ def main(args):
                         dataset='yourefit',
                         split='val',
                         transform=input_transform,
-                        augment=False, args=args)
+                        augment=False, args=args, config=config)
     sampler = (
         DistributedSampler(dset,
                            shuffle=False) if args.distributed else torch.utils.data.SequentialSampler(
@@ -524,19 +608,15 @@ def main(args):
         drop_last=False,
         collate_fn=partial(utils.collate_fn, False),
         num_workers=args.num_workers,
-        persistent_workers=PERSISTENT_WORKERS
+        persistent_workers=config.persistent_workers,
+        generator=torch.Generator().manual_seed(args.seed)
     )
     base_ds = None
     val_tuples.append(
         Val_all(dataset_name='yourefit', dataloader=dataloader, base_ds=base_ds,
                 evaluator_list=None))
     if args.frozen_weights is not None:
-        if args.resume.startswith("https"):
-            checkpoint = torch.hub.load_state_dict_from_url(args.resume,
-                                                            map_location="cpu",
-                                                            check_hash=True)
-        else:
-            checkpoint = torch.load(args.resume, map_location="cpu")
+        checkpoint = load_checkpoint(args.resume)
         if "model_ema" in checkpoint and checkpoint["model_ema"] is not None:
             model_without_ddp.detr.load_state_dict(checkpoint["model_ema"],
                                                    strict=False)
@@ -551,28 +631,30 @@ def main(args):
     # loading into a model with different functionality.
     if args.load:
         print("loading from", args.load)
-        checkpoint = torch.load(args.load, map_location="cpu")
-        if "model_ema" in checkpoint:
-            model_without_ddp.load_state_dict(checkpoint["model_ema"],
-                                              strict=False)
-        else:
-            model_without_ddp.load_state_dict(checkpoint["model"], strict=False)
+        if loaded_weights is None:
+            # inference checkpoints of slim_checkpoint.py are memory-mapped and read as they are loaded
+            loaded_weights = load_model_weights(args.load)
+        model_without_ddp.load_state_dict(loaded_weights, strict=False)
+        del loaded_weights
 
         if args.ema:
             model_ema = deepcopy(model_without_ddp)
 
     # Used for resuming training from the checkpoint of a model. Used when training times-out or is pre-empted.
+    # Checkpoints written within an epoch resume from their step, with the random states of their processes.
+    start_step, rng_states = 0, None
     if args.resume:
-        if args.resume.startswith("https"):
-            checkpoint = torch.hub.load_state_dict_from_url(args.resume,
-                                                            map_location="cpu",
-                                                            check_hash=True)
-        else:
-            checkpoint = torch.load(args.resume, map_location="cpu")
+        if checkpoint is None:
+            checkpoint = load_checkpoint(args.resume)
         model_without_ddp.load_state_dict(checkpoint["model"])
         if not args.eval and "optimizer" in checkpoint and "epoch" in checkpoint:
-            optimizer.load_state_dict(checkpoint["optimizer"])
-            args.start_epoch = checkpoint["epoch"] + 1
+            load_optimizer_state_dict(optimizer, checkpoint["optimizer"], args.resume)
+            if checkpoint.get("step") is not None:
+                args.start_epoch, start_step = checkpoint["epoch"], checkpoint["step"]
+                print(f"Resuming epoch {args.start_epoch} from step {start_step}")
+            else:
+                args.start_epoch = checkpoint["epoch"] + 1
+            rng_states = checkpoint.get("rng")
         if args.ema:
             if "model_ema" not in checkpoint:
                 print(
@@ -600,10 +682,11 @@ def main(args):
     if args.eval:
         test_stats = {}
         test_model = model_ema if model_ema is not None else model
+        eval_start_time = time.time()
         for i, item in enumerate(val_tuples):
             evaluator_list = build_evaluator_list(item.base_ds,
                                                   item.dataset_name, dset)
-            postprocessors = build_postprocessors(args, item.dataset_name)
+            postprocessors = build_postprocessors(args, item.dataset_name, config)
             item = item._replace(evaluator_list=evaluator_list)
             print(f"Evaluating {item.dataset_name}")
             curr_test_stats = evaluate(
@@ -617,9 +700,11 @@ def main(args):
                 evaluator_list=item.evaluator_list,
                 device=device,
                 args=args,
+                config=config,
             )
             test_stats.update({item.dataset_name + "_" + k: v for k, v in
                                curr_test_stats.items()})
+        report_profile(writer, "Profile_eval", 0, time.time() - eval_start_time)
 
         # Write Precisions to tensorboard
         if len(args.combine_datasets_val) == 1 and args.combine_datasets_val[
@@ -651,16 +736,16 @@ def main(args):
             # unscaled_contrastive_align_loss =  test_stats['yourefit_loss_contrastive_align_unscaled']
 
             if dist.get_world_size() > 1:
-                if PREDICT_POSE_USING_A_DIFFERENT_MODEL:
+                if config.predict_pose_using_a_different_model:
                     pose_decoder_last_layer_index = len(
                         model.module.pose_decoder) - 1
                 else:
-                    pose_decoder_last_layer_index = POSE_MLP_NUM_LAYERS - 1
+                    pose_decoder_last_layer_index = config.pose_mlp_num_layers - 1
             else:
-                if PREDICT_POSE_USING_A_DIFFERENT_MODEL:
+                if config.predict_pose_using_a_different_model:
                     pose_decoder_last_layer_index = len(model.pose_decoder) - 1
                 else:
-                    pose_decoder_last_layer_index = POSE_MLP_NUM_LAYERS - 1
+                    pose_decoder_last_layer_index = config.pose_mlp_num_layers - 1
             # # unscaled_pose_loss = test_stats['yourefit_pose_loss_' + str(pose_decoder_last_layer_index) + '_unscaled']
             # unscaled_arm_loss = test_stats['yourefit_arm_loss_' + str(
             #     pose_decoder_last_layer_index) + '_unscaled']
@@ -690,10 +775,60 @@ def main(args):
     print("Start training")
     start_time = time.time()
     best_metric = 0.0
+    checkpoint_writer = AsyncCheckpointWriter(output_dir, keep_last=args.keep_checkpoints,
+                                              asynchronous=args.async_checkpoint)
+    # with sharded optimizer checkpoints, every rank writes the optimizer state of its share of the parameters
+    sharded_optimizer = args.zero_optimizer and args.optimizer_checkpoint == "sharded"
+    optimizer_writer = None
+    if sharded_optimizer and args.output_dir:
+        optimizer_writer = AsyncCheckpointWriter(
+            output_dir, keep_last=args.keep_checkpoints,
+            keep_pattern=optimizer_shard_path("checkpoint[0-9]*.pth", dist.get_rank()).name,
+            asynchronous=args.async_checkpoint, all_ranks=True)
+    preemption = PreemptionHandler()
+    interrupted_step = None
+
+    def save_checkpoint(state, paths):
+        """Write state to paths, and the optimizer state of this rank next to them with sharded optimizer
+        checkpoints. To be called on all ranks."""
+        checkpoint_writer.save(state, paths)
+        if optimizer_writer is not None:
+            optimizer_writer.save(optimizer.optim.state_dict(),
+                                  [optimizer_shard_path(path, dist.get_rank()) for path in paths])
+
+    def training_checkpoint(epoch, step=None):
+        """The state of training after step steps of epoch, or after the epoch. To be called on all ranks."""
+        return {
+            "model": model_without_ddp.state_dict(),
+            "model_ema": model_ema.state_dict() if args.ema else None,
+            "optimizer": optimizer_state_dict(optimizer, sharded_optimizer),
+            "epoch": epoch,
+            "step": step,
+            "rng": gather_rng_states(),
+            "args": args,
+            "runtime_config": config.to_dict(),
+        }
+
+    def checkpoint_step(epoch, epoch_steps, steps_done):
+        """Checkpoint within the epoch every --checkpoint_every_steps, and stop after a SIGTERM or SIGUSR1, which is
+        polled every --print_freq steps and at these checkpoints, the same steps on every rank."""
+        nonlocal interrupted_step
+        every = args.checkpoint_every_steps > 0 and steps_done % args.checkpoint_every_steps == 0
+        poll = every or steps_done % args.print_freq == 0
+        stop = poll and preemption.should_stop() and steps_done < epoch_steps
+        if args.output_dir and (stop or every and steps_done < epoch_steps):
+            save_checkpoint(training_checkpoint(epoch, steps_done), [output_dir / "checkpoint.pth"])
+        if stop:
+            interrupted_step = steps_done
+        return stop
+
+    if rng_states is not None:
+        restore_rng_states(rng_states)
     for epoch in range(args.start_epoch, args.epochs):
         print(f"Starting epoch {epoch}")
-        if args.distributed:
-            sampler_train.set_epoch(epoch)
+        batch_sampler_train.set_epoch(epoch, start_step if epoch == args.start_epoch else 0)
+        epoch_steps = batch_sampler_train.start_batch + len(data_loader_train)
+        epoch_start_time = time.time()
         train_stats = train_one_epoch(
             model=model,
             criterion=criterion,
@@ -707,7 +842,15 @@ def main(args):
             args=args,
             max_norm=args.clip_max_norm,
             model_ema=model_ema,
+            start_step=batch_sampler_train.start_batch,
+            step_callback=partial(checkpoint_step, epoch, epoch_steps),
+            config=config,
         )
+        report_profile(writer, "Profile_train", epoch, time.time() - epoch_start_time)
+        if interrupted_step is not None:
+            print(f"Stopped epoch {epoch} after step {interrupted_step}, resume with --resume "
+                  f"{output_dir / 'checkpoint.pth'}")
+            break
 
         # Write train stats to tensorboard
         if dist.get_rank() == 0:
@@ -718,15 +861,15 @@ def main(args):
             # Find out lr
             lr = train_stats['lr']
             writer.add_scalar('Misc_train/lr', lr, epoch_number)
-            writer.add_scalar('Misc_train/ARM_LOSS_COEF', ARM_LOSS_COEF,
+            writer.add_scalar('Misc_train/ARM_LOSS_COEF', config.arm_loss_coef,
                               epoch_number)
             writer.add_scalar('Misc_train/ARM_SCORE_LOSS_COEF',
-                              ARM_SCORE_LOSS_COEF, epoch_number)
+                              config.arm_score_loss_coef, epoch_number)
             writer.add_scalar('Misc_train/ARM_BOX_ALIGN_LOSS_COEF',
-                              ARM_BOX_ALIGN_LOSS_COEF, epoch_number)
-            if ARM_BOX_ALIGN_OFFSET_BY_GT:
+                              config.arm_box_align_loss_coef, epoch_number)
+            if config.arm_box_align_offset_by_gt:
                 writer.add_scalar('Misc_train/ARM_BOX_ALIGH_FIXED_OFFSET',
-                                  ARM_BOX_ALIGH_FIXED_OFFSET, epoch_number)
+                                  config.arm_box_aligh_fixed_offset, epoch_number)
             else:
                 writer.add_scalar('Misc_train/ARM_BOX_ALIGH_FIXED_OFFSET', -1,
                                   epoch_number)
@@ -746,16 +889,16 @@ def main(args):
                 unscaled_contrastive_align_loss = 0.0
 
             if dist.get_world_size() > 1:
-                if PREDICT_POSE_USING_A_DIFFERENT_MODEL:
+                if config.predict_pose_using_a_different_model:
                     pose_decoder_last_layer_index = len(
                         model.module.pose_decoder) - 1
                 else:
-                    pose_decoder_last_layer_index = POSE_MLP_NUM_LAYERS - 1
+                    pose_decoder_last_layer_index = config.pose_mlp_num_layers - 1
             else:
-                if PREDICT_POSE_USING_A_DIFFERENT_MODEL:
+                if config.predict_pose_using_a_different_model:
                     pose_decoder_last_layer_index = len(model.pose_decoder) - 1
                 else:
-                    pose_decoder_last_layer_index = POSE_MLP_NUM_LAYERS - 1
+                    pose_decoder_last_layer_index = config.pose_mlp_num_layers - 1
             # unscaled_pose_loss = train_stats['pose_loss_' + str(pose_decoder_last_layer_index) + '_unscaled']
             if ARGS_POSE:
                 unscaled_arm_loss = train_stats[
@@ -793,29 +936,27 @@ def main(args):
             checkpoint_paths = [output_dir / "checkpoint.pth"]
             # extra checkpoint before LR drop and every 2 epochs
             if (epoch + 1) % args.lr_drop == 0 or (
-                    epoch + 1) % CHECKPOINT_FREQUENCY == 0:
+                    epoch + 1) % config.checkpoint_frequency == 0:
                 checkpoint_paths.append(
                     output_dir / f"checkpoint{epoch:04}.pth")
-            for checkpoint_path in checkpoint_paths:
-                dist.save_on_master(
-                    {
-                        "model": model_without_ddp.state_dict(),
-                        "model_ema": model_ema.state_dict() if args.ema else None,
-                        "optimizer": optimizer.state_dict(),
-                        "epoch": epoch,
-                        "args": args,
-                    },
-                    checkpoint_path,
-                )
+            save_checkpoint(training_checkpoint(epoch), checkpoint_paths)
+            if dist.get_rank() == 0:
+                writer.add_scalar('Checkpoint/blocked_ms', checkpoint_writer.metrics["wait_ms"] +
+                                  checkpoint_writer.metrics["snapshot_ms"], epoch)
+                writer.add_scalar('Checkpoint/last_write_ms', checkpoint_writer.metrics["write_ms"], epoch)
+        if preemption.should_stop():
+            print(f"Stopped after epoch {epoch}, resume with --resume {output_dir / 'checkpoint.pth'}")
+            break
 
         if epoch % args.eval_skip == 0:
             test_stats = {}
             test_model = model_ema if model_ema is not None else model
+            eval_start_time = time.time()
             for i, item in enumerate(val_tuples):
                 evaluator_list = build_evaluator_list(item.base_ds,
                                                       item.dataset_name, dset)
                 item = item._replace(evaluator_list=evaluator_list)
-                postprocessors = build_postprocessors(args, item.dataset_name)
+                postprocessors = build_postprocessors(args, item.dataset_name, config)
                 print(f"Evaluating {item.dataset_name}")
                 curr_test_stats = evaluate(
                     model=test_model,
@@ -828,9 +969,11 @@ def main(args):
                     evaluator_list=item.evaluator_list,
                     device=device,
                     args=args,
+                    config=config,
                 )
                 test_stats.update({item.dataset_name + "_" + k: v for k, v in
                                    curr_test_stats.items()})
+            report_profile(writer, "Profile_eval", epoch, time.time() - eval_start_time)
         else:
             test_stats = {}
 
@@ -865,16 +1008,16 @@ def main(args):
 
 
             if dist.get_world_size() > 1:
-                if PREDICT_POSE_USING_A_DIFFERENT_MODEL:
+                if config.predict_pose_using_a_different_model:
                     pose_decoder_last_layer_index = len(
                         model.module.pose_decoder) - 1
                 else:
-                    pose_decoder_last_layer_index = POSE_MLP_NUM_LAYERS - 1
+                    pose_decoder_last_layer_index = config.pose_mlp_num_layers - 1
             else:
-                if PREDICT_POSE_USING_A_DIFFERENT_MODEL:
+                if config.predict_pose_using_a_different_model:
                     pose_decoder_last_layer_index = len(model.pose_decoder) - 1
                 else:
-                    pose_decoder_last_layer_index = POSE_MLP_NUM_LAYERS - 1
+                    pose_decoder_last_layer_index = config.pose_mlp_num_layers - 1
             # unscaled_pose_loss = test_stats['yourefit_pose_loss_' + str(pose_decoder_last_layer_index) + '_unscaled']
             if ARGS_POSE:
                 unscaled_arm_loss = test_stats['yourefit_arm_loss_' + str(
@@ -932,22 +1075,30 @@ def main(args):
                     metric = temp
                     Save_Best_Checkpoint = False
 
-            if Save_Best_Checkpoint and args.output_dir and metric > temp_vars.max_p75:
-                temp_vars.max_p75 = metric
+            save_best = bool(Save_Best_Checkpoint and args.output_dir and metric > best_metric)
+            # the metric is only computed on the main process, whose decision every rank follows, as saving the
+            # optimizer state is a collective with --zero_optimizer
+            save_best = dist.all_gather(save_best)[0]
+            if save_best:
+                if Save_Best_Checkpoint:
+                    best_metric = metric
                 checkpoint_paths = [output_dir / ("BEST_checkpoint_since" + str(args.start_epoch) + ".pth")]
-                # extra checkpoint before LR drop and every 100 epochs
-                for checkpoint_path in checkpoint_paths:
-                    dist.save_on_master(
-                        {
-                            "model": model_without_ddp.state_dict(),
-                            "model_ema": model_ema.state_dict() if args.ema else None,
-                            "optimizer": optimizer.state_dict(),
-                            "epoch": epoch,
-                            "args": args,
-                        },
-                        checkpoint_path,
-                    )
+                save_checkpoint(
+                    {
+                        "model": model_without_ddp.state_dict(),
+                        "model_ema": model_ema.state_dict() if args.ema else None,
+                        "optimizer": optimizer_state_dict(optimizer, sharded_optimizer),
+                        "epoch": epoch,
+                        "args": args,
+                    },
+                    checkpoint_paths,
+                )
 
+    checkpoint_writer.close()
+    if optimizer_writer is not None:
+        optimizer_writer.close()
+    preemption.close()
+    profiling.stop_trace()
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print("Training time {}".format(total_time_str))
@@ -3,5 +3,5 @@
 from .mdetr import build
 
 
-def build_model(args):
-    return build(args)
+def build_model(args, pretrained=True, config=None):
+    return build(args, pretrained, config)
@@ -14,6 +14,8 @@ from torchvision.models._utils import IntermediateLayerGetter
 
 from util.misc import NestedTensor
 
+from .checkpointing import checkpoint, is_checkpointing
+from .meta_init import skip_init
 from .position_encoding import build_position_encoding
 
 
@@ -56,8 +58,48 @@ class FrozenBatchNorm2d(torch.nn.Module):
         bias = b - rm * scale
         return x * scale + bias
 
+    def scale_and_bias(self):
+        """Return the per-channel affine transform this layer applies, as two 1d tensors."""
+        scale = self.weight * (self.running_var + 1e-5).rsqrt()
+        bias = self.bias - self.running_mean * scale
+        return scale, bias
+
+
+@torch.no_grad()
+def fold_frozen_batchnorm(module: nn.Module) -> int:
+    """Fold every FrozenBatchNorm2d into the convolution registered right before it.
+
+    The folded convolution gets the scale multiplied into its weight and the shift added to its bias,
+    and the batch norm is replaced by an identity. This relies on the registration order of the
+    torchvision ResNets (conv1/bn1, conv2/bn2, ..., downsample = Sequential(conv, bn)).
+    Returns the number of folded layers.
+    """
+    num_folded = 0
+    for parent in list(module.modules()):
+        previous = None
+        for name, child in list(parent.named_children()):
+            if (
+                isinstance(child, FrozenBatchNorm2d)
+                and isinstance(previous, nn.Conv2d)
+                and previous.out_channels == child.weight.numel()
+            ):
+                scale, bias = child.scale_and_bias()
+                conv = previous
+                conv_bias = conv.bias if conv.bias is not None else torch.zeros_like(bias)
+                conv.weight.copy_(conv.weight * scale.reshape(-1, 1, 1, 1))
+                conv.bias = nn.Parameter(conv_bias * scale + bias, requires_grad=False)
+                setattr(parent, name, nn.Identity())
+                num_folded += 1
+            previous = child
+    return num_folded
+
 
 class BackboneBase(nn.Module):
+    # Set to True by models.deploy when the backbone weights were converted to channels-last
+    channels_last = False
+    # Set to True by models.checkpointing to checkpoint each ResNet stage
+    checkpoint_stages = False
+
     def __init__(self, backbone: nn.Module, train_backbone: bool, num_channels: int, return_interm_layers: bool):
         super().__init__()
         for name, parameter in backbone.named_parameters():
@@ -71,7 +113,17 @@ class BackboneBase(nn.Module):
         self.num_channels = num_channels
 
     def forward(self, tensor_list):
-        xs = self.body(tensor_list.tensors)
+        x = tensor_list.tensors
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if self.checkpoint_stages and is_checkpointing(self):
+            xs = OrderedDict()
+            for name, module in self.body.items():
+                x = checkpoint(module, x) if name.startswith("layer") else module(x)
+                if name in self.body.return_layers:
+                    xs[self.body.return_layers[name]] = x
+        else:
+            xs = self.body(x)
         out = OrderedDict()
         for name, x in xs.items():
             mask = F.interpolate(tensor_list.mask[None].float(), size=x.shape[-2:]).bool()[0]
@@ -82,10 +134,14 @@ class BackboneBase(nn.Module):
 class Backbone(BackboneBase):
     """ResNet backbone with frozen BatchNorm."""
 
-    def __init__(self, name: str, train_backbone: bool, return_interm_layers: bool, dilation: bool):
-        backbone = getattr(torchvision.models, name)(
-            replace_stride_with_dilation=[False, False, dilation], pretrained=True, norm_layer=FrozenBatchNorm2d
-        )
+    def __init__(
+        self, name: str, train_backbone: bool, return_interm_layers: bool, dilation: bool, pretrained: bool = True
+    ):
+        with skip_init(not pretrained):
+            backbone = getattr(torchvision.models, name)(
+                replace_stride_with_dilation=[False, False, dilation], pretrained=pretrained,
+                norm_layer=FrozenBatchNorm2d
+            )
         num_channels = 512 if name in ("resnet18", "resnet34") else 2048
         super().__init__(backbone, train_backbone, num_channels, return_interm_layers)
 
@@ -98,17 +154,21 @@ class GroupNorm32(torch.nn.GroupNorm):
 class GroupNormBackbone(BackboneBase):
     """ResNet backbone with GroupNorm with 32 channels."""
 
-    def __init__(self, name: str, train_backbone: bool, return_interm_layers: bool, dilation: bool):
+    def __init__(
+        self, name: str, train_backbone: bool, return_interm_layers: bool, dilation: bool, pretrained: bool = True
+    ):
         name_map = {
             "resnet50-gn": ("resnet50", "/checkpoint/szagoruyko/imagenet/22014122/checkpoint.pth"),
             "resnet101-gn": ("resnet101", "/checkpoint/szagoruyko/imagenet/22080524/checkpoint.pth"),
         }
-        backbone = getattr(torchvision.models, name_map[name][0])(
-            replace_stride_with_dilation=[False, False, dilation], pretrained=False, norm_layer=GroupNorm32
-        )
-        checkpoint = torch.load(name_map[name][1], map_location="cpu")
-        state_dict = {k[7:]: p for k, p in checkpoint["model"].items()}
-        backbone.load_state_dict(state_dict)
+        with skip_init(not pretrained):
+            backbone = getattr(torchvision.models, name_map[name][0])(
+                replace_stride_with_dilation=[False, False, dilation], pretrained=False, norm_layer=GroupNorm32
+            )
+        if pretrained:
+            checkpoint = torch.load(name_map[name][1], map_location="cpu")
+            state_dict = {k[7:]: p for k, p in checkpoint["model"].items()}
+            backbone.load_state_dict(state_dict)
         num_channels = 512 if name_map[name][0] in ("resnet18", "resnet34") else 2048
         super().__init__(backbone, train_backbone, num_channels, return_interm_layers)
 
@@ -119,8 +179,10 @@ def replace_bn(m, name=""):
         if isinstance(target_attr, torch.nn.BatchNorm2d):
             frozen = FrozenBatchNorm2d(target_attr.num_features)
             bn = getattr(m, attr_str)
-            frozen.weight.data.copy_(bn.weight)
-            frozen.bias.data.copy_(bn.bias)
+            if not bn.weight.is_meta:
+                # the weights of a backbone built in skip_init come from the checkpoint
+                frozen.weight.data.copy_(bn.weight)
+                frozen.bias.data.copy_(bn.bias)
             frozen.running_mean.data.copy_(bn.running_mean)
             frozen.running_var.data.copy_(bn.running_var)
             setattr(m, attr_str, frozen)
@@ -138,9 +200,11 @@ class GN_8(nn.Module):
 
 
 class TimmBackbone(nn.Module):
-    def __init__(self, name, return_interm_layers, main_layer=-1, group_norm=False):
+    def __init__(self, name, return_interm_layers, main_layer=-1, group_norm=False, pretrained=True):
         super().__init__()
-        backbone = create_model(name, pretrained=True, in_chans=3, features_only=True, out_indices=(1, 2, 3, 4))
+        with skip_init(not pretrained):
+            backbone = create_model(name, pretrained=pretrained, in_chans=3, features_only=True,
+                                    out_indices=(1, 2, 3, 4))
 
         with torch.no_grad():
             replace_bn(backbone)
@@ -177,7 +241,8 @@ class Joiner(nn.Sequential):
         return out, pos
 
 
-def build_backbone(args):
+def build_backbone(args, pretrained=True):
+    """The backbone of args, without its pretrained weights if not pretrained (see models.meta_init)."""
     position_embedding = build_position_encoding(args)
     train_backbone = args.lr_backbone > 0
     return_interm_layers = args.masks
@@ -187,11 +252,12 @@ def build_backbone(args):
             return_interm_layers,
             main_layer=-1,
             group_norm=True,
+            pretrained=pretrained,
         )
     elif args.backbone in ("resnet50-gn", "resnet101-gn"):
-        backbone = GroupNormBackbone(args.backbone, train_backbone, return_interm_layers, args.dilation)
+        backbone = GroupNormBackbone(args.backbone, train_backbone, return_interm_layers, args.dilation, pretrained)
     else:
-        backbone = Backbone(args.backbone, train_backbone, return_interm_layers, args.dilation)
+        backbone = Backbone(args.backbone, train_backbone, return_interm_layers, args.dilation, pretrained)
     model = Joiner(backbone, position_embedding)
     model.num_channels = backbone.num_channels
     return model
@@ -0,0 +1,60 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Activation checkpointing of the submodules of MDETR.
+
+A checkpointed module does not keep its intermediate activations for the backward pass, it runs its forward
+again during the backward pass instead. This trades about one extra forward of the module for the memory of
+its activations. Checkpointing is only active in training mode with gradients enabled.
+"""
+import functools
+import inspect
+
+import torch
+import torch.utils.checkpoint
+
+CHECKPOINTABLE_MODULES = ("backbone", "encoder", "decoder", "text_encoder")
+
+
+def checkpoint(function, *args, **kwargs):
+    """Checkpointed function(*args, **kwargs).
+
+    The non-reentrant implementation is used, so that modules whose inputs do not require gradients
+    (e.g. the first trainable stage of a partially frozen backbone) still get gradients for their parameters.
+    """
+    if "use_reentrant" not in inspect.signature(torch.utils.checkpoint.checkpoint).parameters:
+        raise RuntimeError("Activation checkpointing requires torch >= 1.11")
+    return torch.utils.checkpoint.checkpoint(functools.partial(function, **kwargs), *args, use_reentrant=False)
+
+
+def is_checkpointing(module):
+    return module.training and torch.is_grad_enabled()
+
+
+def enable_activation_checkpointing(model, modules):
+    """Checkpoint the given submodules of an MDETR model.
+
+    modules is a subset of CHECKPOINTABLE_MODULES:
+        backbone: each stage of the ResNet backbone
+        encoder: each layer of the transformer encoder
+        decoder: each layer of the transformer decoder
+        text_encoder: each layer of the RoBERTa text encoder
+    """
+    for name in modules:
+        if name == "backbone":
+            backbone = model.backbone[0]
+            if not hasattr(backbone, "checkpoint_stages"):
+                raise NotImplementedError("Activation checkpointing is only implemented for ResNet backbones")
+            backbone.checkpoint_stages = True
+        elif name == "encoder":
+            model.transformer.encoder.checkpoint_layers = True
+        elif name == "decoder":
+            model.transformer.decoder.checkpoint_layers = True
+        elif name == "text_encoder":
+            text_encoder = model.transformer.text_encoder
+            if hasattr(text_encoder, "gradient_checkpointing_enable"):
+                text_encoder.gradient_checkpointing_enable()
+            else:
+                # transformers < 4.11
+                text_encoder.config.gradient_checkpointing = True
+        else:
+            raise RuntimeError(f"Unknown module {name}, expected one of {CHECKPOINTABLE_MODULES}")
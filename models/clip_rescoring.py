@@ -0,0 +1,118 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+CLIP rescoring of predicted boxes.
+
+The score of a box is the probability CLIP gives to the referring sentence against "nothing" for the
+crop of the box. CLIP is loaded once, the text features are cached per sentence, and the crops of all
+the boxes are decoded and preprocessed by DataLoader workers and encoded in large batches.
+Requires the openai CLIP package (https://github.com/openai/CLIP).
+"""
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+
+
+def crop_box(image, box):
+    """Crop a normalized xyxy box out of a PIL image, with the rounding of the original evaluator."""
+    W, H = image.size
+    xmin, ymin, xmax, ymax = (int(v) for v in np.asarray(box) * np.array([W, H, W, H]))
+    xmin = min(max(0, xmin), W - 1)
+    ymin = min(max(0, ymin), H - 1)
+    xmax = max(min(W, xmax - 1), xmin)
+    ymax = max(min(H, ymax - 1), ymin)
+    return image.crop((xmin, ymin, xmax + 1, ymax + 1))
+
+
+class BoxCropDataset(Dataset):
+    """One item per image: the preprocessed crops of all its boxes, so each image is decoded once."""
+
+    def __init__(self, groups, preprocess):
+        self.groups = groups
+        self.preprocess = preprocess
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __getitem__(self, idx):
+        image_path, boxes, indices = self.groups[idx]
+        image = Image.open(image_path).convert("RGB")
+        crops = torch.stack([self.preprocess(crop_box(image, box)) for box in boxes])
+        return crops, torch.as_tensor(indices)
+
+
+def _collate(batch):
+    crops, indices = zip(*batch)
+    return torch.cat(crops), torch.cat(indices)
+
+
+class ClipRescorer(object):
+    """Score (image, box, sentence) triplets with CLIP.
+
+    Args:
+        device: device CLIP runs on
+        model_name: name of the CLIP model, as accepted by clip.load
+        images_per_batch: number of images whose crops are encoded together
+        num_workers: number of DataLoader workers decoding and cropping the images
+        negative_sentence: the sentence the referring sentence is compared against
+    """
+
+    def __init__(self, device="cuda", model_name="ViT-B/32", images_per_batch=16, num_workers=4,
+                 negative_sentence="nothing"):
+        import clip
+
+        self.clip = clip
+        self.device = torch.device(device)
+        self.model, self.preprocess = clip.load(model_name, device=self.device)
+        self.model.eval()
+        self.images_per_batch = images_per_batch
+        self.num_workers = num_workers
+        self.negative_sentence = negative_sentence
+        self._text_features = OrderedDict()
+
+    @torch.no_grad()
+    def text_features(self, sentences):
+        """Normalized text features of sentences, [len(sentences), D]. Each sentence is encoded only once."""
+        missing = list(OrderedDict.fromkeys(s for s in sentences if s not in self._text_features))
+        if missing:
+            tokens = self.clip.tokenize(missing, truncate=True).to(self.device)
+            features = F.normalize(self.model.encode_text(tokens).float(), dim=-1)
+            self._text_features.update(zip(missing, features))
+        return torch.stack([self._text_features[s] for s in sentences])
+
+    @torch.no_grad()
+    def score(self, image_paths, boxes, sentences):
+        """Return the CLIP score of every box, as a numpy array.
+
+        Args:
+            image_paths: path of the image of every box
+            boxes: normalized xyxy boxes, [N, 4]
+            sentences: referring sentence of every box
+        """
+        sentences = list(sentences)
+        groups = OrderedDict()
+        for i, (image_path, box) in enumerate(zip(image_paths, boxes)):
+            groups.setdefault(image_path, ([], []))
+            groups[image_path][0].append(box)
+            groups[image_path][1].append(i)
+        dataset = BoxCropDataset([(p, b, idx) for p, (b, idx) in groups.items()], self.preprocess)
+        data_loader = DataLoader(dataset, self.images_per_batch, shuffle=False, collate_fn=_collate,
+                                 num_workers=self.num_workers, pin_memory=self.device.type == "cuda")
+
+        negative = self.text_features([self.negative_sentence])[0]
+        self.text_features(sentences)
+        logit_scale = self.model.logit_scale.exp().float()
+        scores = np.full(len(sentences), np.nan, dtype=np.float32)
+        for crops, indices in data_loader:
+            image_features = F.normalize(self.model.encode_image(crops.to(self.device, non_blocking=True)).float(),
+                                         dim=-1)
+            positive = self.text_features([sentences[i] for i in indices.tolist()])
+            # same as the logits_per_image of CLIP, restricted to (sentence, negative sentence) for every crop
+            logits = logit_scale * torch.stack(
+                [(image_features * positive).sum(-1), image_features @ negative], dim=-1
+            )
+            scores[indices.numpy()] = logits.softmax(dim=-1)[:, 0].cpu().numpy()
+        return scores
@@ -0,0 +1,85 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Graph-level optimizations for CPU-only inference.
+
+    * FrozenBatchNorm2d layers of the backbone are folded into the preceding convolutions
+    * the backbone runs in channels-last memory format
+    * the linears of the transformer (including the text encoder) are dynamically quantized to int8
+
+The optimized model is meant for inference only and is saved as a whole pickled module,
+see optimize_cpu.py for the command line entry point.
+"""
+import torch
+from torch import nn
+
+from .backbone import BackboneBase, fold_frozen_batchnorm
+
+
+def _select_quantized_engine():
+    supported = torch.backends.quantized.supported_engines
+    for engine in ("fbgemm", "qnnpack"):
+        if engine in supported:
+            torch.backends.quantized.engine = engine
+            return engine
+    raise RuntimeError(f"No int8 engine available, supported engines: {supported}")
+
+
+def _quantize_linears(module: nn.Module):
+    # Only plain nn.Linear are converted: the out projection of nn.MultiheadAttention is a
+    # NonDynamicallyQuantizableLinear and keeps running in fp32.
+    return torch.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+@torch.no_grad()
+def optimize_for_cpu(model: nn.Module, fold_bn=True, channels_last=True, quantize=True, quantize_heads=False):
+    """Apply the CPU inference optimizations in-place and return the model.
+
+    Args:
+        model: MDETR model, already loaded with the weights to deploy
+        fold_bn: fold the frozen batch norms of the backbone into the convolutions
+        channels_last: convert the backbone to channels-last memory format
+        quantize: dynamically quantize the linears of the transformer and of the text encoder to int8
+        quantize_heads: also quantize the prediction heads (class, box, eye, fingertip and arm score MLPs).
+                        Off by default, since the heads are tiny and regress the coordinates directly.
+    Returns:
+        the optimized model, and a dict describing what was applied
+    """
+    model.eval()
+    model.cpu()
+    report = {"folded_batchnorms": 0, "channels_last": False, "quantized_engine": None, "quantized_linears": 0}
+
+    backbone_modules = [m for m in model.backbone.modules() if isinstance(m, BackboneBase)]
+    if fold_bn:
+        report["folded_batchnorms"] = fold_frozen_batchnorm(model.backbone)
+    if channels_last:
+        for backbone in backbone_modules:
+            backbone.body.to(memory_format=torch.channels_last)
+            backbone.channels_last = True
+        report["channels_last"] = len(backbone_modules) > 0
+
+    if quantize:
+        report["quantized_engine"] = _select_quantized_engine()
+        _quantize_linears(model.transformer)
+        if quantize_heads:
+            for name, child in model.named_children():
+                if name not in ("backbone", "transformer"):
+                    _quantize_linears(child)
+        report["quantized_linears"] = sum(
+            1 for m in model.modules() if isinstance(m, torch.nn.quantized.dynamic.Linear)
+        )
+    return model, report
+
+
+def save_deployed_model(model: nn.Module, path, args=None, report=None):
+    """Save an optimized model, together with the args it was built with."""
+    torch.save({"deployed_model": model, "args": args, "report": report}, path)
+
+
+def load_deployed_model(path):
+    """Load a model saved with save_deployed_model. Returns the model and the args it was built with."""
+    checkpoint = torch.load(path, map_location="cpu")
+    if "deployed_model" not in checkpoint:
+        raise RuntimeError(f"{path} is not a deployed model, use optimize_cpu.py to create one")
+    model = checkpoint["deployed_model"]
+    model.eval()
+    return model, checkpoint["args"]
@@ -0,0 +1,182 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+ONNX export of the touch-line transformer, and a CPU runtime for the exported graph.
+
+The exported graph takes pre-tokenized captions instead of strings, so the tokenizer
+stays outside of the graph:
+    inputs:  image [B, 3, H, W] (normalized), image_mask [B, H, W] (True on padded pixels),
+             input_ids [B, T], attention_mask [B, T] (HuggingFace convention, 1 on real tokens),
+             positive_map [B, T] (1 on the tokens of the referring expression)
+    outputs: scores [B, Q], boxes [B, Q, 4] (normalized xyxy), align_cost [B, Q],
+             arms [B, A, 4] (normalized eye x, y and fingertip x, y), arm_scores [B, A]
+
+The switches of magic_numbers.py are read at export time and baked into the graph.
+See export_onnx.py for the command line entry point.
+"""
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from util import box_ops
+from util.misc import NestedTensor
+
+INPUT_NAMES = ["image", "image_mask", "input_ids", "attention_mask", "positive_map"]
+OUTPUT_NAMES = ["scores", "boxes", "align_cost", "arms", "arm_scores"]
+DYNAMIC_AXES = {
+    "image": {0: "batch", 2: "height", 3: "width"},
+    "image_mask": {0: "batch", 1: "height", 2: "width"},
+    "input_ids": {0: "batch", 1: "tokens"},
+    "attention_mask": {0: "batch", 1: "tokens"},
+    "positive_map": {0: "batch", 1: "tokens"},
+    "scores": {0: "batch"},
+    "boxes": {0: "batch"},
+    "align_cost": {0: "batch"},
+    "arms": {0: "batch"},
+    "arm_scores": {0: "batch"},
+}
+
+
+def caption_positive_map(tokenized, captions):
+    """Mark the tokens spanned by each whole caption, as PostProcess does with engine.inference_targets."""
+    positive_map = torch.zeros(tokenized["input_ids"].shape, dtype=torch.float)
+    for i, caption in enumerate(captions):
+        beg, end = 0, len(caption)
+        beg_pos = tokenized.char_to_token(i, beg)
+        end_pos = tokenized.char_to_token(i, end - 1)
+        # Skip leading / trailing characters that do not belong to any token (e.g. whitespace)
+        while beg_pos is None and beg < end - 1:
+            beg += 1
+            beg_pos = tokenized.char_to_token(i, beg)
+        while end_pos is None and end > beg + 1:
+            end -= 1
+            end_pos = tokenized.char_to_token(i, end - 1)
+        if beg_pos is None or end_pos is None:
+            continue
+        positive_map[i, beg_pos: end_pos + 1] = 1
+    return positive_map
+
+
+class ExportableMDETR(nn.Module):
+    """Single-pass, tensor-only view of MDETR suitable for tracing.
+
+    The text is encoded from the token ids inside the graph and handed to the transformer as an
+    already encoded tuple, then the two passes of MDETR.forward (encode_and_save=True / False)
+    are chained, and the raw outputs are reduced to the quantities PostProcess reports.
+    """
+
+    def __init__(self, model, temperature=0.07):
+        super().__init__()
+        if model.transformer.CLS is not None:
+            raise NotImplementedError("Export of models trained with --contrastive_loss is not supported")
+        if not model.contrastive_align_loss:
+            raise NotImplementedError("Export requires the contrastive align head (for align_cost)")
+        self.model = model
+        self.temperature = temperature
+
+    def encode_text(self, input_ids, attention_mask):
+        transformer = self.model.transformer
+        encoded_text = transformer.text_encoder(input_ids=input_ids, attention_mask=attention_mask)
+        # Same as Transformer.forward: sequence first, inverted mask, resized to d_model
+        text_memory = encoded_text.last_hidden_state.transpose(0, 1)
+        text_attention_mask = attention_mask.ne(1)
+        text_memory_resized = transformer.resizer(text_memory)
+        return text_attention_mask, text_memory_resized, None
+
+    def align_cost(self, proj_queries, proj_tokens, positive_map):
+        # Same reduction as PostProcess.loss_contrastive_align, with every query matched to the caption
+        logits = torch.matmul(proj_queries, proj_tokens.transpose(-1, -2)) / self.temperature
+        pos_term = -(logits * positive_map[:, None, :]).sum(2)
+        neg_term = logits.logsumexp(2)
+        nb_pos = positive_map.sum(1, keepdim=True)
+        return ((pos_term / (nb_pos + 1e-6) + neg_term) * (nb_pos > 0).to(logits.dtype))
+
+    def forward(self, image, image_mask, input_ids, attention_mask, positive_map):
+        samples = NestedTensor(image, image_mask)
+        text = self.encode_text(input_ids, attention_mask)
+        memory_cache, pose_out = self.model(samples, text, encode_and_save=True)
+        outputs = self.model(samples, text, encode_and_save=False, memory_cache=memory_cache)
+        if pose_out is not None:
+            outputs.update(pose_out)
+
+        prob = F.softmax(outputs["pred_logits"], -1)
+        scores = 1 - prob[:, :, -1]
+        boxes = box_ops.box_cxcywh_to_xyxy(outputs["pred_boxes"])
+        align_cost = self.align_cost(outputs["proj_queries"], outputs["proj_tokens"], positive_map)
+        if "2_arms" in outputs:
+            arms = outputs["2_arms"]
+            arm_scores = outputs["2_arm_score"].softmax(dim=2)[:, :, 1]
+        else:
+            arms = boxes.new_zeros((boxes.shape[0], 0, 4))
+            arm_scores = boxes.new_zeros((boxes.shape[0], 0))
+        return scores, boxes, align_cost, arms, arm_scores
+
+
+def export_onnx(model, path, tokenizer, image_size=(800, 1066), opset_version=13):
+    """Trace the model on a dummy input and write the ONNX graph to path."""
+    model.eval()
+    wrapper = ExportableMDETR(model).eval()
+    caption = "the cup on the table"
+    tokenized = tokenizer.batch_encode_plus([caption], padding="longest", return_tensors="pt")
+    image = torch.randn(1, 3, *image_size)
+    image_mask = torch.zeros(1, *image_size, dtype=torch.bool)
+    inputs = (image, image_mask, tokenized["input_ids"], tokenized["attention_mask"],
+              caption_positive_map(tokenized, [caption]))
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper,
+            inputs,
+            path,
+            input_names=INPUT_NAMES,
+            output_names=OUTPUT_NAMES,
+            dynamic_axes=DYNAMIC_AXES,
+            opset_version=opset_version,
+            do_constant_folding=True,
+        )
+
+
+class OnnxTouchLineModel:
+    """Run an exported graph with onnxruntime on CPU.
+
+    Calling it with normalized images and captions returns the same list of dicts as
+    engine.run_inference followed by PostProcess (scores, boxes, align_cost, arms, arms_scores),
+    with the boxes and arms in absolute coordinates of target_sizes.
+    """
+
+    def __init__(self, path, tokenizer, num_threads=0):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.tokenizer = tokenizer
+
+    def __call__(self, samples, captions, target_sizes):
+        if not isinstance(samples, NestedTensor):
+            samples = NestedTensor.from_tensor_list(samples)
+        tokenized = self.tokenizer.batch_encode_plus(captions, padding="longest", return_tensors="pt")
+        feeds = {
+            "image": samples.tensors.cpu().numpy().astype(np.float32),
+            "image_mask": samples.mask.cpu().numpy(),
+            "input_ids": tokenized["input_ids"].numpy(),
+            "attention_mask": tokenized["attention_mask"].numpy(),
+            "positive_map": caption_positive_map(tokenized, captions).numpy(),
+        }
+        scores, boxes, align_cost, arms, arm_scores = (
+            torch.from_numpy(o) for o in self.session.run(OUTPUT_NAMES, feeds)
+        )
+
+        img_h, img_w = target_sizes.unbind(1)
+        scale_fct = torch.stack([img_w, img_h, img_w, img_h], dim=1).to(boxes.dtype)
+        boxes = boxes * scale_fct[:, None, :]
+        arms = arms * scale_fct[:, None, :]
+        results = []
+        for i in range(len(captions)):
+            result = {"scores": scores[i], "boxes": boxes[i], "align_cost": align_cost[i]}
+            if arms.shape[1] > 0:
+                result["arms"] = arms[i]
+                result["arms_scores"] = arm_scores[i]
+            results.append(result)
+        return results
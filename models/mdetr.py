@@ -17,23 +17,20 @@ import torch.nn.functional as F
 from torch import nn
 import math
 import util.dist as dist
-from util import box_ops
+from util import box_ops, profiling
 from util.metrics import accuracy
 from util.misc import NestedTensor, interpolate
 
 from .backbone import build_backbone
 from .matcher import build_matcher
-from .postprocessors import build_postprocessors
+from .postprocessors import build_postprocessors, char_span_to_token_span
 from .segmentation import DETRsegm, dice_loss, sigmoid_focal_loss
 from .transformer import build_transformer, TransformerEncoder, \
     TransformerEncoderLayer, TransformerDecoderLayer
 # from .transformer_ori import TransformerDecoderLayer
 from util.box_ops import box_cxcywh_to_xyxy, generalized_box_iou
-from magic_numbers import *
-import temp_vars
-
-global img_size_pairs
-img_size_pairs = {}
+from util.ray_ops import aspect_scale, ray_vectors
+from util.runtime_config import RuntimeConfig
 
 
 class ConstrainedLearnablePE(nn.Module):
@@ -74,6 +71,9 @@ class ConstrainedLearnablePE(nn.Module):
 class MDETR(nn.Module):
     """ This is the MDETR module that performs modulated object detection """
 
+    # heads that earlier versions built without ever using them, whose weights are dropped from their checkpoints
+    removed_modules = ("object_score", "arm_query_proj")
+
     def __init__(
             self,
             backbone,
@@ -88,7 +88,8 @@ class MDETR(nn.Module):
             split_qa_heads=True,
             predict_final=False,
             yourefit=False,
-            pose=True
+            pose=True,
+            config=None
     ):
         """Initializes the model.
 
@@ -106,13 +107,14 @@ class MDETR(nn.Module):
             split_qa_heads: If true, use several head for each question type
             predict_final: If true, will predict if a given box is in the actual referred set.
                            Useful for CLEVR-Ref+ only currently.
+            config: the RuntimeConfig of the pose heads and reserved arm queries, by default RuntimeConfig()
         """
         super().__init__()
+        self.config = config if config is not None else RuntimeConfig()
         self.num_queries = num_queries
         self.transformer = transformer
         hidden_dim = transformer.d_model
         self.class_embed = nn.Linear(hidden_dim, num_classes + 1)
-        self.object_score = nn.Linear(hidden_dim, 1)
 
         self.isfinal_embed = nn.Linear(hidden_dim, 1) if predict_final else None
         self.bbox_embed = MLP(hidden_dim, hidden_dim, 4, 3)
@@ -126,13 +128,13 @@ class MDETR(nn.Module):
 
         self.pose = pose
 
-        if self.pose and not PREDICT_POSE_USING_A_DIFFERENT_MODEL:
-            self.eye_embed = MLP(hidden_dim, hidden_dim, 2, POSE_MLP_NUM_LAYERS)
-            self.fingertip_embed = MLP(hidden_dim, hidden_dim, 2, POSE_MLP_NUM_LAYERS)
-            self.unified_arm_class_embed = MLP(hidden_dim, hidden_dim, 2, POSE_MLP_NUM_LAYERS)
+        if self.pose and not self.config.predict_pose_using_a_different_model:
+            num_layers = self.config.pose_mlp_num_layers
+            self.eye_embed = MLP(hidden_dim, hidden_dim, 2, num_layers)
+            self.fingertip_embed = MLP(hidden_dim, hidden_dim, 2, num_layers)
+            self.unified_arm_class_embed = MLP(hidden_dim, hidden_dim, 2, num_layers)
 
-        if self.pose and PREDICT_POSE_USING_A_DIFFERENT_MODEL:
-            self.arm_query_proj = nn.Conv1d(4, 256, kernel_size=1)
+        if self.pose and self.config.predict_pose_using_a_different_model:
             pose_encoder_layer = TransformerEncoderLayer(hidden_dim,
                                                          transformer.nhead)
             self.pose_encoder = TransformerEncoder(pose_encoder_layer, 3)
@@ -148,8 +150,6 @@ class MDETR(nn.Module):
                     TransformerDecoderLayer(hidden_dim, transformer.nhead,
                                             pose=True))
 
-            # self.constrained_pe = ConstrainedLearnablePE(hidden_dim,num_queries)
-
         self.aux_loss = aux_loss
         self.contrastive_loss = contrastive_loss
         if contrastive_loss:
@@ -170,6 +170,12 @@ class MDETR(nn.Module):
         self.qa_dataset = qa_dataset
         self.split_qa_heads = split_qa_heads
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        removed = tuple(prefix + name + "." for name in self.removed_modules)
+        for key in [key for key in state_dict if key.startswith(removed)]:
+            del state_dict[key]
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, samples: NestedTensor, captions, encode_and_save=True,
                 memory_cache=None, paf_samples=None, arm_query=None,
                 img_names=None, encodings_of_tokenized=None):
@@ -192,39 +198,41 @@ class MDETR(nn.Module):
 
         if encode_and_save:
             assert memory_cache is None
-            features, pos = self.backbone(samples)
+            with profiling.region("model/backbone"):
+                features, pos = self.backbone(samples)
             src, mask = features[-1].decompose()
 
             query_embed = self.query_embed.weight
 
             pose_out = None
-            if self.pose and PREDICT_POSE_USING_A_DIFFERENT_MODEL:
-                pose_out = {}
-                bs = src.shape[0]
-                pose_src = self.pose_input_proj(src).flatten(2).permute(2, 0, 1)
-                src_pos = pos[-1].flatten(2).permute(2, 0, 1)
-                pose_mask = mask.flatten(1)
-                pose_memory = self.pose_encoder(pose_src,
-                                                src_key_padding_mask=pose_mask,
-                                                pos=src_pos)
-
-                pose_query = self.pose_query.weight.unsqueeze(1).repeat(1, bs,
-                                                                        1)
-                for i in range(3):
-                    keypoint_query = self.pose_decoder[i](pose_query,
-                                                          pose_memory,
-                                                          memory_key_padding_mask=pose_mask,
-                                                          pos=src_pos,
-                                                          query_pos=None,
-                                                          last_layer=(i == 2),
-                                                          img_names=img_names)
-                    arms = self.arm_head(
-                        keypoint_query.transpose(0, 1)).sigmoid()
-                    arm_classes = self.arm_class(keypoint_query.transpose(0, 1))
-                    pose_out.update({
-                        '{}_arms'.format(i): arms,
-                        '{}_arm_score'.format(i): arm_classes,
-                    })
+            if self.pose and self.config.predict_pose_using_a_different_model:
+                with profiling.region("model/pose_model"):
+                    pose_out = {}
+                    bs = src.shape[0]
+                    pose_src = self.pose_input_proj(src).flatten(2).permute(2, 0, 1)
+                    src_pos = pos[-1].flatten(2).permute(2, 0, 1)
+                    pose_mask = mask.flatten(1)
+                    pose_memory = self.pose_encoder(pose_src,
+                                                    src_key_padding_mask=pose_mask,
+                                                    pos=src_pos)
+
+                    pose_query = self.pose_query.weight.unsqueeze(1).repeat(1, bs,
+                                                                            1)
+                    for i in range(3):
+                        keypoint_query = self.pose_decoder[i](pose_query,
+                                                              pose_memory,
+                                                              memory_key_padding_mask=pose_mask,
+                                                              pos=src_pos,
+                                                              query_pos=None,
+                                                              last_layer=(i == 2),
+                                                              img_names=img_names)
+                        arms = self.arm_head(
+                            keypoint_query.transpose(0, 1)).sigmoid()
+                        arm_classes = self.arm_class(keypoint_query.transpose(0, 1))
+                        pose_out.update({
+                            '{}_arms'.format(i): arms,
+                            '{}_arm_score'.format(i): arm_classes,
+                        })
 
             memory_cache = self.transformer(
                 self.input_proj(src),
@@ -265,9 +273,9 @@ class MDETR(nn.Module):
             )
             out = {}
 
-            if RESERVE_QUERIES_FOR_ARMS:
-                hs_for_arm = hs[:, :, -NUM_RESERVED_QUERIES_FOR_ARMS:]
-                hs = hs[:, :, :-NUM_RESERVED_QUERIES_FOR_ARMS]
+            if self.config.reserve_queries_for_arms:
+                hs_for_arm = hs[:, :, -self.config.num_reserved_queries_for_arms:]
+                hs = hs[:, :, :-self.config.num_reserved_queries_for_arms]
             else:
                 hs_for_arm = hs
 
@@ -277,8 +285,9 @@ class MDETR(nn.Module):
             if encodings_of_tokenized is not None:
                 memory_cache['tokenized']._encodings = encodings_of_tokenized
 
-            outputs_class = self.class_embed(hs)
-            outputs_coord = self.bbox_embed(hs).sigmoid()
+            with profiling.region("model/box_heads"):
+                outputs_class = self.class_embed(hs)
+                outputs_coord = self.bbox_embed(hs).sigmoid()
             out.update(
                 {
                     "pred_logits": outputs_class[-1],
@@ -288,11 +297,12 @@ class MDETR(nn.Module):
             )
 
             # Predict eye and fingertip
-            if self.pose and not PREDICT_POSE_USING_A_DIFFERENT_MODEL:
-                outputs_eye = self.eye_embed(hs_for_arm).sigmoid()
-                outputs_fingertip = self.fingertip_embed(hs_for_arm).sigmoid()
-                arm_classes = self.unified_arm_class_embed(hs_for_arm)
-                arms = torch.cat([outputs_eye, outputs_fingertip], -1)
+            if self.pose and not self.config.predict_pose_using_a_different_model:
+                with profiling.region("model/pose_heads"):
+                    outputs_eye = self.eye_embed(hs_for_arm).sigmoid()
+                    outputs_fingertip = self.fingertip_embed(hs_for_arm).sigmoid()
+                    arm_classes = self.unified_arm_class_embed(hs_for_arm)
+                    arms = torch.cat([outputs_eye, outputs_fingertip], -1)
                 # this '2' was hard-coded by ***
                 i = 2
                 out.update({
@@ -596,15 +606,19 @@ class SetCriterion(nn.Module):
         2) we supervise each pair of matched ground-truth / prediction (supervise class and box)
     """
 
-    def __init__(self, num_classes, matcher, eos_coef, losses, temperature):
+    def __init__(self, num_classes, matcher, eos_coef, losses, temperature, config=None):
         """Create the criterion.
         Parameters:
             num_classes: number of object categories, omitting the special no-object category
             matcher: module able to compute a matching between targets and proposals
             eos_coef: relative classification weight applied to the no-object category
             losses: list of all the losses to be applied. See get_loss for list of available losses.
+            config: the RuntimeConfig of the arm box alignment loss, by default RuntimeConfig()
         """
         super().__init__()
+        self.config = config if config is not None else RuntimeConfig()
+        # sums of the cosine similarities of the boxes with the arms, with config.calculate_cos_sim
+        self.cos_sim_stats = {"image_count": 0, "gt_cos_sim": 0.0, "pred_cos_sim": 0.0}
         self.num_classes = num_classes
         self.matcher = matcher
         self.eos_coef = eos_coef
@@ -674,9 +688,47 @@ class SetCriterion(nn.Module):
 
         return losses
 
+    @staticmethod
+    def target_token_spans(tokenized, targets, device):
+        """Table [N, 4] of (image index, target index, first token, last token) of the token spans of every target,
+        on device. It only depends on the batch, so it is built once for the losses of all the decoder layers."""
+        spans = []
+        for i, tgt in enumerate(targets):
+            tokens = tgt["tokens_positive"] if "tokens_positive" in tgt else tgt["tokens"]
+            for j, tok_list in enumerate(tokens):
+                for (beg, end) in tok_list:
+                    span = char_span_to_token_span(tokenized, i, beg, end)
+                    if span is not None:
+                        spans.append((i, j, *span))
+        return torch.as_tensor(spans, dtype=torch.long).view(-1, 4).to(device, non_blocking=True)
+
+    @staticmethod
+    def query_token_map(token_spans, indices, num_targets, shape):
+        """Bool map of the given [BS, num_queries, num_tokens] shape such that map[k, i, j] = True iff query i is
+        matched to a target of batch item k with token j in its spans, built on the device of token_spans."""
+        bs, num_queries, num_tokens = shape
+        device = token_spans.device
+        matched = torch.stack([
+            torch.cat([torch.full_like(src, i) for i, (src, _) in enumerate(indices)]),
+            torch.cat([src for src, _ in indices]),
+            torch.cat([tgt for _, tgt in indices]),
+        ]).to(device, non_blocking=True)
+        # query matched to every target, -1 for the unmatched ones
+        query_of_target = torch.full((bs, max(num_targets, 1)), -1, dtype=torch.long, device=device)
+        query_of_target[matched[0], matched[2]] = matched[1]
+        query = query_of_target[token_spans[:, 0], token_spans[:, 1]]
+        # the spans of unmatched targets go to an extra row, dropped afterwards
+        rows = torch.where(query >= 0, token_spans[:, 0] * num_queries + query,
+                           torch.full_like(query, bs * num_queries))
+        tokens = torch.arange(num_tokens, device=device)
+        in_span = (tokens >= token_spans[:, 2:3]) & (tokens <= token_spans[:, 3:4])
+        counts = torch.zeros((bs * num_queries + 1, num_tokens), dtype=torch.long, device=device).index_add_(
+            0, rows, in_span.long())
+        return (counts[:-1] > 0).view(bs, num_queries, num_tokens)
+
     def loss_contrastive_align(self, outputs, targets, positive_map, indices,
-                               num_boxes):
-        bs = outputs["proj_queries"].shape[0]
+                               num_boxes, token_spans=None):
+        """token_spans: target_token_spans() of the batch, built here if not given"""
         tokenized = outputs["tokenized"]
 
         normalized_text_emb = outputs["proj_tokens"]  # BS x (num_tokens) x hdim
@@ -688,45 +740,17 @@ class SetCriterion(nn.Module):
         )  # BS x (num_queries) x (num_tokens)
 
         # construct a map such that positive_map[k, i,j] = True iff query i is associated to token j in batch item k
-        # For efficency, the construction happens on CPU, then the whole matrix is transferred to GPU in one go.
-        positive_map = torch.zeros(logits.shape, dtype=torch.bool)
-        for i, ((idx_src, idx_tgt), tgt) in enumerate(zip(indices, targets)):
-            if "tokens_positive" in tgt:
-                cur_tokens = [tgt["tokens_positive"][j] for j in idx_tgt]
-            else:
-                cur_tokens = [tgt["tokens"][j] for j in idx_tgt]
-
-            for j, tok_list in enumerate(cur_tokens):
-                for (beg, end) in tok_list:
-                    beg_pos = tokenized.char_to_token(i, beg)
-                    end_pos = tokenized.char_to_token(i, end - 1)
-                    if beg_pos is None:
-                        try:
-                            beg_pos = tokenized.char_to_token(beg + 1)
-                            if beg_pos is None:
-                                beg_pos = tokenized.char_to_token(beg + 2)
-                        except:
-                            beg_pos = None
-                    if end_pos is None:
-                        try:
-                            end_pos = tokenized.char_to_token(end - 2)
-                            if end_pos is None:
-                                end_pos = tokenized.char_to_token(end - 3)
-                        except:
-                            end_pos = None
-                    if beg_pos is None or end_pos is None:
-                        continue
-
-                    assert beg_pos is not None and end_pos is not None
-                    positive_map[i, idx_src[j], beg_pos: end_pos + 1].fill_(
-                        True)
-
-        positive_map = positive_map.to(logits.device)
-        positive_logits = -logits.masked_fill(~positive_map, 0)
+        # on the device, from the token spans of the targets and the matching
+        if token_spans is None:
+            token_spans = self.target_token_spans(tokenized, targets, logits.device)
+        num_targets = max(len(t["tokens_positive"] if "tokens_positive" in t else t["tokens"]) for t in targets)
+        positive_map = self.query_token_map(token_spans, indices, num_targets, logits.shape)
+        # a single masked copy of the logits serves both directions
+        positive_logits = logits * positive_map
         negative_logits = logits  # .masked_fill(positive_map, -1000000)
 
         boxes_with_pos = positive_map.any(2)
-        pos_term = positive_logits.sum(2)
+        pos_term = -positive_logits.sum(2)
         neg_term = negative_logits.logsumexp(2)
 
         nb_pos = positive_map.sum(2) + 1e-6
@@ -735,7 +759,7 @@ class SetCriterion(nn.Module):
             ((pos_term / nb_pos + neg_term)).masked_fill(~boxes_with_pos, 0).sum()
 
         tokens_with_pos = positive_map.any(1)
-        pos_term = positive_logits.sum(1)
+        pos_term = -positive_logits.sum(1)
         neg_term = negative_logits.logsumexp(1)
 
         nb_pos = positive_map.sum(1) + 1e-6
@@ -865,7 +889,9 @@ class SetCriterion(nn.Module):
 
         null_list = [i for i in range(bs) if targets[i]['arm'].shape[0] == 0]
 
-        if not USE_GT__ARM_FOR_ARM_BOX_ALIGN_LOSS and RESERVE_QUERIES_FOR_ARMS and not CALCULATE_COS_SIM:
+        config = self.config
+        if not config.use_gt__arm_for_arm_box_align_loss and config.reserve_queries_for_arms and \
+                not config.calculate_cos_sim:
             raise NotImplementedError()
 
         pred_arm = outputs['pred_arm'][idx[0]]
@@ -896,61 +922,37 @@ class SetCriterion(nn.Module):
         assert pred_arm.shape[0] == len(targets)
         assert target_arm.shape[0] == pred_arm.shape[0]
 
-        if USE_GT__ARM_FOR_ARM_BOX_ALIGN_LOSS:
-            if COS_SIM_VERTEX == 'EYE':
-                arm_tensor = target_arm[:, 2:4] - target_arm[:, 0:2]  # fingertip to eye
-                box_tensor = src_boxes[:, :2] - target_arm[:, 0:2]  # box center to eye
-            elif COS_SIM_VERTEX == 'FINGERTIP':
-                arm_tensor = target_arm[:, 2:4] - target_arm[:, 0:2]   # fingertip to eye
-                box_tensor = src_boxes[:, :2] - target_arm[:, 2:4]  # box center to fingertip
-            elif COS_SIM_VERTEX == 'OBJECT':
-                arm_tensor = target_arm[:, 0:2] - src_boxes[:, :2]  # eye to box center
-                box_tensor = target_arm[:, 2:4] - src_boxes[:, :2]  # fingertip to box center
-            else:
-                raise ValueError('Invalid COS_SIM_VERTEX')
+        if config.use_gt__arm_for_arm_box_align_loss:
+            arm_tensor, box_tensor = ray_vectors(target_arm, src_boxes[:, :2], config.cos_sim_vertex)
         else:
-            if COS_SIM_VERTEX != 'EYE':
-                raise NotImplementedError('Cosine similarity other than the eye is not implemented when USE_GT__ARM_FOR_ARM_BOX_ALIGN_LOSS == False')
-            arm_tensor = pred_arm[:, 2:4] - pred_arm[:, 0:2]  # eye to fingertip
-            box_tensor = src_boxes[:, :2] - pred_arm[:,
-                                            0:2]  # eye to box center
+            if config.cos_sim_vertex != 'EYE':
+                raise NotImplementedError('Cosine similarity other than the eye is not implemented without '
+                                          'use_gt__arm_for_arm_box_align_loss')
+            arm_tensor, box_tensor = ray_vectors(pred_arm, src_boxes[:, :2])
 
         # Cosine similarity between predicted eye-to-fingertip and eye-to-box
         assert (arm_tensor.shape[0] == box_tensor.shape[0])
         cos_sim = F.cosine_similarity(arm_tensor, box_tensor, dim=1)
 
         # Cosine similarities between ground truth eye-to-fingertip and eye-to-box
-        if COS_SIM_VERTEX == 'EYE':
-            gt_arm_tensor = target_arm[:, 2:4] - target_arm[:, 0:2]
-            gt_box_tensor = target_boxes[:, :2] - target_arm[:, 0:2]
-        elif COS_SIM_VERTEX == 'FINGERTIP':
-            gt_arm_tensor = target_arm[:, 2:4] - target_arm[:, 0:2]
-            gt_box_tensor = target_boxes[:, :2] - target_arm[:, 2:4]
-        elif COS_SIM_VERTEX == 'OBJECT':
-            gt_arm_tensor = target_arm[:, 0:2] - target_boxes[:, :2]
-            gt_box_tensor = target_arm[:, 2:4] - target_boxes[:, :2]
-        else:
-            raise ValueError('Invalid COS_SIM_VERTEX')
+        gt_arm_tensor, gt_box_tensor = ray_vectors(target_arm, target_boxes[:, :2], config.cos_sim_vertex)
         # Note: gt_cos_sim is 0 for indices in null_list
-        if CALCULATE_COS_SIM:
-            for i in range(len(gt_box_tensor)):
-                if i in null_list:
-                    continue
-                original_height, original_width = targets[i]['orig_size']
-                h_w_ratio = original_height / original_width
-                gt_arm_tensor[i][1] *= h_w_ratio
-                gt_box_tensor[i][1] *= h_w_ratio
+        if config.calculate_cos_sim:
+            image_sizes = torch.stack([t['orig_size'] for t in targets]).to(gt_arm_tensor.device)
+            image_sizes[null_list] = 1
+            gt_arm_tensor = aspect_scale(gt_arm_tensor, image_sizes)
+            gt_box_tensor = aspect_scale(gt_box_tensor, image_sizes)
         gt_cos_sim = F.cosine_similarity(gt_arm_tensor, gt_box_tensor, dim=1)
 
-        if CALCULATE_COS_SIM:
-            temp_vars.gt_cos_sim += gt_cos_sim.sum().item()
-            temp_vars.pred_cos_sim += cos_sim.sum().item()
-            temp_vars.image_count += gt_cos_sim.shape[0] - len(null_list)
+        if config.calculate_cos_sim:
+            self.cos_sim_stats["gt_cos_sim"] += gt_cos_sim.sum().item()
+            self.cos_sim_stats["pred_cos_sim"] += cos_sim.sum().item()
+            self.cos_sim_stats["image_count"] += gt_cos_sim.shape[0] - len(null_list)
 
-        if ARM_BOX_ALIGN_OFFSET_BY_GT:
+        if config.arm_box_align_offset_by_gt:
             offset = gt_cos_sim
         else:
-            offset = ARM_BOX_ALIGH_FIXED_OFFSET
+            offset = config.arm_box_aligh_fixed_offset
 
         relu = nn.ReLU()
         arm_box_aligned_loss = relu(offset - cos_sim).sum()
@@ -980,30 +982,44 @@ class SetCriterion(nn.Module):
                             postive_score.sum() + negtive_score.sum()))
         return contrastive_obj_loss
 
-    def forward(self, outputs, targets, positive_map, args=None):
+    @staticmethod
+    def get_num_boxes(targets, device):
+        """Average number of target boxes accross all nodes, for normalization purposes"""
+        num_boxes = sum(len(t["labels"]) for t in targets)
+        num_boxes = torch.as_tensor(num_boxes, dtype=torch.float, device=device)
+        if dist.is_dist_avail_and_initialized():
+            torch.distributed.all_reduce(num_boxes)
+        return torch.clamp(num_boxes / dist.get_world_size(), min=1)
+
+    def forward(self, outputs, targets, positive_map, args=None, num_boxes=None):
         """This performs the loss computation.
         Parameters:
              outputs: dict of tensors, see the output specification of the model for the format
              targets: list of dicts, such that len(targets) == batch_size.
                       The expected keys in each dict depends on the losses applied, see each loss' doc
+             num_boxes: normalization of the losses, by default get_num_boxes(targets). With gradient
+                        accumulation, the normalization of the whole batch rather than of the micro-batch.
         """
 
         # TODO: bug. Remove arm aux outputs
         outputs_without_aux = {k: v for k, v in outputs.items() if
                                k != "aux_outputs"}
 
-        if ARGS_POSE and 'pred_arm' not in outputs_without_aux.keys():
+        if self.config.args_pose and 'pred_arm' not in outputs_without_aux.keys():
             raise RuntimeError('missing predicted arm from outputs')
         # Retrieve the matching between the outputs of the last layer and the targets
-        indices = self.matcher(outputs_without_aux, targets, positive_map)
+        with profiling.region("criterion/matcher", host=True):
+            indices = self.matcher(outputs_without_aux, targets, positive_map)
 
-        # Compute the average number of target boxes accross all nodes, for normalization purposes
-        num_boxes = sum(len(t["labels"]) for t in targets)
-        num_boxes = torch.as_tensor([num_boxes], dtype=torch.float,
-                                    device=next(iter(outputs.values())).device)
-        if dist.is_dist_avail_and_initialized():
-            torch.distributed.all_reduce(num_boxes)
-        num_boxes = torch.clamp(num_boxes / dist.get_world_size(), min=1).item()
+        if num_boxes is None:
+            num_boxes = self.get_num_boxes(targets, next(iter(outputs.values())).device)
+
+        # the token spans of the targets are shared by the contrastive alignment losses of all the layers
+        align_kwargs = {}
+        if "contrastive_align" in self.losses:
+            with profiling.region("criterion/token_spans", host=True):
+                align_kwargs["token_spans"] = self.target_token_spans(outputs["tokenized"], targets,
+                                                                      outputs["proj_queries"].device)
 
         # Compute all the requested losses
         losses = {}
@@ -1012,53 +1028,70 @@ class SetCriterion(nn.Module):
         # losses.update({'contrastive_obj_loss':contrastive_obj_loss})
 
         if 'pred_arm' in outputs:
-            arm_box_aligned_loss = self.arm_box_aligned_loss(outputs, targets,
-                                                             indices)
+            with profiling.region("criterion/arm_box_aligned"):
+                arm_box_aligned_loss = self.arm_box_aligned_loss(outputs, targets,
+                                                                 indices)
             losses.update({'arm_box_aligned_loss': arm_box_aligned_loss})
 
         for loss in self.losses:
-            losses.update(
-                self.get_loss(loss, outputs, targets, positive_map, indices,
-                              num_boxes, args=args))
+            with profiling.region(f"criterion/{loss}"):
+                losses.update(
+                    self.get_loss(loss, outputs, targets, positive_map, indices,
+                                  num_boxes, args=args,
+                                  **(align_kwargs if loss == "contrastive_align" else {})))
 
         # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
         if "aux_outputs" in outputs:
             for i, aux_outputs in enumerate(outputs["aux_outputs"]):
-                indices = self.matcher(aux_outputs, targets, positive_map,
-                                       aux=True)
+                with profiling.region("criterion/matcher", host=True):
+                    indices = self.matcher(aux_outputs, targets, positive_map,
+                                           aux=True)
                 for loss in self.losses:
                     if loss == "masks":
                         # Intermediate masks losses are too costly to compute, we ignore them.
                         continue
-                    kwargs = {}
-                    l_dict = self.get_loss(loss, aux_outputs, targets,
-                                           positive_map, indices, num_boxes,
-                                           **kwargs)
+                    kwargs = align_kwargs if loss == "contrastive_align" else {}
+                    with profiling.region(f"criterion/{loss}"):
+                        l_dict = self.get_loss(loss, aux_outputs, targets,
+                                               positive_map, indices, num_boxes,
+                                               **kwargs)
                     l_dict = {k + f"_{i}": v for k, v in l_dict.items()}
                     losses.update(l_dict)
 
         return losses
 
 
-def get_pose_loss(arm, arm_class, target_arm, idx=0):
-    loss_scaling_factor_for_missing_annotations = 1
+def get_pose_loss_scaling_factor(target_arm, config=None):
+    """Fraction of the images of the batch with an eye to fingertip annotation, which normalizes the arm score loss.
+
+    A tensor on the device of the targets, so that the host does not wait for the device.
+    """
+    config = config if config is not None else RuntimeConfig()
+    if not config.replace_arm_with_eye_to_fingertip:
+        return 1
+    num_images_with_missing_annotations = torch.stack([(k < 0).any() for k in target_arm]).sum()
+    return (len(target_arm) - num_images_with_missing_annotations) / len(target_arm)
+
+
+def get_pose_loss(arm, arm_class, target_arm, idx=0, loss_scaling_factor=None, config=None):
+    """Arm losses of one decoder layer, with the coefficients of config (by default RuntimeConfig()).
+
+    loss_scaling_factor defaults to get_pose_loss_scaling_factor(target_arm). With gradient accumulation,
+    it is the factor of the whole batch rather than of the micro-batch.
+    """
+    config = config if config is not None else RuntimeConfig()
+    if loss_scaling_factor is None:
+        loss_scaling_factor = get_pose_loss_scaling_factor(target_arm, config)
+    loss_scaling_factor_for_missing_annotations = loss_scaling_factor
 
     # Handle missing eye to fingertip annotations in the yourefit valid set
-    if REPLACE_ARM_WITH_EYE_TO_FINGERTIP:
-        # Determine which images in the batch do not have eye to fingertip annotations
-        missing_eye_to_fingertip_annotations = [bool((k < 0).sum() > 0) for k in
-                                                target_arm]
-        # Handle missing annotations by setting predictions equal to targets
-        for i in range(len(missing_eye_to_fingertip_annotations)):
-            if missing_eye_to_fingertip_annotations[i]:
-                arm[i] = target_arm[i].repeat(arm.shape[1], 1)
-        num_images_with_missing_annotations = 0
-        for i in range(len(missing_eye_to_fingertip_annotations)):
-            if missing_eye_to_fingertip_annotations[i]:
-                num_images_with_missing_annotations += 1
-        loss_scaling_factor_for_missing_annotations = (
-                                                                  len(target_arm) - num_images_with_missing_annotations) / len(
-            target_arm)
+    if config.replace_arm_with_eye_to_fingertip:
+        # Handle missing annotations by setting predictions equal to targets,
+        # selected on the device rather than branching on the host
+        for i in range(len(target_arm)):
+            if target_arm[i].shape[0] > 0:
+                arm[i] = torch.where((target_arm[i] < 0).any(),
+                                     target_arm[i].repeat(arm.shape[1], 1), arm[i])
 
     bs, num = arm.shape[0], arm.shape[1]
     null_list = [i for i in range(bs) if target_arm[i].shape[0] == 0]
@@ -1066,7 +1099,7 @@ def get_pose_loss(arm, arm_class, target_arm, idx=0):
         target_arm[i] = torch.tensor([[0.0, 0.0, 1.0, 1.0]]).to(arm.device)
 
     target_arm = torch.cat(target_arm, 0)
-    if PREDICT_POSE_USING_A_DIFFERENT_MODEL:
+    if config.predict_pose_using_a_different_model:
         l1_dist = F.l1_loss(arm, target_arm.unsqueeze(1).repeat(1, 10, 1),
                             reduction='none').sum(dim=2) # Hard-coded by ***
     else:
@@ -1075,7 +1108,7 @@ def get_pose_loss(arm, arm_class, target_arm, idx=0):
         l1_dist = F.l1_loss(arm, expanded_target_arm, reduction='none').sum(dim=2)
     min_dist, min_idx = torch.min(l1_dist, dim=1)
 
-    cls_weights = ARM_SCORE_CLASS_WEIGHTS # It was hard-coded by *** as [0.2, 0.8]
+    cls_weights = list(config.arm_score_class_weights) # It was hard-coded by *** as [0.2, 0.8]
     class_criterion = nn.CrossEntropyLoss(
         torch.Tensor(cls_weights).to(arm.device), reduction='none')
     arm_cls_label = torch.zeros((bs, num), dtype=torch.long).to(arm.device)
@@ -1094,7 +1127,7 @@ def get_pose_loss(arm, arm_class, target_arm, idx=0):
                              num * loss_scaling_factor_for_missing_annotations)
 
     # Total loss
-    pose_loss = ARM_LOSS_COEF * arm_loss + ARM_SCORE_LOSS_COEF * score_loss
+    pose_loss = config.arm_loss_coef * arm_loss + config.arm_score_loss_coef * score_loss
 
     # Predicted arm
     arm = arm.unsqueeze(2)
@@ -1123,7 +1156,11 @@ class MLP(nn.Module):
         return x
 
 
-def build(args):
+def build(args, pretrained=True, config=None):
+    """The model, criterions and loss weights of args and of the RuntimeConfig config (by default RuntimeConfig()).
+    With pretrained False, the backbone and text encoder are built without their pretrained weights, on the meta
+    device, to be materialized from a checkpoint (models.meta_init)."""
+    config = config if config is not None else RuntimeConfig()
     num_classes = 255
     device = torch.device(args.device)
 
@@ -1131,10 +1168,10 @@ def build(args):
 
     qa_dataset = None
 
-    backbone = build_backbone(args)
+    backbone = build_backbone(args, pretrained)
 
-    transformer = build_transformer(args)
-    if REMOVE_LANGUAGE_BY_SETTING_CAPTION_TO_NONE:
+    transformer = build_transformer(args, pretrained, config)
+    if config.remove_language_by_setting_caption_to_none:
         args.contrastive_align_loss = False
     else:
         args.contrastive_align_loss = True
@@ -1150,7 +1187,8 @@ def build(args):
         qa_dataset=qa_dataset,
         split_qa_heads=args.split_qa_heads,
         predict_final=args.predict_final,
-        pose=args.pose
+        pose=args.pose,
+        config=config
     )
     if args.mask_model != "none":
         model = DETRsegm(
@@ -1163,7 +1201,7 @@ def build(args):
                    "loss_bbox": args.bbox_loss_coef}
     for i in range(3):
         weight_dict['pose_loss_{0}'.format(i)] = 1
-    weight_dict['arm_box_aligned_loss'] = ARM_BOX_ALIGN_LOSS_COEF
+    weight_dict['arm_box_aligned_loss'] = config.arm_box_align_loss_coef
     weight_dict['contrastive_obj_loss'] = 1
     if args.contrastive_loss:
         weight_dict["contrastive_loss"] = args.contrastive_loss_coef
@@ -1201,6 +1239,7 @@ def build(args):
             eos_coef=args.eos_coef,
             losses=losses,
             temperature=args.temperature_NCE,
+            config=config,
         )
         criterion.to(device)
 
@@ -1215,6 +1254,19 @@ def build(args):
     return model, criterion, contrastive_criterion, qa_criterion, weight_dict
 
 
+def inference_unused_prefixes(args, config=None):
+    """Prefixes of the state dict keys of the model of build(args, config=config) that no prediction depends on: the
+    heads of the training losses and the modules whose outputs are never used, stripped from inference checkpoints."""
+    config = config if config is not None else RuntimeConfig()
+    # the removed modules and the text pooler are only in the checkpoints of earlier versions
+    prefixes = [name + "." for name in MDETR.removed_modules] + ["transformer.text_encoder.pooler."]
+    if args.contrastive_loss:
+        prefixes += ["contrastive_projection_image.", "contrastive_projection_text."]
+    if getattr(args, "mask_model", "none") != "none":
+        prefixes = ["detr." + prefix for prefix in prefixes]
+    return prefixes
+
+
 if __name__ == '__main__':
     pe = ConstrainedLearnablePE(512, 10)
     pe(0.1, 0.1, 0.2, 0.2)
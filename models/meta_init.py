@@ -0,0 +1,91 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Building the pretrained submodules of MDETR without their pretrained weights, when a checkpoint holds them.
+
+The ResNet backbone and the RoBERTa text encoder are otherwise downloaded (or read from the cache) and initialized,
+only for --load or --resume to overwrite their weights. In skip_init, the parameters of the modules are created on
+the meta device, without memory nor initialization, and materialize later gives them the tensors of the checkpoint.
+The buffers are still created, as some of them (e.g. the position ids of RoBERTa) are not in the state dicts.
+"""
+import contextlib
+
+import torch
+from torch import nn
+
+
+def meta_device_available():
+    try:
+        torch.empty(0, device="meta")
+    except (RuntimeError, TypeError):
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def skip_init(enabled=True):
+    """Create the parameters of the modules built in this context on the meta device.
+
+    The initialization of these parameters does not compute anything. Without meta device support, the parameters
+    are created and initialized as usual.
+    """
+    if not enabled or not meta_device_available():
+        yield
+        return
+    register_parameter = nn.Module.register_parameter
+
+    def register_meta_parameter(module, name, param):
+        register_parameter(module, name, param)
+        if param is not None:
+            module._parameters[name] = nn.Parameter(param.to("meta"), requires_grad=param.requires_grad)
+
+    nn.Module.register_parameter = register_meta_parameter
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = register_parameter
+
+
+def has_meta_parameters(model):
+    return any(p.is_meta for p in model.parameters())
+
+
+@torch.no_grad()
+def materialize(model, state_dict, report=True):
+    """Replace the meta parameters of model by the tensors of state_dict, without copying them when they have the
+    dtype of the parameter.
+
+    The meta parameters without a tensor in state_dict (e.g. the text pooler removed from inference checkpoints)
+    are initialized by the reset_parameters of their module, or to zero. Returns their names, also printed with
+    report.
+    """
+    uninitialized = []
+    for module_name, module in model.named_modules():
+        reset = False
+        for name, param in list(module._parameters.items()):
+            if param is None or not param.is_meta:
+                continue
+            key = module_name + "." + name if module_name else name
+            if key in state_dict:
+                tensor = state_dict[key]
+                if tensor.shape != param.shape:
+                    raise RuntimeError(f"{key} has shape {tuple(tensor.shape)} in the checkpoint, "
+                                       f"{tuple(param.shape)} in the model")
+                tensor = tensor.to(device="cpu", dtype=param.dtype)
+            else:
+                tensor = torch.zeros(param.shape, dtype=param.dtype)
+                uninitialized.append(key)
+                reset = True
+            module._parameters[name] = nn.Parameter(tensor, requires_grad=param.requires_grad)
+        if reset and hasattr(module, "reset_parameters"):
+            module.reset_parameters()
+    if uninitialized and report:
+        print(f"WARNING: {len(uninitialized)} pretrained parameters are not in the checkpoint, initialized from "
+              f"scratch: {uninitialized}")
+    return uninitialized
+
+
+def load_weights(model, state_dict):
+    """model.load_state_dict(state_dict, strict=False), for models built with skip_init too."""
+    if has_meta_parameters(model):
+        materialize(model, state_dict)
+    return model.load_state_dict(state_dict, strict=False)
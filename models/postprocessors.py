@@ -10,11 +10,8 @@ import torch
 import torch.nn.functional as F
 from torch import nn
 
-from util import box_ops
-
-import sys
-sys.path.append('..')
-from magic_numbers import *
+from util import box_ops, ray_ops
+from util.runtime_config import RuntimeConfig
 
 global img_token_pairs
 img_token_pairs = {}
@@ -130,79 +127,116 @@ class PostProcessPhrasecut(nn.Module):
         return final_results
 
 
+def char_span_to_token_span(tokenized, i, beg, end):
+    """(first token, last token) of the characters [beg, end) of the caption i of a tokenized batch, or None.
+
+    Characters that do not map to a token are retried on the neighbouring characters, as MDETR does. As in MDETR,
+    the retries look the characters up in the first caption of the batch.
+    """
+    beg_pos = tokenized.char_to_token(i, beg)
+    end_pos = tokenized.char_to_token(i, end - 1)
+    if beg_pos is None:
+        try:
+            beg_pos = tokenized.char_to_token(beg + 1)
+            if beg_pos is None:
+                beg_pos = tokenized.char_to_token(beg + 2)
+        except:
+            beg_pos = None
+    if end_pos is None:
+        try:
+            end_pos = tokenized.char_to_token(end - 2)
+            if end_pos is None:
+                end_pos = tokenized.char_to_token(end - 3)
+        except:
+            end_pos = None
+    if beg_pos is None or end_pos is None:
+        return None
+    return beg_pos, end_pos
+
+
+def token_offsets(tokenized, device):
+    """Table [B, T, 2] of the (first, past the last) characters of the tokens of a tokenized batch, on device: the
+    offset_mapping the Transformer asks the tokenizer for, or else the offsets of its encodings.
+
+    Special tokens and padding have the empty range (0, 0), which holds no character.
+    """
+    if "offset_mapping" in tokenized:
+        return tokenized["offset_mapping"].to(device, non_blocking=True)
+    return torch.as_tensor([encoding.offsets for encoding in tokenized.encodings], dtype=torch.long,
+                           device=device).view(len(tokenized.encodings), -1, 2)
+
+
+def char_spans_to_token_spans(offsets, char_spans):
+    """char_span_to_token_span of every row (caption, first character, past the last character) of char_spans
+    [N, 3], given the token_offsets of the batch, on their device without synchronizing with it.
+
+    Returns [N, 3] of (caption, first token, last token). The spans that map to no token get an empty token range.
+    """
+    caption, beg, end = char_spans.unbind(1)
+    first = torch.zeros_like(caption)
+    # the characters looked up, in the order of char_span_to_token_span: the retries are in the first caption
+    captions = torch.stack([caption, first, first, caption, first, first], 1)
+    chars = torch.stack([beg, beg + 1, beg + 2, end - 1, end - 2, end - 3], 1)[..., None]
+    token_ranges = offsets[captions]
+    # as char_to_token, the first token whose range holds the character
+    found = (token_ranges[..., 0] <= chars) & (chars < token_ranges[..., 1])
+    tokens = found.long().argmax(2)
+    found = found.any(2).view(-1, 2, 3)
+    # the first character of each end that was found
+    tokens = tokens.view(-1, 2, 3).gather(2, found.long().argmax(2, keepdim=True))[..., 0]
+    mapped = found.any(2).all(1)
+    beg_token = torch.where(mapped, tokens[:, 0], torch.ones_like(caption))
+    end_token = torch.where(mapped, tokens[:, 1], torch.zeros_like(caption))
+    return torch.stack([caption, beg_token, end_token], 1)
+
+
 class PostProcess(nn.Module):
-    """ This module converts the model's output into the format expected by the coco api"""
+    """ This module converts the model's output into the format expected by the coco api
 
+    With rerank_top_k > 0 and arm predictions, each result also holds the alignment of every box with the
+    top predicted arm and the top-k boxes reranked by score * ((1 + alignment) / 2) ** alignment_weight.
+    Both default to those of config, by default RuntimeConfig().
+    """
+
+    def __init__(self, rerank_top_k=None, alignment_weight=None, config=None):
+        super().__init__()
+        self.config = config if config is not None else RuntimeConfig()
+        self.rerank_top_k = rerank_top_k if rerank_top_k is not None else self.config.alignment_rerank_top_k
+        self.alignment_weight = alignment_weight if alignment_weight is not None else \
+            self.config.alignment_rerank_weight
+
+    @staticmethod
+    def positive_token_spans(tokenized, targets, device):
+        """Table [N, 3] of (image index, first token, last token) of the spans of the first target of every image,
+        on device, from the character offsets of the tokens (char_spans_to_token_spans)."""
+        char_spans = [(i, beg, end) for i, tgt in enumerate(targets)
+                      for (beg, end) in (tgt["tokens_positive"] if "tokens_positive" in tgt else tgt["tokens"])[0]]
+        char_spans = torch.as_tensor(char_spans, dtype=torch.long).view(-1, 3).to(device, non_blocking=True)
+        return char_spans_to_token_spans(token_offsets(tokenized, device), char_spans)
 
     # Compute the alignment between box and text
     def loss_contrastive_align(self, outputs, targets, temperature=0.07):
 
-        if REMOVE_LANGUAGE_BY_SETTING_CAPTION_TO_NONE:
+        if self.config.remove_language_by_setting_caption_to_none:
             return torch.zeros([outputs['pred_boxes'].shape[0], outputs['pred_boxes'].shape[1]])
 
-        # Construct dummy indices
-        bs = outputs["proj_queries"].shape[0]
-        indices = []
-        for i in range(bs):
-            query_index = torch.tensor([0])
-            target_index = torch.tensor([0])
-            index_pair = (query_index, target_index)
-            indices.append(index_pair)
-
-        num_queries = outputs['pred_boxes'].shape[1]
-        num_boxes = num_queries * bs
-
         # Compute logits
-        tokenized = outputs["tokenized"]
         normalized_text_emb = outputs["proj_tokens"]
         normalized_img_emb = outputs["proj_queries"]
         logits = (
                 torch.matmul(normalized_img_emb,
                              normalized_text_emb.transpose(-1, -2)) / temperature
         )
+        bs, num_queries, num_tokens = logits.shape
 
-        # Construct positive map using dummy indices.
-        positive_map = torch.zeros(logits.shape, dtype=torch.bool)
-        for i, ((idx_src, idx_tgt), tgt) in enumerate(zip(indices, targets)):
-            if "tokens_positive" in tgt:
-                cur_tokens = [tgt["tokens_positive"][j] for j in idx_tgt]
-            else:
-                cur_tokens = [tgt["tokens"][j] for j in idx_tgt]
-
-            for j, tok_list in enumerate(cur_tokens):
-                for (beg, end) in tok_list:
-                    beg_pos = tokenized.char_to_token(i, beg)
-                    end_pos = tokenized.char_to_token(i, end - 1)
-                    if beg_pos is None:
-                        try:
-                            beg_pos = tokenized.char_to_token(beg + 1)
-                            if beg_pos is None:
-                                beg_pos = tokenized.char_to_token(beg + 2)
-                        except:
-                            beg_pos = None
-                    if end_pos is None:
-                        try:
-                            end_pos = tokenized.char_to_token(end - 2)
-                            if end_pos is None:
-                                end_pos = tokenized.char_to_token(end - 3)
-                        except:
-                            end_pos = None
-                    if beg_pos is None or end_pos is None:
-                        continue
-
-                    assert beg_pos is not None and end_pos is not None
-                    positive_map[i, idx_src[j], beg_pos: end_pos + 1].fill_(
-                        True)
-
-        # Process the positive_map created using dummy indices
-        # so that all queries for one image are matched to the same tokens
-        positive_map_for_each_image = []
-        for image_index in range(positive_map.shape[0]):
-            positive_map_for_current_image = \
-                positive_map[image_index][0].repeat(num_queries,1)
-            positive_map_for_each_image.append(positive_map_for_current_image)
-        positive_map = torch.stack(positive_map_for_each_image)
-        positive_map = positive_map.to(logits.device)
+        # All queries of an image are matched to the tokens of its first target:
+        # build one [bs, num_tokens] positive map on the device and broadcast it over the queries
+        spans = self.positive_token_spans(outputs["tokenized"], targets, logits.device)
+        tokens = torch.arange(num_tokens, device=logits.device)
+        in_span = (tokens >= spans[:, 1:2]) & (tokens <= spans[:, 2:3])
+        positive_map = torch.zeros((bs, num_tokens), dtype=torch.long, device=logits.device).index_add_(
+            0, spans[:, 0], in_span.long()) > 0
+        positive_map = positive_map[:, None, :]
 
         # Fill positions for un-matched tokens with 0
         positive_logits = -logits.masked_fill(~positive_map, 0)
@@ -224,10 +258,6 @@ class PostProcess(nn.Module):
 
         return raw_box_to_token_loss
 
-
-
-
-
     @torch.no_grad()
     def forward(self, outputs, target_sizes, img_names=None, targets=None):
         """Perform the computation
@@ -239,7 +269,7 @@ class PostProcess(nn.Module):
         """
 
         # Call the function that computes the alignment between box and text
-        if REMOVE_LANGUAGE_BY_SETTING_CAPTION_TO_NONE:
+        if self.config.remove_language_by_setting_caption_to_none:
             align_cost = self.loss_contrastive_align(outputs, targets)
         else:
             align_cost = self.loss_contrastive_align(outputs, targets)
@@ -273,11 +303,28 @@ class PostProcess(nn.Module):
             arms, arm_scores = outputs["2_arms"], outputs["2_arm_score"]
             arms = arms * scale_fct[:, None, :]
             # arm_prob = F.softmax(arm_scores, -1)
+            arm_probs = arm_scores.softmax(dim=2)[:, :, 1]
             for i in range(len(results)):
                 results[i]['arms'] = arms[i]
-                results[i]['arms_scores'] = arm_scores.softmax(dim=2)[i, :, 1]
+                results[i]['arms_scores'] = arm_probs[i]
+            if self.rerank_top_k > 0:
+                self.rerank(results, scores, boxes, arms, arm_probs)
         return results
 
+    def rerank(self, results, scores, boxes, arms, arm_probs):
+        """Add the alignment-reranked top-k boxes to results, for the whole batch at once."""
+        top_arm = arms.gather(1, arm_probs.argmax(1)[:, None, None].expand(-1, 1, 4))
+        # boxes and arms are in pixels, so the plain cosine is already measured in the original image
+        alignment = ray_ops.arm_box_alignment(boxes, top_arm)["cos_sim"][..., 0]
+        rerank_scores = scores * ((1 + alignment) / 2) ** self.alignment_weight
+        top_scores, top_indices = rerank_scores.topk(min(self.rerank_top_k, rerank_scores.shape[1]), dim=1)
+        top_boxes = boxes.gather(1, top_indices[..., None].expand(-1, -1, 4))
+        for i in range(len(results)):
+            results[i]['alignment'] = alignment[i]
+            results[i]['rerank_scores'] = top_scores[i]
+            results[i]['rerank_indices'] = top_indices[i]
+            results[i]['rerank_boxes'] = top_boxes[i]
+
 
 class PostProcessSegm(nn.Module):
     """Similar to PostProcess but for segmentation masks.
@@ -337,8 +384,8 @@ class PostProcessSegm(nn.Module):
         return results
 
 
-def build_postprocessors(args, dataset_name) -> Dict[str, nn.Module]:
-    postprocessors: Dict[str, nn.Module] = {"bbox": PostProcess()}
+def build_postprocessors(args, dataset_name, config=None) -> Dict[str, nn.Module]:
+    postprocessors: Dict[str, nn.Module] = {"bbox": PostProcess(config=config)}
     if args.masks:
         postprocessors["segm"] = PostProcessSegm()
 
@@ -12,21 +12,18 @@ Copy-paste from torch.nn.Transformer with modifications:
     * decoder returns a stack of activations from all decoding layers
 """
 import copy
+from functools import partial
 from typing import List, Optional
 
 import torch
 import torch.nn.functional as F
 from torch import Tensor, nn
-from transformers import RobertaModel, RobertaTokenizerFast
+from transformers import RobertaModel
 
-import sys
-sys.path.append('..')
-from magic_numbers import *
-
-global img_names
-global img_token_size
-global img_attn_pairs
-img_attn_pairs = {}
+from util import profiling, text_assets
+from util.runtime_config import RuntimeConfig
+from .checkpointing import checkpoint, is_checkpointing
+from .meta_init import skip_init
 
 
 class Transformer(nn.Module):
@@ -45,9 +42,15 @@ class Transformer(nn.Module):
             text_encoder_type="roberta-base",
             freeze_text_encoder=False,
             contrastive_loss=False,
-            no_text=False
+            no_text=False,
+            pretrained=True,
+            config=None
     ):
         super().__init__()
+        self.config = config if config is not None else RuntimeConfig()
+        # tokenized captions and text encoder outputs by captions, shared by models with the same text encoder
+        # weights when it is a dict (sweep.py), to be set in eval mode only
+        self.text_cache = None
 
         self.pass_pos_and_query = pass_pos_and_query
         encoder_layer = TransformerEncoderLayer(d_model, nhead, dim_feedforward,
@@ -70,10 +73,15 @@ class Transformer(nn.Module):
 
         self._reset_parameters()
 
+        self.text_encoder_type = text_encoder_type
         if not no_text:
-            self.tokenizer = RobertaTokenizerFast.from_pretrained(
-                text_encoder_type)
-            self.text_encoder = RobertaModel.from_pretrained(text_encoder_type)
+            # the pooled output of the text encoder is only used by the contrastive loss
+            if pretrained:
+                self.text_encoder = text_assets.text_encoder(text_encoder_type, add_pooling_layer=contrastive_loss)
+            else:
+                with skip_init():
+                    self.text_encoder = RobertaModel(text_assets.text_encoder_config(text_encoder_type),
+                                                     add_pooling_layer=contrastive_loss)
 
             if freeze_text_encoder:
                 for p in self.text_encoder.parameters():
@@ -90,11 +98,24 @@ class Transformer(nn.Module):
         self.d_model = d_model
         self.nhead = nhead
 
+    @property
+    def tokenizer(self):
+        # shared by the process (util.text_assets), so that the EMA model does not copy it
+        return text_assets.tokenizer(self.text_encoder_type)
+
     def _reset_parameters(self):
         for p in self.parameters():
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of earlier versions have a text pooler without the contrastive loss
+        if self.CLS is None:
+            pooler = prefix + "text_encoder.pooler."
+            for key in [key for key in state_dict if key.startswith(pooler)]:
+                del state_dict[key]
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(
             self,
             src=None,
@@ -140,18 +161,28 @@ class Transformer(nn.Module):
 
             device = src.device
 
-            if REMOVE_LANGUAGE_BY_SETTING_CAPTION_TO_NONE:
+            if self.config.remove_language_by_setting_caption_to_none:
                 text = None
 
             if text is None:
                 text_attention_mask, text_memory_resized, tokenized = None, None, None
             elif isinstance(text[0], str):
-                # Encode the text
-                tokenized = self.tokenizer.batch_encode_plus(text,
-                                                             padding="longest",
-                                                             return_tensors="pt").to(
-                    device)
-                encoded_text = self.text_encoder(**tokenized)
+                cached = self.text_cache.get(tuple(text)) if self.text_cache is not None else None
+                if cached is not None:
+                    tokenized, encoded_text = cached
+                else:
+                    # Encode the text, with the character offsets of the tokens for the postprocessors
+                    with profiling.region("model/tokenizer", host=True), text_assets.tokenizer_lock:
+                        tokenized = self.tokenizer.batch_encode_plus(text,
+                                                                     padding="longest",
+                                                                     return_offsets_mapping=True,
+                                                                     return_tensors="pt")
+                    tokenized = tokenized.to(device)
+                    with profiling.region("model/text_encoder"):
+                        encoded_text = self.text_encoder(input_ids=tokenized.input_ids,
+                                                         attention_mask=tokenized.attention_mask)
+                    if self.text_cache is not None:
+                        self.text_cache[tuple(text)] = tokenized, encoded_text
 
                 # Transpose memory because pytorch's attention expects sequence first
                 text_memory = encoded_text.last_hidden_state.transpose(0, 1)
@@ -164,7 +195,6 @@ class Transformer(nn.Module):
                 # The text is already encoded, use as is.
                 text_attention_mask, text_memory_resized, tokenized = text
 
-            global img_token_size
             img_token_size = src.shape[0]
 
             if text is not None:
@@ -176,11 +206,12 @@ class Transformer(nn.Module):
                 pos_embed = torch.cat(
                     [pos_embed, torch.zeros_like(text_memory_resized)], dim=0)
 
-            img_memory = self.encoder(src, src_key_padding_mask=mask,
-                                      pos=pos_embed)
+            with profiling.region("model/encoder"):
+                img_memory = self.encoder(src, src_key_padding_mask=mask,
+                                          pos=pos_embed)
 
             if text is not None:
-                text_memory = img_memory[-len(text_memory_resized):]
+                text_memory = img_memory[-text_memory_resized.shape[0]:]
             else:
                 text_memory = None
             if text_memory is not None:
@@ -210,26 +241,26 @@ class Transformer(nn.Module):
 
             # assert img_memory.shape[1] == text_memory.shape[1] == tgt.shape[1]
 
-            if img_name is not None:
-                global img_names
-                img_names = img_name
-
             if arm_query_embed is not None:
                 query_embed = arm_query_embed.permute(1, 0, 2)
 
-            hs = self.decoder(
-                tgt,
-                img_memory,
-                text_memory,
-                memory_key_padding_mask=mask,
-                text_memory_key_padding_mask=text_attention_mask,
-                pos=pos_embed,
-                query_pos=query_embed,
-            )
+            with profiling.region("model/decoder"):
+                hs = self.decoder(
+                    tgt,
+                    img_memory,
+                    text_memory,
+                    memory_key_padding_mask=mask,
+                    text_memory_key_padding_mask=text_attention_mask,
+                    pos=pos_embed,
+                    query_pos=query_embed,
+                )
             return hs.transpose(1, 2)
 
 
 class TransformerEncoder(nn.Module):
+    # Set to True by models.checkpointing to checkpoint each layer
+    checkpoint_layers = False
+
     def __init__(self, encoder_layer, num_layers, norm=None):
         super().__init__()
         self.layers = _get_clones(encoder_layer, num_layers)
@@ -247,6 +278,8 @@ class TransformerEncoder(nn.Module):
         output = src
 
         for layer in self.layers:
+            if self.checkpoint_layers and is_checkpointing(self):
+                layer = partial(checkpoint, layer)
             output = layer(output, src_mask=mask,
                            src_key_padding_mask=src_key_padding_mask, pos=pos)
 
@@ -257,6 +290,9 @@ class TransformerEncoder(nn.Module):
 
 
 class TransformerDecoder(nn.Module):
+    # Set to True by models.checkpointing to checkpoint each layer
+    checkpoint_layers = False
+
     def __init__(self, decoder_layer, num_layers, norm=None,
                  return_intermediate=False):
         super().__init__()
@@ -284,6 +320,8 @@ class TransformerDecoder(nn.Module):
 
         for layer_num in range(len(self.layers)):
             layer = self.layers[layer_num]
+            if self.checkpoint_layers and is_checkpointing(self):
+                layer = partial(checkpoint, layer)
             output = layer(
                 output,
                 memory,
@@ -573,7 +611,7 @@ def _get_clones(module, N):
     return nn.ModuleList([copy.deepcopy(module) for i in range(N)])
 
 
-def build_transformer(args):
+def build_transformer(args, pretrained=True, config=None):
     return Transformer(
         d_model=args.hidden_dim,
         dropout=args.dropout,
@@ -587,7 +625,9 @@ def build_transformer(args):
         text_encoder_type=args.text_encoder_type,
         freeze_text_encoder=args.freeze_text_encoder,
         contrastive_loss=args.contrastive_loss,
-        no_text=not args.contrastive_align_loss
+        no_text=not args.contrastive_align_loss,
+        pretrained=pretrained,
+        config=config
     )
 
 
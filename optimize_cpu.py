@@ -0,0 +1,179 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Export a CPU-optimized inference model and benchmark it against the original checkpoint.
+
+The frozen batch norms of the backbone are folded into the convolutions, the backbone is converted
+to channels-last and the linears of the transformer and text encoder are dynamically quantized to int8.
+
+Example:
+    python optimize_cpu.py --dataset_config configs/yourefit.json --load pretrained/best_etf.pth \
+        --deploy_output pretrained/best_etf_cpu.pth --benchmark_samples 100
+"""
+import argparse
+import json
+import time
+from copy import deepcopy
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+
+from datasets.coco import make_coco_transforms
+from engine import inference_targets, run_inference
+from main_ref import get_args_parser
+from models import build_model, meta_init
+from models.deploy import optimize_for_cpu, save_deployed_model
+from models.postprocessors import PostProcess
+from util.box_ops import box_iou
+from util.checkpoint import load_model_weights
+from util.misc import NestedTensor
+from util.runtime_config import RuntimeConfig
+
+SYNTHETIC_SENTENCE = "the cup on the table"
+
+
+def get_optimize_args_parser():
+    parser = argparse.ArgumentParser("CPU deployment", add_help=False)
+    parser.add_argument("--deploy_output", required=True, help="where to save the optimized model")
+    parser.add_argument("--no_fold_bn", dest="fold_bn", action="store_false")
+    parser.add_argument("--no_channels_last", dest="channels_last", action="store_false")
+    parser.add_argument("--no_quantize", dest="quantize", action="store_false")
+    parser.add_argument("--quantize_heads", action="store_true",
+                        help="Also quantize the box/eye/fingertip/arm score heads")
+    parser.add_argument("--benchmark_samples", default=50, type=int,
+                        help="Number of validation images used for the latency and accuracy benchmark, 0 to skip")
+    parser.add_argument("--benchmark_threads", default=0, type=int,
+                        help="Number of intra-op threads used for the benchmark, 0 to keep the torch default")
+    return parser
+
+
+def load_weights(model, path):
+    """Load the weights of a checkpoint into a model, which may be built with pretrained=False (models.meta_init)."""
+    meta_init.load_weights(model, load_model_weights(path))
+
+
+def benchmark_inputs(args, num_samples):
+    """Yield (image, caption, gt box in xyxy pixels or None, original size) for the benchmark."""
+    transform = make_coco_transforms("val", False)
+    if Path("yourefit").is_dir():
+        from datasets.yourefit import ReferDataset
+
+        dset = ReferDataset(data_root="./", split_root="./", dataset="yourefit", split="val",
+                            transform=transform, augment=False, args=args, config=RuntimeConfig.from_args(args))
+        for idx in range(min(num_samples, len(dset))):
+            img, target = dset[idx]
+            gt_box, _, _ = dset.pull_item_box(idx)
+            yield img, target["caption"], torch.as_tensor(gt_box, dtype=torch.float).view(1, 4), target["orig_size"]
+    else:
+        print("yourefit not found, benchmarking latency on synthetic images only")
+        rng = np.random.RandomState(args.seed)
+        for _ in range(num_samples):
+            array = rng.randint(0, 255, size=(480, 640, 3), dtype=np.uint8)
+            img, _ = transform(Image.fromarray(array), None)
+            yield img, SYNTHETIC_SENTENCE, None, torch.tensor([480, 640])
+
+
+def top_prediction(result):
+    top_box = result["boxes"][result["scores"].argmax()]
+    top_arm = result["arms"][result["arms_scores"].argmax()] if "arms" in result else None
+    return top_box, top_arm
+
+
+def run_benchmark(models, args):
+    postprocess = PostProcess(config=RuntimeConfig.from_args(args))
+    thresholds = (0.25, 0.5, 0.75)
+    stats = {name: {"latency": [], "hits": {t: 0 for t in thresholds}} for name in models}
+    box_deltas, arm_deltas, agreements = [], [], []
+    num_annotated = 0
+    for i, (img, caption, gt_box, orig_size) in enumerate(benchmark_inputs(args, args.benchmark_samples)):
+        samples = NestedTensor.from_tensor_list([img])
+        targets = inference_targets([caption])
+        tops = {}
+        for name, model in models.items():
+            start = time.perf_counter()
+            outputs = run_inference(model, samples, [caption])
+            result = postprocess(outputs, orig_size.view(1, 2), targets=targets)[0]
+            # the first image of each model warms up the allocator and the quantized kernels
+            if i > 0:
+                stats[name]["latency"].append(time.perf_counter() - start)
+            tops[name] = top_prediction(result)
+            if gt_box is not None:
+                iou = box_iou(tops[name][0].view(1, 4), gt_box)[0].item()
+                for t in thresholds:
+                    stats[name]["hits"][t] += int(iou >= t)
+        num_annotated += int(gt_box is not None)
+
+        (original_box, original_arm), (optimized_box, optimized_arm) = tops["original"], tops["optimized"]
+        box_deltas.append((original_box - optimized_box).abs().max().item())
+        agreements.append(box_iou(original_box.view(1, 4), optimized_box.view(1, 4))[0].item() >= 0.9)
+        if original_arm is not None:
+            arm_deltas.append((original_arm - optimized_arm).abs().max().item())
+
+    report = {}
+    for name, stat in stats.items():
+        latency = np.array(stat["latency"]) * 1000
+        report[name] = {
+            "latency_ms_mean": float(latency.mean()) if len(latency) else None,
+            "latency_ms_p50": float(np.percentile(latency, 50)) if len(latency) else None,
+            "latency_ms_p90": float(np.percentile(latency, 90)) if len(latency) else None,
+        }
+        if num_annotated > 0:
+            report[name]["precision"] = {str(t): stat["hits"][t] / num_annotated for t in thresholds}
+    # the latencies are None when the only image is the warm-up one
+    original_ms, optimized_ms = report["original"]["latency_ms_mean"], report["optimized"]["latency_ms_mean"]
+    report["speedup"] = original_ms / optimized_ms if original_ms is not None else None
+    report["top_box_agreement"] = float(np.mean(agreements))
+    report["top_box_max_abs_delta_px"] = float(np.max(box_deltas))
+    if arm_deltas:
+        report["top_arm_max_abs_delta_px"] = float(np.max(arm_deltas))
+    if num_annotated > 0:
+        report["precision_delta"] = {
+            t: report["optimized"]["precision"][t] - report["original"]["precision"][t]
+            for t in report["original"]["precision"]
+        }
+    report["num_samples"] = len(box_deltas)
+    return report
+
+
+def main(args):
+    if args.dataset_config is not None:
+        with open(args.dataset_config, "r") as f:
+            vars(args).update(json.load(f))
+    if not args.load:
+        raise RuntimeError("Please provide the checkpoint to optimize with --load")
+    args.device = "cpu"
+    if args.benchmark_threads > 0:
+        torch.set_num_threads(args.benchmark_threads)
+
+    model, _, _, _, _ = build_model(args, pretrained=not args.load, config=RuntimeConfig.from_args(args))
+    load_weights(model, args.load)
+    model.eval()
+
+    original = deepcopy(model) if args.benchmark_samples > 0 else None
+    model, deploy_report = optimize_for_cpu(
+        model,
+        fold_bn=args.fold_bn,
+        channels_last=args.channels_last,
+        quantize=args.quantize,
+        quantize_heads=args.quantize_heads,
+    )
+    print("Applied:", deploy_report)
+
+    Path(args.deploy_output).parent.mkdir(parents=True, exist_ok=True)
+    save_deployed_model(model, args.deploy_output, args=args, report=deploy_report)
+    print("Saved deployable model to", args.deploy_output)
+
+    if original is not None:
+        report = run_benchmark({"original": original, "optimized": model}, args)
+        report["deploy"] = deploy_report
+        report["num_threads"] = torch.get_num_threads()
+        print(json.dumps(report, indent=2))
+        with open(str(Path(args.deploy_output).with_suffix(".benchmark.json")), "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("CPU deployment of the touch-line transformer",
+                                     parents=[get_args_parser(), get_optimize_args_parser()])
+    main(parser.parse_args())
@@ -0,0 +1,172 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Run the model over a directory of images and stream the predictions to Parquet.
+
+The sentences file lists the requests, one per line, either as json lines
+    {"image": "frame_000001.jpg", "sentence": "the cup on the table"}
+or as tab separated values
+    frame_000001.jpg<TAB>the cup on the table
+The key of a request is its line number in the sentences file. Keys already present in --predictions_dir are
+skipped, so an interrupted run can simply be restarted. With --num_shards N, process i of N handles the
+requests whose key is i modulo N and writes its own parts.
+
+Example:
+    python predict.py --dataset_config configs/yourefit.json --load pretrained/best_etf.pth \
+        --image_dir frames/ --sentences frames.jsonl --predictions_dir predictions/frames --num_workers 8
+"""
+import argparse
+import json
+import os
+import time
+
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+
+from datasets.coco import make_coco_transforms
+from engine import inference_targets, run_inference
+from main_ref import get_args_parser
+from models import build_model
+from models.postprocessors import PostProcess
+from optimize_cpu import load_weights
+from util.columnar import PartitionedParquetWriter, pa, read_keys, require_pyarrow
+from util.misc import NestedTensor
+from util.runtime_config import RuntimeConfig
+
+
+def prediction_schema():
+    box = pa.list_(pa.float32(), 4)
+    return pa.schema([
+        ("key", pa.int64()),
+        ("image", pa.string()),
+        ("sentence", pa.string()),
+        ("width", pa.int32()),
+        ("height", pa.int32()),
+        ("scores", pa.list_(pa.float32())),
+        ("boxes", pa.list_(box)),
+        ("align_cost", pa.list_(pa.float32())),
+        ("arms", pa.list_(box)),
+        ("arm_scores", pa.list_(pa.float32())),
+    ])
+
+
+def read_sentences(path):
+    """Return the list of (key, image name, sentence) listed in path."""
+    requests = []
+    with open(path, "r") as f:
+        for key, line in enumerate(f):
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+            if line.lstrip().startswith("{"):
+                item = json.loads(line)
+                image, sentence = item["image"], item["sentence"]
+            else:
+                image, sentence = line.split("\t", 1)
+            requests.append((key, image, sentence))
+    return requests
+
+
+class ImageSentenceDataset(Dataset):
+    def __init__(self, image_dir, requests, transform):
+        self.image_dir = image_dir
+        self.requests = requests
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.requests)
+
+    def __getitem__(self, idx):
+        key, image_name, sentence = self.requests[idx]
+        image = Image.open(os.path.join(self.image_dir, image_name)).convert("RGB")
+        w, h = image.size
+        img, _ = self.transform(image, None)
+        return img, {"key": key, "image": image_name, "sentence": sentence, "orig_size": torch.tensor([h, w])}
+
+
+def collate_fn(batch):
+    imgs, metas = zip(*batch)
+    return NestedTensor.from_tensor_list(list(imgs)), list(metas)
+
+
+def get_predict_args_parser():
+    parser = argparse.ArgumentParser("Directory inference", add_help=False)
+    parser.add_argument("--image_dir", required=True)
+    parser.add_argument("--sentences", required=True, help="jsonl or tsv file of (image, sentence) requests")
+    parser.add_argument("--predictions_dir", required=True, help="directory of the parquet parts")
+    parser.add_argument("--num_shards", default=1, type=int)
+    parser.add_argument("--shard_id", default=0, type=int)
+    parser.add_argument("--rows_per_part", default=2048, type=int,
+                        help="number of predictions written per parquet part")
+    return parser
+
+
+def to_list(tensor):
+    return tensor.float().cpu().tolist()
+
+
+def main(args):
+    if args.dataset_config is not None:
+        with open(args.dataset_config, "r") as f:
+            vars(args).update(json.load(f))
+    require_pyarrow()
+    if not 0 <= args.shard_id < args.num_shards:
+        raise RuntimeError(f"--shard_id must be in [0, {args.num_shards})")
+    device = torch.device(args.device)
+
+    requests = [r for r in read_sentences(args.sentences) if r[0] % args.num_shards == args.shard_id]
+    done = read_keys(args.predictions_dir) if os.path.isdir(args.predictions_dir) else set()
+    todo = [r for r in requests if r[0] not in done]
+    print(f"Shard {args.shard_id}/{args.num_shards}: {len(requests)} requests, "
+          f"{len(requests) - len(todo)} already written, {len(todo)} to predict")
+    if not todo:
+        return
+
+    config = RuntimeConfig.from_args(args)
+    model, _, _, _, _ = build_model(args, pretrained=not args.load, config=config)
+    if args.load:
+        load_weights(model, args.load)
+    model.to(device)
+    model.eval()
+    postprocess = PostProcess(config=config)
+
+    dataset = ImageSentenceDataset(args.image_dir, todo, make_coco_transforms("val", False))
+    data_loader = DataLoader(dataset, args.batch_size, shuffle=False, collate_fn=collate_fn,
+                             num_workers=args.num_workers, pin_memory=device.type == "cuda")
+
+    prefix = f"shard-{args.shard_id:05d}-of-{args.num_shards:05d}"
+    start = time.time()
+    num_done = 0
+    with PartitionedParquetWriter(args.predictions_dir, prefix, prediction_schema(), args.rows_per_part) as writer:
+        for samples, metas in data_loader:
+            samples = samples.to(device, non_blocking=True)
+            captions = [m["sentence"] for m in metas]
+            with torch.no_grad():
+                outputs = run_inference(model, samples, captions)
+                target_sizes = torch.stack([m["orig_size"] for m in metas]).to(device)
+                results = postprocess(outputs, target_sizes, targets=inference_targets(captions))
+            for meta, result in zip(metas, results):
+                h, w = meta["orig_size"].tolist()
+                writer.write({
+                    "key": meta["key"],
+                    "image": meta["image"],
+                    "sentence": meta["sentence"],
+                    "width": w,
+                    "height": h,
+                    "scores": to_list(result["scores"]),
+                    "boxes": to_list(result["boxes"]),
+                    "align_cost": to_list(result["align_cost"]),
+                    "arms": to_list(result["arms"]) if "arms" in result else [],
+                    "arm_scores": to_list(result["arms_scores"]) if "arms_scores" in result else [],
+                })
+            num_done += len(metas)
+            if num_done % (args.batch_size * 50) < args.batch_size:
+                elapsed = time.time() - start
+                print(f"{num_done}/{len(todo)} predicted, {num_done / elapsed:.1f} images/s")
+    print(f"Wrote {len(todo)} predictions to {args.predictions_dir} in {time.time() - start:.0f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Touch-line transformer directory inference",
+                                     parents=[get_args_parser(), get_predict_args_parser()])
+    main(parser.parse_args())
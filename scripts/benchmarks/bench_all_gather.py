@@ -0,0 +1,94 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""Time of util.dist.all_gather (pickled) and util.dist.all_gather_tensors on evaluator predictions of 1 MB to 1 GB.
+
+Each rank gathers a dict {image id: {"scores", "boxes", "align_cost", "arms", "arms_scores"}} of the size of the
+payload, as YouRefItEvaluator.synchronize_between_processes does, among --world_size processes spawned on this
+machine (gloo backend on CPU, NCCL with --device cuda and one GPU per process). The results of both are checked
+to be equal for every payload size. Gathering 1 GB on each of N ranks needs several times N GB of memory per
+process with the pickled all_gather.
+
+Example:
+    python scripts/benchmarks/bench_all_gather.py --world_size 2 --sizes_mb 1 16 128 1024
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+PACKAGE_PARENT = "../.."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import util.dist as dist
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("all_gather of evaluator predictions")
+    parser.add_argument("--world_size", default=2, type=int)
+    parser.add_argument("--sizes_mb", default=[1, 16, 128, 1024], type=float, nargs="+",
+                        help="payload of each rank in MB")
+    parser.add_argument("--num_queries", default=100, type=int)
+    parser.add_argument("--repeats", default=3, type=int)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--port", default=29541, type=int)
+    return parser
+
+
+def predictions(size_mb, num_queries, rank, device):
+    """Predictions of about size_mb MB, with the image ids of rank."""
+    bytes_per_image = num_queries * (1 + 4 + 1 + 4 + 1) * 4
+    num_images = max(int(size_mb * 2 ** 20 / bytes_per_image), 1)
+    generator = torch.Generator().manual_seed(rank)
+    values = torch.rand(num_images, num_queries, 11, generator=generator).to(device)
+    return {rank * num_images + i: {"scores": v[:, 0], "boxes": v[:, 1:5], "align_cost": v[:, 5],
+                                    "arms": v[:, 6:10], "arms_scores": v[:, 10]}
+            for i, v in enumerate(values.unbind(0))}
+
+
+def timed(fn, data, repeats, device):
+    durations, result = [], None
+    for _ in range(repeats):
+        result = None
+        torch.distributed.barrier()
+        start = time.perf_counter()
+        result = fn(data)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        durations.append(time.perf_counter() - start)
+    return sorted(durations)[len(durations) // 2], result
+
+
+def equal(a, b):
+    return a.keys() == b.keys() and all(
+        a[k].keys() == b[k].keys() and all(torch.equal(a[k][n].cpu(), b[k][n].cpu()) for n in a[k]) for k in a)
+
+
+def worker(rank, args):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(args.port), RANK=str(rank),
+                      WORLD_SIZE=str(args.world_size), LOCAL_RANK=str(rank), LOCAL_WORLD_SIZE=str(args.world_size))
+    args.dist_url = "env://"
+    args.dist_backend = None
+    dist.init_distributed_mode(args)
+    device = torch.device(args.device, rank) if args.device == "cuda" else torch.device(args.device)
+
+    print(f"{args.world_size} ranks, {args.dist_backend}, {args.device}")
+    print(f"{'MB/rank':>8} {'images':>8} {'pickled s':>10} {'tensors s':>10} {'speedup':>8} {'equal':>6}")
+    for size_mb in args.sizes_mb:
+        data = predictions(size_mb, args.num_queries, rank, device)
+        pickled, pickled_result = timed(dist.all_gather, data, args.repeats, device)
+        del pickled_result
+        tensors, tensors_result = timed(dist.all_gather_tensors, data, args.repeats, device)
+        del tensors_result
+        same = equal(*[{k: v for d in gathered for k, v in d.items()}
+                       for gathered in (dist.all_gather(data), dist.all_gather_tensors(data))])
+        print(f"{size_mb:>8g} {len(data):>8} {pickled:>10.3f} {tensors:>10.3f} {pickled / tensors:>8.2f} "
+              f"{str(same):>6}")
+    torch.distributed.destroy_process_group()
+
+
+if __name__ == "__main__":
+    args = get_args_parser().parse_args()
+    mp.spawn(worker, args=(args,), nprocs=args.world_size)
@@ -0,0 +1,121 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""Time and peak memory of loading the weights of a training checkpoint and of its inference checkpoints.
+
+The training checkpoint is --checkpoint, or one written the way main_ref.py writes them (model, EMA model, AdamW
+state with amsgrad and args) for a model built from the arguments of main_ref.py, which are all accepted. Its
+inference checkpoints are written by slim_checkpoint.py, in single and half precision. Each is loaded in a new
+process, after the model is built, with util.checkpoint.load_model_weights as --load does. The report gives the size
+of the files, the time to load the weights into the model and the increase of the peak RSS of the process
+(Linux only).
+
+Example:
+    python scripts/benchmarks/bench_checkpoint_load.py --dataset_config configs/yourefit.json \
+        --checkpoint output_dir/checkpoint.pth
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from copy import deepcopy
+
+import torch
+
+PACKAGE_PARENT = "../.."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+
+def get_bench_args_parser():
+    """Arguments of the benchmark; all the others are parsed by the parser of main_ref.py."""
+    parser = argparse.ArgumentParser("Checkpoint loading")
+    parser.add_argument("--checkpoint", default=None,
+                        help="training checkpoint, by default one of a model with random weights")
+    parser.add_argument("--work_dir", default=None, help="where the checkpoints are written, by default a temporary "
+                                                         "directory")
+    return parser
+
+
+def rss_mb(field):
+    """VmRSS (current) or VmHWM (peak) of this process, in MB."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    raise RuntimeError(f"No {field} in /proc/self/status")
+
+
+def reset_peak_rss():
+    # building the model peaks higher than loading the weights, the peak is reset in between (Linux 4.0 or later)
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def training_checkpoint(model, args, path):
+    from magic_numbers import AMSGRAD
+    from util.optim import build_adamw, build_param_dicts
+
+    optimizer = build_adamw(build_param_dicts(model, args), lr=args.lr, weight_decay=args.weight_decay,
+                            amsgrad=AMSGRAD)
+    for p in model.parameters():
+        p.grad = torch.zeros_like(p) if p.requires_grad else None
+    optimizer.step()
+    torch.save({"model": model.state_dict(), "model_ema": deepcopy(model).state_dict(),
+                "optimizer": optimizer.state_dict(), "epoch": 0, "args": args}, path)
+
+
+def load(args, path, queue):
+    from models import build_model
+    from util.checkpoint import load_model_weights
+
+    torch.manual_seed(args.seed)
+    model = build_model(args)[0]
+    reset_peak_rss()
+    before = rss_mb("VmRSS")
+    start = time.perf_counter()
+    model.load_state_dict(load_model_weights(path), strict=False)
+    elapsed = time.perf_counter() - start
+    queue.put((elapsed * 1e3, rss_mb("VmHWM") - before))
+
+
+def main(bench_args, remaining):
+    from main_ref import get_args_parser
+    from models import build_model
+    import slim_checkpoint
+
+    parser = get_args_parser()
+    parser.set_defaults(device="cpu")
+    args = parser.parse_args(remaining)
+    if args.dataset_config is not None:
+        with open(args.dataset_config, "r") as f:
+            vars(args).update(json.load(f))
+
+    work_dir = bench_args.work_dir or tempfile.mkdtemp()
+    checkpoint = bench_args.checkpoint
+    if checkpoint is None:
+        checkpoint = os.path.join(work_dir, "checkpoint.pth")
+        torch.manual_seed(args.seed)
+        training_checkpoint(build_model(args)[0], args, checkpoint)
+    variants = [("training checkpoint", checkpoint)]
+    for name, extra in (("inference fp32", []), ("inference fp16", ["--fp16"])):
+        output = os.path.join(work_dir, name.replace(" ", "_") + ".safetensors")
+        slim_checkpoint.main(slim_checkpoint.get_args_parser().parse_args([checkpoint, "--output", output] + extra))
+        variants.append((name, output))
+
+    context = multiprocessing.get_context("spawn")
+    print(f"{'checkpoint':<20} {'MB':>8} {'load ms':>9} {'peak RSS +MB':>13}")
+    for name, path in variants:
+        queue = context.SimpleQueue()
+        process = context.Process(target=load, args=(args, path, queue))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"Loading {path} failed")
+        elapsed, rss = queue.get()
+        print(f"{name:<20} {os.path.getsize(path) / 2 ** 20:>8.0f} {elapsed:>9.0f} {rss:>13.0f}")
+
+
+if __name__ == "__main__":
+    main(*get_bench_args_parser().parse_known_args())
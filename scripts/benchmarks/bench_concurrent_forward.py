@@ -0,0 +1,139 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""Stress test of concurrent CPU inference: requests/s of one shared model for several thread pool sizes.
+
+Every concurrent result is also compared with the result of a serial forward on the same request,
+which fails if some per-call state leaks between threads.
+
+Example:
+    python scripts/benchmarks/bench_concurrent_forward.py --dataset_config configs/yourefit.json \
+        --load pretrained/best_etf.pth --workers 1 2 4 8 --requests 64
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+PACKAGE_PARENT = "../.."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+from main_ref import get_args_parser
+from models import build_model
+from models.deploy import load_deployed_model
+from optimize_cpu import load_weights
+from serving import ThreadedPredictor, available_cores
+
+SENTENCES = [
+    "the cup on the table",
+    "the red bottle next to the chair",
+    "that book",
+    "the small plant on the left of the window near the lamp",
+]
+
+
+def local_get_args_parser():
+    parser = argparse.ArgumentParser(
+        "Concurrent forward stress test", parents=[get_args_parser()], add_help=False
+    )
+    parser.add_argument("--deployed", default=None, help="model saved by optimize_cpu.py, instead of --load")
+    parser.add_argument("--workers", default=[1, 2, 4, 8], type=int, nargs="+")
+    parser.add_argument("--requests", default=64, type=int, help="number of requests per pool size")
+    parser.add_argument("--image_size", default=[480, 640], type=int, nargs=2)
+    parser.add_argument("--atol", default=1e-2, type=float, help="tolerance in pixels / probabilities")
+    parser.add_argument("--output", default=None, help="optional json file for the report")
+    return parser
+
+
+def make_requests(args):
+    rng = np.random.RandomState(args.seed)
+    h, w = args.image_size
+    requests = []
+    for i in range(args.requests):
+        # vary the image size a little so that requests do not share shapes
+        size = (h - 16 * (i % 3), w - 16 * (i % 5), 3)
+        image = Image.fromarray(rng.randint(0, 255, size=size, dtype=np.uint8))
+        requests.append((image, SENTENCES[i % len(SENTENCES)]))
+    return requests
+
+
+def max_abs_diff(expected, actual):
+    return max((expected[k] - actual[k]).abs().max().item() for k in expected)
+
+
+def main(args):
+    if args.deployed:
+        model, _ = load_deployed_model(args.deployed)
+    else:
+        if args.dataset_config is not None:
+            with open(args.dataset_config, "r") as f:
+                vars(args).update(json.load(f))
+        args.device = "cpu"
+        model, _, _, _, _ = build_model(args, pretrained=not args.load)
+        if args.load:
+            load_weights(model, args.load)
+    model.eval()
+    requests = make_requests(args)
+
+    predictor = ThreadedPredictor(model, num_workers=1)
+    reference = [predictor.predict(image, caption) for image, caption in requests]
+    predictor.shutdown()
+
+    report = {"num_cores": available_cores(), "num_requests": len(requests), "runs": []}
+    for num_workers in args.workers:
+        predictor = ThreadedPredictor(model, num_workers=num_workers)
+        # warm up every worker thread
+        predictor.map(*zip(*requests[:num_workers]))
+
+        latencies = [None] * len(requests)
+
+        def record(i, submitted):
+            def callback(future):
+                latencies[i] = time.perf_counter() - submitted
+            return callback
+
+        # all requests are queued at once, so the latencies include the time spent waiting in the queue
+        start = time.perf_counter()
+        futures = []
+        for i, (image, caption) in enumerate(requests):
+            submitted = time.perf_counter()
+            future = predictor.submit(image, caption)
+            future.add_done_callback(record(i, submitted))
+            futures.append(future)
+        results = [f.result() for f in futures]
+        elapsed = time.perf_counter() - start
+        predictor.shutdown()
+
+        diff = max(max_abs_diff(e, a) for e, a in zip(reference, results))
+        latency = np.array(latencies) * 1000
+        run = {
+            "workers": num_workers,
+            "intra_op_threads": predictor.intra_op_threads,
+            "requests_per_s": len(requests) / elapsed,
+            "latency_ms_p50": float(np.percentile(latency, 50)),
+            "latency_ms_p99": float(np.percentile(latency, 99)),
+            "max_abs_diff_vs_serial": diff,
+        }
+        report["runs"].append(run)
+        print(json.dumps(run))
+        if diff > args.atol:
+            raise RuntimeError(f"Concurrent results differ from serial results by {diff} with {num_workers} workers")
+
+    base = report["runs"][0]["requests_per_s"]
+    for run in report["runs"]:
+        run["speedup"] = run["requests_per_s"] / base
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Concurrent forward stress test", parents=[local_get_args_parser()])
+    args = parser.parse_args()
+    torch.set_grad_enabled(False)
+    main(args)
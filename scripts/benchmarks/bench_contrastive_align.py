@@ -0,0 +1,201 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""Parity and timing of the contrastive alignment loss of SetCriterion against its former implementation.
+
+The former implementation filled the query to token positive map of every decoder layer on the CPU, with Python
+loops over the matched targets and their character spans, and copied it to the device. SetCriterion now looks
+the spans up once per batch (target_token_spans) and builds the map of every layer on the device
+(query_token_map). Both run on the same synthetic batches: several targets per caption, some spans starting or
+ending on a space to exercise the fallbacks of the character lookup, and a random matching per layer. The report
+gives the largest relative difference of the losses and of their gradients, and the time of the forward and
+backward passes of the losses of all the layers per step.
+
+Example:
+    python scripts/benchmarks/bench_contrastive_align.py --batch_sizes 2 8 32 --num_layers 6 --device cuda
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+PACKAGE_PARENT = "../.."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+from models.mdetr import SetCriterion
+from util import text_assets
+
+SENTENCES = [
+    "the cup on the table",
+    "the red bottle next to the chair",
+    "that book",
+    "the small plant on the left of the window near the lamp",
+]
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("Contrastive alignment loss parity and timing")
+    parser.add_argument("--text_encoder_type", default="roberta-base")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch_sizes", default=[2, 8, 32], type=int, nargs="+")
+    parser.add_argument("--num_queries", default=100, type=int)
+    parser.add_argument("--num_layers", default=6, type=int, help="final layer and auxiliary layers")
+    parser.add_argument("--contrastive_hdim", default=64, type=int)
+    parser.add_argument("--temperature", default=0.07, type=float)
+    parser.add_argument("--steps", default=10, type=int)
+    parser.add_argument("--warmup_steps", default=2, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    return parser
+
+
+def legacy_loss_contrastive_align(outputs, targets, indices, num_boxes, temperature):
+    """The former SetCriterion.loss_contrastive_align, for reference."""
+    tokenized = outputs["tokenized"]
+    logits = torch.matmul(outputs["proj_queries"], outputs["proj_tokens"].transpose(-1, -2)) / temperature
+    positive_map = torch.zeros(logits.shape, dtype=torch.bool)
+    for i, ((idx_src, idx_tgt), tgt) in enumerate(zip(indices, targets)):
+        cur_tokens = [tgt["tokens_positive"][j] for j in idx_tgt]
+        for j, tok_list in enumerate(cur_tokens):
+            for (beg, end) in tok_list:
+                beg_pos = tokenized.char_to_token(i, beg)
+                end_pos = tokenized.char_to_token(i, end - 1)
+                if beg_pos is None:
+                    try:
+                        beg_pos = tokenized.char_to_token(beg + 1)
+                        if beg_pos is None:
+                            beg_pos = tokenized.char_to_token(beg + 2)
+                    except:
+                        beg_pos = None
+                if end_pos is None:
+                    try:
+                        end_pos = tokenized.char_to_token(end - 2)
+                        if end_pos is None:
+                            end_pos = tokenized.char_to_token(end - 3)
+                    except:
+                        end_pos = None
+                if beg_pos is None or end_pos is None:
+                    continue
+                positive_map[i, idx_src[j], beg_pos: end_pos + 1].fill_(True)
+
+    positive_map = positive_map.to(logits.device)
+    positive_logits = -logits.masked_fill(~positive_map, 0)
+    negative_logits = logits
+
+    boxes_with_pos = positive_map.any(2)
+    pos_term = positive_logits.sum(2)
+    neg_term = negative_logits.logsumexp(2)
+    nb_pos = positive_map.sum(2) + 1e-6
+    box_to_token_loss = ((pos_term / nb_pos + neg_term)).masked_fill(~boxes_with_pos, 0).sum()
+
+    tokens_with_pos = positive_map.any(1)
+    pos_term = positive_logits.sum(1)
+    neg_term = negative_logits.logsumexp(1)
+    nb_pos = positive_map.sum(1) + 1e-6
+    tokens_to_boxes_loss = ((pos_term / nb_pos + neg_term)).masked_fill(~tokens_with_pos, 0).sum()
+    return (box_to_token_loss + tokens_to_boxes_loss) / 2 / num_boxes
+
+
+def synthetic_batch(batch_size, args, tokenizer, device, rng):
+    """Outputs of num_layers decoder layers and targets: up to 3 targets per caption, each spanning a word, two
+    words or a span that starts or ends on a space."""
+    captions, targets = [], []
+    for i in range(batch_size):
+        caption = SENTENCES[i % len(SENTENCES)]
+        words, starts, position = caption.split(), [], 0
+        for word in words:
+            starts.append(caption.index(word, position))
+            position = starts[-1] + len(word)
+        tokens_positive = []
+        for _ in range(rng.randint(1, 3)):
+            w = rng.randrange(len(words))
+            beg, end = starts[w], starts[w] + len(words[w])
+            kind = rng.random()
+            if kind < 0.2 and w > 0:
+                beg -= 1
+            elif kind < 0.4 and w + 1 < len(words):
+                end += 1
+            elif kind < 0.6 and w + 1 < len(words):
+                end = starts[w + 1] + len(words[w + 1])
+            tokens_positive.append([[beg, end]])
+        captions.append(caption)
+        targets.append({"tokens_positive": tokens_positive})
+    tokenized = tokenizer(captions, padding="longest", return_tensors="pt")
+    num_tokens = tokenized["input_ids"].shape[1]
+
+    layers = []
+    for _ in range(args.num_layers):
+        layers.append({
+            "tokenized": tokenized,
+            "proj_queries": F.normalize(torch.randn(batch_size, args.num_queries, args.contrastive_hdim), dim=-1)
+                .to(device).requires_grad_(),
+            "proj_tokens": F.normalize(torch.randn(batch_size, num_tokens, args.contrastive_hdim), dim=-1)
+                .to(device).requires_grad_(),
+        })
+        layers[-1]["indices"] = [
+            (torch.as_tensor(rng.sample(range(args.num_queries), len(t["tokens_positive"])), dtype=torch.int64),
+             torch.as_tensor(rng.sample(range(len(t["tokens_positive"])), len(t["tokens_positive"])),
+                             dtype=torch.int64))
+            for t in targets]
+    num_boxes = sum(len(t["tokens_positive"]) for t in targets)
+    return layers, targets, num_boxes
+
+
+def legacy_step(criterion, layers, targets, num_boxes):
+    return [legacy_loss_contrastive_align(o, targets, o["indices"], num_boxes, criterion.temperature)
+            for o in layers]
+
+
+def step(criterion, layers, targets, num_boxes):
+    token_spans = criterion.target_token_spans(layers[0]["tokenized"], targets, layers[0]["proj_queries"].device)
+    return [criterion.loss_contrastive_align(o, targets, None, o["indices"], num_boxes, token_spans=token_spans)
+            ["loss_contrastive_align"] for o in layers]
+
+
+def timed(fn, criterion, layers, targets, num_boxes, args, device):
+    for _ in range(args.warmup_steps):
+        sum(fn(criterion, layers, targets, num_boxes)).backward()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        sum(fn(criterion, layers, targets, num_boxes)).backward()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) * 1e3 / args.steps
+
+
+def relative_difference(a, b):
+    return ((a - b).norm() / b.norm().clamp(min=1e-12)).item()
+
+
+def main(args):
+    device = torch.device(args.device)
+    rng = random.Random(args.seed)
+    torch.manual_seed(args.seed)
+    tokenizer = text_assets.tokenizer(args.text_encoder_type)
+    criterion = SetCriterion(num_classes=255, matcher=None, eos_coef=0.1, losses=["contrastive_align"],
+                             temperature=args.temperature).to(device)
+    print(f"device {device}, {args.num_queries} queries, {args.num_layers} layers")
+    print(f"{'batch':>5} {'loss diff':>10} {'grad diff':>10} {'before ms':>10} {'after ms':>10} {'speedup':>8}")
+    for batch_size in args.batch_sizes:
+        layers, targets, num_boxes = synthetic_batch(batch_size, args, tokenizer, device, rng)
+        embeddings = [o[k] for o in layers for k in ("proj_queries", "proj_tokens")]
+
+        legacy = legacy_step(criterion, layers, targets, num_boxes)
+        legacy_grads = torch.autograd.grad(sum(legacy), embeddings)
+        new = step(criterion, layers, targets, num_boxes)
+        new_grads = torch.autograd.grad(sum(new), embeddings)
+        loss_diff = relative_difference(torch.stack(new), torch.stack(legacy).detach())
+        grad_diff = max(relative_difference(a, b) for a, b in zip(new_grads, legacy_grads))
+
+        before = timed(legacy_step, criterion, layers, targets, num_boxes, args, device)
+        after = timed(step, criterion, layers, targets, num_boxes, args, device)
+        print(f"{batch_size:>5} {loss_diff:>10.1e} {grad_diff:>10.1e} {before:>10.2f} {after:>10.2f} "
+              f"{before / after:>8.2f}")
+
+
+if __name__ == "__main__":
+    main(get_args_parser().parse_args())
@@ -0,0 +1,151 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""Training step time of DistributedDataParallel with and without the search for unused parameters and the static
+graph, for several numbers of processes on one machine (gloo backend on CPU, NCCL with --device cuda).
+
+For each world size, the processes are spawned with the environment of torchrun and set up by
+util.dist.init_distributed_mode, as in main_ref.py. Each of them trains a copy of the same model, wrapped by
+util.dist.wrap_distributed with the settings of each variant:
+    find_unused: --find_unused_parameters true --ddp_static_graph false (the settings of earlier versions)
+    no_search:   --find_unused_parameters false --ddp_static_graph false
+    static:      --find_unused_parameters false --ddp_static_graph true
+for each of the --bucket_caps_mb, over --warmup_steps and --num_steps steps of engine.train_one_epoch on a synthetic
+YouRefIt batch (see bench_memory_throughput.py). The report gives the median step time after the warm-up, its
+speedup over the first variant and the largest difference of the trained weights from those of the first variant,
+which is 0 up to the order of the additions of the all-reduce.
+All the other arguments are those of main_ref.py.
+
+Example:
+    python scripts/benchmarks/bench_ddp_static_graph.py --dataset_config configs/yourefit.json --world_sizes 2 4 \
+        --batch_size 2 --num_steps 20 --bucket_caps_mb 25 100
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from copy import deepcopy
+
+import torch
+import torch.multiprocessing as mp
+
+PACKAGE_PARENT = "../.."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+VARIANTS = (
+    ("find_unused", True, False),
+    ("no_search", False, False),
+    ("static", False, True),
+)
+
+
+def get_ddp_args_parser():
+    """Arguments of the benchmark; all the others are parsed by the parser of main_ref.py."""
+    parser = argparse.ArgumentParser("DistributedDataParallel settings")
+    parser.add_argument("--world_sizes", default=[2, 4], type=int, nargs="+")
+    parser.add_argument("--bucket_caps_mb", default=[25], type=float, nargs="+")
+    parser.add_argument("--warmup_steps", default=3, type=int)
+    parser.add_argument("--num_steps", default=20, type=int)
+    parser.add_argument("--image_size", default=[480, 640], type=int, nargs=2)
+    parser.add_argument("--port", default=29571, type=int)
+    parser.add_argument("--output", default=None, help="JSON file of the results")
+    return parser
+
+
+def worker(local_rank, world_size, ddp_args, remaining, queue):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(ddp_args.port + world_size),
+                      RANK=str(local_rank), WORLD_SIZE=str(world_size), LOCAL_RANK=str(local_rank),
+                      LOCAL_WORLD_SIZE=str(world_size))
+    import util.dist as dist
+    from bench_memory_throughput import synthetic_batch
+    from engine import train_one_epoch
+    from main_ref import get_args_parser
+    from models import build_model
+    from util.misc import collate_fn
+    from util.optim import build_adamw, build_param_dicts
+
+    parser = get_args_parser()
+    parser.set_defaults(device="cpu")
+    args = parser.parse_args(remaining)
+    if args.dataset_config is not None:
+        with open(args.dataset_config, "r") as f:
+            vars(args).update(json.load(f))
+    # the log of train_one_epoch is not written to a file
+    args.output_dir = None
+    args.epochs = 1
+
+    dist.init_distributed_mode(args)
+    device = torch.device(args.device)
+    if device.type == "cpu" and args.pin_threads:
+        dist.pin_cpu_threads(args.local_rank, args.local_size)
+    torch.manual_seed(args.seed)
+    model, criterion, _, _, weight_dict = build_model(args)
+    model.to(device)
+
+    samples, captions, targets, positive_map = synthetic_batch(args.batch_size, ddp_args.image_size,
+                                                               model.transformer.tokenizer, torch.device("cpu"))
+    batch = collate_fn(False, list(zip(samples.tensors.unbind(0), targets)))
+    batch["positive_map"] = positive_map
+    data_loader = [batch] * (ddp_args.warmup_steps + ddp_args.num_steps)
+
+    reference = None
+    for bucket_cap_mb in ddp_args.bucket_caps_mb:
+        for name, find_unused_parameters, static_graph in VARIANTS:
+            args.find_unused_parameters, args.ddp_static_graph = find_unused_parameters, static_graph
+            args.ddp_bucket_cap_mb = bucket_cap_mb
+            step_model = deepcopy(model)
+            ddp_model = dist.wrap_distributed(step_model, args, device)
+            optimizer = build_adamw(build_param_dicts(step_model, args), lr=args.lr,
+                                    weight_decay=args.weight_decay, amsgrad=True)
+            step_ends = []
+
+            def step_callback(steps_done):
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                step_ends.append(time.perf_counter())
+                return False
+
+            # the same dropout in every variant
+            torch.manual_seed(args.seed)
+            torch.distributed.barrier()
+            with contextlib.redirect_stdout(io.StringIO()):
+                train_one_epoch(ddp_model, criterion, None, None, weight_dict, data_loader, optimizer, device, 0,
+                                args, args.clip_max_norm, step_callback=step_callback)
+            durations = sorted(b - a for a, b in zip(step_ends[ddp_args.warmup_steps:],
+                                                     step_ends[ddp_args.warmup_steps + 1:]))
+            weights = {k: v.detach().cpu() for k, v in step_model.state_dict().items()}
+            if reference is None:
+                reference = weights
+            max_diff = max((weights[k].float() - reference[k].float()).abs().max().item() for k in weights)
+            if dist.is_main_process():
+                queue.put({"world_size": world_size, "backend": args.dist_backend, "variant": name,
+                           "bucket_cap_mb": bucket_cap_mb, "step_ms": durations[len(durations) // 2] * 1e3,
+                           "max_weight_diff": max_diff})
+            del ddp_model, step_model, optimizer
+    torch.distributed.destroy_process_group()
+
+
+def main(ddp_args, remaining):
+    if ddp_args.num_steps < 2:
+        raise RuntimeError("--num_steps must be at least 2")
+    results = []
+    print(f"{'ranks':>5} {'bucket MB':>9} {'variant':<12} {'step ms':>9} {'speedup':>8} {'weight diff':>12}")
+    for world_size in ddp_args.world_sizes:
+        queue = mp.get_context("spawn").SimpleQueue()
+        mp.spawn(worker, args=(world_size, ddp_args, remaining, queue), nprocs=world_size)
+        world_results = [queue.get() for _ in range(len(ddp_args.bucket_caps_mb) * len(VARIANTS))]
+        for result in world_results:
+            speedup = world_results[0]["step_ms"] / result["step_ms"]
+            print(f"{world_size:>5} {result['bucket_cap_mb']:>9g} {result['variant']:<12} {result['step_ms']:>9.1f} "
+                  f"{speedup:>8.2f} {result['max_weight_diff']:>12.2e}")
+        results += world_results
+
+    if ddp_args.output is not None:
+        with open(ddp_args.output, "w") as f:
+            json.dump({"cpu_count": os.cpu_count(), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(*get_ddp_args_parser().parse_known_args())
@@ -0,0 +1,146 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""Throughput of distributed evaluation on CPU (gloo backend) for several numbers of processes on one machine.
+
+For each world size, the processes are spawned with the environment of torchrun and set up by
+util.dist.init_distributed_mode, as in main_ref.py, then run engine.evaluate over their share of the first
+--num_items images of the synthetic YouRefIt validation set (see synthetic_yourefit.py and bench_suite.py), with
+the predictions gathered by YouRefItEvaluator and summarized on rank 0. The report gives the wall time of the
+evaluation, the images per second and the speedup and parallel efficiency relative to the first world size.
+
+By default each process is pinned to its share of the CPUs of the machine (util.dist.pin_cpu_threads), so the
+total number of threads is the same for every world size, and the speedup measures processes against threads.
+With --threads_per_rank, every process gets that many CPUs, and near linear scaling is expected as long as the
+CPUs are not oversubscribed.
+All the other arguments are those of main_ref.py.
+
+Example:
+    python scripts/benchmarks/bench_eval_scaling.py --dataset_config configs/yourefit.json --world_sizes 1 2 4 \
+        --threads_per_rank 4
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+PACKAGE_PARENT = "../.."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+from synthetic_yourefit import generate
+
+
+def string_to_bool(string):
+    return string.lower() not in ("false", "0", "no")
+
+
+def get_scaling_args_parser():
+    """Arguments of the benchmark; all the others are parsed by the parser of main_ref.py."""
+    parser = argparse.ArgumentParser("Distributed evaluation scaling on CPU")
+    parser.add_argument("--synthetic_root", default="yourefit_synthetic")
+    parser.add_argument("--num_synthetic_val", default=32, type=int)
+    parser.add_argument("--world_sizes", default=[1, 2, 4], type=int, nargs="+")
+    parser.add_argument("--num_items", default=16, type=int, help="validation images, split between the processes")
+    parser.add_argument("--threads_per_rank", default=None, type=int,
+                        help="CPUs of each process, by default the CPUs of the machine split between the processes")
+    parser.add_argument("--pin", default=True, type=string_to_bool, help="pin the processes to their CPUs")
+    parser.add_argument("--port", default=29533, type=int)
+    parser.add_argument("--output", default=None, help="JSON file of the results")
+    return parser
+
+
+def worker(local_rank, world_size, scaling_args, remaining, cwd, queue):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(scaling_args.port + world_size),
+                      RANK=str(local_rank), WORLD_SIZE=str(world_size), LOCAL_RANK=str(local_rank),
+                      LOCAL_WORLD_SIZE=str(world_size))
+    # ReferDataset reads the images, and the eye to fingertip annotations at the relative default paths of
+    # RuntimeConfig, from the working directory
+    os.chdir(scaling_args.synthetic_root)
+    from functools import partial
+
+    from torch.utils.data import DataLoader, DistributedSampler, Subset
+
+    import util.dist as dist
+    import util.misc as utils
+    from datasets.coco import make_coco_transforms
+    from datasets.yourefit import ReferDataset, YouRefItEvaluator
+    from engine import evaluate
+    from main_ref import get_args_parser
+    from models import build_model
+    from models.postprocessors import build_postprocessors
+
+    parser = get_args_parser()
+    parser.set_defaults(device="cpu")
+    args = parser.parse_args(remaining)
+    with open(os.path.join(cwd, args.dataset_config), "r") as f:
+        vars(args).update(json.load(f))
+    args.output_dir = None
+
+    dist.init_distributed_mode(args)
+    cpus = []
+    if scaling_args.pin:
+        cpus = dist.pin_cpu_threads(args.local_rank, args.local_size, scaling_args.threads_per_rank)
+    elif scaling_args.threads_per_rank is not None:
+        torch.set_num_threads(scaling_args.threads_per_rank)
+
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    model, criterion, contrastive_criterion, qa_criterion, weight_dict = build_model(args)
+    model.to(device)
+    dset = ReferDataset(data_root=".", split_root=".", dataset="yourefit", split="val",
+                        transform=make_coco_transforms("val", False), augment=False, args=args)
+    subset = Subset(dset, range(min(scaling_args.num_items, len(dset))))
+    data_loader = DataLoader(subset, args.batch_size, sampler=DistributedSampler(subset, shuffle=False),
+                             drop_last=False, collate_fn=partial(utils.collate_fn, False), num_workers=0)
+    postprocessors = build_postprocessors(args, "yourefit")
+
+    elapsed = None
+    # the first run warms up the model and the collectives
+    for _ in range(2):
+        evaluator_list = [YouRefItEvaluator(dset, ("bbox"))]
+        torch.distributed.barrier()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            evaluate(model=model, criterion=criterion, contrastive_criterion=contrastive_criterion,
+                     qa_criterion=qa_criterion, postprocessors=postprocessors, weight_dict=weight_dict,
+                     data_loader=data_loader, evaluator_list=evaluator_list, device=device, args=args)
+        torch.distributed.barrier()
+        elapsed = time.perf_counter() - start
+
+    if dist.is_main_process():
+        queue.put({"world_size": world_size, "backend": args.dist_backend, "threads_per_rank": torch.get_num_threads(),
+                   "pinned_cpus": len(cpus), "images": len(subset), "seconds": elapsed,
+                   "images_per_s": len(subset) / elapsed})
+    torch.distributed.destroy_process_group()
+
+
+def main(scaling_args, remaining):
+    cwd = os.getcwd()
+    scaling_args.synthetic_root = os.path.abspath(scaling_args.synthetic_root)
+    if not os.path.exists(os.path.join(scaling_args.synthetic_root, "yourefit")):
+        generate(scaling_args.synthetic_root, num_val=scaling_args.num_synthetic_val)
+
+    results = []
+    print(f"{'ranks':>5} {'threads/rank':>12} {'seconds':>9} {'images/s':>9} {'speedup':>8} {'efficiency':>10}")
+    for world_size in scaling_args.world_sizes:
+        queue = mp.get_context("spawn").SimpleQueue()
+        mp.spawn(worker, args=(world_size, scaling_args, remaining, cwd, queue), nprocs=world_size)
+        result = queue.get()
+        results.append(result)
+        speedup = result["images_per_s"] / results[0]["images_per_s"]
+        efficiency = speedup * results[0]["world_size"] / world_size
+        print(f"{world_size:>5} {result['threads_per_rank']:>12} {result['seconds']:>9.2f} "
+              f"{result['images_per_s']:>9.2f} {speedup:>8.2f} {efficiency * 100:>9.1f}%")
+
+    if scaling_args.output is not None:
+        with open(os.path.join(cwd, scaling_args.output), "w") as f:
+            json.dump({"cpu_count": os.cpu_count(), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(*get_scaling_args_parser().parse_known_args())
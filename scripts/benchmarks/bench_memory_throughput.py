@@ -0,0 +1,189 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""Memory and throughput of a training step for several effective batch sizes, gradient accumulation steps
+and activation checkpointing configurations.
+
+A step is the forward and backward passes of engine.compute_losses (model, criterion and pose losses) over
+the micro-batches of engine.split_batch, on a synthetic YouRefIt batch. For each configuration the report
+gives:
+    images/s: effective batch size / step time
+    saved MB: the largest activation memory kept for the backward pass by a micro-batch, i.e. the tensors
+              saved by autograd (parameters excluded), measured the same way on every device
+    peak MB: torch.cuda.max_memory_allocated over the step (CUDA only)
+The gradients of every configuration are compared with those of the first configuration of the batch size
+(by default, the whole batch without checkpointing). Checkpointing gives the same gradients; with
+accumulation, the captions of a micro-batch are padded to its longest caption, which changes the contrastive
+alignment loss a little (see engine.split_batch).
+
+Example:
+    python scripts/benchmarks/bench_memory_throughput.py --dataset_config configs/yourefit.json \
+        --effective_batch_sizes 4 8 16 --accumulation_steps 1 2 4 --checkpointing none backbone \
+        backbone,encoder,decoder,text_encoder
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from copy import deepcopy
+
+import torch
+
+PACKAGE_PARENT = "../.."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+from datasets.yourefit import create_positive_map
+from engine import compute_losses, split_batch
+from main_ref import get_args_parser
+from models import build_model
+from models.checkpointing import enable_activation_checkpointing
+from models.mdetr import get_pose_loss_scaling_factor
+from util.misc import NestedTensor
+
+SENTENCES = [
+    "the cup on the table",
+    "the red bottle next to the chair",
+    "that book",
+    "the small plant on the left of the window near the lamp",
+]
+
+
+def local_get_args_parser():
+    parser = argparse.ArgumentParser("Training step memory and throughput", parents=[get_args_parser()])
+    parser.add_argument("--effective_batch_sizes", default=[4, 8], type=int, nargs="+")
+    parser.add_argument("--accumulation_steps", default=[1, 2, 4], type=int, nargs="+")
+    parser.add_argument("--checkpointing", default=["none", "backbone", "backbone,encoder,decoder,text_encoder"],
+                        nargs="+", help="comma separated submodules to checkpoint, or none")
+    parser.add_argument("--steps", default=5, type=int)
+    parser.add_argument("--warmup_steps", default=1, type=int)
+    parser.add_argument("--image_size", default=[480, 640], type=int, nargs=2)
+    return parser
+
+
+def synthetic_batch(batch_size, image_size, tokenizer, device):
+    """Images, captions, targets and the collapsed positive map of a YouRefIt batch, one box per image."""
+    h, w = image_size
+    generator = torch.Generator().manual_seed(batch_size)
+    samples = NestedTensor.from_tensor_list([torch.rand(3, h, w, generator=generator) for _ in range(batch_size)])
+    captions, targets = [], []
+    for i in range(batch_size):
+        caption = SENTENCES[i % len(SENTENCES)]
+        tokens_positive = [[[0, len(caption.split()[0])]]]
+        xy = torch.rand(2, generator=generator) * 0.5 + 0.25
+        wh = torch.rand(2, generator=generator) * 0.3 + 0.05
+        captions.append(caption)
+        targets.append({
+            "boxes": torch.cat([xy, wh])[None],
+            "labels": torch.zeros(1, dtype=torch.int64),
+            "arm": torch.rand(1, 4, generator=generator),
+            "ht_map": torch.rand(1, h, w, generator=generator),
+            "tokens_positive": tokens_positive,
+            "caption": caption,
+            "positive_map": create_positive_map(tokenizer(caption, return_tensors="pt"), tokens_positive),
+            "orig_size": torch.tensor([h, w]),
+            "size": torch.tensor([h, w]),
+        })
+    positive_map = torch.cat([t.pop("positive_map") for t in targets]).to(device)
+    targets = [{k: v.to(device) if torch.is_tensor(v) else v for k, v in t.items()} for t in targets]
+    return samples.to(device), captions, targets, positive_map
+
+
+class SavedTensorsMeter:
+    """Bytes of the tensors saved by autograd for the backward pass, parameters and duplicates excluded."""
+
+    def __init__(self, model):
+        self.parameters = {p.data_ptr() for p in model.parameters()}
+        self.saved = {}
+
+    def pack(self, tensor):
+        ptr = tensor.data_ptr()
+        if ptr not in self.parameters:
+            self.saved[ptr] = max(self.saved.get(ptr, 0), tensor.numel() * tensor.element_size())
+        return tensor
+
+    def __call__(self):
+        return torch.autograd.graph.saved_tensors_hooks(self.pack, lambda tensor: tensor)
+
+    def reset(self):
+        megabytes = sum(self.saved.values()) / 2 ** 20
+        self.saved = {}
+        return megabytes
+
+
+def train_step(model, criterion, weight_dict, batch, accumulation_steps, args, meter):
+    samples, captions, targets, positive_map = batch
+    micro_batches = split_batch(samples, captions, targets, positive_map, None, accumulation_steps)
+    num_boxes = criterion.get_num_boxes(targets, positive_map.device)
+    pose_loss_scaling_factor = get_pose_loss_scaling_factor([t["arm"] for t in targets])
+    model.zero_grad()
+    saved = 0.0
+    for micro_batch in micro_batches:
+        with meter():
+            _, losses = compute_losses(model, criterion, None, None, weight_dict, *micro_batch, args,
+                                       num_boxes=num_boxes, pose_loss_scaling_factor=pose_loss_scaling_factor)
+        saved = max(saved, meter.reset())
+        losses.backward()
+    return saved
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def main(args):
+    if args.dataset_config is not None:
+        with open(args.dataset_config, "r") as f:
+            vars(args).update(json.load(f))
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    model, criterion, _, _, weight_dict = build_model(args)
+    model.to(device)
+    model.train()
+    criterion.train()
+    # without dropout, the gradients of all the configurations can be compared
+    for module in model.modules():
+        if isinstance(module, torch.nn.Dropout):
+            module.p = 0.0
+        elif isinstance(module, torch.nn.MultiheadAttention):
+            module.dropout = 0.0
+    print(f"device {device}, image size {args.image_size}")
+
+    print(f"{'batch':>5} {'accum':>5} {'checkpointing':<40} {'images/s':>9} {'saved MB':>9} {'peak MB':>9} "
+          f"{'grad diff':>9}")
+    for batch_size in args.effective_batch_sizes:
+        batch = synthetic_batch(batch_size, args.image_size, model.transformer.tokenizer, device)
+        reference = None
+        for checkpointing, accumulation_steps in itertools.product(args.checkpointing, args.accumulation_steps):
+            if accumulation_steps > batch_size:
+                continue
+            config_model = deepcopy(model)
+            if checkpointing != "none":
+                enable_activation_checkpointing(config_model, checkpointing.split(","))
+            meter = SavedTensorsMeter(config_model)
+            for _ in range(args.warmup_steps):
+                train_step(config_model, criterion, weight_dict, batch, accumulation_steps, args, meter)
+            if device.type == "cuda":
+                torch.cuda.reset_peak_memory_stats()
+            synchronize(device)
+            start = time.perf_counter()
+            for _ in range(args.steps):
+                saved = train_step(config_model, criterion, weight_dict, batch, accumulation_steps, args, meter)
+            synchronize(device)
+            images_per_second = batch_size * args.steps / (time.perf_counter() - start)
+            peak = f"{torch.cuda.max_memory_allocated() / 2 ** 20:>9.0f}" if device.type == "cuda" else f"{'-':>9}"
+
+            grads = [p.grad for p in config_model.parameters() if p.grad is not None]
+            if reference is None:
+                reference = grads
+            # relative to the norm of all the gradients, some of them are zero up to rounding
+            diff = (torch.stack([(a - b).norm() for a, b in zip(reference, grads)]).norm()
+                    / torch.stack([a.norm() for a in reference]).norm()).item()
+            print(f"{batch_size:>5} {accumulation_steps:>5} {checkpointing:<40} {images_per_second:>9.2f} "
+                  f"{saved:>9.1f} {peak} {diff:>9.1e}")
+            del config_model
+
+
+if __name__ == "__main__":
+    main(local_get_args_parser().parse_args())
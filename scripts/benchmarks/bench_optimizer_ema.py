@@ -0,0 +1,145 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""Per-step timing breakdown of a training step: forward + backward, gradient clipping, optimizer step and EMA.
+
+Each configuration trains the same model (the MDETR parameter set built from the arguments) on the same
+synthetic batch:
+    baseline: AdamW with one kernel per parameter, EMA updated tensor by tensor (the former update_ema)
+    foreach: multi-tensor AdamW and EMA
+    fused: fused AdamW (CUDA only) and multi-tensor EMA
+    foreach, EMA every N: as foreach, with the EMA updated every --ema_every steps
+The EMA of the foreach update is also compared with the tensor by tensor update.
+
+Example:
+    python scripts/benchmarks/bench_optimizer_ema.py --dataset_config configs/yourefit.json --batch_size 4 --steps 20
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from copy import deepcopy
+
+import torch
+
+PACKAGE_PARENT = "../.."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+from main_ref import get_args_parser
+from models import build_model
+from util.misc import NestedTensor
+from util.optim import build_adamw, build_param_dicts, maybe_update_ema, update_ema
+
+SENTENCES = [
+    "the cup on the table",
+    "the red bottle next to the chair",
+    "that book",
+    "the small plant on the left of the window near the lamp",
+]
+
+
+def local_get_args_parser():
+    parser = argparse.ArgumentParser("Optimizer and EMA timing", parents=[get_args_parser()])
+    parser.add_argument("--steps", default=20, type=int)
+    parser.add_argument("--warmup_steps", default=3, type=int)
+    parser.add_argument("--image_size", default=[480, 640], type=int, nargs=2)
+    parser.add_argument("--amsgrad", default=True, type=lambda x: x.lower() != "false")
+    return parser
+
+
+def legacy_update_ema(model, model_ema, decay):
+    """The tensor by tensor EMA update, for reference."""
+    with torch.no_grad():
+        msd = model.state_dict()
+        for k, ema_v in model_ema.state_dict().items():
+            ema_v.copy_(ema_v * decay + (1.0 - decay) * msd[k].detach())
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def run(name, model, args, device, samples, captions, implementation, ema_fn):
+    model = deepcopy(model)
+    model_ema = deepcopy(model)
+    optimizer = build_adamw(build_param_dicts(model, args), lr=args.lr, weight_decay=args.weight_decay,
+                            amsgrad=args.amsgrad, implementation=implementation)
+    timings = {"forward_backward": 0.0, "clip": 0.0, "optimizer": 0.0, "ema": 0.0}
+    for step in range(args.warmup_steps + args.steps):
+        synchronize(device)
+        t0 = time.perf_counter()
+        memory_cache, _ = model(samples, captions, encode_and_save=True)
+        outputs = model(samples, captions, encode_and_save=False, memory_cache=memory_cache)
+        loss = outputs["pred_logits"].logsumexp(-1).mean() + outputs["pred_boxes"].mean()
+        optimizer.zero_grad()
+        loss.backward()
+        synchronize(device)
+        t1 = time.perf_counter()
+        if args.clip_max_norm > 0:
+            torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip_max_norm)
+        synchronize(device)
+        t2 = time.perf_counter()
+        optimizer.step()
+        synchronize(device)
+        t3 = time.perf_counter()
+        ema_fn(model, model_ema, step + 1)
+        synchronize(device)
+        t4 = time.perf_counter()
+        if step >= args.warmup_steps:
+            for key, elapsed in zip(timings, (t1 - t0, t2 - t1, t3 - t2, t4 - t3)):
+                timings[key] += elapsed * 1e3 / args.steps
+    total = sum(timings.values())
+    share = (timings["optimizer"] + timings["ema"]) / total * 100
+    print(f"{name:<24} {timings['forward_backward']:>10.1f} {timings['clip']:>8.1f} {timings['optimizer']:>10.1f} "
+          f"{timings['ema']:>8.2f} {total:>9.1f} {share:>13.1f}%")
+
+
+def main(args):
+    if args.dataset_config is not None:
+        with open(args.dataset_config, "r") as f:
+            vars(args).update(json.load(f))
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    model, _, _, _, _ = build_model(args)
+    model.to(device)
+    model.train()
+    num_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    num_tensors = len(model.state_dict())
+    print(f"{num_params / 1e6:.1f}M trainable parameters, {num_tensors} tensors in the state dict, device {device}")
+
+    h, w = args.image_size
+    samples = NestedTensor.from_tensor_list([torch.rand(3, h, w) for _ in range(args.batch_size)]).to(device)
+    captions = [SENTENCES[i % len(SENTENCES)] for i in range(args.batch_size)]
+
+    configs = [("baseline", "for_loop", lambda m, e, step: legacy_update_ema(m, e, args.ema_decay)),
+               ("foreach", "foreach", lambda m, e, step: update_ema(m, e, args.ema_decay))]
+    if device.type == "cuda":
+        configs.append(("fused", "fused", lambda m, e, step: update_ema(m, e, args.ema_decay)))
+    if args.ema_every > 1:
+        configs.append((f"foreach, EMA every {args.ema_every}", "foreach",
+                        lambda m, e, step: maybe_update_ema(m, e, args.ema_decay, step, args.ema_every)))
+
+    print(f"{'ms / step':<24} {'fwd + bwd':>10} {'clip':>8} {'optimizer':>10} {'ema':>8} {'total':>9} "
+          f"{'optim + ema':>14}")
+    for name, implementation, ema_fn in configs:
+        try:
+            run(name, model, args, device, samples, captions, implementation, ema_fn)
+        except RuntimeError as e:
+            print(f"{name:<24} skipped: {e}")
+
+    # one EMA update of the same pair of models with both implementations
+    perturbed = deepcopy(model)
+    with torch.no_grad():
+        for p in perturbed.parameters():
+            p.add_(torch.randn_like(p) * 1e-2)
+    ema_legacy, ema_foreach = deepcopy(model), deepcopy(model)
+    legacy_update_ema(perturbed, ema_legacy, args.ema_decay)
+    update_ema(perturbed, ema_foreach, args.ema_decay)
+    diff = max((a.double() - b.double()).abs().max().item()
+               for a, b in zip(ema_legacy.state_dict().values(), ema_foreach.state_dict().values()))
+    print(f"max |EMA tensor by tensor - EMA foreach| after one update: {diff:.2e}")
+
+
+if __name__ == "__main__":
+    main(local_get_args_parser().parse_args())
@@ -0,0 +1,120 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""Micro-benchmarks of the arm / box alignment kernels of util/ray_ops.py.
+
+The batched kernel is compared, for speed and values, with the per-image and per-box Python loops it
+replaces, and PostProcess is timed with and without the alignment-reranked top-k on random outputs.
+
+Example:
+    python scripts/benchmarks/bench_ray_alignment.py --batch_sizes 1 8 32 --num_queries 20 100 --num_arms 1 10
+"""
+import argparse
+import itertools
+import os
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+PACKAGE_PARENT = "../.."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+from models.postprocessors import PostProcess
+from util import ray_ops
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("Arm / box alignment micro-benchmarks")
+    parser.add_argument("--batch_sizes", default=[1, 8, 32], type=int, nargs="+")
+    parser.add_argument("--num_queries", default=[20, 100], type=int, nargs="+")
+    parser.add_argument("--num_arms", default=[1, 10], type=int, nargs="+")
+    parser.add_argument("--repeats", default=20, type=int)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser
+
+
+def random_boxes(*shape, device):
+    xy = torch.rand(*shape, 2, device=device) * 0.8
+    wh = torch.rand(*shape, 2, device=device) * 0.2 + 0.01
+    return torch.cat([xy, xy + wh], dim=-1)
+
+
+def per_box_loop(boxes, arms):
+    """One cosine_similarity call per (image, box, arm), as in the former datasets.yourefit.aligned_score."""
+    B, Q, _ = boxes.shape
+    K = arms.shape[1]
+    out = torch.empty(B, Q, K, device=boxes.device)
+    for b in range(B):
+        for k in range(K):
+            arm = arms[b, k].tolist()
+            arm_tensor = torch.Tensor(arm[2:]) - torch.Tensor(arm[:2])
+            for q in range(Q):
+                box = boxes[b, q].tolist()
+                box_center = [(box[0] + box[2]) / 2, (box[1] + box[3]) / 2]
+                box_tensor = torch.Tensor(box_center) - torch.Tensor(arm[:2])
+                out[b, q, k] = F.cosine_similarity(arm_tensor, box_tensor, dim=0)
+    return out
+
+
+def per_image_loop(boxes, arms):
+    """One vectorized call per (image, arm), as in the former datasets.yourefit.aligned_scores."""
+    B, Q, _ = boxes.shape
+    K = arms.shape[1]
+    out = torch.empty(B, Q, K, device=boxes.device)
+    for b in range(B):
+        for k in range(K):
+            ray = arms[b, k, 2:4] - arms[b, k, 0:2]
+            centers = (boxes[b, :, 0:2] + boxes[b, :, 2:4]) / 2
+            out[b, :, k] = F.cosine_similarity(ray[None], centers - arms[b, k, 0:2], dim=1)
+    return out
+
+
+def timed(fn, repeats, device):
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return result, (time.perf_counter() - start) / repeats * 1e3
+
+
+def main(args):
+    device = torch.device(args.device)
+    print(f"{'B':>4} {'Q':>4} {'K':>3} {'per box ms':>11} {'per image ms':>13} {'batched ms':>11} {'max diff':>9}")
+    for B, Q, K in itertools.product(args.batch_sizes, args.num_queries, args.num_arms):
+        boxes = random_boxes(B, Q, device=device)
+        arms = random_boxes(B, K, device=device)
+        sizes = torch.tensor([[480, 640]], device=device).expand(B, 2)
+        batched, batched_ms = timed(lambda: ray_ops.arm_box_alignment(boxes, arms, sizes), args.repeats, device)
+        looped, image_ms = timed(lambda: per_image_loop(boxes, arms), args.repeats, device)
+        # the per box loop is orders of magnitude slower, time it once
+        reference, box_ms = timed(lambda: per_box_loop(boxes.cpu(), arms.cpu()), 1, torch.device("cpu"))
+        diff = max((batched["cos_sim"] - looped).abs().max().item(),
+                   (batched["cos_sim"].cpu() - reference).abs().max().item())
+        print(f"{B:>4} {Q:>4} {K:>3} {box_ms:>11.2f} {image_ms:>13.3f} {batched_ms:>11.3f} {diff:>9.1e}")
+
+    print()
+    print(f"{'B':>4} {'Q':>4} {'PostProcess ms':>15} {'+ rerank ms':>12}")
+    for B, Q in itertools.product(args.batch_sizes, args.num_queries):
+        outputs = {
+            "pred_logits": torch.randn(B, Q, 256, device=device),
+            "pred_boxes": torch.rand(B, Q, 4, device=device) * 0.5 + 0.1,
+            "2_arms": random_boxes(B, 10, device=device),
+            "2_arm_score": torch.randn(B, 10, 2, device=device),
+            "proj_queries": F.normalize(torch.randn(B, Q, 64, device=device), dim=-1),
+            "proj_tokens": F.normalize(torch.randn(B, 16, 64, device=device), dim=-1),
+            "tokenized": None,
+        }
+        sizes = torch.tensor([[480, 640]], device=device).expand(B, 2)
+        targets = [{"tokens_positive": [[]]}] * B
+        _, plain_ms = timed(lambda: PostProcess(rerank_top_k=0)(outputs, sizes, targets=targets), args.repeats, device)
+        _, rerank_ms = timed(lambda: PostProcess(rerank_top_k=5)(outputs, sizes, targets=targets), args.repeats, device)
+        print(f"{B:>4} {Q:>4} {plain_ms:>15.3f} {rerank_ms:>12.3f}")
+
+
+if __name__ == "__main__":
+    main(get_args_parser().parse_args())
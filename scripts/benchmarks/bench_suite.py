@@ -0,0 +1,234 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""Reproducible CPU benchmark suite on a synthetic YouRefIt dataset, with results stored as JSON so that
+they can be compared across commits.
+
+The dataset is written by synthetic_yourefit.py to --synthetic_root, unless it is already there, and the
+benchmarks run from that directory. They time:
+    getitem, data/*: ReferDataset.__getitem__ on the validation split and its stages (load, positive map,
+                     transform)
+    collate: util.misc.collate_fn of a batch
+    evaluate: engine.evaluate over the first --num_items validation images, the same loop as --eval, and the
+              profiling regions it runs through: model/* (backbone, text encoder, encoder, decoder, heads),
+              criterion/* (matcher and each loss), eval/postprocess and eval/summarize (YouRefItEvaluator)
+For each, the results give the median, p90, mean and min in ms over --repeats runs, after --warmup runs.
+The model is built from the arguments of main_ref.py, which are all accepted, with random weights on top of
+the pretrained backbone and text encoder. A benchmark that cannot run, e.g. when the pretrained weights
+cannot be downloaded, is recorded as skipped.
+
+Examples:
+    python scripts/benchmarks/bench_suite.py --dataset_config configs/yourefit.json --output bench_HEAD.json
+    python scripts/benchmarks/bench_suite.py --dataset_config configs/yourefit.json --output bench_new.json \
+        --compare bench_HEAD.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from functools import partial
+
+import numpy as np
+import torch
+
+PACKAGE_PARENT = "../.."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+REPO_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT))
+sys.path.append(REPO_DIR)
+
+from synthetic_yourefit import generate
+
+
+def get_suite_args_parser():
+    """Arguments of the suite; all the others are parsed by the parser of main_ref.py."""
+    parser = argparse.ArgumentParser("Benchmark suite on a synthetic YouRefIt dataset")
+    parser.add_argument("--synthetic_root", default="yourefit_synthetic")
+    parser.add_argument("--num_synthetic_val", default=32, type=int)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", default=None, help="results of an earlier run to compare with")
+    parser.add_argument("--threshold", default=0.1, type=float,
+                        help="relative change of the median reported as a regression by --compare")
+    parser.add_argument("--min_change_ms", default=1.0, type=float,
+                        help="smaller changes of the median are not reported, whatever their relative change")
+    parser.add_argument("--num_items", default=8, type=int, help="validation images per run")
+    parser.add_argument("--repeats", default=5, type=int)
+    parser.add_argument("--warmup", default=1, type=int)
+    parser.add_argument("--threads", default=None, type=int, help="torch intra-op threads")
+    parser.add_argument("--verbose", action="store_true", help="print the output of engine.evaluate")
+    return parser
+
+
+def stats(values):
+    values = np.asarray(values, dtype=np.float64)
+    return {"count": int(len(values)), "median_ms": float(np.median(values)),
+            "p90_ms": float(np.percentile(values, 90)), "mean_ms": float(values.mean()),
+            "min_ms": float(values.min())}
+
+
+def timed(fn, repeats, warmup):
+    """Durations of repeats calls of fn in ms, after warmup calls."""
+    for _ in range(warmup):
+        fn()
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        durations.append((time.perf_counter() - start) * 1e3)
+    return durations
+
+
+def regions(profiling, keep):
+    return {name: values.tolist() for name, values in profiling.collect().items() if keep(name)}
+
+
+def bench_dataset(results, dset, suite_args, profiling, collate_fn, batch_size):
+    items = range(min(suite_args.num_items, len(dset)))
+    profiling.collect()
+    getitem = timed(lambda: [dset[i] for i in items], suite_args.repeats, suite_args.warmup)
+    durations = regions(profiling, lambda name: name.startswith("data/"))
+    skip = len(items) * suite_args.warmup
+    results["getitem"] = stats(np.asarray(getitem) / len(items))
+    results["getitem"]["items_per_s"] = len(items) * 1e3 / results["getitem"]["median_ms"]
+    for name, values in durations.items():
+        results[name] = stats(values[skip:])
+
+    batch = [dset[i % len(dset)] for i in range(batch_size)]
+    results["collate"] = stats(timed(lambda: collate_fn(batch), suite_args.repeats, suite_args.warmup))
+
+
+def bench_evaluate(results, dset, args, suite_args, profiling, collate_fn):
+    from torch.utils.data import DataLoader, SequentialSampler, Subset
+
+    from datasets.yourefit import YouRefItEvaluator
+    from engine import evaluate
+    from models import build_model
+    from models.postprocessors import build_postprocessors
+
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    model, criterion, contrastive_criterion, qa_criterion, weight_dict = build_model(args)
+    model.to(device)
+    subset = Subset(dset, range(min(suite_args.num_items, len(dset))))
+    data_loader = DataLoader(subset, args.batch_size, sampler=SequentialSampler(subset), drop_last=False,
+                             collate_fn=collate_fn, num_workers=0)
+    postprocessors = build_postprocessors(args, "yourefit")
+
+    durations, totals = {}, []
+    for run in range(suite_args.warmup + suite_args.repeats):
+        evaluator_list = [YouRefItEvaluator(dset, ("bbox"))]
+        profiling.collect()
+        output = io.StringIO() if not suite_args.verbose else sys.stdout
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(output):
+            evaluate(model=model, criterion=criterion, contrastive_criterion=contrastive_criterion,
+                     qa_criterion=qa_criterion, postprocessors=postprocessors, weight_dict=weight_dict,
+                     data_loader=data_loader, evaluator_list=evaluator_list, device=device, args=args)
+        elapsed = (time.perf_counter() - start) * 1e3
+        # the data/* regions are timed by bench_dataset on their own
+        run_durations = regions(profiling, lambda name: not name.startswith("data/"))
+        if run >= suite_args.warmup:
+            totals.append(elapsed)
+            for name, values in run_durations.items():
+                durations.setdefault(name, []).extend(values)
+    results["evaluate"] = stats(totals)
+    results["evaluate"]["items_per_s"] = len(subset) * 1e3 / results["evaluate"]["median_ms"]
+    for name, values in durations.items():
+        results[name] = stats(values)
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip() != ""
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def compare(results, previous, threshold, min_change_ms):
+    print(f"{'benchmark':<32} {'before':>10} {'after':>10} {'change':>8}")
+    for name, after in results.items():
+        before = previous.get(name)
+        if before is None or "median_ms" not in before or "median_ms" not in after:
+            continue
+        change = after["median_ms"] / before["median_ms"] - 1
+        flag = ""
+        if abs(after["median_ms"] - before["median_ms"]) >= min_change_ms:
+            flag = "  regression" if change > threshold else ("  improvement" if change < -threshold else "")
+        print(f"{name:<32} {before['median_ms']:>10.2f} {after['median_ms']:>10.2f} {change * 100:>+7.1f}%{flag}")
+
+
+def main(suite_args, remaining):
+    cwd = os.getcwd()
+    output = os.path.join(cwd, suite_args.output)
+    synthetic_root = os.path.abspath(suite_args.synthetic_root)
+    if not os.path.exists(os.path.join(synthetic_root, "yourefit")):
+        generate(synthetic_root, num_val=suite_args.num_synthetic_val)
+    # the validation set is read from the working directory (data_root "."), and so are the eye to fingertip
+    # annotations, whose default paths in RuntimeConfig are relative
+    os.chdir(synthetic_root)
+    import util.misc as utils
+    from datasets.coco import make_coco_transforms
+    from datasets.yourefit import ReferDataset
+    from main_ref import get_args_parser
+    from util import profiling
+
+    parser = get_args_parser()
+    parser.set_defaults(device="cpu")
+    args = parser.parse_args(remaining)
+    with open(os.path.join(cwd, args.dataset_config), "r") as f:
+        vars(args).update(json.load(f))
+    args.output_dir = None
+    if suite_args.threads is not None:
+        torch.set_num_threads(suite_args.threads)
+    torch.manual_seed(args.seed)
+    profiling.enable(args.device)
+    collate_fn = partial(utils.collate_fn, False)
+
+    results = {}
+    try:
+        dset = ReferDataset(data_root=".", split_root=".", dataset="yourefit", split="val",
+                            transform=make_coco_transforms("val", False), augment=False, args=args)
+    except OSError as e:
+        dset = None
+        results["getitem"] = results["evaluate"] = {"skipped": str(e)}
+    if dset is not None:
+        bench_dataset(results, dset, suite_args, profiling, collate_fn, args.batch_size)
+        try:
+            bench_evaluate(results, dset, args, suite_args, profiling, collate_fn)
+        except OSError as e:
+            results["evaluate"] = {"skipped": str(e)}
+
+    commit, dirty = git_commit()
+    report = {
+        "meta": {
+            "commit": commit, "dirty": dirty, "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(), "torch": torch.__version__, "platform": platform.platform(),
+            "processor": platform.processor(), "cpu_count": os.cpu_count(), "threads": torch.get_num_threads(),
+            "suite_args": vars(suite_args), "args": vars(args),
+        },
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+
+    print(f"{'benchmark':<32} {'median':>10} {'p90':>10} {'count':>7}")
+    for name, result in results.items():
+        if "skipped" in result:
+            print(f"{name:<32} skipped: {result['skipped']}")
+        else:
+            print(f"{name:<32} {result['median_ms']:>10.2f} {result['p90_ms']:>10.2f} {result['count']:>7}")
+    print(f"Wrote {output}")
+
+    if suite_args.compare is not None:
+        with open(os.path.join(cwd, suite_args.compare), "r") as f:
+            compare(results, json.load(f)["results"], suite_args.threshold, suite_args.min_change_ms)
+
+
+if __name__ == "__main__":
+    main(*get_suite_args_parser().parse_known_args())
@@ -0,0 +1,146 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""Startup time and memory of the processes of a training run, and the tokenizers each of them holds.
+
+The main process builds what main_ref.py builds before its first step, on a synthetic YouRefIt dataset (see
+synthetic_yourefit.py): the train and val datasets, the model, its EMA copy with --ema and a YouRefItEvaluator, then
+starts the --num_workers DataLoader workers of the training set, which each load one sample. The report gives, for
+each process, the time until it is ready (the main process: after the evaluator, a worker: after its first sample,
+from its start), its RSS and USS (the memory that is not shared with the other processes, e.g. the pages a forked
+worker wrote to), the number of tokenizer objects it holds and the time it spent creating the shared text assets
+(util.text_assets). --start_method spawn shows the cost of workers that do not inherit the main process.
+The report is also written to --output. All the other arguments are those of main_ref.py.
+
+Example:
+    python scripts/benchmarks/bench_text_assets.py --dataset_config configs/yourefit.json --num_workers 4 --ema
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+from copy import deepcopy
+
+START = time.perf_counter()
+
+import torch
+from torch.utils.data import DataLoader, Dataset, get_worker_info
+
+PACKAGE_PARENT = "../.."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+from synthetic_yourefit import generate
+
+
+def get_bench_args_parser():
+    """Arguments of the benchmark; all the others are parsed by the parser of main_ref.py."""
+    parser = argparse.ArgumentParser("Startup time and memory per process")
+    parser.add_argument("--synthetic_root", default="yourefit_synthetic")
+    parser.add_argument("--start_method", default=None, choices=("fork", "spawn", "forkserver"),
+                        help="start method of the DataLoader workers, by default the one of the platform")
+    parser.add_argument("--output", default="text_assets_startup.json")
+    return parser
+
+
+def memory_mb():
+    """RSS and USS of this process in MB (Linux)."""
+    fields = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    return fields["Rss"], fields["Private_Clean"] + fields["Private_Dirty"]
+
+
+def process_stats(name, start):
+    from transformers import PreTrainedTokenizerBase
+
+    from util import text_assets
+
+    rss, uss = memory_mb()
+    return {"process": name, "pid": os.getpid(), "ready_s": time.perf_counter() - start, "rss_mb": rss,
+            "uss_mb": uss, "tokenizers": sum(isinstance(o, PreTrainedTokenizerBase) for o in gc.get_objects()),
+            "text_assets_s": sum(text_assets.load_seconds.values())}
+
+
+class WorkerStats(Dataset):
+    """Loads a sample of dataset, and returns the process_stats of the worker that loaded it."""
+
+    def __init__(self, dataset, text_assets_dir):
+        self.dataset = dataset
+        self.text_assets_dir = text_assets_dir
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        self.dataset[index]
+        return process_stats(f"worker {get_worker_info().id}", worker_start)
+
+
+worker_start = None
+
+
+def worker_init_fn(worker_id):
+    from util import text_assets
+
+    global worker_start
+    worker_start = time.perf_counter()
+    # for the workers that do not inherit the main process
+    text_assets.TEXT_ASSETS_DIR = get_worker_info().dataset.text_assets_dir
+
+
+def main(bench_args, remaining):
+    from util import text_assets
+
+    cwd = os.getcwd()
+    synthetic_root = os.path.abspath(bench_args.synthetic_root)
+    if not os.path.exists(os.path.join(synthetic_root, "yourefit")):
+        generate(synthetic_root)
+    # the local text assets are relative to the working directory, which becomes the synthetic dataset, as the
+    # datasets and the default annotation paths of RuntimeConfig are relative to it
+    text_assets.TEXT_ASSETS_DIR = os.path.join(cwd, text_assets.TEXT_ASSETS_DIR)
+    os.chdir(synthetic_root)
+    from datasets.coco import make_coco_transforms
+    from datasets.yourefit import ReferDataset, YouRefItEvaluator
+    from main_ref import get_args_parser
+    from models import build_model
+
+    parser = get_args_parser()
+    parser.set_defaults(device="cpu")
+    args = parser.parse_args(remaining)
+    if args.dataset_config is not None:
+        with open(os.path.join(cwd, args.dataset_config), "r") as f:
+            vars(args).update(json.load(f))
+
+    dataset_train = ReferDataset(data_root=".", split_root=".", dataset="yourefit", split="train",
+                                 transform=make_coco_transforms("train", False), augment=False, args=args)
+    dataset_val = ReferDataset(data_root=".", split_root=".", dataset="yourefit", split="val",
+                               transform=make_coco_transforms("val", False), augment=False, args=args)
+    model = build_model(args)[0]
+    model_ema = deepcopy(model) if args.ema else None
+    evaluator = YouRefItEvaluator(dataset_val, ("bbox",))
+    stats = [process_stats("main", START)]
+
+    if args.num_workers > 0:
+        loader = DataLoader(WorkerStats(dataset_train, text_assets.TEXT_ASSETS_DIR), batch_size=1,
+                            sampler=range(args.num_workers), num_workers=args.num_workers, collate_fn=list,
+                            worker_init_fn=worker_init_fn, multiprocessing_context=bench_args.start_method)
+        stats += sorted((batch[0] for batch in loader), key=lambda s: s["process"])
+
+    print(f"{'process':<10} {'ready s':>8} {'RSS MB':>8} {'USS MB':>8} {'tokenizers':>11} {'text assets s':>14}")
+    for s in stats:
+        print(f"{s['process']:<10} {s['ready_s']:>8.2f} {s['rss_mb']:>8.0f} {s['uss_mb']:>8.0f} {s['tokenizers']:>11} "
+              f"{s['text_assets_s']:>14.2f}")
+    output = os.path.join(cwd, bench_args.output)
+    with open(output, "w") as f:
+        json.dump({"start_method": bench_args.start_method or torch.multiprocessing.get_start_method(),
+                   "num_workers": args.num_workers, "ema": args.ema, "processes": stats}, f, indent=2)
+    print(f"Wrote {output}")
+    del model_ema, evaluator
+
+
+if __name__ == "__main__":
+    main(*get_bench_args_parser().parse_known_args())
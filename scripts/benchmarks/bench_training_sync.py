@@ -0,0 +1,84 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""Training throughput against the number of steps between two reductions and logs of the losses.
+
+train_one_epoch keeps the losses of each step on the device (util.metrics.LossRingBuffer) and only reduces
+them over the processes, copies them to the host and logs them every --print_freq steps. With print_freq 1,
+the host waits for the device at every step, as it used to. Each configuration trains a copy of the same
+model on the same synthetic YouRefIt batches (see bench_memory_throughput.py).
+
+Example:
+    python scripts/benchmarks/bench_training_sync.py --dataset_config configs/yourefit.json --batch_size 4 \
+        --num_batches 50 --print_freqs 1 10 50
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from copy import deepcopy
+
+import torch
+
+PACKAGE_PARENT = "../.."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+from bench_memory_throughput import synthetic_batch
+from engine import train_one_epoch
+from main_ref import get_args_parser
+from models import build_model
+from util.misc import collate_fn
+from util.optim import build_adamw, build_param_dicts
+
+
+def local_get_args_parser():
+    parser = argparse.ArgumentParser("Training throughput against the logging frequency", parents=[get_args_parser()])
+    parser.add_argument("--print_freqs", default=[1, 10, 50], type=int, nargs="+")
+    parser.add_argument("--num_batches", default=50, type=int)
+    parser.add_argument("--image_size", default=[480, 640], type=int, nargs=2)
+    return parser
+
+
+def main(args):
+    if args.dataset_config is not None:
+        with open(args.dataset_config, "r") as f:
+            vars(args).update(json.load(f))
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    model, criterion, _, _, weight_dict = build_model(args)
+    model.to(device)
+    # the log of train_one_epoch is not written to a file
+    args.output_dir = None
+    args.epochs = 1
+
+    samples, captions, targets, positive_map = synthetic_batch(args.batch_size, args.image_size,
+                                                               model.transformer.tokenizer, torch.device("cpu"))
+    batch = collate_fn(False, list(zip(samples.tensors.unbind(0), targets)))
+    batch["positive_map"] = positive_map
+    data_loader = [batch] * args.num_batches
+    print(f"device {device}, batch size {args.batch_size}, {args.num_batches} steps")
+
+    print(f"{'print_freq':>10} {'images/s':>9} {'speedup':>8}")
+    baseline = None
+    for print_freq in args.print_freqs:
+        args.print_freq = print_freq
+        step_model = deepcopy(model)
+        optimizer = build_adamw(build_param_dicts(step_model, args), lr=args.lr, weight_decay=args.weight_decay,
+                                amsgrad=True)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            train_one_epoch(step_model, criterion, None, None, weight_dict, data_loader, optimizer, device, 0, args,
+                            args.clip_max_norm)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        images_per_second = args.batch_size * args.num_batches / (time.perf_counter() - start)
+        baseline = baseline or images_per_second
+        print(f"{print_freq:>10} {images_per_second:>9.2f} {images_per_second / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main(local_get_args_parser().parse_args())
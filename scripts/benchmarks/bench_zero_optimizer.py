@@ -0,0 +1,192 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""Memory per process of distributed training with the AdamW state replicated on every process or sharded between
+them (--zero_optimizer, util.optim.build_adamw), for several numbers of processes on one machine (gloo backend on CPU,
+NCCL with --device cuda).
+
+For each world size and variant, the processes are spawned with the environment of torchrun and set up by
+util.dist.init_distributed_mode, as in main_ref.py. Each of them builds the model, wraps it with
+util.dist.wrap_distributed and trains it for --num_steps steps of engine.train_one_epoch on a synthetic YouRefIt batch
+(see bench_memory_throughput.py). The report gives for each rank:
+    params MB: the trainable parameters, the same on every rank
+    state MB: the optimizer state kept by the rank (exp_avg, exp_avg_sq and max_exp_avg_sq with amsgrad)
+    peak RSS MB: the largest resident memory of the process (peak GPU memory with --device cuda)
+and for the sharded variant, whether the optimizer state of the rank is restored from a consolidated and from a
+sharded checkpoint (util.checkpoint.optimizer_state_dict and load_optimizer_state_dict), and the time taken to
+consolidate the state on rank 0. The checksum of the trained weights of rank 0 is the same for both variants.
+All the other arguments are those of main_ref.py.
+
+Example:
+    python scripts/benchmarks/bench_zero_optimizer.py --dataset_config configs/yourefit.json --world_sizes 2 4 8 \
+        --batch_size 1 --num_steps 3
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+PACKAGE_PARENT = "../.."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+VARIANTS = ("replicated", "sharded")
+
+
+def get_zero_args_parser():
+    """Arguments of the benchmark; all the others are parsed by the parser of main_ref.py."""
+    parser = argparse.ArgumentParser("Optimizer state sharding")
+    parser.add_argument("--world_sizes", default=[2, 4, 8], type=int, nargs="+")
+    parser.add_argument("--num_steps", default=3, type=int)
+    parser.add_argument("--image_size", default=[480, 640], type=int, nargs=2)
+    parser.add_argument("--port", default=29591, type=int)
+    parser.add_argument("--output", default=None, help="JSON file of the results")
+    return parser
+
+
+def megabytes(tensors):
+    return sum(t.numel() * t.element_size() for t in tensors) / 2 ** 20
+
+
+def state_tensors(optimizer):
+    """The tensors of the state the optimizer keeps on this rank."""
+    local = getattr(optimizer, "optim", optimizer)
+    return [v for state in local.state.values() for v in state.values() if torch.is_tensor(v) and v.dim() > 0]
+
+
+def same_local_state(a, b):
+    a, b = a.optim.state_dict()["state"], b.optim.state_dict()["state"]
+    return a.keys() == b.keys() and all(torch.equal(a[k][n].cpu(), b[k][n].cpu()) for k in a for n in a[k]
+                                        if torch.is_tensor(a[k][n]))
+
+
+def check_checkpoints(optimizer, build_optimizer, directory):
+    """Whether the state of optimizer on this rank is restored from a consolidated and from a sharded checkpoint,
+    and the milliseconds taken to consolidate it."""
+    import util.dist as dist
+    from util.checkpoint import load_optimizer_state_dict, optimizer_shard_path, optimizer_state_dict
+
+    path = os.path.join(directory, "checkpoint.pth")
+    start = time.perf_counter()
+    consolidated = optimizer_state_dict(optimizer)
+    consolidate_ms = (time.perf_counter() - start) * 1e3
+    if dist.is_main_process():
+        torch.save(consolidated, path)
+    torch.distributed.barrier()
+    restored = build_optimizer()
+    load_optimizer_state_dict(restored, torch.load(path, map_location="cpu"), path)
+    from_consolidated = same_local_state(optimizer, restored)
+    torch.distributed.barrier()
+
+    if dist.is_main_process():
+        torch.save(optimizer_state_dict(optimizer, sharded=True), path)
+    torch.save(optimizer.optim.state_dict(), optimizer_shard_path(path, dist.get_rank()))
+    torch.distributed.barrier()
+    restored = build_optimizer()
+    load_optimizer_state_dict(restored, torch.load(path, map_location="cpu"), path)
+    from_shards = same_local_state(optimizer, restored)
+    return from_consolidated, from_shards, consolidate_ms
+
+
+def worker(local_rank, world_size, variant, zero_args, remaining, directory, queue):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(zero_args.port + world_size),
+                      RANK=str(local_rank), WORLD_SIZE=str(world_size), LOCAL_RANK=str(local_rank),
+                      LOCAL_WORLD_SIZE=str(world_size))
+    import util.dist as dist
+    from bench_memory_throughput import synthetic_batch
+    from engine import train_one_epoch
+    from main_ref import get_args_parser
+    from models import build_model
+    from util.misc import collate_fn
+    from util.optim import build_adamw, build_param_dicts
+    from util.runtime_config import RuntimeConfig
+
+    parser = get_args_parser()
+    parser.set_defaults(device="cpu")
+    args = parser.parse_args(remaining)
+    if args.dataset_config is not None:
+        with open(args.dataset_config, "r") as f:
+            vars(args).update(json.load(f))
+    # the log of train_one_epoch is not written to a file
+    args.output_dir = None
+    args.epochs = 1
+    config = RuntimeConfig.from_args(args)
+
+    dist.init_distributed_mode(args)
+    device = torch.device(args.device)
+    if device.type == "cpu" and args.pin_threads:
+        dist.pin_cpu_threads(args.local_rank, args.local_size)
+    torch.manual_seed(args.seed)
+    model, criterion, _, _, weight_dict = build_model(args, config=config)
+    model.to(device)
+    ddp_model = dist.wrap_distributed(model, args, device)
+
+    def build_optimizer():
+        return build_adamw(build_param_dicts(model, args), lr=args.lr, weight_decay=args.weight_decay,
+                           amsgrad=config.amsgrad, implementation=args.optimizer_impl, shard=variant == "sharded")
+
+    optimizer = build_optimizer()
+    samples, captions, targets, positive_map = synthetic_batch(args.batch_size, zero_args.image_size,
+                                                               model.transformer.tokenizer, torch.device("cpu"))
+    batch = collate_fn(False, list(zip(samples.tensors.unbind(0), targets)))
+    batch["positive_map"] = positive_map
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    with contextlib.redirect_stdout(io.StringIO()):
+        train_one_epoch(ddp_model, criterion, None, None, weight_dict, [batch] * zero_args.num_steps, optimizer,
+                        device, 0, args, args.clip_max_norm, config=config)
+    if device.type == "cuda":
+        peak_mb = torch.cuda.max_memory_allocated(device) / 2 ** 20
+    else:
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+    result = {"world_size": world_size, "variant": variant, "rank": dist.get_rank(),
+              "params_mb": megabytes([p for p in model.parameters() if p.requires_grad]),
+              "state_mb": megabytes(state_tensors(optimizer)), "peak_mb": peak_mb,
+              "weights_checksum": sum(p.detach().double().sum().item() for p in model.parameters())}
+    if variant == "sharded":
+        result["from_consolidated"], result["from_shards"], result["consolidate_ms"] = check_checkpoints(
+            optimizer, build_optimizer, directory)
+    queue.put(result)
+    torch.distributed.barrier()
+    torch.distributed.destroy_process_group()
+
+
+def main(zero_args, remaining):
+    results = []
+    print(f"{'ranks':>5} {'variant':<10} {'rank':>4} {'params MB':>9} {'state MB':>9} {'peak MB':>8} "
+          f"{'consolidated':>12} {'shards':>6} {'consolidate ms':>14}")
+    for world_size in zero_args.world_sizes:
+        checksums = {}
+        for variant in VARIANTS:
+            queue = mp.get_context("spawn").SimpleQueue()
+            with tempfile.TemporaryDirectory() as directory:
+                mp.spawn(worker, args=(world_size, variant, zero_args, remaining, directory, queue),
+                         nprocs=world_size)
+            ranks = sorted((queue.get() for _ in range(world_size)), key=lambda r: r["rank"])
+            for r in ranks:
+                checks = ""
+                if variant == "sharded":
+                    checks = (f"{str(r['from_consolidated']):>12} {str(r['from_shards']):>6} "
+                              f"{r['consolidate_ms']:>14.0f}")
+                print(f"{world_size:>5} {variant:<10} {r['rank']:>4} {r['params_mb']:>9.1f} {r['state_mb']:>9.1f} "
+                      f"{r['peak_mb']:>8.0f} {checks}")
+            print(f"{world_size:>5} {variant:<10} {'sum':>4} {'':>9} {sum(r['state_mb'] for r in ranks):>9.1f} "
+                  f"{sum(r['peak_mb'] for r in ranks):>8.0f}")
+            checksums[variant] = ranks[0]["weights_checksum"]
+            results += ranks
+        print(f"weights checksum of rank 0: {checksums}")
+
+    if zero_args.output is not None:
+        with open(zero_args.output, "w") as f:
+            json.dump({"cpu_count": os.cpu_count(), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(*get_zero_args_parser().parse_known_args())
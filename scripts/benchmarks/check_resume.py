@@ -0,0 +1,215 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""Check that training interrupted in the middle of an epoch and resumed from its checkpoint has the same losses,
+bit for bit, as uninterrupted training.
+
+Three runs train the same model on the training split of a synthetic YouRefIt dataset (see synthetic_yourefit.py),
+with the random augmentations of the training set, the data loading of main_ref.py (util.resume) and
+engine.train_one_epoch:
+    uninterrupted: --epochs epochs
+    interrupted:   the same, until the process sends itself SIGUSR1 after --interrupt_step steps; the
+                   PreemptionHandler stops it at the end of the step, and the training state is saved the way
+                   main_ref.py saves it
+    resumed:       a new model, built with another seed, loads the checkpoint and trains until the end
+The losses of every step (the outputs of the criterion) of the interrupted and resumed runs must be equal to the
+ones of the uninterrupted run, and so must the final weights, EMA weights and optimizer state. The arguments of
+main_ref.py are all accepted, e.g. to train a smaller model or to load the data in worker processes.
+
+Example:
+    python scripts/benchmarks/check_resume.py --dataset_config configs/yourefit.json --epochs 2 --batch_size 2 \
+        --num_workers 2 --ema
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import signal
+import sys
+import tempfile
+from copy import deepcopy
+from functools import partial
+
+import numpy as np
+import torch
+
+PACKAGE_PARENT = "../.."
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+from synthetic_yourefit import generate
+
+
+def get_check_args_parser():
+    """Arguments of the check; all the others are parsed by the parser of main_ref.py."""
+    parser = argparse.ArgumentParser("Bitwise identical losses of interrupted and uninterrupted training")
+    parser.add_argument("--synthetic_root", default="yourefit_synthetic")
+    parser.add_argument("--num_synthetic_train", default=16, type=int)
+    parser.add_argument("--interrupt_step", default=None, type=int,
+                        help="number of steps before the interruption, by default the middle of the last epoch")
+    parser.add_argument("--verbose", action="store_true", help="print the output of engine.train_one_epoch")
+    return parser
+
+
+class Run(object):
+    """A model, its optimizer and the data loader of main_ref.py, built with seed, and the losses of its steps."""
+
+    def __init__(self, args, dataset, seed):
+        from torch.utils.data import DataLoader, RandomSampler
+
+        import util.misc as utils
+        from magic_numbers import AMSGRAD
+        from models import build_model
+        from util.optim import build_adamw, build_param_dicts
+        from util.resume import ResumableBatchSampler, SeededDataset
+
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        self.model, self.criterion, _, _, self.weight_dict = build_model(args)
+        self.model.to(args.device)
+        self.model_ema = deepcopy(self.model) if args.ema else None
+        self.optimizer = build_adamw(build_param_dicts(self.model, args), lr=args.lr, weight_decay=args.weight_decay,
+                                     amsgrad=AMSGRAD, implementation=args.optimizer_impl)
+        self.batch_sampler = ResumableBatchSampler(RandomSampler(dataset), args.batch_size, drop_last=True,
+                                                   seed=args.seed)
+        self.data_loader = DataLoader(SeededDataset(dataset), batch_sampler=self.batch_sampler,
+                                      collate_fn=partial(utils.collate_fn, False), num_workers=args.num_workers,
+                                      generator=torch.Generator().manual_seed(args.seed))
+        self.losses = []
+        self.criterion.register_forward_hook(self.record)
+
+    def record(self, module, inputs, output):
+        self.losses.append({k: v.detach().cpu().clone() for k, v in output.items()})
+
+    def state(self, epoch, step):
+        from util.resume import gather_rng_states
+
+        return {
+            "model": self.model.state_dict(),
+            "model_ema": self.model_ema.state_dict() if self.model_ema is not None else None,
+            "optimizer": self.optimizer.state_dict(),
+            "epoch": epoch,
+            "step": step,
+            "rng": gather_rng_states(),
+        }
+
+    def load(self, checkpoint):
+        from util.resume import restore_rng_states
+
+        self.model.load_state_dict(checkpoint["model"])
+        if self.model_ema is not None:
+            self.model_ema.load_state_dict(checkpoint["model_ema"])
+        self.optimizer.load_state_dict(checkpoint["optimizer"])
+        restore_rng_states(checkpoint["rng"])
+
+    def train(self, args, verbose, start_epoch=0, start_step=0, step_callback=None):
+        """Train from step start_step of start_epoch, and return the epoch where step_callback stopped, if it did."""
+        from engine import train_one_epoch
+
+        for epoch in range(start_epoch, args.epochs):
+            self.batch_sampler.set_epoch(epoch, start_step if epoch == start_epoch else 0)
+            callback = partial(step_callback, epoch) if step_callback is not None else None
+            steps_before = len(self.losses)
+            with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+                train_one_epoch(self.model, self.criterion, None, None, self.weight_dict, self.data_loader,
+                                self.optimizer, torch.device(args.device), epoch, args, args.clip_max_norm,
+                                model_ema=self.model_ema, start_step=self.batch_sampler.start_batch,
+                                step_callback=callback)
+            if len(self.losses) - steps_before < len(self.data_loader):
+                return epoch
+        return None
+
+
+def first_difference(a, b):
+    """The first step where the losses of a and b differ, or None."""
+    for step, (x, y) in enumerate(zip(a, b)):
+        if x.keys() != y.keys() or not all(torch.equal(x[k], y[k]) for k in x):
+            return step
+    return None if len(a) == len(b) else min(len(a), len(b))
+
+
+def equal_state_dicts(a, b):
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(equal_state_dicts(a[k], b[k]) for k in a)
+    if isinstance(a, torch.Tensor):
+        return torch.equal(a, b)
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(equal_state_dicts(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def main(check_args, remaining):
+    cwd = os.getcwd()
+    synthetic_root = os.path.abspath(check_args.synthetic_root)
+    if not os.path.exists(os.path.join(synthetic_root, "yourefit")):
+        generate(synthetic_root, num_train=check_args.num_synthetic_train)
+    # the training set and its eye to fingertip annotations (a relative default path of RuntimeConfig) are read
+    # from the working directory
+    os.chdir(synthetic_root)
+    from datasets.coco import make_coco_transforms
+    from datasets.yourefit import ReferDataset
+    from main_ref import get_args_parser
+    from util.resume import PreemptionHandler
+
+    parser = get_args_parser()
+    parser.set_defaults(device="cpu", epochs=2, num_workers=0)
+    # the dataset config sets the defaults, so that --epochs and such still apply
+    config = parser.parse_known_args(remaining)[0].dataset_config
+    if config is not None:
+        with open(os.path.join(cwd, config), "r") as f:
+            parser.set_defaults(**json.load(f))
+    args = parser.parse_args(remaining)
+    args.output_dir = None
+    dataset = ReferDataset(data_root=".", split_root=".", dataset="yourefit", split="train",
+                           transform=make_coco_transforms("train", False), augment=False, args=args)
+
+    uninterrupted = Run(args, dataset, args.seed)
+    uninterrupted.train(args, check_args.verbose)
+    steps = len(uninterrupted.losses)
+    interrupt_step = check_args.interrupt_step
+    if interrupt_step is None:
+        interrupt_step = steps - len(uninterrupted.data_loader) // 2
+    print(f"uninterrupted: {args.epochs} epochs of {len(uninterrupted.data_loader)} steps")
+
+    interrupted = Run(args, dataset, args.seed)
+    handler = PreemptionHandler()
+    checkpoint_path = os.path.join(tempfile.mkdtemp(), "checkpoint.pth")
+
+    def interrupt(epoch, steps_done):
+        if len(interrupted.losses) == interrupt_step:
+            os.kill(os.getpid(), signal.SIGUSR1)
+        # as main_ref.py, a signal on the last step of an epoch stops after the checkpoint of the epoch
+        epoch_steps = interrupted.batch_sampler.start_batch + len(interrupted.data_loader)
+        if handler.should_stop() and steps_done < epoch_steps:
+            torch.save(interrupted.state(epoch, steps_done), checkpoint_path)
+            return True
+        return False
+
+    interrupted_epoch = interrupted.train(args, check_args.verbose, step_callback=interrupt)
+    handler.close()
+    if interrupted_epoch is None:
+        raise RuntimeError(f"Training was not interrupted, --interrupt_step should be smaller than {steps}")
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+    print(f"interrupted: after {len(interrupted.losses)} steps, in epoch {checkpoint['epoch']} "
+          f"after step {checkpoint['step']}")
+
+    resumed = Run(args, dataset, args.seed + 1)
+    resumed.load(checkpoint)
+    resumed.train(args, check_args.verbose, start_epoch=checkpoint["epoch"], start_step=checkpoint["step"])
+    print(f"resumed: {len(resumed.losses)} steps")
+
+    difference = first_difference(uninterrupted.losses, interrupted.losses + resumed.losses)
+    same_model = equal_state_dicts(uninterrupted.model.state_dict(), resumed.model.state_dict())
+    same_ema = uninterrupted.model_ema is None or equal_state_dicts(uninterrupted.model_ema.state_dict(),
+                                                                     resumed.model_ema.state_dict())
+    same_optimizer = equal_state_dicts(uninterrupted.optimizer.state_dict(), resumed.optimizer.state_dict())
+    print(f"identical losses: {difference is None}" + (f" (first difference at step {difference})"
+                                                       if difference is not None else ""))
+    print(f"identical weights: {same_model}, EMA: {same_ema}, optimizer state: {same_optimizer}")
+    if difference is not None or not (same_model and same_ema and same_optimizer):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(*get_check_args_parser().parse_known_args())
@@ -0,0 +1,135 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""Offline load generator for serve.py.
+
+Sends (image, sentence) requests with a fixed number of concurrent connections, then prints the
+client-side latency percentiles and throughput next to the /metrics reported by the server.
+Images are synthetic unless --image_dir is given, so no dataset or network access is needed.
+
+Example:
+    python scripts/benchmarks/load_generator.py --port 8080 --requests 500 --concurrency 16
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+SENTENCES = [
+    "the cup on the table",
+    "the red bottle next to the chair",
+    "that book",
+    "the small plant on the left of the window near the lamp",
+]
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("Load generator for serve.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", default=8080, type=int)
+    parser.add_argument("--requests", default=200, type=int)
+    parser.add_argument("--concurrency", default=8, type=int, help="number of concurrent connections")
+    parser.add_argument("--image_dir", default=None, help="directory of jpg / png images, synthetic if not set")
+    parser.add_argument("--image_size", default=[480, 640], type=int, nargs=2)
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument("--output", default=None, help="optional json file for the report")
+    return parser
+
+
+def make_payloads(args, num_payloads=16):
+    if args.image_dir:
+        names = sorted(n for n in os.listdir(args.image_dir) if n.lower().endswith((".jpg", ".jpeg", ".png")))
+        images = []
+        for name in names[:num_payloads]:
+            with open(os.path.join(args.image_dir, name), "rb") as f:
+                images.append(f.read())
+    else:
+        rng = np.random.RandomState(args.seed)
+        h, w = args.image_size
+        images = []
+        for _ in range(num_payloads):
+            buffer = io.BytesIO()
+            Image.fromarray(rng.randint(0, 255, size=(h, w, 3), dtype=np.uint8)).save(buffer, format="JPEG")
+            images.append(buffer.getvalue())
+    return [
+        json.dumps({"image": base64.b64encode(image).decode(), "sentence": SENTENCES[i % len(SENTENCES)]}).encode()
+        for i, image in enumerate(images)
+    ]
+
+
+async def http_request(reader, writer, method, path, body=b""):
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: keep-alive\r\n\r\n".encode("latin-1") + body
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        key, value = line.decode("latin-1").split(":", 1)
+        headers[key.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return status, json.loads(body)
+
+
+async def client(args, payloads, counter, latencies, errors):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    try:
+        while True:
+            i = next(counter, None)
+            if i is None:
+                break
+            start = time.perf_counter()
+            status, response = await http_request(reader, writer, "POST", "/predict", payloads[i % len(payloads)])
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors.append(response)
+    finally:
+        writer.close()
+
+
+async def run(args):
+    payloads = make_payloads(args)
+    latencies, errors = [], []
+    counter = iter(range(args.requests))
+    start = time.perf_counter()
+    await asyncio.gather(*[client(args, payloads, counter, latencies, errors) for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    _, server_metrics = await http_request(reader, writer, "GET", "/metrics")
+    writer.close()
+
+    latency = np.array(latencies) * 1000
+    report = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "errors": len(errors),
+        "client_latency_ms_p50": float(np.percentile(latency, 50)) if len(latency) else None,
+        "client_latency_ms_p99": float(np.percentile(latency, 99)) if len(latency) else None,
+        "client_throughput_per_s": len(latencies) / elapsed,
+        "server": server_metrics,
+    }
+    if errors:
+        report["first_error"] = errors[0]
+    return report
+
+
+def main(args):
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(get_args_parser().parse_args())
@@ -0,0 +1,143 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""Write a synthetic dataset in the on-disk layout of YouRefIt, as read by datasets.yourefit.ReferDataset.
+
+    <root>/yourefit/
+        images/<name>.jpg                   random image with the referred object drawn in it
+        paf/<name>_rendered.png             part affinity field rendering, 3 channels, same size as the image
+        saliency/<name>.jpeg                saliency map
+        pickle/<name>.p                     {"bbox": [x1, y1, x2, y2], "anno_target": word, "anno_sentence": sentence}
+        arms.json                           {name: [[elbow x, elbow y], [wrist x, wrist y]]}
+        {train,val,test}_id.txt             one image name per line
+        eye_to_fingertip/eye_to_fingertip_annotations_{train,valid}.csv
+                                            name, eye_x, eye_y, fingertip_x, fingertip_y
+
+The arms and eye to fingertip rays point at the center of the referred object. Every training image has an
+eye to fingertip annotation, as ReferDataset requires, while one validation image in five has none, to
+exercise the handling of missing annotations. Object sizes cycle through the small, medium and large
+categories of the evaluator. The content only depends on the seed.
+
+The default paths of the eye to fingertip annotations in RuntimeConfig (magic_numbers.py) are relative, so the
+datasets are built from <root> as the working directory, as bench_suite.py does.
+
+Example:
+    python scripts/benchmarks/synthetic_yourefit.py --root /tmp/yourefit_synthetic --num_train 64 --num_val 32
+"""
+import argparse
+import csv
+import json
+import os
+import pickle
+import random
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+OBJECTS = ["cup", "bottle", "book", "chair", "plant", "lamp", "bag", "box", "shoes", "laptop"]
+COLORS = ["red", "blue", "green", "white", "black", "yellow"]
+PLACES = ["on the table", "on the floor", "next to the sofa", "near the window", "on the shelf", "by the door"]
+# fractions of the image area of small, medium and large objects, see EVAL_SMALL_MEDIUM_LARGE_THRESHODS
+OBJECT_AREAS = [0.003, 0.01, 0.05]
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("Synthetic YouRefIt dataset")
+    parser.add_argument("--root", default="yourefit_synthetic", help="the dataset is written to <root>/yourefit")
+    parser.add_argument("--num_train", default=64, type=int)
+    parser.add_argument("--num_val", default=32, type=int)
+    parser.add_argument("--num_test", default=16, type=int)
+    parser.add_argument("--image_size", default=[540, 960], type=int, nargs=2, help="height and width")
+    parser.add_argument("--seed", default=0, type=int)
+    return parser
+
+
+def random_sample(rng, index, height, width):
+    """The annotations of one image: box, arm and eye to fingertip ray in pixels, target word and sentence."""
+    area = OBJECT_AREAS[index % len(OBJECT_AREAS)] * height * width
+    aspect = rng.uniform(0.5, 2.0)
+    box_w = min(np.sqrt(area * aspect), width / 2)
+    box_h = min(area / box_w, height / 2)
+    x1 = rng.uniform(width / 2, width - box_w - 1)
+    y1 = rng.uniform(0, height - box_h - 1)
+    bbox = [int(x1), int(y1), int(x1 + box_w), int(y1 + box_h)]
+    center = np.array([(bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2])
+
+    # a person on the left pointing at the object
+    eye = np.array([rng.uniform(0.05, 0.3) * width, rng.uniform(0.2, 0.5) * height])
+    ray = (center - eye) / np.linalg.norm(center - eye)
+    fingertip = eye + ray * rng.uniform(0.1, 0.2) * width
+    wrist = fingertip - ray * 0.03 * width
+    elbow = wrist - ray * 0.08 * width + np.array([0, 0.05 * height])
+
+    word = OBJECTS[index % len(OBJECTS)]
+    sentence = f"the {rng.choice(COLORS)} {word} {rng.choice(PLACES)}"
+    return {"bbox": bbox, "arm": [elbow.tolist(), wrist.tolist()], "eye": eye.tolist(),
+            "fingertip": fingertip.tolist(), "anno_target": word, "anno_sentence": sentence}
+
+
+def write_image(path, rng_np, height, width, bbox):
+    image = (rng_np.rand(height // 8, width // 8, 3) * 255).astype(np.uint8)
+    image = Image.fromarray(image).resize((width, height), Image.BILINEAR)
+    ImageDraw.Draw(image).rectangle(bbox, fill=tuple(int(c) for c in rng_np.randint(0, 255, 3)))
+    image.save(path, quality=90)
+
+
+def write_paf(path, height, width, sample):
+    paf = Image.new("RGB", (width, height))
+    draw = ImageDraw.Draw(paf)
+    draw.line([tuple(sample["arm"][0]), tuple(sample["arm"][1])], fill=(255, 255, 255), width=max(width // 100, 1))
+    draw.line([tuple(sample["eye"]), tuple(sample["fingertip"])], fill=(128, 128, 128), width=max(width // 200, 1))
+    paf.save(path)
+
+
+def write_saliency(path, height, width, bbox):
+    saliency = Image.new("RGB", (width // 4, height // 4))
+    ImageDraw.Draw(saliency).ellipse([c // 4 for c in bbox], fill=(255, 255, 255))
+    saliency.save(path, quality=90)
+
+
+def generate(root, num_train=64, num_val=32, num_test=16, image_size=(540, 960), seed=0):
+    """Write the dataset to <root>/yourefit and return its directory."""
+    height, width = image_size
+    dataset_root = os.path.join(root, "yourefit")
+    for directory in ("images", "paf", "saliency", "pickle", "eye_to_fingertip"):
+        os.makedirs(os.path.join(dataset_root, directory), exist_ok=True)
+
+    rng = random.Random(seed)
+    rng_np = np.random.RandomState(seed)
+    arms = {}
+    annotations = {"train": [], "valid": []}
+    index = 0
+    for split, count in (("train", num_train), ("val", num_val), ("test", num_test)):
+        names = []
+        for _ in range(count):
+            name = f"synthetic_{split}_{index:06d}"
+            sample = random_sample(rng, index, height, width)
+            write_image(os.path.join(dataset_root, "images", name + ".jpg"), rng_np, height, width, sample["bbox"])
+            write_paf(os.path.join(dataset_root, "paf", name + "_rendered.png"), height, width, sample)
+            write_saliency(os.path.join(dataset_root, "saliency", name + ".jpeg"), height, width, sample["bbox"])
+            with open(os.path.join(dataset_root, "pickle", name + ".p"), "wb") as f:
+                pickle.dump({k: sample[k] for k in ("bbox", "anno_target", "anno_sentence")}, f, protocol=4)
+            arms[name] = sample["arm"]
+            if split == "train" or (split == "val" and index % 5 != 0):
+                annotations["train" if split == "train" else "valid"].append(
+                    [name, *sample["eye"], *sample["fingertip"]])
+            names.append(name)
+            index += 1
+        with open(os.path.join(dataset_root, f"{split}_id.txt"), "w") as f:
+            f.writelines(name + "\n" for name in names)
+
+    with open(os.path.join(dataset_root, "arms.json"), "w") as f:
+        json.dump(arms, f)
+    for split, rows in annotations.items():
+        path = os.path.join(dataset_root, "eye_to_fingertip", f"eye_to_fingertip_annotations_{split}.csv")
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["name", "eye_x", "eye_y", "fingertip_x", "fingertip_y"])
+            writer.writerows(rows)
+    return dataset_root
+
+
+if __name__ == "__main__":
+    args = get_args_parser().parse_args()
+    path = generate(args.root, args.num_train, args.num_val, args.num_test, args.image_size, args.seed)
+    print(f"Wrote {args.num_train} train, {args.num_val} val and {args.num_test} test images to {path}")
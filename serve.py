@@ -0,0 +1,288 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Long-lived HTTP inference service for touch-line referring expressions.
+
+The model is loaded once. Concurrent requests are coalesced into micro-batches: a batch is run as soon
+as --max_batch_size requests are waiting, or when the oldest waiting request has spent --max_wait_ms
+in the queue. Only the standard library is used for the HTTP layer.
+
+Endpoints:
+    POST /predict   {"image": <base64 encoded jpeg / png>, "sentence": "the cup on the table"}
+                    -> {"box": [x0, y0, x1, y1], "score": s, "eye": [x, y], "fingertip": [x, y], "arm_score": s}
+                    (coordinates in pixels of the submitted image)
+    GET  /metrics   latency percentiles, throughput and batch sizes
+    GET  /health
+
+Example:
+    python serve.py --dataset_config configs/yourefit.json --load pretrained/best_etf.pth --port 8080
+    python scripts/benchmarks/load_generator.py --port 8080 --requests 500 --concurrency 16
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+from datasets.coco import make_coco_transforms
+from engine import inference_targets, run_inference
+from main_ref import get_args_parser
+from models import build_model
+from models.deploy import load_deployed_model
+from models.postprocessors import PostProcess
+from optimize_cpu import load_weights
+from util.misc import NestedTensorBuffer
+
+
+class ServingMetrics(object):
+    """Latency and throughput of the requests served, over a sliding window of the last window_size requests."""
+
+    def __init__(self, window_size=10000):
+        self.latencies = deque(maxlen=window_size)
+        self.batch_sizes = deque(maxlen=window_size)
+        self.num_requests = 0
+        self.num_errors = 0
+        self.first_request_time = None
+
+    def record_batch(self, batch_size):
+        self.batch_sizes.append(batch_size)
+
+    def record_request(self, latency):
+        if self.first_request_time is None:
+            self.first_request_time = time.perf_counter() - latency
+        self.latencies.append(latency)
+        self.num_requests += 1
+
+    def summary(self):
+        latency = np.array(self.latencies) * 1000
+        elapsed = time.perf_counter() - self.first_request_time if self.first_request_time else 0.0
+        return {
+            "num_requests": self.num_requests,
+            "num_errors": self.num_errors,
+            "latency_ms_p50": float(np.percentile(latency, 50)) if len(latency) else None,
+            "latency_ms_p99": float(np.percentile(latency, 99)) if len(latency) else None,
+            "latency_ms_mean": float(latency.mean()) if len(latency) else None,
+            "throughput_per_s": self.num_requests / elapsed if elapsed > 0 else None,
+            "batch_size_mean": float(np.mean(self.batch_sizes)) if self.batch_sizes else None,
+            "batch_size_max": int(max(self.batch_sizes)) if self.batch_sizes else None,
+        }
+
+
+def top_prediction(result):
+    """Reduce one PostProcess result to the top box and the top arm, as plain python values."""
+    best = result["scores"].argmax()
+    prediction = {"box": result["boxes"][best].tolist(), "score": result["scores"][best].item()}
+    if "arms" in result:
+        best_arm = result["arms_scores"].argmax()
+        arm = result["arms"][best_arm].tolist()
+        prediction.update({"eye": arm[0:2], "fingertip": arm[2:4], "arm_score": result["arms_scores"][best_arm].item()})
+    return prediction
+
+
+class MicroBatcher(object):
+    """Coalesce single requests into batches under a latency budget.
+
+    Preprocessing (decoding, resizing) runs on a pool of threads. The model runs on a single
+    dedicated thread, so that every batch gets all the intra-op threads.
+    """
+
+    def __init__(self, model, device="cpu", max_batch_size=8, max_wait_ms=10, preprocess_workers=2):
+        self.model = model.eval()
+        self.device = torch.device(device)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.transform = make_coco_transforms("val", False)
+        self.postprocess = PostProcess()
+        self.buffer = NestedTensorBuffer(device=self.device)
+        self.metrics = ServingMetrics()
+        self._preprocess_executor = ThreadPoolExecutor(preprocess_workers, thread_name_prefix="preprocess")
+        self._model_executor = ThreadPoolExecutor(1, thread_name_prefix="model")
+        self._queue = None
+        self._task = None
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_event_loop().create_task(self._batch_loop())
+
+    async def stop(self):
+        self._task.cancel()
+        self._preprocess_executor.shutdown()
+        self._model_executor.shutdown()
+
+    def _preprocess(self, image_bytes):
+        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        w, h = image.size
+        img, _ = self.transform(image, None)
+        return img, torch.tensor([h, w])
+
+    async def predict(self, image_bytes, sentence):
+        start = time.perf_counter()
+        loop = asyncio.get_event_loop()
+        img, orig_size = await loop.run_in_executor(self._preprocess_executor, self._preprocess, image_bytes)
+        future = loop.create_future()
+        await self._queue.put((img, sentence, orig_size, future))
+        prediction = await future
+        self.metrics.record_request(time.perf_counter() - start)
+        return prediction
+
+    async def _next_batch(self):
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    @torch.no_grad()
+    def _run_batch(self, imgs, captions, orig_sizes):
+        samples = self.buffer.from_tensor_list(imgs)
+        outputs = run_inference(self.model, samples, captions)
+        results = self.postprocess(outputs, torch.stack(orig_sizes).to(self.device),
+                                   targets=inference_targets(captions))
+        return [top_prediction(r) for r in results]
+
+    async def _batch_loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._next_batch()
+            imgs, captions, orig_sizes, futures = zip(*batch)
+            self.metrics.record_batch(len(batch))
+            try:
+                predictions = await loop.run_in_executor(self._model_executor, self._run_batch,
+                                                         list(imgs), list(captions), list(orig_sizes))
+            except Exception as e:
+                self.metrics.num_errors += len(batch)
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for future, prediction in zip(futures, predictions):
+                if not future.done():
+                    future.set_result(prediction)
+
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+
+async def read_request(reader):
+    """Parse one HTTP/1.1 request. Returns (method, path, headers, body), or None on a closed connection."""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, value = line.decode("latin-1").split(":", 1)
+        headers[key.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path, headers, body
+
+
+def write_response(writer, status, payload, keep_alive):
+    body = json.dumps(payload).encode()
+    head = (
+        f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+        f"Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    writer.write(head.encode("latin-1") + body)
+
+
+class InferenceServer(object):
+    def __init__(self, batcher, host="127.0.0.1", port=8080):
+        self.batcher = batcher
+        self.host = host
+        self.port = port
+
+    async def handle(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        if method == "GET" and path == "/metrics":
+            return 200, self.batcher.metrics.summary()
+        if method == "POST" and path == "/predict":
+            try:
+                request = json.loads(body)
+                image_bytes = base64.b64decode(request["image"])
+                sentence = request["sentence"]
+            except (ValueError, KeyError, TypeError) as e:
+                return 400, {"error": f"expected a json body with 'image' and 'sentence': {e}"}
+            try:
+                return 200, await self.batcher.predict(image_bytes, sentence)
+            except Exception as e:
+                return 500, {"error": repr(e)}
+        return 404, {"error": f"unknown endpoint {method} {path}"}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get("connection", "keep-alive").lower() != "close"
+                status, payload = await self.handle(method, path, body)
+                write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve_forever(self):
+        self.batcher.start()
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        print(f"Serving on http://{self.host}:{self.port}")
+        async with server:
+            await server.serve_forever()
+
+
+def get_serve_args_parser():
+    parser = argparse.ArgumentParser("Inference server", add_help=False)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", default=8080, type=int)
+    parser.add_argument("--deployed", default=None, help="model saved by optimize_cpu.py, instead of --load")
+    parser.add_argument("--max_batch_size", default=8, type=int)
+    parser.add_argument("--max_wait_ms", default=10, type=float,
+                        help="latency budget: longest time a request waits for a batch to fill up")
+    parser.add_argument("--preprocess_workers", default=2, type=int)
+    return parser
+
+
+def main(args):
+    if args.deployed:
+        model, _ = load_deployed_model(args.deployed)
+        args.device = "cpu"
+    else:
+        if args.dataset_config is not None:
+            with open(args.dataset_config, "r") as f:
+                vars(args).update(json.load(f))
+        model, _, _, _, _ = build_model(args, pretrained=not args.load)
+        if args.load:
+            load_weights(model, args.load)
+        model.to(args.device)
+    batcher = MicroBatcher(model, device=args.device, max_batch_size=args.max_batch_size,
+                           max_wait_ms=args.max_wait_ms, preprocess_workers=args.preprocess_workers)
+    asyncio.run(InferenceServer(batcher, args.host, args.port).serve_forever())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Touch-line transformer inference server",
+                                     parents=[get_args_parser(), get_serve_args_parser()])
+    main(parser.parse_args())
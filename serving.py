@@ -0,0 +1,96 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Concurrent CPU inference with a single loaded model.
+
+The forward pass keeps all per-call state in local variables (see engine.run_inference), so one
+model instance can be shared by the threads of a pool. The cores of the machine are split between
+the workers: each request runs its operators on cores // num_workers intra-op threads.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from datasets.coco import make_coco_transforms
+from engine import inference_targets, run_inference
+from models.postprocessors import PostProcess
+from util.misc import NestedTensor
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def partition_threads(num_workers, num_cores=None):
+    """Give each of num_workers concurrent callers an equal share of the cores. Returns the share."""
+    num_cores = num_cores or available_cores()
+    intra_op_threads = max(1, num_cores // num_workers)
+    torch.set_num_threads(intra_op_threads)
+    return intra_op_threads
+
+
+class ThreadedPredictor(object):
+    """Run single-image requests through one model from a pool of threads.
+
+    Args:
+        model: MDETR model (or a model returned by models.deploy.load_deployed_model)
+        num_workers: number of requests processed concurrently
+        intra_op_threads: threads used by each request, defaults to cores // num_workers
+    """
+
+    def __init__(self, model, num_workers=1, intra_op_threads=None, device="cpu"):
+        self.model = model.eval()
+        self.device = torch.device(device)
+        self.transform = make_coco_transforms("val", False)
+        self.postprocess = PostProcess()
+        self.num_workers = num_workers
+        if intra_op_threads is None:
+            self.intra_op_threads = partition_threads(num_workers)
+        else:
+            self.intra_op_threads = intra_op_threads
+            torch.set_num_threads(intra_op_threads)
+        self._executor = ThreadPoolExecutor(
+            max_workers=num_workers,
+            thread_name_prefix="predictor",
+            initializer=torch.set_num_threads,
+            initargs=(self.intra_op_threads,),
+        )
+        self._num_inflight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def num_inflight(self):
+        return self._num_inflight
+
+    @torch.no_grad()
+    def predict(self, image, caption):
+        """Predict boxes and arms for one PIL image, in pixels of the original image."""
+        w, h = image.size
+        img, _ = self.transform(image, None)
+        samples = NestedTensor.from_tensor_list([img]).to(self.device)
+        outputs = run_inference(self.model, samples, [caption])
+        target_sizes = torch.tensor([[h, w]], device=self.device)
+        result = self.postprocess(outputs, target_sizes, targets=inference_targets([caption]))[0]
+        return {k: v.cpu() for k, v in result.items()}
+
+    def _predict_tracked(self, image, caption):
+        with self._lock:
+            self._num_inflight += 1
+        try:
+            return self.predict(image, caption)
+        finally:
+            with self._lock:
+                self._num_inflight -= 1
+
+    def submit(self, image, caption):
+        """Queue one request, returns a concurrent.futures.Future of the predict result."""
+        return self._executor.submit(self._predict_tracked, image, caption)
+
+    def map(self, images, captions):
+        return [f.result() for f in [self.submit(i, c) for i, c in zip(images, captions)]]
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
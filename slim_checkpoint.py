@@ -0,0 +1,73 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Write the inference checkpoint of a training checkpoint.
+
+The training checkpoints of main_ref.py hold the model, the EMA model, the AdamW state, the args and the runtime
+config. The inference checkpoint only holds the EMA weights (or the model weights with --weights model), without the
+parameters no prediction depends on (models.mdetr.inference_unused_prefixes, for the args and runtime config of the
+checkpoint, and the --strip prefixes), in half precision with --fp16. It is written in the safetensors layout,
+memory-mapped by --load of main_ref.py, demo.py and optimize_cpu.py (util.checkpoint.LazyStateDict), and keeps the
+args of the checkpoint in its metadata.
+
+Example:
+    python slim_checkpoint.py output_dir/BEST_checkpoint_since0.pth --output pretrained/best_etf.safetensors --fp16
+"""
+import argparse
+import json
+import os
+
+import torch
+
+from models.mdetr import inference_unused_prefixes
+from util.checkpoint import save_slim
+from util.runtime_config import RuntimeConfig
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("Inference checkpoint")
+    parser.add_argument("checkpoint", help="checkpoint written by main_ref.py")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--weights", default="ema", choices=("ema", "model"),
+                        help="the EMA weights, or the model weights if the checkpoint has no EMA weights")
+    parser.add_argument("--fp16", action="store_true", help="store the floating point weights in half precision")
+    parser.add_argument("--keep_unused", action="store_true",
+                        help="keep the parameters no prediction depends on")
+    parser.add_argument("--strip", default=[], nargs="*", help="also remove the parameters with these prefixes")
+    return parser
+
+
+def main(args):
+    checkpoint = torch.load(args.checkpoint, map_location="cpu")
+    weights = "model"
+    if args.weights == "ema" and checkpoint.get("model_ema") is not None:
+        weights = "model_ema"
+    elif args.weights == "ema":
+        print("No EMA weights in the checkpoint, using the model weights")
+    state_dict = checkpoint[weights]
+    train_args = checkpoint.get("args")
+
+    prefixes = list(args.strip)
+    if not args.keep_unused:
+        if train_args is not None:
+            config = RuntimeConfig.from_dict(checkpoint.get("runtime_config") or {})
+            prefixes += inference_unused_prefixes(train_args, config)
+        else:
+            print("No args in the checkpoint, only removing the --strip parameters")
+    stripped = [k for k in state_dict if k.startswith(tuple(prefixes))]
+    state_dict = {k: v for k, v in state_dict.items() if k not in stripped}
+    if args.fp16:
+        state_dict = {k: v.half() if v.is_floating_point() else v for k, v in state_dict.items()}
+
+    metadata = {"format": "pt", "source": os.path.basename(args.checkpoint), "weights": weights,
+                "epoch": checkpoint.get("epoch")}
+    if train_args is not None:
+        metadata["args"] = json.dumps(vars(train_args), default=str)
+    save_slim(state_dict, args.output, metadata)
+
+    print(f"Removed {len(stripped)} tensors with the prefixes {sorted(set(prefixes))}")
+    print(f"Wrote the {weights} weights of {args.checkpoint} ({os.path.getsize(args.checkpoint) / 2 ** 20:.0f} MB) "
+          f"to {args.output} ({os.path.getsize(args.output) / 2 ** 20:.0f} MB)")
+
+
+if __name__ == "__main__":
+    main(get_args_parser().parse_args())
@@ -0,0 +1,211 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Evaluate several runtime configs (util.runtime_config) of a checkpoint in one process.
+
+--sweep is a JSON file mapping the name of each trial to the RuntimeConfig fields it changes, on top of the
+--runtime_config of the run, e.g.
+    {"baseline": {}, "no_reserved_queries": {"reserve_queries_for_arms": false},
+     "rerank": {"alignment_rerank_top_k": 5}, "eye_vertex": {"cos_sim_vertex": "FINGERTIP"}}
+
+The checkpoint is read once. The models of the trials share its backbone and text encoder, and only load the rest
+of their weights. The trials whose configs load the same samples (RuntimeConfig.dataset_key) share a validation
+set and run image-major: each batch is loaded once and fed to every model of the group, whose shared backbone
+computes its features once, and whose transformers tokenize and encode its captions once (Transformer.text_cache).
+Each trial has its own criterion, PostProcess and YouRefItEvaluator. The precisions and the mean loss of the trials
+are printed as a table and written to --output.
+
+Example:
+    python sweep.py --dataset_config configs/yourefit.json --load pretrained/best_etf.pth --sweep ablations.json
+"""
+import argparse
+import copy
+import json
+import time
+from collections import OrderedDict
+from functools import partial
+
+import torch
+from torch import nn
+from torch.utils.data import DataLoader
+
+import util.misc as utils
+from datasets.coco import make_coco_transforms
+from datasets.yourefit import ReferDataset, YouRefItEvaluator
+from engine import evaluate_losses
+from main_ref import get_args_parser
+from models import build_model
+from models.meta_init import load_weights
+from models.postprocessors import PostProcess
+from util.checkpoint import load_model_weights
+from util.misc import targets_to
+from util.runtime_config import RuntimeConfig
+
+
+def get_sweep_args_parser():
+    parser = argparse.ArgumentParser("Runtime config sweep", add_help=False)
+    parser.add_argument("--sweep", required=True, help="JSON file of the RuntimeConfig changes of each trial")
+    parser.add_argument("--output", default="sweep_results.json")
+    return parser
+
+
+class SharedBackbone(nn.Module):
+    """The backbone of every model of a group of trials, which keeps its output for the last samples it was given,
+    so that the models fed the same batch compute its features once."""
+
+    def __init__(self, backbone):
+        super().__init__()
+        self.backbone = backbone
+        self.num_channels = backbone.num_channels
+        self._samples = None
+        self._output = None
+
+    def forward(self, samples):
+        if samples is not self._samples:
+            self._samples, self._output = samples, self.backbone(samples)
+        return self._output
+
+    def clear(self):
+        self._samples, self._output = None, None
+
+
+class Trial:
+    """The config, model, criterion and evaluator of a trial, and the sums of its losses."""
+
+    def __init__(self, name, changes, config, args, built, dataset):
+        self.name = name
+        self.changes = changes
+        self.config = config
+        self.args = args
+        self.model, self.criterion, self.contrastive_criterion, self.qa_criterion, self.weight_dict = built
+        self.postprocess = PostProcess(config=config)
+        self.evaluator = YouRefItEvaluator(dataset, ("bbox",), config=config)
+        self.loss_sum = 0.0
+        self.num_batches = 0
+
+    def done(self, batch_index):
+        return self.config.eval_early_stop and batch_index >= self.config.eval_early_stop_count
+
+
+def read_sweep(path, base_config):
+    """The (name, changes, config) of the trials of the --sweep file, in its order."""
+    with open(path, "r") as f:
+        sweep = json.load(f, object_pairs_hook=OrderedDict)
+    if not sweep:
+        raise RuntimeError(f"No trials in {path}")
+    return [(name, dict(changes), base_config.replace(**changes)) for name, changes in sweep.items()]
+
+
+def build_trial_model(args, config, weights, shared):
+    """The model and criterions of config with the weights of the checkpoint, on the backbone and text encoder of
+    shared, the modules of the first model, or with its own for the first one."""
+    args = copy.copy(args)
+    if config.remove_language_by_setting_caption_to_none:
+        args.contrastive_align_loss = False
+    built = build_model(args, pretrained=False, config=config)
+    model = built[0]
+    if shared is not None:
+        model.backbone = shared.backbone
+        if hasattr(model.transformer, "text_encoder") and hasattr(shared.transformer, "text_encoder"):
+            model.transformer.text_encoder = shared.transformer.text_encoder
+    missing = load_weights(model, weights).missing_keys
+    if missing:
+        print(f"WARNING: {len(missing)} parameters of the model are not in the checkpoint: {missing}")
+    return args, built
+
+
+def evaluate_group(trials, dataset, device, args):
+    """Feed every batch of dataset to the models of trials, which share their backbone and text cache."""
+    first = trials[0].model
+    backbone = SharedBackbone(first.backbone)
+    text_cache = {}
+    for trial in trials:
+        trial.model.backbone = backbone
+        trial.model.transformer.text_cache = text_cache
+        trial.model.to(device).eval()
+        for criterion in (trial.criterion, trial.contrastive_criterion, trial.qa_criterion):
+            if criterion is not None:
+                criterion.eval()
+
+    data_loader = DataLoader(dataset, args.batch_size, shuffle=False, drop_last=False,
+                             collate_fn=partial(utils.collate_fn, False), num_workers=args.num_workers)
+    for batch_index, batch_dict in enumerate(data_loader):
+        if all(trial.done(batch_index) for trial in trials):
+            break
+        samples = batch_dict["samples"].to(device)
+        positive_map = batch_dict["positive_map"].to(device) if "positive_map" in batch_dict else None
+        captions = [t["caption"] for t in batch_dict["targets"]]
+        img_names = [t["img_name"] for t in batch_dict["targets"]]
+        targets = targets_to(batch_dict["targets"], device)
+        orig_target_sizes = torch.stack([t["orig_size"] for t in targets], dim=0)
+        text_cache.clear()
+        for trial in trials:
+            if trial.done(batch_index):
+                continue
+            # the losses change the arms of the targets in place
+            trial_targets = [dict(t) for t in targets]
+            loss_dict, outputs = evaluate_losses(
+                trial.model, trial.criterion, trial.contrastive_criterion, trial.qa_criterion, samples, captions,
+                trial_targets, positive_map, None, img_names, trial.args, trial.config)
+            trial.loss_sum += sum(v.item() * trial.weight_dict[k] for k, v in loss_dict.items()
+                                  if k in trial.weight_dict)
+            trial.num_batches += 1
+            results = trial.postprocess(outputs, orig_target_sizes, img_names=img_names, targets=trial_targets)
+            trial.evaluator.update({t["image_id"].item(): r for t, r in zip(trial_targets, results)})
+    backbone.clear()
+    text_cache.clear()
+
+
+def main(args):
+    if args.dataset_config is not None:
+        with open(args.dataset_config, "r") as f:
+            vars(args).update(json.load(f))
+    if not args.load:
+        raise RuntimeError("Please provide the checkpoint to evaluate with --load")
+    device = torch.device(args.device)
+    base_config = RuntimeConfig.from_args(args)
+    start = time.time()
+
+    weights = load_model_weights(args.load)
+    groups = OrderedDict()
+    for name, changes, config in read_sweep(args.sweep, base_config):
+        groups.setdefault(config.dataset_key(), []).append((name, changes, config))
+
+    trials, shared = [], None
+    for key, group in groups.items():
+        dataset = ReferDataset(data_root="./", split_root="./", dataset="yourefit", split="val",
+                               transform=make_coco_transforms("val", False), augment=False, args=args,
+                               config=group[0][2])
+        group_trials = []
+        for name, changes, config in group:
+            trial_args, built = build_trial_model(args, config, weights, shared)
+            shared = built[0] if shared is None else shared
+            group_trials.append(Trial(name, changes, config, trial_args, built, dataset))
+        print(f"Evaluating {', '.join(trial.name for trial in group_trials)} on {len(dataset)} images")
+        evaluate_group(group_trials, dataset, device, args)
+        trials += group_trials
+    del weights
+
+    report = {"checkpoint": args.load, "base_config": base_config.to_dict(), "trials": []}
+    for trial in trials:
+        print(f"Summarizing {trial.name}")
+        precisions = trial.evaluator.summarize()["yourefit"]
+        report["trials"].append({
+            "name": trial.name, "changes": trial.changes, "precision": dict(zip(("0.25", "0.5", "0.75"), precisions)),
+            "loss": trial.loss_sum / max(trial.num_batches, 1),
+        })
+    report["seconds"] = time.time() - start
+
+    print(f"{'trial':<24} {'P@0.25':>8} {'P@0.5':>8} {'P@0.75':>8} {'loss':>9}  changes")
+    for trial in report["trials"]:
+        p = trial["precision"]
+        print(f"{trial['name']:<24} {p['0.25']:>8.4f} {p['0.5']:>8.4f} {p['0.75']:>8.4f} {trial['loss']:>9.4f}  "
+              f"{json.dumps(trial['changes'])}")
+    print(f"{len(trials)} trials in {report['seconds']:.0f}s")
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Runtime config sweep", parents=[get_args_parser(), get_sweep_args_parser()])
+    main(parser.parse_args())
@@ -1,18 +0,0 @@
-image_count = 0
-gt_cos_sim = 0.0
-pred_cos_sim = 0.0
-
-small_object_count = 0
-medium_object_count = 0
-large_object_count = 0
-small_object_success_count_25 = 0
-medium_object_success_count_25 = 0
-large_object_success_count_25 = 0
-small_object_success_count_50 = 0
-medium_object_success_count_50 = 0
-large_object_success_count_50 = 0
-small_object_success_count_75 = 0
-medium_object_success_count_75 = 0
-large_object_success_count_75 = 0
-
-max_p75 = 0
\ No newline at end of file
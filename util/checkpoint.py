@@ -0,0 +1,281 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Checkpoint writing off the training loop, and inference checkpoints.
+
+    writer = AsyncCheckpointWriter(output_dir, keep_last=3)
+    writer.save({"model": model.state_dict(), "epoch": epoch}, [output_dir / "checkpoint.pth"])
+    ...
+    writer.close()
+
+save() only blocks for the snapshot: the tensors of the checkpoint are copied to CPU buffers (pinned when CUDA is
+available, and reused from one save to the next) and the other values are deep copied. A background thread then
+serialises the snapshot to a temporary file next to each path and renames it over the path, so that a checkpoint
+file is always complete. A save first waits for the previous write to finish, so writes never overlap and the
+snapshot buffers are never overwritten while they are written.
+Only the main process writes; save() returns right away on the others.
+
+Inference checkpoints (slim_checkpoint.py) only hold the weights of a model, in the safetensors layout: the length
+of a JSON header on 8 bytes, the header, which gives the dtype, shape and offsets of each tensor, and the tensors.
+LazyStateDict maps such a file in memory, so that its tensors are only read from the disk when they are copied into
+the model. load_model_weights reads the weights to evaluate from either kind of checkpoint.
+
+With --zero_optimizer, the optimizer state is sharded between the processes (util.optim.build_adamw). It is either
+consolidated on the main process when a checkpoint is written, or written by each process next to the checkpoint
+(optimizer_shard_path), see optimizer_state_dict.
+"""
+import copy
+import json
+import os
+import shutil
+import struct
+import threading
+import time
+from collections.abc import Mapping
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.distributed.optim import ZeroRedundancyOptimizer
+
+from util.dist import get_rank, get_world_size, is_main_process
+
+
+class AsyncCheckpointWriter:
+    """Writes checkpoints from a background thread, see the module docstring.
+
+    keep_last > 0 keeps the keep_last latest files of output_dir matching keep_pattern, by name, after each write.
+    asynchronous=False writes in the calling thread, with the same atomic renames and rotation.
+    all_ranks=True writes on every process rather than only on the main one, e.g. the optimizer state of each rank.
+    """
+
+    def __init__(self, output_dir, keep_last=0, keep_pattern="checkpoint[0-9]*.pth", asynchronous=True,
+                 all_ranks=False):
+        self.output_dir = Path(output_dir)
+        self.keep_last = keep_last
+        self.keep_pattern = keep_pattern
+        self.asynchronous = asynchronous
+        self.enabled = all_ranks or is_main_process()
+        self.pin_memory = torch.cuda.is_available()
+        self._buffers = {}
+        self._thread = None
+        self._error = None
+        self.metrics = {"saves": 0, "snapshot_ms": 0.0, "wait_ms": 0.0, "write_ms": 0.0, "megabytes": 0.0,
+                        "total_snapshot_ms": 0.0, "total_write_ms": 0.0}
+
+    def _snapshot(self, value, key):
+        if isinstance(value, torch.Tensor):
+            buffer = self._buffers.get(key)
+            if buffer is None or buffer.shape != value.shape or buffer.dtype != value.dtype:
+                buffer = torch.empty(value.shape, dtype=value.dtype, pin_memory=self.pin_memory)
+                self._buffers[key] = buffer
+            buffer.copy_(value.detach(), non_blocking=True)
+            return buffer
+        if type(value) is dict:
+            return {k: self._snapshot(v, key + (k,)) for k, v in value.items()}
+        if type(value) in (list, tuple):
+            return type(value)(self._snapshot(v, key + (i,)) for i, v in enumerate(value))
+        return copy.deepcopy(value)
+
+    def save(self, state, paths):
+        """Snapshot state and write it to every path of paths, in the background if asynchronous."""
+        if not self.enabled:
+            return
+        start = time.perf_counter()
+        self.wait()
+        waited = time.perf_counter()
+        snapshot = self._snapshot(state, ())
+        if torch.cuda.is_available():
+            # the copies to pinned memory are asynchronous
+            torch.cuda.synchronize()
+        self.metrics["wait_ms"] = (waited - start) * 1e3
+        self.metrics["snapshot_ms"] = (time.perf_counter() - waited) * 1e3
+        self.metrics["total_snapshot_ms"] += self.metrics["snapshot_ms"]
+        paths = [Path(p) for p in paths]
+        if self.asynchronous:
+            self._thread = threading.Thread(target=self._write, args=(snapshot, paths), name="checkpoint-writer")
+            self._thread.start()
+        else:
+            self._write(snapshot, paths)
+            self._raise_error()
+
+    def _write(self, snapshot, paths):
+        try:
+            start = time.perf_counter()
+            first = paths[0].with_name(paths[0].name + ".tmp")
+            torch.save(snapshot, first)
+            size = first.stat().st_size
+            # the other paths are copies of the first file, serialised once
+            for path in paths[1:]:
+                shutil.copyfile(first, path.with_name(path.name + ".tmp"))
+            for path in paths[1:] + paths[:1]:
+                os.replace(path.with_name(path.name + ".tmp"), path)
+            self._rotate()
+            self.metrics["saves"] += 1
+            self.metrics["write_ms"] = (time.perf_counter() - start) * 1e3
+            self.metrics["total_write_ms"] += self.metrics["write_ms"]
+            self.metrics["megabytes"] = size / 2 ** 20
+            print("Wrote {} ({:.0f} MB) in {:.0f} ms, training blocked {:.0f} ms".format(
+                ", ".join(str(p) for p in paths), self.metrics["megabytes"], self.metrics["write_ms"],
+                self.metrics["wait_ms"] + self.metrics["snapshot_ms"]))
+        except Exception as e:
+            self._error = e
+
+    def _rotate(self):
+        if self.keep_last <= 0:
+            return
+        for path in sorted(self.output_dir.glob(self.keep_pattern))[:-self.keep_last]:
+            path.unlink()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing a checkpoint failed") from error
+
+    def wait(self):
+        """Wait for the write in progress, and raise its error if it failed."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+
+    def close(self):
+        """Wait for the last write and release the snapshot buffers."""
+        self.wait()
+        self._buffers = {}
+
+
+def optimizer_shard_path(path, rank):
+    """The file of the optimizer state of rank next to the training checkpoint path, with sharded optimizer
+    checkpoints."""
+    path = Path(path)
+    return path.with_name(f"{path.name}.optimizer{rank}")
+
+
+def optimizer_state_dict(optimizer, sharded=False):
+    """The "optimizer" entry of a training checkpoint. To be called on all ranks.
+
+    A ZeroRedundancyOptimizer only keeps the state of its share of the parameters on each rank. By default the shares
+    are gathered on the main process into the state dict of the whole optimizer, in the layout of the optimizer
+    without sharding, and the other ranks, which do not write checkpoints, get None. With sharded, the entry only
+    records the number of shards, and every rank writes optimizer.optim.state_dict() to optimizer_shard_path.
+    """
+    if not isinstance(optimizer, ZeroRedundancyOptimizer):
+        return optimizer.state_dict()
+    if sharded:
+        return {"shards": get_world_size()}
+    optimizer.consolidate_state_dict(to=0)
+    return optimizer.state_dict() if is_main_process() else None
+
+
+def load_optimizer_state_dict(optimizer, state_dict, path):
+    """Load the "optimizer" entry state_dict of the training checkpoint at path, whether consolidated, into any
+    optimizer over the same parameters, or sharded, into a ZeroRedundancyOptimizer on as many processes."""
+    if "shards" not in state_dict:
+        optimizer.load_state_dict(state_dict)
+        return
+    if not isinstance(optimizer, ZeroRedundancyOptimizer) or state_dict["shards"] != get_world_size():
+        raise RuntimeError(f"The optimizer state of {path} is sharded between {state_dict['shards']} processes, "
+                           f"resume it with --zero_optimizer on as many processes")
+    optimizer.optim.load_state_dict(torch.load(optimizer_shard_path(path, get_rank()), map_location="cpu"))
+
+
+# safetensors dtype names, and the numpy dtypes their bytes are read as (bfloat16 is read as int16 and viewed as such)
+_SLIM_DTYPES = {
+    torch.float64: ("F64", np.float64), torch.float32: ("F32", np.float32), torch.float16: ("F16", np.float16),
+    torch.bfloat16: ("BF16", np.int16), torch.int64: ("I64", np.int64), torch.int32: ("I32", np.int32),
+    torch.int16: ("I16", np.int16), torch.int8: ("I8", np.int8), torch.uint8: ("U8", np.uint8),
+    torch.bool: ("BOOL", np.bool_),
+}
+_SLIM_TORCH_DTYPES = {name: dtype for dtype, (name, _) in _SLIM_DTYPES.items()}
+
+
+def save_slim(state_dict, path, metadata=None):
+    """Write the tensors of state_dict to path in the safetensors layout, with the str to str dict metadata."""
+    # the largest elements first, so that every tensor is aligned on its element size in the file
+    names = sorted(state_dict, key=lambda name: -state_dict[name].element_size())
+    header, tensors, offset = {}, [], 0
+    for name in names:
+        tensor = state_dict[name].detach().cpu().contiguous()
+        if tensor.dtype not in _SLIM_DTYPES:
+            raise RuntimeError(f"Unsupported dtype {tensor.dtype} of {name}")
+        size = tensor.numel() * tensor.element_size()
+        header[name] = {"dtype": _SLIM_DTYPES[tensor.dtype][0], "shape": list(tensor.shape),
+                        "data_offsets": [offset, offset + size]}
+        tensors.append(tensor.view(torch.int16) if tensor.dtype == torch.bfloat16 else tensor)
+        offset += size
+    if metadata:
+        header["__metadata__"] = {str(k): str(v) for k, v in metadata.items()}
+    header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header += b" " * (-len(header) % 8)
+
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for tensor in tensors:
+            f.write(tensor.numpy().tobytes())
+    os.replace(tmp, path)
+
+
+def is_slim_checkpoint(path):
+    """Whether path was written by save_slim (or is a safetensors file), rather than by torch.save."""
+    with open(path, "rb") as f:
+        start = f.read(9)
+    return len(start) == 9 and struct.unpack("<Q", start[:8])[0] < os.path.getsize(path) and start[8:] == b"{"
+
+
+class LazyStateDict(Mapping):
+    """Read-only state dict of a file written by save_slim, whose tensors are views of a memory map of the file.
+
+    Their bytes are only read from the disk when they are used, e.g. copied into a model by load_state_dict, and the
+    pages of the file can then be dropped from memory. Writing to the tensors does not change the file.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            header_size = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(header_size).decode("utf-8"))
+        self.path = str(path)
+        self.metadata = header.pop("__metadata__", {})
+        self._entries = header
+        data_size = max((entry["data_offsets"][1] for entry in header.values()), default=0)
+        self._data = np.memmap(path, dtype=np.uint8, mode="c", offset=8 + header_size, shape=(data_size,)) \
+            if data_size > 0 else np.empty(0, dtype=np.uint8)
+
+    def __getitem__(self, name):
+        entry = self._entries[name]
+        begin, end = entry["data_offsets"]
+        dtype = _SLIM_TORCH_DTYPES[entry["dtype"]]
+        array = self._data[begin:end].view(_SLIM_DTYPES[dtype][1]).reshape(entry["shape"])
+        tensor = torch.from_numpy(array)
+        return tensor.view(dtype) if dtype == torch.bfloat16 else tensor
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def copy(self):
+        """A dict of the tensors, still views of the memory map. Module.load_state_dict of torch 1.11 copies the
+        state dict it is given with copy()."""
+        return dict(self)
+
+
+def load_model_weights(path):
+    """The weights to evaluate of a checkpoint: a LazyStateDict for inference checkpoints, and the EMA weights, or
+    else the model weights, of the checkpoints written by training."""
+    if is_slim_checkpoint(path):
+        return LazyStateDict(path)
+    checkpoint = torch.load(path, map_location="cpu")
+    if checkpoint.get("model_ema") is not None:
+        return checkpoint["model_ema"]
+    return checkpoint["model"]
+
+
+def load_checkpoint(path):
+    """The training checkpoint at path or at an https URL, on CPU."""
+    if path.startswith("https"):
+        return torch.hub.load_state_dict_from_url(path, map_location="cpu", check_hash=True)
+    return torch.load(path, map_location="cpu")
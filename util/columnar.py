@@ -0,0 +1,93 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Incremental Parquet output for long offline jobs.
+
+Rows are buffered and flushed as numbered part files: prefix-00000.parquet, prefix-00001.parquet, ...
+Each part is written to a temporary file and renamed, so an interrupted job leaves only complete parts,
+and a restarted job can skip the keys that are already on disk.
+"""
+import glob
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+def require_pyarrow():
+    if pa is None:
+        raise RuntimeError("pyarrow is required for Parquet output, install it with `pip install pyarrow`")
+
+
+def part_files(output_dir, prefix=""):
+    return sorted(glob.glob(os.path.join(output_dir, f"{prefix}*.parquet")))
+
+
+def read_keys(output_dir, prefix="", key_column="key"):
+    """Return the set of keys already written under output_dir."""
+    require_pyarrow()
+    keys = set()
+    for path in part_files(output_dir, prefix):
+        keys.update(pq.read_table(path, columns=[key_column]).column(key_column).to_pylist())
+    return keys
+
+
+def read_table(output_dir, prefix="", columns=None):
+    """Concatenate all the parts written under output_dir into one pyarrow Table."""
+    require_pyarrow()
+    paths = part_files(output_dir, prefix)
+    if not paths:
+        raise RuntimeError(f"No parquet files found in {output_dir}")
+    return pa.concat_tables([pq.read_table(path, columns=columns) for path in paths])
+
+
+class PartitionedParquetWriter(object):
+    """Append rows (dicts) and write them as Parquet parts of rows_per_part rows.
+
+    Args:
+        output_dir: directory of the parts, created if needed
+        prefix: name prefix of the parts, e.g. "shard-00001-of-00004"
+        schema: pyarrow schema of the rows
+        rows_per_part: number of rows buffered before a part is written
+    """
+
+    def __init__(self, output_dir, prefix, schema, rows_per_part=1024):
+        require_pyarrow()
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.schema = schema
+        self.rows_per_part = rows_per_part
+        self.num_rows_written = 0
+        self._rows = []
+        # continue the numbering of a previous, interrupted run
+        self._next_part = len(part_files(output_dir, prefix + "-"))
+
+    def write(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self.rows_per_part:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        columns = {name: [row[name] for row in self._rows] for name in self.schema.names}
+        table = pa.Table.from_pydict(columns, schema=self.schema)
+        path = os.path.join(self.output_dir, f"{self.prefix}-{self._next_part:05d}.parquet")
+        pq.write_table(table, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self._next_part += 1
+        self.num_rows_written += len(self._rows)
+        self._rows = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
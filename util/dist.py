@@ -3,12 +3,16 @@
 """
 Utilities related to distributed mode.
 
-By default, the reduce of metrics and such are done on GPU, since it's more straightforward (we reuse the NCCL backend)
-If you want to reduce on CPU instead (required for big datasets like GQA), use the env variable MDETR_CPU_REDUCE=1
+The backend is NCCL on CUDA devices and gloo otherwise (see init_distributed_mode). The reduce of metrics and such
+are done on the device of the backend, i.e. on GPU with NCCL and on CPU with gloo.
+If you want to reduce on CPU with NCCL (required for big datasets like GQA), use the env variable MDETR_CPU_REDUCE=1
 """
 import functools
+import glob
 import io
+import operator
 import os
+import re
 
 import torch
 import torch.distributed as dist
@@ -31,27 +35,24 @@ def _get_global_gloo_group():
     return dist.group.WORLD
 
 
-def all_gather(data):
+def collective_device():
     """
-    Run all_gather on arbitrary picklable data (not necessarily tensors)
-    Args:
-        data: any picklable object
     Returns:
-        list[data]: list of data gathered from each rank
+        The device of the tensors exchanged by the default process group: cuda with NCCL, cpu otherwise
     """
+    if is_dist_avail_and_initialized() and dist.get_backend() == "nccl":
+        return torch.device("cuda")
+    return torch.device("cpu")
 
-    world_size = get_world_size()
-    if world_size == 1:
-        return [data]
 
+def _all_gather_bytes(data_view):
+    """all_gather of the bytes-like data_view of every rank, returned as uint8 tensors on the CPU."""
+    world_size = get_world_size()
     cpu_group = None
     if os.getenv("MDETR_CPU_REDUCE") == "1":
         cpu_group = _get_global_gloo_group()
 
-    buffer = io.BytesIO()
-    torch.save(data, buffer)
-    data_view = buffer.getbuffer()
-    device = "cuda" if cpu_group is None else "cpu"
+    device = collective_device() if cpu_group is None else torch.device("cpu")
     tensor = torch.ByteTensor(data_view).to(device)
 
     # obtain Tensor size of each rank
@@ -81,16 +82,139 @@ def all_gather(data):
     else:
         dist.all_gather(tensor_list, tensor, group=cpu_group)
 
+    return [torch.split(tensor, [size, max_size - size], dim=0)[0].cpu()
+            for size, tensor in zip(size_list, tensor_list)]
+
+
+def all_gather(data):
+    """
+    Run all_gather on arbitrary picklable data (not necessarily tensors)
+    Args:
+        data: any picklable object
+    Returns:
+        list[data]: list of data gathered from each rank
+    """
+
+    world_size = get_world_size()
+    if world_size == 1:
+        return [data]
+
+    buffer = io.BytesIO()
+    torch.save(data, buffer)
     data_list = []
-    for size, tensor in zip(size_list, tensor_list):
-        tensor = torch.split(tensor, [size, max_size - size], dim=0)[0]
-        buffer = io.BytesIO(tensor.cpu().numpy())
+    for tensor in _all_gather_bytes(buffer.getbuffer()):
+        buffer = io.BytesIO(tensor.numpy())
         obj = torch.load(buffer, map_location=torch.device('cpu'))
         data_list.append(obj)
 
     return data_list
 
 
+class _TensorLeaf:
+    """Placeholder of the index-th tensor of a structure sent by all_gather_tensors."""
+
+    __slots__ = ("index",)
+
+    def __init__(self, index):
+        self.index = index
+
+
+# dtypes that not every backend can exchange, sent as another dtype of the same size
+_TRANSPORT_DTYPES = {torch.bool: torch.uint8}
+
+
+def _split_tensors(data, tensors):
+    """Copy of the structure of dicts, lists and tuples data with its tensors replaced by _TensorLeaf placeholders
+    and appended to tensors. Other containers are leaves, sent by pickling."""
+    if isinstance(data, torch.Tensor):
+        tensors.append(data.detach() if data.requires_grad else data)
+        return _TensorLeaf(len(tensors) - 1)
+    if type(data) is dict:
+        return {k: _split_tensors(v, tensors) for k, v in data.items()}
+    if type(data) in (list, tuple):
+        return type(data)(_split_tensors(v, tensors) for v in data)
+    return data
+
+
+def _merge_tensors(skeleton, tensors):
+    if isinstance(skeleton, _TensorLeaf):
+        return tensors[skeleton.index]
+    if type(skeleton) is dict:
+        return {k: _merge_tensors(v, tensors) for k, v in skeleton.items()}
+    if type(skeleton) in (list, tuple):
+        return type(skeleton)(_merge_tensors(v, tensors) for v in skeleton)
+    return skeleton
+
+
+def _all_gather_flat(output, tensor):
+    """Gather the 1D tensor of every rank into output, [world_size * numel], rank after rank."""
+    if dist.get_backend() == "nccl":
+        if hasattr(dist, "all_gather_into_tensor"):
+            dist.all_gather_into_tensor(output, tensor)
+        else:
+            dist._all_gather_base(output, tensor)
+    else:
+        # gloo has no gather into a single tensor: gather into views of it
+        dist.all_gather(list(output.view(get_world_size(), -1).unbind(0)), tensor)
+
+
+def all_gather_tensors(data):
+    """
+    Run all_gather on a structure of dicts, lists and tuples whose leaves are mostly tensors, e.g. the predictions
+    of an evaluator, without pickling the tensors.
+    The structures, with the shapes and dtypes of their tensors and their other leaves, are exchanged first by
+    all_gather. Then the tensors of each dtype are gathered in one flat buffer, padded to the largest rank, from
+    which the tensors of every rank are rebuilt as views.
+    Args:
+        data: structure of dicts, lists and tuples, with tensors and any picklable leaves
+    Returns:
+        list[data]: list of data gathered from each rank, with the tensors on the device of the backend
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return [data]
+
+    device = collective_device()
+    tensors = []
+    skeleton = _split_tensors(data, tensors)
+    # the structures hold no tensor: pickle them, which is lighter than torch.save
+    dtype_names = {dtype: str(dtype).split(".")[-1] for dtype in {t.dtype for t in tensors}}
+    specs = [(dtype_names[t.dtype], tuple(t.shape)) for t in tensors]
+    buffer = io.BytesIO()
+    pickle.dump((skeleton, specs), buffer, protocol=pickle.HIGHEST_PROTOCOL)
+    metadata = [pickle.loads(tensor.numpy().tobytes()) for tensor in _all_gather_bytes(buffer.getbuffer())]
+
+    gathered = [[None] * len(rank_specs) for _, rank_specs in metadata]
+    for dtype_name in sorted({name for _, rank_specs in metadata for name, _ in rank_specs}):
+        dtype = getattr(torch, dtype_name)
+        transport_dtype = _TRANSPORT_DTYPES.get(dtype, dtype)
+        numels = [[(i, functools.reduce(operator.mul, shape, 1)) for i, (name, shape) in enumerate(rank_specs) if name == dtype_name]
+                  for _, rank_specs in metadata]
+        max_numel = max(sum(n for _, n in rank_numels) for rank_numels in numels)
+        if max_numel == 0:
+            for rank, rank_numels in enumerate(numels):
+                for i, _ in rank_numels:
+                    gathered[rank][i] = torch.empty(metadata[rank][1][i][1], dtype=dtype, device=device)
+            continue
+
+        buffer = torch.empty(max_numel, dtype=transport_dtype, device=device)
+        local = [tensors[i].reshape(-1).to(device, transport_dtype) for i, _ in numels[get_rank()]]
+        if local:
+            torch.cat(local, out=buffer[:sum(t.numel() for t in local)])
+        output = torch.empty(world_size * max_numel, dtype=transport_dtype, device=device)
+        _all_gather_flat(output, buffer)
+
+        for rank, (rank_numels, rank_output) in enumerate(zip(numels, output.view(world_size, max_numel))):
+            sizes = [numel for _, numel in rank_numels]
+            views = torch.split(rank_output, sizes + [max_numel - sum(sizes)])
+            for (i, _), view in zip(rank_numels, views):
+                tensor = view.view(metadata[rank][1][i][1])
+                gathered[rank][i] = tensor if transport_dtype == dtype else tensor.to(dtype)
+
+    return [_merge_tensors(rank_skeleton, rank_tensors)
+            for (rank_skeleton, _), rank_tensors in zip(metadata, gathered)]
+
+
 def reduce_dict(input_dict, average=True):
     """
     Args:
@@ -213,25 +337,87 @@ def save_on_master(*args, **kwargs):
         torch.save(*args, **kwargs)
 
 
+def _parse_cpu_list(text):
+    """CPUs of a sysfs cpulist such as "0-3,8-11"."""
+    cpus = []
+    for part in text.strip().split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def numa_ordered_cpus():
+    """
+    Returns:
+        The CPUs this process may run on, grouped by NUMA node (node 0 first). Without NUMA information,
+        e.g. outside Linux, they are in increasing order.
+    """
+    allowed = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else set(range(os.cpu_count()))
+    paths = glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")
+    cpus = []
+    for path in sorted(paths, key=lambda p: int(re.search(r"node(\d+)", p).group(1))):
+        with open(path) as f:
+            cpus.extend(cpu for cpu in _parse_cpu_list(f.read()) if cpu in allowed and cpu not in cpus)
+    cpus.extend(sorted(allowed - set(cpus)))
+    return cpus
+
+
+def pin_cpu_threads(local_rank, local_size, num_threads=None):
+    """
+    Pin the current process to its share of the CPUs of the machine and size the intra-op thread pool of torch
+    accordingly. The processes of a machine get contiguous blocks of CPUs in NUMA node order, so that the threads of
+    a process stay on one node whenever the processes divide evenly across the nodes.
+    Args:
+        local_rank (int): rank of the process on the machine
+        local_size (int): number of processes on the machine
+        num_threads (int): CPUs per process, by default the CPUs of the machine split evenly between its processes
+    Returns:
+        list[int]: the CPUs of the process, empty if they could not be pinned
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        return []
+    cpus = numa_ordered_cpus()
+    if num_threads is None:
+        num_threads = len(cpus) // local_size
+    own = cpus[local_rank * num_threads:(local_rank + 1) * num_threads]
+    if num_threads == 0 or len(own) < num_threads:
+        print("Not pinning rank {} to CPUs: {} processes of {} threads on {} CPUs".format(
+            local_rank, local_size, num_threads, len(cpus)))
+        return []
+    os.sched_setaffinity(0, own)
+    torch.set_num_threads(len(own))
+    return own
+
+
 def init_distributed_mode(args):
-    """Initialize distributed training, if appropriate"""
+    """Initialize distributed training, if appropriate. The backend is args.dist_backend if set, otherwise NCCL on
+    CUDA devices and gloo on the others."""
     if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
         args.rank = int(os.environ["RANK"])
         args.world_size = int(os.environ["WORLD_SIZE"])
         args.gpu = int(os.environ["LOCAL_RANK"])
+        args.local_size = int(os.environ.get("LOCAL_WORLD_SIZE", args.world_size))
     elif "SLURM_PROCID" in os.environ:
         args.rank = int(os.environ["SLURM_PROCID"])
-        args.gpu = args.rank % torch.cuda.device_count()
+        num_gpus = max(torch.cuda.device_count(), 1)
+        args.gpu = int(os.environ.get("SLURM_LOCALID", args.rank % num_gpus))
+        args.local_size = int(os.environ.get("SLURM_NTASKS_PER_NODE", num_gpus))
     else:
         print("Not using distributed mode")
         args.distributed = False
         return
 
     args.distributed = True
+    args.local_rank = args.gpu
 
-    torch.cuda.set_device(args.gpu)
-    args.dist_backend = "nccl"
-    print("| distributed init (rank {}): {}".format(args.rank, args.dist_url), flush=True)
+    if getattr(args, "dist_backend", None) is None:
+        args.dist_backend = "nccl" if torch.device(args.device).type == "cuda" else "gloo"
+    if args.dist_backend == "nccl":
+        torch.cuda.set_device(args.gpu)
+    print("| distributed init (rank {}, {}): {}".format(args.rank, args.dist_backend, args.dist_url), flush=True)
 
     try:
         torch.distributed.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
@@ -245,3 +431,29 @@ def init_distributed_mode(args):
 
     dist.barrier()
     setup_for_distributed(args.rank == 0)
+
+
+def wrap_distributed(model, args, device):
+    """model in DistributedDataParallel with the --find_unused_parameters, --ddp_static_graph and
+    --ddp_bucket_cap_mb of args.
+
+    MDETR only builds the modules its config uses, so every parameter gets a gradient at each step and the autograd
+    graph does not need to be searched for unused ones. Its buffers (frozen batch norm statistics, position ids of
+    the text encoder) never change, so they are not broadcast from rank 0 at each forward either. The gradients are
+    views of the all-reduce buckets, which saves a copy of them.
+    The static graph does not support the no_sync of the micro-batches of --grad_accumulation_steps, which only use
+    find_unused_parameters=False.
+    """
+    static_graph = args.ddp_static_graph
+    if static_graph and args.grad_accumulation_steps > 1:
+        print("WARNING: --ddp_static_graph is not supported with --grad_accumulation_steps, disabled")
+        static_graph = False
+    return torch.nn.parallel.DistributedDataParallel(
+        model,
+        device_ids=[args.gpu] if device.type == "cuda" else None,
+        find_unused_parameters=args.find_unused_parameters,
+        static_graph=static_graph,
+        bucket_cap_mb=args.ddp_bucket_cap_mb,
+        broadcast_buffers=False,
+        gradient_as_bucket_view=True,
+    )
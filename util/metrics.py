@@ -9,7 +9,7 @@ from collections import defaultdict, deque
 import torch
 import torch.distributed as dist
 
-from util.dist import is_dist_avail_and_initialized
+from util.dist import collective_device, is_dist_avail_and_initialized
 
 
 class SmoothedValue:
@@ -37,7 +37,7 @@ class SmoothedValue:
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device="cuda")
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=collective_device())
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -168,6 +168,98 @@ class MetricLogger(object):
                 f.write(print_str+'\n')
 
 
+class LossRingBuffer:
+    """Per-step losses kept on the device between two logging steps.
+
+    push() writes the detached losses of a step in the next row of a [capacity, num_losses] tensor and folds
+    the finiteness of their weighted sum into a device flag, without waiting for the device. flush() averages
+    the stored steps over all processes in a single all_reduce and copies them to the host at once.
+    The losses must come in the same order at every step and on every process.
+    """
+
+    def __init__(self, capacity, weight_dict):
+        self.capacity = capacity
+        self.weight_dict = weight_dict
+        self.names = None
+        self.count = 0
+        self._is_finite = True
+        self._finite_host = None
+        self._finite_event = None
+
+    def __len__(self):
+        return self.count
+
+    def _allocate(self, loss_dict):
+        self.names = list(loss_dict)
+        device = next(iter(loss_dict.values())).device
+        self.values = torch.empty(self.capacity, len(self.names), device=device)
+        self.scaled_index = torch.tensor([j for j, k in enumerate(self.names) if k in self.weight_dict],
+                                         device=device)
+        self.weights = torch.tensor([self.weight_dict[k] for k in self.names if k in self.weight_dict],
+                                    device=device)
+        self.finite = torch.ones((), dtype=torch.bool, device=device)
+        if device.type == "cuda":
+            self._finite_host = torch.ones((), dtype=torch.bool).pin_memory()
+            self._finite_event = torch.cuda.Event()
+
+    @torch.no_grad()
+    def push(self, loss_dict):
+        if self.names is None:
+            self._allocate(loss_dict)
+        if list(loss_dict) != self.names:
+            raise RuntimeError(f"Expected the losses {self.names}, got {list(loss_dict)}")
+        if self.count == self.capacity:
+            raise RuntimeError("The loss buffer is full, flush it every {} steps".format(self.capacity))
+        row = torch.stack([v.detach().float().reshape(()) for v in loss_dict.values()])
+        self.values[self.count] = row
+        self.count += 1
+        self.finite &= torch.isfinite((row[self.scaled_index] * self.weights).sum())
+        if self._finite_event is not None and self._finite_event.query():
+            # the previous copy is done, start a new one
+            self._is_finite &= bool(self._finite_host)
+            self._finite_host.copy_(self.finite, non_blocking=True)
+            self._finite_event.record()
+
+    def all_finite(self):
+        """False once a step with a non-finite weighted loss has been pushed.
+
+        On CUDA the flag is copied to the host asynchronously, so a non-finite step is reported a few steps
+        late. On other devices, it is reported right away.
+        """
+        if self._finite_event is None:
+            return self.names is None or bool(self.finite)
+        if self._finite_event.query():
+            self._is_finite &= bool(self._finite_host)
+        return self._is_finite
+
+    @torch.no_grad()
+    def flush(self, reduce=True):
+        """Empty the buffer and return the list of its steps, oldest first, as dicts of Python floats:
+        the weighted sum "loss", the weighted losses and the raw losses (suffixed with "_unscaled").
+
+        With reduce, the losses are averaged over all processes, so all processes must flush together, and a step
+        is not finite on any process if it is not on one of them.
+        """
+        if self.count == 0:
+            return []
+        values = self.values[:self.count].clone()
+        if reduce and is_dist_avail_and_initialized():
+            dist.all_reduce(values)
+            values /= dist.get_world_size()
+        scaled = values[:, self.scaled_index] * self.weights
+        rows = torch.cat([scaled.sum(1, keepdim=True), scaled, values], dim=1).tolist()
+        self.count = 0
+
+        scaled_names = [k for k in self.names if k in self.weight_dict]
+        steps = []
+        for row in rows:
+            step = {"loss": row[0]}
+            step.update(zip(scaled_names, row[1:1 + len(scaled_names)]))
+            step.update((f"{k}_unscaled", v) for k, v in zip(self.names, row[1 + len(scaled_names):]))
+            steps.append(step)
+        return steps
+
+
 @torch.no_grad()
 def accuracy(output, target, topk=(1,)):
     """Computes the precision@k for the specified values of k"""
@@ -127,6 +127,36 @@ class NestedTensor(object):
         return repr(self.tensors)
 
 
+class NestedTensorBuffer(object):
+    """Batches images like NestedTensor.from_tensor_list, but pads into storage reused across calls.
+
+    The storage only grows, so a long-lived server stops allocating once it has seen its largest batch.
+    The returned NestedTensor is a view of the storage: it is only valid until the next call.
+    """
+
+    def __init__(self, dtype=torch.float32, device="cpu"):
+        self.dtype = dtype
+        self.device = torch.device(device)
+        self._tensor_storage = torch.empty(0, dtype=dtype, device=self.device)
+        self._mask_storage = torch.empty(0, dtype=torch.bool, device=self.device)
+
+    def from_tensor_list(self, tensor_list):
+        b = len(tensor_list)
+        c, h, w = (max(s) for s in zip(*[img.shape for img in tensor_list]))
+        if self._tensor_storage.numel() < b * c * h * w:
+            self._tensor_storage = torch.empty(b * c * h * w, dtype=self.dtype, device=self.device)
+        if self._mask_storage.numel() < b * h * w:
+            self._mask_storage = torch.empty(b * h * w, dtype=torch.bool, device=self.device)
+        tensor = self._tensor_storage[: b * c * h * w].view(b, c, h, w)
+        mask = self._mask_storage[: b * h * w].view(b, h, w)
+        tensor.zero_()
+        mask.fill_(True)
+        for img, pad_img, m in zip(tensor_list, tensor, mask):
+            pad_img[: img.shape[0], : img.shape[1], : img.shape[2]].copy_(img)
+            m[: img.shape[1], : img.shape[2]] = False
+        return NestedTensor(tensor, mask)
+
+
 def interpolate(input, size=None, scale_factor=None, mode="nearest", align_corners=None):
     # type: (Tensor, Optional[List[int]], Optional[float], str, Optional[bool]) -> Tensor
     """
@@ -1,8 +1,37 @@
 # Copyright (c) Aishwarya Kamath & Nicolas Carion. Licensed under the Apache License 2.0. All Rights Reserved
 """Collections of utilities related to optimization."""
+import inspect
+import weakref
 from bisect import bisect_right
 
 import torch
+from torch.distributed.optim import ZeroRedundancyOptimizer
+
+
+class _EmaBuckets(object):
+    """The (ema, model) state tensors of a pair of models, grouped by device and dtype.
+
+    The tensors share their storage with the parameters and buffers, so the buckets stay valid as long as
+    the models are not moved or rebuilt.
+    """
+
+    def __init__(self, model, model_ema):
+        self.model_id = id(model)
+        self.buckets = {}
+        self.others = []
+        msd = model.state_dict()
+        for k, ema_v in model_ema.state_dict().items():
+            model_v = msd[k].detach()
+            if ema_v.is_floating_point():
+                bucket = self.buckets.setdefault((ema_v.device, ema_v.dtype), ([], []))
+                bucket[0].append(ema_v)
+                bucket[1].append(model_v)
+            else:
+                self.others.append((ema_v, model_v))
+
+
+# kept outside of the EMA model, so that copies and pickles of it do not carry stale buckets
+_ema_buckets = weakref.WeakKeyDictionary()
 
 
 def update_ema(model, model_ema, decay):
@@ -10,6 +39,7 @@ def update_ema(model, model_ema, decay):
 
     The  weights are updated in-place as follow:
     w_ema = w_ema * decay + (1 - decay) * w
+    The floating point tensors are updated with one multi-tensor (_foreach) op per device and dtype.
     Args:
         model: active model that is being optimized
         model_ema: running average model
@@ -19,12 +49,99 @@ def update_ema(model, model_ema, decay):
         if hasattr(model, "module"):
             # unwrapping DDP
             model = model.module
-        msd = model.state_dict()
-        for k, ema_v in model_ema.state_dict().items():
-            model_v = msd[k].detach()
+        buckets = _ema_buckets.get(model_ema)
+        if buckets is None or buckets.model_id != id(model):
+            buckets = _ema_buckets[model_ema] = _EmaBuckets(model, model_ema)
+        for ema_vs, model_vs in buckets.buckets.values():
+            torch._foreach_mul_(ema_vs, decay)
+            torch._foreach_add_(ema_vs, model_vs, alpha=1.0 - decay)
+        for ema_v, model_v in buckets.others:
             ema_v.copy_(ema_v * decay + (1.0 - decay) * model_v)
 
 
+def maybe_update_ema(model, model_ema, decay, step, every=1):
+    """Update the EMA only every `every` steps, with the decay of `every` steps (decay ** every).
+
+    step is the number of optimization steps taken so far, including the current one.
+    """
+    if every <= 1:
+        update_ema(model, model_ema, decay)
+    elif step % every == 0:
+        update_ema(model, model_ema, decay ** every)
+
+
+def build_param_dicts(model, args):
+    """The three parameter groups of the model: transformer and heads, backbone, text encoder.
+
+    Their order is the order of the learning rates in adjust_learning_rate.
+    """
+    return [
+        {
+            "params": [
+                p
+                for n, p in model.named_parameters()
+                if
+                "backbone" not in n and "text_encoder" not in n and p.requires_grad
+            ]
+        },
+        {
+            "params": [p for n, p in model.named_parameters() if
+                       "backbone" in n and p.requires_grad],
+            "lr": args.lr_backbone,
+        },
+        {
+            "params": [p for n, p in model.named_parameters() if
+                       "text_encoder" in n and p.requires_grad],
+            "lr": args.text_encoder_lr,
+        },
+    ]
+
+
+def adamw_implementation_kwargs(params, implementation="auto"):
+    """Keyword arguments of torch.optim.AdamW selecting its multi-tensor implementation.
+
+    implementation is one of:
+        auto: fused on CUDA if this version of torch has it, otherwise foreach
+        fused: single fused kernel (CUDA only)
+        foreach: multi-tensor kernels
+        for_loop: one kernel per parameter
+    Versions of torch without the argument are left on their default implementation.
+    """
+    supported = inspect.signature(torch.optim.AdamW).parameters
+    on_cuda = all(p.is_cuda for p in params)
+    if implementation == "auto":
+        implementation = "fused" if "fused" in supported and on_cuda else "foreach"
+    if implementation == "fused":
+        if "fused" not in supported:
+            raise RuntimeError("This version of torch has no fused AdamW")
+        if not on_cuda:
+            raise RuntimeError("The fused AdamW requires all the parameters on CUDA")
+        return {"fused": True}
+    if implementation in ("foreach", "for_loop"):
+        return {"foreach": implementation == "foreach"} if "foreach" in supported else {}
+    raise RuntimeError(f"Unsupported optimizer implementation {implementation}")
+
+
+def build_adamw(param_dicts, lr, weight_decay, amsgrad, implementation="auto", shard=False):
+    """AdamW over param_dicts with the requested implementation.
+
+    torch 1.11 has no foreach argument but ships the multi-tensor AdamW in torch.optim._multi_tensor.
+    With shard, each process of the default process group only keeps the state (exp_avg, exp_avg_sq and with amsgrad
+    max_exp_avg_sq) of its share of the parameters, updates them and broadcasts them to the other processes
+    (ZeroRedundancyOptimizer, ZeRO stage 1). Its param_groups are still the groups of param_dicts, whose learning
+    rates adjust_learning_rate sets.
+    """
+    params = [p for group in param_dicts for p in group["params"]]
+    kwargs = adamw_implementation_kwargs(params, implementation)
+    optimizer_class = torch.optim.AdamW
+    if not kwargs and implementation != "for_loop" and hasattr(torch.optim, "_multi_tensor"):
+        optimizer_class = torch.optim._multi_tensor.AdamW
+    if shard:
+        return ZeroRedundancyOptimizer(param_dicts, optimizer_class=optimizer_class, lr=lr, weight_decay=weight_decay,
+                                       amsgrad=amsgrad, **kwargs)
+    return optimizer_class(param_dicts, lr=lr, weight_decay=weight_decay, amsgrad=amsgrad, **kwargs)
+
+
 def adjust_learning_rate(
     optimizer,
     epoch: int,
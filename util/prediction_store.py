@@ -0,0 +1,147 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Memory-mapped columnar store of MDETR predictions, used as distillation targets.
+
+A store is a directory with one .npy file per column and an index.json mapping every image name to its row:
+    scores.npy      float32 [N, Q]     max softmax probability of every query
+    classes.npy     int64   [N, Q]     argmax class of every query, no_object_class is the "no object" class
+    boxes.npy       float32 [N, Q, 4]  normalized xyxy box of every query
+    foreground.npy  int64   [N]        highest scoring query not predicted as "no object", -1 if there is none
+The columns are opened with np.load(mmap_mode='r'), so opening a store is cheap and a lookup reads one row.
+index.json is written last: a directory without it is an interrupted export.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+
+from util.box_ops import box_cxcywh_to_xyxy
+
+INDEX_FILE = "index.json"
+
+
+class PredictionStoreWriter(object):
+    """Write the predictions of a known list of images, batch by batch, into a store.
+
+    Args:
+        path: directory of the store
+        image_names: names of all the images of the store, in row order
+    The columns are allocated on the first batch, with the number of queries of the model.
+    """
+
+    def __init__(self, path, image_names):
+        os.makedirs(path, exist_ok=True)
+        index_path = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        self.path = path
+        self.image_names = list(image_names)
+        self.rows = {name: row for row, name in enumerate(self.image_names)}
+        if len(self.rows) != len(self.image_names):
+            raise RuntimeError("Image names of a prediction store must be unique")
+        self.written = np.zeros(len(self.image_names), dtype=bool)
+        self.no_object_class = None
+
+    def _allocate(self, num_queries):
+        n = len(self.image_names)
+        open_memmap = np.lib.format.open_memmap
+        self.scores = open_memmap(os.path.join(self.path, "scores.npy"), "w+", np.float32, (n, num_queries))
+        self.classes = open_memmap(os.path.join(self.path, "classes.npy"), "w+", np.int64, (n, num_queries))
+        self.boxes = open_memmap(os.path.join(self.path, "boxes.npy"), "w+", np.float32, (n, num_queries, 4))
+
+    def write(self, image_names, pred_logits, pred_boxes):
+        """Write the raw outputs of a batch: pred_logits [B, Q, C] and pred_boxes [B, Q, 4] in cxcywh."""
+        if self.no_object_class is None:
+            self._allocate(pred_logits.shape[1])
+        rows = np.array([self.rows[name] for name in image_names])
+        scores, classes = pred_logits.softmax(-1).max(-1)
+        boxes = box_cxcywh_to_xyxy(pred_boxes)
+        self.scores[rows] = scores.float().cpu().numpy()
+        self.classes[rows] = classes.cpu().numpy()
+        self.boxes[rows] = boxes.float().cpu().numpy()
+        self.written[rows] = True
+        self.no_object_class = pred_logits.shape[-1] - 1
+
+    def close(self):
+        missing = int((~self.written).sum())
+        if missing:
+            raise RuntimeError(f"{missing} images of the prediction store have no prediction")
+        foreground_scores = np.where(self.classes != self.no_object_class, self.scores, -1.0)
+        foreground = foreground_scores.argmax(-1)
+        foreground[foreground_scores.max(-1) < 0] = -1
+        np.save(os.path.join(self.path, "foreground.npy"), foreground)
+        for column in (self.scores, self.classes, self.boxes):
+            column.flush()
+        del self.scores, self.classes, self.boxes
+
+        tmp_path = os.path.join(self.path, INDEX_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"no_object_class": self.no_object_class, "image_names": self.image_names}, f)
+        os.replace(tmp_path, os.path.join(self.path, INDEX_FILE))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+
+class PredictionStore(object):
+    """Read-only view of a store written by PredictionStoreWriter."""
+
+    def __init__(self, path):
+        index_path = os.path.join(path, INDEX_FILE)
+        if not os.path.exists(index_path):
+            raise RuntimeError(f"{path} is not a complete prediction store, run export_distillation.py")
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        self.path = path
+        self.no_object_class = index["no_object_class"]
+        self.image_names = index["image_names"]
+        self.rows = {name: row for row, name in enumerate(self.image_names)}
+        self.scores = np.load(os.path.join(path, "scores.npy"), mmap_mode="r")
+        self.classes = np.load(os.path.join(path, "classes.npy"), mmap_mode="r")
+        self.boxes = np.load(os.path.join(path, "boxes.npy"), mmap_mode="r")
+        self.foreground = np.load(os.path.join(path, "foreground.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.image_names)
+
+    def __contains__(self, image_name):
+        return image_name in self.rows
+
+    def row(self, image_name):
+        """All the query predictions of an image."""
+        row = self.rows[image_name]
+        return {"scores": np.asarray(self.scores[row]),
+                "classes": np.asarray(self.classes[row]),
+                "boxes": np.asarray(self.boxes[row])}
+
+    def get(self, image_name, default=None):
+        """Normalized xyxy foreground box of an image, or default if it has no foreground prediction."""
+        row = self.rows.get(image_name)
+        if row is None or self.foreground[row] < 0:
+            return default
+        return np.asarray(self.boxes[row, self.foreground[row]])
+
+    def to_tensors(self, image_names):
+        """Stack the predictions of several images, e.g. for a distillation loss."""
+        rows = np.array([self.rows[name] for name in image_names])
+        return {"scores": torch.from_numpy(self.scores[rows]),
+                "classes": torch.from_numpy(self.classes[rows]),
+                "boxes": torch.from_numpy(self.boxes[rows])}
+
+
+def load_foreground_boxes(path):
+    """Return a lookup image name -> normalized xyxy foreground box supporting .get(name).
+
+    path is either a store directory or a processed csv with one (img_name, xmin, ymin, xmax, ymax) row per image.
+    """
+    if os.path.isdir(path):
+        return PredictionStore(path)
+    df = pd.read_csv(path).drop_duplicates("img_name")
+    boxes = df[["xmin", "ymin", "xmax", "ymax"]].to_numpy(dtype=np.float64)
+    return dict(zip(df["img_name"].astype(str), boxes))
@@ -0,0 +1,176 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Named timing regions for the training and evaluation loops.
+
+    with profiling.region("model/backbone"):
+        features, pos = self.backbone(samples)
+
+Regions cost a global lookup until enable() is called. Once enabled, each region is a
+torch.profiler.record_function, so that it is named in profiler traces, and its duration is added to the
+histogram of its name:
+    - regions of device work are timed with a pair of CUDA events on CUDA devices, resolved when the
+      durations are collected, so that timing does not wait for the device
+    - host regions (data loading, matching on the CPU, evaluation) and all regions on other devices are timed
+      with perf_counter
+Durations are kept per process. Regions run in DataLoader worker processes are only recorded with
+--num_workers 0.
+
+A torch.profiler trace of a window of training steps is captured with enable_trace() and step().
+"""
+import os
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+_timer = None
+_trace = None
+
+
+class StageTimer:
+    """Thread-safe durations, in ms, of named regions since the last collect()."""
+
+    def __init__(self, use_cuda_events=False):
+        self.use_cuda_events = use_cuda_events
+        self._lock = threading.Lock()
+        self._durations = defaultdict(list)
+        self._pending = []
+
+    def add(self, name, milliseconds):
+        with self._lock:
+            self._durations[name].append(milliseconds)
+
+    def add_events(self, name, start, end):
+        with self._lock:
+            self._pending.append((name, start, end))
+
+    def collect(self):
+        """Return the durations of every region name, and start over."""
+        with self._lock:
+            durations, pending = self._durations, self._pending
+            self._durations, self._pending = defaultdict(list), []
+        if pending:
+            torch.cuda.synchronize()
+            for name, start, end in pending:
+                durations[name].append(start.elapsed_time(end))
+        return {name: np.asarray(values) for name, values in sorted(durations.items())}
+
+
+class _Region:
+    __slots__ = ("name", "host", "timer", "record_function", "start")
+
+    def __init__(self, name, host, timer):
+        self.name = name
+        self.host = host
+        self.timer = timer
+
+    def __enter__(self):
+        self.record_function = torch.profiler.record_function(self.name)
+        self.record_function.__enter__()
+        if self.timer.use_cuda_events and not self.host:
+            self.start = torch.cuda.Event(enable_timing=True)
+            self.start.record()
+        else:
+            self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if isinstance(self.start, float):
+            self.timer.add(self.name, (time.perf_counter() - self.start) * 1e3)
+        else:
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            self.timer.add_events(self.name, self.start, end)
+        self.record_function.__exit__(*exc)
+        return False
+
+
+class _NullRegion:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_REGION = _NullRegion()
+
+
+def region(name, host=False):
+    """Context manager timing its body under name. host marks regions without device work."""
+    timer = _timer
+    if timer is None:
+        return _NULL_REGION
+    return _Region(name, host, timer)
+
+
+def enable(device):
+    global _timer
+    _timer = StageTimer(use_cuda_events=torch.device(device).type == "cuda")
+
+
+def is_enabled():
+    return _timer is not None
+
+
+def collect():
+    """Durations per region name since the last call, empty if profiling is not enabled."""
+    return _timer.collect() if _timer is not None else {}
+
+
+def format_summary(durations, total_ms=None):
+    """One line per region: count, mean, percentiles and max in ms and, given the wall time total_ms they
+    were collected over, the share of that time spent in the region. Nested regions are also counted in
+    the regions they are nested in.
+    """
+    lines = [f"{'region':<32} {'count':>7} {'mean':>9} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9} {'share':>7}"]
+    for name, values in durations.items():
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        share = f"{values.sum() / total_ms * 100:>6.1f}%" if total_ms else f"{'-':>7}"
+        lines.append(f"{name:<32} {len(values):>7} {values.mean():>9.2f} {p50:>9.2f} {p90:>9.2f} {p99:>9.2f} "
+                     f"{values.max():>9.2f} {share}")
+    return "\n".join(lines)
+
+
+def add_to_tensorboard(writer, tag, durations, step):
+    """Histogram and mean of the durations of every region."""
+    for name, values in durations.items():
+        writer.add_histogram(f"{tag}/{name}", values, step)
+        writer.add_scalar(f"{tag}_mean/{name}", values.mean(), step)
+
+
+def enable_trace(start_step, num_steps, output_dir, device):
+    """Capture a torch.profiler trace of the training steps [start_step, start_step + num_steps), written
+    for tensorboard to output_dir."""
+    global _trace
+    _trace = {"start": start_step, "stop": start_step + num_steps, "output_dir": output_dir, "device": device,
+              "profiler": None}
+
+
+def step(global_step):
+    """Mark the start of the training step global_step, starting or stopping the trace window."""
+    if _trace is None:
+        return
+    if global_step == _trace["start"] and _trace["profiler"] is None:
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.device(_trace["device"]).type == "cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        os.makedirs(_trace["output_dir"], exist_ok=True)
+        _trace["profiler"] = torch.profiler.profile(
+            activities=activities, record_shapes=True, profile_memory=True,
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(_trace["output_dir"]))
+        _trace["profiler"].__enter__()
+        print(f"Profiling training steps {_trace['start']} to {_trace['stop'] - 1} to {_trace['output_dir']}")
+    elif global_step == _trace["stop"] and _trace["profiler"] is not None:
+        stop_trace()
+
+
+def stop_trace():
+    """Stop the trace window early, e.g. at the end of training."""
+    if _trace is not None and _trace["profiler"] is not None:
+        _trace["profiler"].__exit__(None, None, None)
+        _trace["profiler"] = None
+        print(f"Wrote the profiler trace to {_trace['output_dir']}")
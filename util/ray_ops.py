@@ -0,0 +1,77 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Geometry of pointing rays against boxes.
+
+An arm is [eye x, eye y, fingertip x, fingertip y]; the pointing ray starts at the eye and goes through
+the fingertip. Arms, boxes and points must be in the same coordinates.
+"""
+import torch
+import torch.nn.functional as F
+
+EPS = 1e-8
+
+
+def ray_vectors(arms, points, vertex="EYE"):
+    """The two vectors whose cosine measures how well points are aligned with arms.
+
+    vertex is the vertex of the angle:
+        EYE: eye -> fingertip and eye -> point
+        FINGERTIP: eye -> fingertip and fingertip -> point
+        OBJECT: point -> eye and point -> fingertip
+    arms [..., 4] and points [..., 2] are broadcast against each other.
+    """
+    eye, fingertip = arms[..., 0:2], arms[..., 2:4]
+    if vertex == "EYE":
+        return fingertip - eye, points - eye
+    if vertex == "FINGERTIP":
+        return fingertip - eye, points - fingertip
+    if vertex == "OBJECT":
+        return eye - points, fingertip - points
+    raise ValueError("Invalid COS_SIM_VERTEX")
+
+
+def aspect_scale(vectors, image_sizes):
+    """Multiply the y components of normalized vectors [B, ..., 2] by the h / w ratio of their image [B, 2],
+    so that angles are measured as in the original image."""
+    h, w = image_sizes.unbind(-1)
+    ratio = (h / w).to(vectors.dtype).view(-1, *([1] * (vectors.dim() - 1)))
+    return torch.cat([vectors[..., :1], vectors[..., 1:] * ratio], dim=-1)
+
+
+def ray_cosine(arms, points, vertex="EYE"):
+    """Cosine similarity of the two ray_vectors, [...]."""
+    arm_vectors, point_vectors = ray_vectors(arms, points, vertex)
+    return F.cosine_similarity(arm_vectors, point_vectors, dim=-1)
+
+
+def arm_box_alignment(boxes, arms, image_sizes=None):
+    """Alignment of every box with every arm of the same image, in a single pass.
+
+    Args:
+        boxes: [B, Q, 4] xyxy boxes
+        arms: [B, K, 4] arms
+        image_sizes: [B, 2] (h, w), for normalized coordinates only
+
+    Returns a dict of [B, Q, K] tensors:
+        cos_sim: cosine of eye -> fingertip and eye -> box center
+        distance: distance from the box center to the ray (to the eye for centers behind the eye)
+        aspect_cos_sim: cos_sim measured in the original image, if image_sizes is given
+    """
+    centers = (boxes[..., 0:2] + boxes[..., 2:4]) / 2
+    eye = arms[:, None, :, 0:2]
+    ray = arms[:, None, :, 2:4] - eye  # [B, 1, K, 2]
+    to_center = centers[:, :, None, :] - eye  # [B, Q, K, 2]
+
+    ray_norm = ray.norm(dim=-1)
+    center_norm = to_center.norm(dim=-1)
+    dot = (ray * to_center).sum(-1)
+    cross = ray[..., 0] * to_center[..., 1] - ray[..., 1] * to_center[..., 0]
+    result = {
+        "cos_sim": dot / (ray_norm * center_norm).clamp(min=EPS),
+        "distance": torch.where(dot > 0, cross.abs() / ray_norm.clamp(min=EPS), center_norm),
+    }
+    if image_sizes is not None:
+        ray, to_center = aspect_scale(ray, image_sizes), aspect_scale(to_center, image_sizes)
+        result["aspect_cos_sim"] = (ray * to_center).sum(-1) / (
+            ray.norm(dim=-1) * to_center.norm(dim=-1)).clamp(min=EPS)
+    return result
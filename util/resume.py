@@ -0,0 +1,151 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Resuming training in the middle of an epoch, with the data order and random numbers of an uninterrupted run.
+
+- ResumableBatchSampler draws the order of an epoch from (seed, epoch) only, can start an epoch at any batch
+  without loading the batches before it, and gives every sample a seed drawn from (seed, epoch, index).
+- SeededDataset seeds python, numpy and torch with that seed before loading the sample, so that its random
+  augmentations depend neither on the worker that loads it nor on the samples loaded before it.
+- rng_state / set_rng_state capture the random number generators of the training process (dropout), saved per rank
+  in the checkpoint by gather_rng_states and restored by restore_rng_states.
+- PreemptionHandler turns SIGTERM and SIGUSR1 into a request to checkpoint and stop at the next step where it is
+  polled.
+"""
+import os
+import random
+import signal
+import sys
+from itertools import islice
+
+import numpy as np
+import torch
+from torch.utils.data import BatchSampler, Dataset, RandomSampler, get_worker_info
+
+import util.dist as dist
+
+
+class ResumableBatchSampler(BatchSampler):
+    """BatchSampler of (index, seed) pairs whose order only depends on (seed, epoch), see the module docstring.
+
+    The sampler is a RandomSampler, whose generator is seeded at each epoch, a DistributedSampler, whose epoch is set
+    by set_epoch, or any other deterministic sampler. len() is the number of batches left in the epoch.
+    """
+
+    def __init__(self, sampler, batch_size, drop_last, seed=0):
+        super().__init__(sampler, batch_size, drop_last)
+        self.seed = seed
+        self.epoch = 0
+        self.start_batch = 0
+
+    def set_epoch(self, epoch, start_batch=0):
+        """Iterate over the batches of epoch, from its batch start_batch."""
+        self.epoch = epoch
+        self.start_batch = start_batch
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)
+
+    def sample_seed(self, *keys):
+        """A 32 bits seed drawn from the seed, the epoch and keys."""
+        return int(np.random.SeedSequence([self.seed, self.epoch, *keys]).generate_state(1)[0])
+
+    def __iter__(self):
+        if isinstance(self.sampler, RandomSampler):
+            self.sampler.generator = torch.Generator().manual_seed(self.sample_seed())
+        for batch in islice(super().__iter__(), self.start_batch, None):
+            yield [(index, self.sample_seed(index)) for index in batch]
+
+    def __len__(self):
+        return super().__len__() - self.start_batch
+
+
+class SeededDataset(Dataset):
+    """Loads the (index, seed) items of ResumableBatchSampler from dataset, after seeding python, numpy and torch.
+
+    In the main process (num_workers 0), the random states of the training are restored after each sample.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, item):
+        index, seed = item
+        state = rng_state(cuda=False) if get_worker_info() is None else None
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.random.default_generator.manual_seed(seed)
+        try:
+            return self.dataset[index]
+        finally:
+            if state is not None:
+                set_rng_state(state)
+
+
+def rng_state(cuda=True):
+    """The states of the python, numpy, torch and CUDA random number generators of this process."""
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if cuda and torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def gather_rng_states():
+    """The rng_state of every rank, in rank order. To be called on all ranks."""
+    return dist.all_gather(rng_state())
+
+
+def restore_rng_states(states):
+    """Restore the state of this rank from gather_rng_states, if the checkpoint has the same number of ranks."""
+    if len(states) != dist.get_world_size():
+        print(f"WARNING: the checkpoint has the random states of {len(states)} processes, not restoring them in "
+              f"{dist.get_world_size()} processes, the resumed run will not be identical to an uninterrupted one")
+        return
+    set_rng_state(states[dist.get_rank()])
+
+
+class PreemptionHandler(object):
+    """Records SIGTERM and SIGUSR1, so that training checkpoints and stops at the next step should_stop is called at.
+
+    A second signal is handled by the previous handler, e.g. to terminate a process stuck before the next step.
+    """
+
+    def __init__(self, signals=(signal.SIGTERM, signal.SIGUSR1)):
+        self.requested = False
+        self.stopping = False
+        self._previous = {s: signal.signal(s, self._handle) for s in signals}
+
+    def _handle(self, signum, frame):
+        if self.requested:
+            signal.signal(signum, self._previous[signum])
+            os.kill(os.getpid(), signum)
+            return
+        print(f"Received signal {signum}, checkpointing and stopping after the current step", file=sys.stderr)
+        self.requested = True
+
+    def should_stop(self):
+        """Whether any rank received a signal. To be called on all ranks, at the same steps.
+
+        In distributed training this is an all-reduce, which waits for the device, so it is only polled every few
+        steps rather than after each one.
+        """
+        if not self.stopping and dist.is_dist_avail_and_initialized():
+            requested = torch.tensor([float(self.requested)], device=dist.collective_device())
+            torch.distributed.all_reduce(requested)
+            self.stopping = requested.item() > 0
+        else:
+            self.stopping = self.stopping or self.requested
+        return self.stopping
+
+    def close(self):
+        for s, handler in self._previous.items():
+            signal.signal(s, handler)
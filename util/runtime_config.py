@@ -0,0 +1,118 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Runtime configuration: the behaviour switches of magic_numbers.py as one typed, immutable object.
+
+ReferDataset, YouRefItEvaluator, MDETR, the Transformer, SetCriterion, PostProcess and the engine take a config
+and read their switches from it rather than from module globals, so that several configurations can run in the
+same process (sweep.py). The fields are the lower case names of the constants of magic_numbers.py, whose values
+are the defaults, so that magic_numbers.py stays the place to change them for every run.
+
+    config = RuntimeConfig.from_file("ablation.json")  # {"reserve_queries_for_arms": false}
+    config = config.replace(alignment_rerank_top_k=5)
+"""
+import dataclasses
+import json
+from typing import Optional, Tuple
+
+import magic_numbers as defaults
+
+
+@dataclasses.dataclass(frozen=True)
+class RuntimeConfig:
+    # data
+    use_mdetr_predictions_as_groundtruths: bool = defaults.USE_MDETR_PREDICTIONS_AS_GROUNDTRUTHS
+    mdetr_prediction_path: str = defaults.MDETR_PREDICTION_PATH
+    replace_arm_with_eye_to_fingertip: bool = defaults.REPLACE_ARM_WITH_EYE_TO_FINGERTIP
+    eye_to_fingertip_annotation_train_path: str = defaults.EYE_TO_FINGERTIP_ANNOTATION_TRAIN_PATH
+    eye_to_fingertip_annotation_valid_path: str = defaults.EYE_TO_FINGERTIP_ANNOTATION_VALID_PATH
+    deactivate_extra_transforms: bool = defaults.DEACTIVATE_EXTRA_TRANSFORMS
+    replace_images_with_inpaint: bool = defaults.REPLACE_IMAGES_WITH_INPAINT
+    inpaint_dir: str = defaults.INPAINT_DIR
+    replace_language_inputs: bool = defaults.REPLACE_LANGUAGE_INPUTS
+    dummy_language_input: str = defaults.DUMMY_LANGUAGE_INPUT
+    replace_sentence_with_target_word: bool = defaults.REPLACE_SENTENCE_WITH_TARGET_WORD
+    drop_last: bool = defaults.DROP_LAST
+    persistent_workers: bool = defaults.PERSISTENT_WORKERS
+
+    # model
+    predict_pose_using_a_different_model: bool = defaults.PREDICT_POSE_USING_A_DIFFERENT_MODEL
+    pose_mlp_num_layers: int = defaults.POSE_MLP_NUM_LAYERS
+    reserve_queries_for_arms: bool = defaults.RESERVE_QUERIES_FOR_ARMS
+    num_reserved_queries_for_arms: int = defaults.NUM_RESERVED_QUERIES_FOR_ARMS
+    remove_language_by_setting_caption_to_none: bool = defaults.REMOVE_LANGUAGE_BY_SETTING_CAPTION_TO_NONE
+
+    # losses
+    arm_loss_coef: float = defaults.ARM_LOSS_COEF
+    arm_score_loss_coef: float = defaults.ARM_SCORE_LOSS_COEF
+    arm_box_align_loss_coef: float = defaults.ARM_BOX_ALIGN_LOSS_COEF
+    use_gt__arm_for_arm_box_align_loss: bool = defaults.USE_GT__ARM_FOR_ARM_BOX_ALIGN_LOSS
+    arm_box_align_offset_by_gt: bool = defaults.ARM_BOX_ALIGN_OFFSET_BY_GT
+    arm_box_aligh_fixed_offset: float = defaults.ARM_BOX_ALIGH_FIXED_OFFSET
+    arm_score_class_weights: Tuple[float, ...] = tuple(defaults.ARM_SCORE_CLASS_WEIGHTS)
+    cos_sim_vertex: str = defaults.COS_SIM_VERTEX
+    args_pose: Optional[bool] = defaults.ARGS_POSE
+
+    # training
+    amsgrad: bool = defaults.AMSGRAD
+    checkpoint_frequency: int = defaults.CHECKPOINT_FREQUENCY
+    train_early_stop: bool = defaults.TRAIN_EARLY_STOP
+    train_early_stop_count: int = defaults.TRAIN_EARLY_STOP_COUNT
+
+    # evaluation
+    alignment_rerank_top_k: int = defaults.ALIGNMENT_RERANK_TOP_K
+    alignment_rerank_weight: float = defaults.ALIGNMENT_RERANK_WEIGHT
+    eval_early_stop: bool = defaults.EVAL_EARLY_STOP
+    eval_early_stop_count: int = defaults.EVAL_EARLY_STOP_COUNT
+    print_predictions_at_breakpoint: bool = defaults.PRINT_PREDICTIONS_AT_BREAKPOINT
+    calculate_cos_sim: bool = defaults.CALCULATE_COS_SIM
+    evaluate_using_giou_threshods: bool = defaults.EVALUATE_USING_GIOU_THRESHODS
+    eval_small_medium_large_threshods: Tuple[float, ...] = tuple(defaults.EVAL_SMALL_MEDIUM_LARGE_THRESHODS)
+    save_evaluation_predictions: bool = defaults.SAVE_EVALUATION_PREDICTIONS
+    save_clip_scores: bool = defaults.SAVE_CLIP_SCORES
+    prediction_dir: str = defaults.prediction_dir
+    prediction_file_name: str = defaults.prediction_file_name
+
+    # the fields that change the samples of ReferDataset and their transforms
+    DATASET_FIELDS = (
+        "use_mdetr_predictions_as_groundtruths", "mdetr_prediction_path", "replace_arm_with_eye_to_fingertip",
+        "eye_to_fingertip_annotation_train_path", "eye_to_fingertip_annotation_valid_path",
+        "deactivate_extra_transforms", "replace_images_with_inpaint", "inpaint_dir", "replace_language_inputs",
+        "dummy_language_input", "replace_sentence_with_target_word", "calculate_cos_sim",
+    )
+
+    @classmethod
+    def from_dict(cls, values):
+        """The defaults updated with values, whose keys are field names in lower or upper case (the constants)."""
+        fields = {field.name: field for field in dataclasses.fields(cls)}
+        kwargs = {}
+        for key, value in values.items():
+            name = key.lower()
+            if name not in fields:
+                raise RuntimeError(f"Unknown runtime config field {key}")
+            if isinstance(value, list):
+                value = tuple(value)
+            kwargs[name] = value
+        return cls(**kwargs)
+
+    @classmethod
+    def from_file(cls, path):
+        """from_dict of a JSON file."""
+        with open(path, "r") as f:
+            return cls.from_dict(json.load(f))
+
+    @classmethod
+    def from_args(cls, args):
+        """The config of the --runtime_config file of the args of main_ref.py, or the defaults without one."""
+        path = getattr(args, "runtime_config", None)
+        return cls.from_file(path) if path else cls()
+
+    def replace(self, **changes):
+        """A copy of the config with the fields of changes, e.g. the arms of an ablation."""
+        return self.from_dict({**self.to_dict(), **changes})
+
+    def to_dict(self):
+        return dataclasses.asdict(self)
+
+    def dataset_key(self):
+        """The values of DATASET_FIELDS: configs with the same key load the same samples."""
+        return tuple(getattr(self, name) for name in self.DATASET_FIELDS)
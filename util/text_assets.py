@@ -0,0 +1,77 @@
+# Copyright (c): Yang Li and Xiaoxue Chen. Licensed under the Apache License 2.0. All Rights Reserved
+"""
+Process-wide registry of the tokenizers and text encoder configurations of --text_encoder_type.
+
+Each asset is created once per process, on first use, from the first of:
+    - the directory TEXT_ASSETS_DIR/<name> (magic_numbers), written by download_text_assets.py,
+    - the HuggingFace cache, without network access,
+    - the HuggingFace hub.
+The datasets and the model only keep the name of their text encoder and read the shared tokenizer with
+tokenizer(name). Deep copies (the EMA model, the val dataset of YouRefItEvaluator) and pickles (DataLoader workers
+started by spawn) do not copy the tokenizer, and forked DataLoader workers share the one of the main process.
+"""
+import os
+import threading
+import time
+
+from transformers import RobertaConfig, RobertaModel, RobertaTokenizerFast
+
+from magic_numbers import TEXT_ASSETS_DIR
+
+# HuggingFace fast tokenizers cannot be used from several threads at once ("Already borrowed"). The lock is
+# module-level rather than an attribute so that the modules using a shared tokenizer stay deep-copyable (EMA).
+tokenizer_lock = threading.Lock()
+
+_assets = {}
+_assets_lock = threading.Lock()
+# seconds spent creating each (kind, name) asset of this process
+load_seconds = {}
+
+
+def local_dir(name):
+    return os.path.join(TEXT_ASSETS_DIR, name)
+
+
+def from_pretrained(cls, name, **kwargs):
+    """cls.from_pretrained of the local directory of name, else of the HuggingFace cache, else of the hub."""
+    if os.path.isdir(local_dir(name)):
+        return cls.from_pretrained(local_dir(name), **kwargs)
+    try:
+        return cls.from_pretrained(name, local_files_only=True, **kwargs)
+    except (OSError, ValueError):
+        return cls.from_pretrained(name, **kwargs)
+
+
+def _get(kind, name, create):
+    with _assets_lock:
+        if (kind, name) not in _assets:
+            start = time.perf_counter()
+            _assets[kind, name] = create()
+            load_seconds[kind, name] = time.perf_counter() - start
+        return _assets[kind, name]
+
+
+def tokenizer(name):
+    """The shared tokenizer of the text encoder name."""
+    return _get("tokenizer", name, lambda: from_pretrained(RobertaTokenizerFast, name))
+
+
+def text_encoder_config(name):
+    """The shared configuration of the text encoder name."""
+    return _get("config", name, lambda: from_pretrained(RobertaConfig, name))
+
+
+def text_encoder(name, add_pooling_layer=True):
+    """A new text encoder with the pretrained weights of name. The weights are not shared, each model (and its EMA)
+    trains its own."""
+    return from_pretrained(RobertaModel, name, add_pooling_layer=add_pooling_layer)
+
+
+def save_text_assets(name, directory=None):
+    """Write the tokenizer, configuration and weights of the text encoder name to directory, by default its local
+    directory, so that later runs do not need the network nor the HuggingFace cache."""
+    directory = directory or local_dir(name)
+    tokenizer(name).save_pretrained(directory)
+    text_encoder_config(name).save_pretrained(directory)
+    text_encoder(name).save_pretrained(directory)
+    return directory
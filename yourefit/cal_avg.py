@@ -58,10 +58,7 @@ for name in arm_data.keys():
 
 
     #embed()
-    # arm_tensor = torch.Tensor(arm[1])-torch.Tensor(arm[0])
-    # box_center = [(box[0]+box[2])/2,(box[1]+box[3])/2]
-    # box_tensor = torch.Tensor(box_center)-torch.Tensor(arm[0])
-    # cos_sim = F.cosine_similarity(arm_tensor,box_tensor,dim=0)
+    # cos_sim = aligned_score(arm[0]+arm[1],box) # from datasets.yourefit, see util/ray_ops.py
     # cos_sim_list.append(cos_sim)
 
 